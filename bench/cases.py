@@ -0,0 +1,310 @@
+""" Benchmark Cases (hot paths of the `sii` utilities)
+
+Every case is a `setup(data, size)` preparing its input (untimed) and a `run(state)` doing the measured
+work, returning the number of items processed. `data` is the directory prepared by `prepare`.
+"""
+import io
+import os
+import sys
+import glob
+import shutil
+import contextlib
+import subprocess
+import collections
+
+import synth
+
+__all__ = [
+    'CASES',
+    'Skip',
+    'prepare'
+]
+
+Case = collections.namedtuple('Case', ['name', 'setup', 'run', 'sized'])
+
+
+class Skip(Exception):
+    """ Case cannot run in this environment (missing library, binary, ...). """
+    pass
+
+
+def prepare(data, size):
+    """ Synthetic inputs of `size` documents/rows below `data`, generated only once per size. """
+    marker = os.path.join(data, '.complete')
+    if os.path.exists(marker):
+        return data
+
+    os.makedirs(data, exist_ok=True)
+
+    synth.write_dtes(os.path.join(data, 'dtes'), size)
+    synth.write_xml(synth.enviodte_xml(size), os.path.join(data, 'enviodte.xml'))
+    synth.write_xml(synth.libro_xml(size),    os.path.join(data, 'libro.xml'))
+
+    if shutil.which('openssl'):
+        synth.write_caf(os.path.join(data, 'cafs'), size)
+        synth.write_key_cert(os.path.join(data, 'auth'))
+
+    open(marker, 'w').close()
+    return data
+
+
+def _require(module):
+    try:
+        __import__(module)
+    except ImportError as exc:
+        raise Skip("{0} not available ({1})".format(module, str(exc)))
+
+    return sys.modules[module]
+
+
+def _dte_paths(data):
+    return sorted(glob.glob(os.path.join(data, 'dtes', '*.xml')))
+
+
+def _auth(data):
+    auth = os.path.join(data, 'auth')
+    if not os.path.isdir(auth):
+        raise Skip("no signing key (openssl missing)")
+
+    return os.path.join(auth, 'key.pem'), os.path.join(auth, 'cert.pem')
+
+
+def _bundled(data):
+    """ Bundled and signed DTE's (setup only, for cases working on final documents). """
+    schemas   = _require('sii.lib.schemas')
+    signature = _require('sii.lib.signature')
+    types     = _require('sii.lib.types')
+    helpers   = _require('sii.bin.helpers')
+
+    if not os.path.isdir(os.path.join(data, 'cafs')):
+        raise Skip("no CAF (openssl missing)")
+
+    key_path, cert_path = _auth(data)
+    caf_pool = types.CAFPool(os.path.join(data, 'cafs'))
+
+    return [
+        signature.sign_document(
+            xml       = schemas.bundle_dte(helpers.read_xml(path), caf_pool),
+            key_path  = key_path,
+            cert_path = cert_path
+        )
+        for path in _dte_paths(data)
+    ]
+
+
+# -- helpers: read_xml/write_xml/condense_xml ----------------------------------------------------------
+
+def setup_read_xml(data, size):
+    return _require('sii.bin.helpers'), _dte_paths(data)
+
+
+def run_read_xml(state):
+    helpers, paths = state
+    for path in paths:
+        helpers.read_xml(path)
+    return len(paths)
+
+
+def setup_read_envelope(data, size):
+    return _require('sii.bin.helpers'), os.path.join(data, 'enviodte.xml'), size
+
+
+def run_read_envelope(state):
+    helpers, path, size = state
+    helpers.read_xml(path)
+    return size
+
+
+def setup_read_header(data, size):
+    return _require('sii.utils.headers'), _dte_paths(data) + [os.path.join(data, 'enviodte.xml')]
+
+
+def run_read_header(state):
+    headers, paths = state
+    for path in paths:
+        headers.read_header(path)
+    return len(paths)
+
+
+def setup_write_xml(data, size):
+    helpers = _require('sii.bin.helpers')
+    sink    = os.path.join(data, 'written')
+    os.makedirs(sink, exist_ok=True)
+    trees   = [helpers.read_xml(path) for path in _dte_paths(data)]
+    return helpers, trees, sink
+
+
+def run_write_xml(state):
+    helpers, trees, sink = state
+    for idx, tree in enumerate(trees):
+        helpers.write_xml(tree, os.path.join(sink, "{0}.xml".format(idx)))
+    return len(trees)
+
+
+def setup_condense_xml(data, size):
+    helpers = _require('sii.bin.helpers')
+    buffs   = []
+
+    for path in _dte_paths(data):
+        with open(path, 'rb') as fh:
+            buffs.append(fh.read())
+
+    return helpers, buffs
+
+
+def run_condense_xml(state):
+    helpers, buffs = state
+    for buff in buffs:
+        helpers.condense_xml(buff)
+    return len(buffs)
+
+
+# -- bundling, signing, verification -------------------------------------------------------------------
+
+def setup_bundle_dte(data, size):
+    schemas = _require('sii.lib.schemas')
+    types   = _require('sii.lib.types')
+    helpers = _require('sii.bin.helpers')
+
+    if not os.path.isdir(os.path.join(data, 'cafs')):
+        raise Skip("no CAF (openssl missing)")
+
+    caf_pool = types.CAFPool(os.path.join(data, 'cafs'))
+    trees    = [helpers.read_xml(path) for path in _dte_paths(data)]
+    return schemas, caf_pool, trees
+
+
+def run_bundle_dte(state):
+    schemas, caf_pool, trees = state
+    for tree in trees:
+        schemas.bundle_dte(tree, caf_pool)
+    return len(trees)
+
+
+def setup_bundle_lv(data, size):
+    return _require('sii.lib.schemas'), _bundled(data)
+
+
+def run_bundle_lv(state):
+    schemas, dtes = state
+    schemas.bundle_libro_ventas(dtes)
+    return len(dtes)
+
+
+def setup_sign(data, size):
+    signature = _require('sii.lib.signature')
+    schemas   = _require('sii.lib.schemas')
+    types     = _require('sii.lib.types')
+    helpers   = _require('sii.bin.helpers')
+
+    key_path, cert_path = _auth(data)
+    caf_pool = types.CAFPool(os.path.join(data, 'cafs'))
+    trees    = [schemas.bundle_dte(helpers.read_xml(path), caf_pool) for path in _dte_paths(data)]
+
+    return signature, trees, key_path, cert_path
+
+
+def run_sign(state):
+    signature, trees, key_path, cert_path = state
+    for tree in trees:
+        signature.sign_document(xml=tree, key_path=key_path, cert_path=cert_path)
+    return len(trees)
+
+
+def setup_verify_schema(data, size):
+    return _require('sii.lib.validation'), _bundled(data)
+
+
+def run_verify_schema(state):
+    validation, dtes = state
+    for dte in dtes:
+        validation.validate_schema(dte)
+    return len(dtes)
+
+
+def setup_verify_signature(data, size):
+    return _require('sii.utils.dsig'), _bundled(data)
+
+
+def run_verify_signature(state):
+    dsig, dtes = state
+    for dte in dtes:
+        dsig.verify_signatures(dte)
+    return len(dtes)
+
+
+def setup_unbundle(data, size):
+    schemas = _require('sii.lib.schemas')
+    helpers = _require('sii.bin.helpers')
+    return schemas, helpers.read_xml(os.path.join(data, 'enviodte.xml')), size
+
+
+def run_unbundle(state):
+    schemas, enviodte, size = state
+    schemas.unbundle_enviodte(enviodte)
+    return size
+
+
+def setup_lazy_access(data, size):
+    return _require('sii.utils.lazyxml'), os.path.join(data, 'enviodte.xml')
+
+
+def run_lazy_access(state):
+    lazyxml, path = state
+    with lazyxml.LazyDocument(path) as document:
+        document[len(document) - 1]
+    return 1
+
+
+# -- introspection and printing ------------------------------------------------------------------------
+
+def setup_lcv_stats(data, size):
+    return _require('sii.bin.cmd_lcv'), os.path.join(data, 'libro.xml'), size
+
+
+def run_lcv_stats(state):
+    cmd_lcv, path, size = state
+    with contextlib.redirect_stdout(io.StringIO()):
+        cmd_lcv.handle(None, ['lcv', 'stats', path, '--header', '--amounts', '--items'])
+    return size
+
+
+def setup_pdf_template(data, size):
+    printing = _require('sii.lib.printing')
+    return printing, _bundled(data)
+
+
+def run_pdf_template(state):
+    printing, dtes = state
+    for dte in dtes:
+        printing.create_template(dte_xml=dte, medium='carta', company=None, cedible=False, draft=True)
+    return len(dtes)
+
+
+def setup_cli_startup(data, size):
+    _require('sii.bin.main')
+    return [sys.executable, '-c', 'import sys; from sii.bin.main import main; sys.argv = ["sii", "version"]; main()']
+
+
+def run_cli_startup(state):
+    subprocess.check_call(state, stdout=subprocess.DEVNULL)
+    return 1
+
+
+CASES = collections.OrderedDict((case.name, case) for case in (
+    Case('read_xml',         setup_read_xml,         run_read_xml,         True),
+    Case('read_envelope',    setup_read_envelope,    run_read_envelope,    True),
+    Case('read_header',      setup_read_header,      run_read_header,      True),
+    Case('write_xml',        setup_write_xml,        run_write_xml,        True),
+    Case('condense_xml',     setup_condense_xml,     run_condense_xml,     True),
+    Case('bundle_dte',       setup_bundle_dte,       run_bundle_dte,       True),
+    Case('bundle_lv',        setup_bundle_lv,        run_bundle_lv,        True),
+    Case('sign',             setup_sign,             run_sign,             True),
+    Case('verify_schema',    setup_verify_schema,    run_verify_schema,    True),
+    Case('verify_signature', setup_verify_signature, run_verify_signature, True),
+    Case('unbundle',         setup_unbundle,         run_unbundle,         True),
+    Case('lazy_access',      setup_lazy_access,      run_lazy_access,      True),
+    Case('lcv_stats',        setup_lcv_stats,        run_lcv_stats,        True),
+    Case('pdf_template',     setup_pdf_template,     run_pdf_template,     True),
+    Case('cli_startup',      setup_cli_startup,      run_cli_startup,      False)
+))
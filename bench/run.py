@@ -0,0 +1,172 @@
+""" Benchmarks of the `sii` hot paths, compared against a stored baseline.
+
+Usage:
+    run.py [options] [<case>...]
+    run.py list
+
+Options:
+    --sizes <sizes>      # Comma separated documents/rows per input. [default: 10,100,1000]
+    --repeat <n>         # Timed runs per case and size, the best one is reported. [default: 3]
+    --workdir <dir>      # Where synthetic inputs are generated (and reused). [default: ~/.cache/sii/bench]
+    --baseline <file>    # Baseline to compare against. [default: bench/baseline.json]
+    --save               # Store these results as the new baseline.
+    --tolerance <pct>    # Throughput drop against the baseline reported as regression. [default: 10]
+
+Notes:
+    * Every case runs in a fresh process, so its peak RSS is its own. Inputs are generated once per size
+      and kept in --workdir; delete it to regenerate them.
+
+    * Cases needing python-sii, or openssl (CAF and signing key generation), are skipped if those are not
+      available. Exit code is 1 if any case regressed against the baseline.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+import docopt
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import cases  # noqa: E402 (needs the path setup above)
+
+BASELINE_VERSION = 1
+
+
+def main():
+    args = docopt.docopt(__doc__)
+
+    if args['list']:
+        for name in cases.CASES:
+            print(name)
+        return
+
+    selected = args['<case>'] or list(cases.CASES)
+    unknown  = [name for name in selected if name not in cases.CASES]
+    if unknown:
+        raise SystemExit("Unknown cases: {0}".format(", ".join(unknown)))
+
+    sizes     = [int(size) for size in args['--sizes'].split(',')]
+    repeat    = int(args['--repeat'])
+    workdir   = os.path.abspath(os.path.expanduser(args['--workdir']))
+    tolerance = float(args['--tolerance'])
+
+    baseline = _load_baseline(args['--baseline'])
+    results  = {}
+    regressed = False
+
+    print("{0:<18} {1:>7} {2:>12} {3:>14} {4:>10} {5:>10}".format("case", "size", "seconds", "items/s", "rss MB", "vs base"))
+
+    for name in selected:
+        case = cases.CASES[name]
+
+        for size in (sizes if case.sized else sizes[:1]):
+            data    = cases.prepare(os.path.join(workdir, str(size)), size)
+            outcome = _run_isolated(name, data, size, repeat)
+            label   = str(size) if case.sized else "-"
+
+            if 'skipped' in outcome:
+                print("{0:<18} {1:>7} {2}".format(name, label, "skipped: " + outcome['skipped']))
+                continue
+
+            results.setdefault(name, {})[label] = outcome
+
+            base = baseline.get(name, {}).get(label, None)
+            if base:
+                delta = (outcome['rate'] - base['rate']) / base['rate'] * 100
+                flag  = "{0:+.1f}%".format(delta)
+
+                if delta < -tolerance:
+                    regressed = True
+                    flag += " REGRESSION"
+            else:
+                flag = "new"
+
+            print("{0:<18} {1:>7} {2:>12.4f} {3:>14.1f} {4:>10.1f} {5:>10}".format(
+                name, label, outcome['seconds'], outcome['rate'], outcome['rss_mb'], flag
+            ))
+            sys.stdout.flush()
+
+    if args['--save']:
+        _save_baseline(args['--baseline'], baseline, results)
+
+    if regressed:
+        sys.exit(1)
+
+
+def _run_isolated(name, data, size, repeat):
+    """ Runs a case in a fresh (spawned, not forked) process to get an untainted peak RSS. """
+    context = multiprocessing.get_context('spawn')
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(_run_case, name, data, size, repeat).result()
+
+
+def _run_case(name, data, size, repeat):
+    case = cases.CASES[name]
+
+    try:
+        state = case.setup(data, size)
+    except cases.Skip as exc:
+        return {'skipped': str(exc)}
+
+    best  = None
+    items = 0
+    for _ in range(repeat):
+        start   = time.perf_counter()
+        items   = case.run(state)
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = maxrss / (1024.0 * 1024.0) if sys.platform == 'darwin' else maxrss / 1024.0
+
+    return {
+        'seconds': best,
+        'items':   items,
+        'rate':    items / best if best else 0.0,
+        'rss_mb':  rss_mb
+    }
+
+
+def _load_baseline(fpath):
+    if not os.path.isfile(fpath):
+        return {}
+
+    with open(fpath, 'r') as fh:
+        stored = json.load(fh)
+
+    if stored.get('version') != BASELINE_VERSION:
+        print("Ignoring baseline of another version: {0}".format(fpath), file=sys.stderr)
+        return {}
+
+    return stored['results']
+
+
+def _save_baseline(fpath, baseline, results):
+    merged = dict(baseline)
+    for name, per_size in results.items():
+        merged.setdefault(name, {}).update(per_size)
+
+    with open(fpath, 'w') as fh:
+        json.dump({
+            'version': BASELINE_VERSION,
+            'python':  platform.python_version(),
+            'machine': platform.machine(),
+            'saved':   time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': merged
+        }, fh, indent=2, sort_keys=True)
+
+    print("Baseline saved: {0}".format(fpath), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
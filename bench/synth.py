@@ -0,0 +1,217 @@
+""" Synthetic SII Documents (DTE, EnvioDTE, LibroCompraVenta, CAF) for benchmarking
+"""
+import os
+import base64
+import datetime
+import subprocess
+
+from lxml import etree
+
+__all__ = [
+    'RUT_EMISOR',
+    'RUT_RECEPTOR',
+    'dte_xml',
+    'enviodte_xml',
+    'libro_xml',
+    'write_xml',
+    'write_dtes',
+    'write_caf',
+    'write_key_cert'
+]
+
+SII_NS = 'http://www.sii.cl/SiiDte'
+
+RUT_EMISOR   = '76000000-0'
+RUT_RECEPTOR = '11111111-1'
+
+TODAY = datetime.date(2016, 6, 1).isoformat()
+
+_E = lambda name: '{' + SII_NS + '}' + name
+
+
+def _sub(parent, name, text=None, **attrs):
+    node = etree.SubElement(parent, _E(name), **attrs)
+
+    if text is not None:
+        node.text = str(text)
+
+    return node
+
+
+def dte_xml(folio, lines=3, dte_type=33):
+    """ Unbundled (no TED, unsigned) invoice with `lines` detail lines. """
+    root = etree.Element(_E('DTE'), nsmap={None: SII_NS}, version="1.0")
+    doc  = _sub(root, 'Documento', ID="F{0}T{1}".format(folio, dte_type))
+    enc  = _sub(doc, 'Encabezado')
+
+    iddoc = _sub(enc, 'IdDoc')
+    _sub(iddoc, 'TipoDTE', dte_type)
+    _sub(iddoc, 'Folio',   folio)
+    _sub(iddoc, 'FchEmis', TODAY)
+
+    emisor = _sub(enc, 'Emisor')
+    _sub(emisor, 'RUTEmisor',  RUT_EMISOR)
+    _sub(emisor, 'RznSoc',     "Empresa de Prueba SpA")
+    _sub(emisor, 'GiroEmis',   "Servicios")
+    _sub(emisor, 'Acteco',     "620200")
+    _sub(emisor, 'DirOrigen',  "Calle Falsa 123")
+    _sub(emisor, 'CmnaOrigen', "Santiago")
+
+    receptor = _sub(enc, 'Receptor')
+    _sub(receptor, 'RUTRecep',  RUT_RECEPTOR)
+    _sub(receptor, 'RznSocRecep', "Cliente de Prueba Ltda")
+    _sub(receptor, 'GiroRecep', "Comercio")
+    _sub(receptor, 'DirRecep',  "Avenida Siempre Viva 742")
+    _sub(receptor, 'CmnaRecep', "Providencia")
+
+    net = 1000 * lines
+    vat = int(round(net * 0.19))
+
+    totales = _sub(enc, 'Totales')
+    _sub(totales, 'MntNeto',  net)
+    _sub(totales, 'TasaIVA',  19)
+    _sub(totales, 'IVA',      vat)
+    _sub(totales, 'MntTotal', net + vat)
+
+    for idx in range(1, lines + 1):
+        det = _sub(doc, 'Detalle')
+        _sub(det, 'NroLinDet', idx)
+        _sub(det, 'NmbItem',   "Item {0}".format(idx))
+        _sub(det, 'QtyItem',   1)
+        _sub(det, 'PrcItem',   1000)
+        _sub(det, 'MontoItem', 1000)
+
+    return root
+
+
+def enviodte_xml(count, lines=3):
+    root = etree.Element(_E('EnvioDTE'), nsmap={None: SII_NS}, version="1.0")
+    sdte = _sub(root, 'SetDTE', ID="SetDoc")
+    car  = _sub(sdte, 'Caratula', version="1.0")
+
+    _sub(car, 'RutEmisor',    RUT_EMISOR)
+    _sub(car, 'RutEnvia',     RUT_EMISOR)
+    _sub(car, 'RutReceptor',  RUT_RECEPTOR)
+    _sub(car, 'FchResol',     TODAY)
+    _sub(car, 'NroResol',     0)
+    _sub(car, 'TmstFirmaEnv', TODAY + "T00:00:00")
+
+    subtot = _sub(car, 'SubTotDTE')
+    _sub(subtot, 'TpoDTE', 33)
+    _sub(subtot, 'NroDTE', count)
+
+    for folio in range(1, count + 1):
+        sdte.append(dte_xml(folio, lines))
+
+    return root
+
+
+def libro_xml(count):
+    root  = etree.Element(_E('LibroCompraVenta'), nsmap={None: SII_NS}, version="1.0")
+    libro = _sub(root, 'EnvioLibro', ID="Libro")
+    car   = _sub(libro, 'Caratula')
+
+    _sub(car, 'RutEmisorLibro',    RUT_EMISOR)
+    _sub(car, 'RutEnvia',          RUT_EMISOR)
+    _sub(car, 'PeriodoTributario', TODAY[:7])
+    _sub(car, 'FchResol',          TODAY)
+    _sub(car, 'NroResol',          0)
+    _sub(car, 'TipoOperacion',     "VENTA")
+    _sub(car, 'TipoLibro',         "MENSUAL")
+    _sub(car, 'TipoEnvio',         "TOTAL")
+
+    net = 3000
+    vat = 570
+
+    resumen = _sub(libro, 'ResumenPeriodo')
+    totales = _sub(resumen, 'TotalesPeriodo')
+    _sub(totales, 'TpoDoc',      33)
+    _sub(totales, 'TotDoc',      count)
+    _sub(totales, 'TotMntExe',   0)
+    _sub(totales, 'TotMntNeto',  net * count)
+    _sub(totales, 'TotMntIVA',   vat * count)
+    _sub(totales, 'TotMntTotal', (net + vat) * count)
+
+    for folio in range(1, count + 1):
+        det = _sub(libro, 'Detalle')
+        _sub(det, 'TpoDoc',   33)
+        _sub(det, 'NroDoc',   folio)
+        _sub(det, 'TasaImp',  19)
+        _sub(det, 'FchDoc',   TODAY)
+        _sub(det, 'RUTDoc',   RUT_RECEPTOR)
+        _sub(det, 'RznSoc',   "Cliente de Prueba Ltda")
+        _sub(det, 'MntExe',   0)
+        _sub(det, 'MntNeto',  net)
+        _sub(det, 'MntIVA',   vat)
+        _sub(det, 'MntTotal', net + vat)
+
+    return root
+
+
+def write_xml(xtree, fpath):
+    with open(fpath, 'wb') as fh:
+        fh.write(etree.tostring(xtree, pretty_print=True, encoding='ISO-8859-1', xml_declaration=True))
+
+    return fpath
+
+
+def write_dtes(dirpath, count, lines=3):
+    os.makedirs(dirpath, exist_ok=True)
+
+    return [
+        write_xml(dte_xml(folio, lines), os.path.join(dirpath, "dte_{0}.xml".format(folio)))
+        for folio in range(1, count + 1)
+    ]
+
+
+def write_caf(dirpath, last_folio, dte_type=33):
+    """ CAF authorizing folios 1 to `last_folio` with a fresh key (needs the openssl binary). The SII's
+    <FRMA> over it is fake, nothing locally can check it anyway.
+    """
+    os.makedirs(dirpath, exist_ok=True)
+
+    pem = subprocess.check_output(['openssl', 'genrsa', '1024'], stderr=subprocess.DEVNULL)
+    pub = subprocess.check_output(['openssl', 'rsa', '-pubout'], input=pem, stderr=subprocess.DEVNULL)
+    mod = subprocess.check_output(['openssl', 'rsa', '-noout', '-modulus'], input=pem, stderr=subprocess.DEVNULL)
+
+    modulus = bytes.fromhex(mod.decode('ascii').strip().split('=', 1)[1])
+
+    caf = (
+        '<AUTORIZACION><CAF version="1.0"><DA>'
+        '<RE>{rut}</RE><RS>Empresa de Prueba SpA</RS><TD>{type}</TD>'
+        '<RNG><D>1</D><H>{last}</H></RNG><FA>{date}</FA>'
+        '<RSAPK><M>{m}</M><E>AQAB</E></RSAPK><IDK>100</IDK>'
+        '</DA><FRMA algoritmo="SHA1withRSA">{frma}</FRMA></CAF>'
+        '<RSASK>{sk}</RSASK><RSAPUBK>{pk}</RSAPUBK></AUTORIZACION>'
+    ).format(
+        rut  = RUT_EMISOR,
+        type = dte_type,
+        last = last_folio,
+        date = TODAY,
+        m    = base64.b64encode(modulus).decode('ascii'),
+        frma = base64.b64encode(b'\0' * 64).decode('ascii'),
+        sk   = pem.decode('ascii').strip(),
+        pk   = pub.decode('ascii').strip()
+    )
+
+    fpath = os.path.join(dirpath, "caf_{0}_{1}.xml".format(dte_type, last_folio))
+    with open(fpath, 'w', encoding='ISO-8859-1') as fh:
+        fh.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n' + caf)
+
+    return fpath
+
+
+def write_key_cert(dirpath):
+    """ Self-signed signing key and certificate (needs the openssl binary). """
+    os.makedirs(dirpath, exist_ok=True)
+
+    key_path  = os.path.join(dirpath, 'key.pem')
+    cert_path = os.path.join(dirpath, 'cert.pem')
+
+    subprocess.check_call([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+        '-subj', '/CN=Benchmark/serialNumber=' + RUT_EMISOR,
+        '-keyout', key_path, '-out', cert_path
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return key_path, cert_path
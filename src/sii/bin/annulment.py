@@ -0,0 +1,93 @@
+""" Annulment Documents (Nota de Credito voiding a previously issued DTE)
+"""
+import copy
+import datetime
+
+from lxml import etree
+
+__all__ = [
+    'VOIDABLE_TYPES',
+    'create_annulment'
+]
+
+SII_NS = 'http://www.sii.cl/SiiDte'
+
+TYPE_CREDIT_NOTE = 61
+VOIDABLE_TYPES   = (33, 34, 46, 56)
+
+COD_REF_VOID   = 1
+RAZON_REF_VOID = "Anula documento de referencia"
+
+_E = lambda name: '{' + SII_NS + '}' + name
+
+
+def create_annulment(dte, folio, date=None):
+    """ Unbundled (no TED, unsigned) <DTE> of a credit note with `folio` voiding `dte` completely.
+
+    It replicates emitter, receiver, detail lines and totals of the voided document and references it with
+    CodRef 1. To be bundled and signed like any other document.
+    """
+    date = date or datetime.date.today()
+    doc  = _find(dte, 'Documento')
+    enc  = _find(doc, 'Encabezado')
+    iddoc = _find(enc, 'IdDoc')
+
+    ref_type  = int(_find(iddoc, 'TipoDTE').text)
+    ref_folio = int(_find(iddoc, 'Folio').text)
+    ref_date  = _find(iddoc, 'FchEmis').text.strip()
+
+    if ref_type not in VOIDABLE_TYPES:
+        raise ValueError("Documents of type {0} cannot be voided with a credit note".format(ref_type))
+
+    root     = etree.Element(_E('DTE'), nsmap={None: SII_NS}, version="1.0")
+    document = etree.SubElement(root, _E('Documento'), ID="F{0}T{1}".format(folio, TYPE_CREDIT_NOTE))
+
+    # Header
+    encabezado = etree.SubElement(document, _E('Encabezado'))
+    id_doc     = etree.SubElement(encabezado, _E('IdDoc'))
+
+    etree.SubElement(id_doc, _E('TipoDTE')).text = str(TYPE_CREDIT_NOTE)
+    etree.SubElement(id_doc, _E('Folio')).text   = str(folio)
+    etree.SubElement(id_doc, _E('FchEmis')).text = date.isoformat()
+
+    for name in ('Emisor', 'Receptor', 'Totales'):
+        encabezado.append(_copy(_find(enc, name)))
+
+    # Detail lines and global discounts/surcharges as in the voided document
+    for name in ('Detalle', 'DscRcgGlobal'):
+        for node in doc.iterchildren(_E(name), name):
+            document.append(_copy(node))
+
+    # Reference to the voided document
+    referencia = etree.SubElement(document, _E('Referencia'))
+
+    etree.SubElement(referencia, _E('NroLinRef')).text  = "1"
+    etree.SubElement(referencia, _E('TpoDocRef')).text  = str(ref_type)
+    etree.SubElement(referencia, _E('FolioRef')).text   = str(ref_folio)
+    etree.SubElement(referencia, _E('FchRef')).text     = ref_date
+    etree.SubElement(referencia, _E('CodRef')).text     = str(COD_REF_VOID)
+    etree.SubElement(referencia, _E('RazonRef')).text   = RAZON_REF_VOID
+
+    return root
+
+
+def _find(node, name):
+    found = node.xpath("descendant-or-self::*[local-name() = $name]", name=name)
+
+    if not found:
+        raise ValueError("Expected <{0}> in document to void".format(name))
+
+    return found[0]
+
+
+def _copy(node):
+    """ Copy of `node` in the SII namespace, whether the source had it or not. """
+    clone = copy.deepcopy(node)
+    clone.tail = None
+
+    for elem in clone.iter():
+        if isinstance(elem.tag, str):
+            elem.tag = _E(etree.QName(elem).localname)
+
+    etree.cleanup_namespaces(clone)
+    return clone
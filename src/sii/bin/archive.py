@@ -0,0 +1,337 @@
+""" XML Archive (append-only container of compressed documents, indexed by emitter, type and folio)
+
+Keeping every XML for the retention period as a file each wastes more on the filesystem than the documents
+take. An archive is a single data file (*.xmlz) documents are appended to as records, each compressed on
+its own (zstd where the `zstandard` module is installed, gzip otherwise) and prefixed with its key:
+
+    magic (4) | codec (1) | key length (2) | data length (4) | key (UTF-8) | compressed document
+
+A sqlite sidecar (<archive>.idx) maps every (RUT, TipoDTE, Folio, kind) to its latest record, so reading a
+document is a lookup, a seek and a decompress. It is derived from the data file alone and brought up to
+date from it whenever it lags behind (or is gone). Adding a document again appends it again, unless it did
+not change.
+
+A document in an archive is addressed as <archive>#<RUT>/<TipoDTE>/<Folio> (with /<kind> for envelopes,
+any root other than <DTE>), which `helpers.read_xml` and `helpers.write_xml` take like any other path.
+Writing to the archive itself keys the document by its header. Archives are only created by writing to
+them, reading one that does not exist raises `FileNotFoundError`.
+"""
+import os
+import zlib
+import fcntl
+import struct
+import hashlib
+import collections
+
+from lxml import etree
+
+try:
+    import zstandard  # optional, archives are written with gzip without it
+except ImportError:
+    zstandard = None
+
+from sii.utils.headers import header_of
+
+from .database import Database
+
+__all__ = [
+    'ARCHIVE_EXT',
+    'Archive',
+    'Key',
+    'Summary',
+    'key_of',
+    'open_archive',
+    'is_archive',
+    'split_ref',
+    'expand_paths'
+]
+
+ARCHIVE_EXT = '.xmlz'
+
+CODEC_GZIP = b'g'
+CODEC_ZSTD = b'z'
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+MAGIC   = b'SXA1'
+_RECORD = struct.Struct('>4scHI')  # magic, codec, key length, data length
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    rut       TEXT    NOT NULL,
+    dte_type  INTEGER NOT NULL,
+    folio     INTEGER NOT NULL,
+    kind      TEXT    NOT NULL,
+    position  INTEGER NOT NULL,
+    length    INTEGER NOT NULL,
+    size      INTEGER NOT NULL,
+    digest    TEXT    NOT NULL,
+    PRIMARY KEY (rut, dte_type, folio, kind)
+);
+CREATE INDEX IF NOT EXISTS documents_position ON documents (position);
+"""
+
+Key     = collections.namedtuple('Key',     ['rut', 'dte_type', 'folio', 'kind'])
+Summary = collections.namedtuple('Summary', ['documents', 'stored', 'size'])
+
+_ARCHIVES = {}
+
+
+def open_archive(fpath, writable=False):
+    """ `Archive` at `fpath`, opened only once per process (again for writing if first opened to read). """
+    fpath   = os.path.abspath(os.path.expanduser(fpath))
+    archive = _ARCHIVES.get(fpath, None)
+
+    if archive is not None and writable and not archive.writable:
+        archive.close()
+        archive = None
+
+    if archive is None:
+        archive = Archive(fpath, writable=writable)
+        _ARCHIVES[fpath] = archive
+
+    return archive
+
+
+def is_archive(fpath):
+    return split_ref(fpath)[0] is not None
+
+
+def split_ref(fpath):
+    """ (archive, member) of a path into an archive, (None, None) for any other. The member is `None` for the
+    archive itself.
+    """
+    if not isinstance(fpath, str):
+        return None, None
+
+    head, sep, member = fpath.partition('#')
+
+    if not head.endswith(ARCHIVE_EXT):
+        return None, None
+    if sep and os.path.isfile(fpath):
+        return None, None  # a file with a '#' in its name after all
+
+    return head, (member or None)
+
+
+def expand_paths(paths):
+    """ `paths` with every archive itself replaced by the references of all its documents. """
+    for fpath in paths:
+        archive, member = split_ref(fpath)
+
+        if archive is None or member is not None:
+            yield fpath
+        else:
+            for key in open_archive(archive).keys():
+                yield archive + '#' + _member(key)
+
+
+class Archive(Database):
+    """ Archive at `fpath`, created if missing when `writable`, read-only (and required to exist) otherwise. """
+
+    def __init__(self, fpath, writable=False):
+        self.path     = os.path.abspath(os.path.expanduser(fpath))
+        self.writable = writable
+
+        if not (writable or os.path.isfile(self.path)):
+            raise FileNotFoundError("No such archive: {0}".format(self.path))
+
+        super().__init__(self.path + '.idx', SCHEMA, synchronous='NORMAL')
+
+        self._fh = open(self.path, 'a+b' if writable else 'rb')
+
+        self._catch_up()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def __contains__(self, key):
+        return self._locate(_key(key)) is not None
+
+    def close(self):
+        _ARCHIVES.pop(self.path, None)
+
+        super().close()
+        self._fh.close()
+
+    def add(self, buff, key=None):
+        """ Appends a document (the bytes to be kept, see `helpers.write_xml`), keyed by its header unless
+        `key` (a `Key` or "RUT/TipoDTE/Folio[/kind]") is given. Returns its `Key`, nothing is appended if
+        the archive already holds the very same bytes under it.
+        """
+        if not self.writable:
+            raise ValueError("Archive opened read-only: {0}".format(self.path))
+
+        key = key_of(etree.fromstring(buff)) if key is None else _key(key)
+
+        digest = hashlib.sha1(buff).hexdigest()
+        found  = self._conn.execute(
+            "SELECT digest FROM documents WHERE rut = ? AND dte_type = ? AND folio = ? AND kind = ?", key
+        ).fetchone()
+
+        if found is not None and found[0] == digest:
+            return key
+
+        codec, data = _compress(buff)
+        member      = _member(key).encode('UTF-8')
+        record      = _RECORD.pack(MAGIC, codec, len(member), len(data)) + member + data
+
+        # Other processes may append at the same time, the lock keeps records whole and in index order
+        fcntl.flock(self._fh, fcntl.LOCK_EX)
+        try:
+            position = self._catch_up()
+
+            if position < self._fh.seek(0, os.SEEK_END):
+                self._fh.truncate(position)  # torn record of an interrupted append
+
+            self._fh.write(record)
+            self._fh.flush()
+
+            with self._conn:
+                self._index(key, position, len(record), len(buff), digest)
+        finally:
+            fcntl.flock(self._fh, fcntl.LOCK_UN)
+
+        return key
+
+    def read(self, key):
+        """ Bytes of the document at `key` (a `Key` or "RUT/TipoDTE/Folio[/kind]"), raises `KeyError` if the
+        archive has none.
+        """
+        key   = _key(key)
+        found = self._locate(key)
+
+        if found is None:
+            self._catch_up()
+            found = self._locate(key)
+
+        if found is None:
+            raise KeyError("No document {0} in archive: {1}".format(_member(key), self.path))
+
+        position, length = found
+        return self._record(position, length)[1]
+
+    def keys(self):
+        """ Keys of the documents in the archive, in the order they were (last) added. """
+        self._catch_up()
+
+        rows = self._conn.execute("SELECT rut, dte_type, folio, kind FROM documents ORDER BY position")
+        return [Key(*row) for row in rows]
+
+    def documents(self):
+        """ (key, bytes) of every document, read sequentially through the data file. """
+        self._catch_up()
+
+        rows = self._conn.execute("SELECT rut, dte_type, folio, kind, position, length FROM documents ORDER BY position").fetchall()
+
+        for rut, dte_type, folio, kind, position, length in rows:
+            yield Key(rut, dte_type, folio, kind), self._record(position, length)[1]
+
+    def summary(self):
+        documents, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM documents").fetchone()
+        return Summary(documents, self._fh.seek(0, os.SEEK_END), size)
+
+    def _locate(self, key):
+        return self._conn.execute(
+            "SELECT position, length FROM documents WHERE rut = ? AND dte_type = ? AND folio = ? AND kind = ?", key
+        ).fetchone()
+
+    def _record(self, position, length):
+        """ (key, document bytes) of the record of `length` bytes at `position`. """
+        self._fh.seek(position)
+        record = self._fh.read(length)
+
+        magic, codec, key_len, data_len = _RECORD.unpack_from(record)
+        if magic != MAGIC or _RECORD.size + key_len + data_len != len(record):
+            raise ValueError("Corrupt record at {0} of archive: {1}".format(position, self.path))
+
+        member = record[_RECORD.size:_RECORD.size + key_len].decode('UTF-8')
+        return _key(member), _decompress(codec, record[_RECORD.size + key_len:])
+
+    def _catch_up(self):
+        """ Indexes the records appended after the last one indexed (by another process, or before a crash).
+        Returns where the last whole record ends.
+        """
+        end  = self._conn.execute("SELECT COALESCE(MAX(position + length), 0) FROM documents").fetchone()[0]
+        size = self._fh.seek(0, os.SEEK_END)
+
+        if end >= size:
+            return end
+
+        with self._conn:
+            while end + _RECORD.size <= size:
+                self._fh.seek(end)
+                magic, codec, key_len, data_len = _RECORD.unpack(self._fh.read(_RECORD.size))
+
+                if magic != MAGIC:
+                    raise ValueError("Corrupt record at {0} of archive: {1}".format(end, self.path))
+
+                length = _RECORD.size + key_len + data_len
+                if end + length > size:
+                    break  # torn by an interrupted append, truncated by the next one
+
+                key, buff = self._record(end, length)
+                self._index(key, end, length, len(buff), hashlib.sha1(buff).hexdigest())
+
+                end += length
+
+        return end
+
+    def _index(self, key, position, length, size, digest):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO documents (rut, dte_type, folio, kind, position, length, size, digest) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            tuple(key) + (position, length, size, digest)
+        )
+
+
+def key_of(xml):
+    """ `Key` a document is archived by, from its header. """
+    header = header_of(xml)
+
+    if not (header.rut and header.dte_type and header.folio):
+        raise ValueError("Document has no emitter, type and folio to archive it by, give its key explicitly")
+
+    return Key(header.rut.upper(), int(header.dte_type), int(header.folio), header.kind)
+
+
+def _key(key):
+    """ `Key` of a key or of a "RUT/TipoDTE/Folio[/kind]" member name. """
+    if isinstance(key, Key):
+        return key
+
+    parts = key.strip('/').split('/')
+    if len(parts) not in (3, 4):
+        raise ValueError("Expected an archive member like RUT/TipoDTE/Folio[/kind], got: {0}".format(key))
+
+    try:
+        return Key(parts[0].upper(), int(parts[1]), int(parts[2]), parts[3] if len(parts) == 4 else 'DTE')
+    except ValueError:
+        raise ValueError("Expected an archive member like RUT/TipoDTE/Folio[/kind], got: {0}".format(key))
+
+
+def _member(key):
+    member = "{0}/{1}/{2}".format(key.rut, key.dte_type, key.folio)
+    return member if key.kind == 'DTE' else member + '/' + key.kind
+
+
+def _compress(buff):
+    if zstandard is not None:
+        return CODEC_ZSTD, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(buff)
+
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip framing
+    return CODEC_GZIP, compressor.compress(buff) + compressor.flush()
+
+
+def _decompress(codec, data):
+    if codec == CODEC_GZIP:
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("Archive record is zstd compressed, reading it needs the zstandard module")
+
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    raise ValueError("Unknown archive record codec: {0!r}".format(codec))
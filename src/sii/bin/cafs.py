@@ -0,0 +1,228 @@
+""" CAF Index (authorized folio ranges per emitter and document type, TED stamp verification)
+"""
+import os
+import base64
+import bisect
+import collections
+
+from lxml import etree
+
+from sii.utils.accessors import DTES
+from sii.utils.crypto    import rsa_verify
+
+
+__all__ = [
+    'CAF',
+    'CAFIndex',
+    'Stamp',
+    'parse_caf',
+    'extract_stamps',
+    'verify_stamp'
+]
+
+CAF   = collections.namedtuple('CAF',   ['path', 'rut', 'dte_type', 'first', 'last', 'modulus', 'exponent'])
+Stamp = collections.namedtuple('Stamp', ['rut', 'dte_type', 'folio', 'doc_type', 'doc_folio', 'signed', 'frmt', 'caf'])
+
+
+class CAFIndex:
+    """ Interval index of CAF folio ranges keyed by (RUT, TipoDTE). Lookups are a bisect, no scanning. """
+
+    def __init__(self, cafs=()):
+        self._starts = collections.defaultdict(list)
+        self._cafs   = collections.defaultdict(list)
+
+        for caf in cafs:
+            self.add(caf)
+
+    @classmethod
+    def from_directory(cls, cafs_dir, on_error=None):
+        """ Reads every CAF (<AUTORIZACION>) below `cafs_dir` once, other files are ignored. Those that are
+        not a well formed CAF are skipped, passed to `on_error(path, exception)` if given.
+        """
+        index = cls()
+
+        for base, _, fnames in os.walk(os.path.abspath(os.path.expanduser(cafs_dir))):
+            for fname in sorted(fnames):
+                fpath = os.path.join(base, fname)
+
+                try:
+                    root = etree.parse(fpath).getroot()
+                except etree.XMLSyntaxError:
+                    continue
+
+                if etree.QName(root).localname != 'AUTORIZACION':
+                    continue
+
+                try:
+                    index.add(parse_caf(_child(root, 'CAF'), fpath))
+                except ValueError as exc:
+                    if on_error is not None:
+                        on_error(fpath, exc)
+
+        return index
+
+    def add(self, caf):
+        key = (caf.rut, caf.dte_type)
+        idx = bisect.bisect(self._starts[key], caf.first)
+
+        self._starts[key].insert(idx, caf.first)
+        self._cafs[key].insert(idx, caf)
+
+    def lookup(self, rut, dte_type, folio):
+        """ CAF authorizing `folio`, or None. """
+        key    = (rut.upper(), int(dte_type))
+        starts = self._starts.get(key, None)
+
+        if not starts:
+            return None
+
+        idx = bisect.bisect_right(starts, folio) - 1
+        if idx < 0:
+            return None
+
+        caf = self._cafs[key][idx]
+        return caf if folio <= caf.last else None
+
+    def cafs(self, rut=None, dte_type=None):
+        for (caf_rut, caf_type), cafs in sorted(self._cafs.items()):
+            if rut is not None and caf_rut != rut.upper():
+                continue
+            if dte_type is not None and caf_type != int(dte_type):
+                continue
+
+            for caf in cafs:
+                yield caf
+
+    def __contains__(self, key):
+        rut, dte_type = key
+        return bool(self._starts.get((rut.upper(), int(dte_type)), None))
+
+    def __len__(self):
+        return sum(len(cafs) for cafs in self._cafs.values())
+
+
+def parse_caf(caf_node, path=None):
+    """ CAF record from a <CAF> node, as found in a CAF file or embedded in a TED. Raises `ValueError` if
+    it is missing or lacks any of its fields.
+    """
+    if caf_node is None:
+        raise ValueError("Expected <CAF>")
+
+    da = _child(caf_node, 'DA')
+    if da is None:
+        raise ValueError("Expected <DA> in <CAF>")
+
+    try:
+        return _parse_da(da, path)
+    except TypeError:  # a missing <RNG> or <RSAPK>
+        raise ValueError("Expected <RNG> and <RSAPK> in <DA>")
+
+
+def _parse_da(da, path):
+    return CAF(
+        path     = path,
+        rut      = _text(da, 'RE').upper(),
+        dte_type = int(_text(da, 'TD')),
+        first    = int(_text(_child(da, 'RNG'), 'D')),
+        last     = int(_text(_child(da, 'RNG'), 'H')),
+        modulus  = int.from_bytes(base64.b64decode(_text(_child(da, 'RSAPK'), 'M')), 'big'),
+        exponent = int.from_bytes(base64.b64decode(_text(_child(da, 'RSAPK'), 'E')), 'big')
+    )
+
+
+def extract_stamps(xml):
+    """ Stamp of every <DTE> in `xml` (a DTE itself or any envelope containing them). """
+    stamps = []
+
+    for dte in DTES(xml):
+        doc = _child(dte, 'Documento')
+        if doc is None:
+            continue
+
+        id_doc = _child(_child(doc, 'Encabezado'), 'IdDoc')
+        ted    = _child(doc, 'TED')
+        dd     = _child(ted, 'DD') if ted is not None else None
+
+        if dd is None:
+            stamps.append(Stamp(
+                rut       = _text(_child(_child(doc, 'Encabezado'), 'Emisor'), 'RUTEmisor').upper(),
+                dte_type  = int(_text(id_doc, 'TipoDTE')),
+                folio     = int(_text(id_doc, 'Folio')),
+                doc_type  = int(_text(id_doc, 'TipoDTE')),
+                doc_folio = int(_text(id_doc, 'Folio')),
+                signed    = None,
+                frmt      = None,
+                caf       = None
+            ))
+            continue
+
+        stamps.append(Stamp(
+            rut       = _text(dd, 'RE').upper(),
+            dte_type  = int(_text(dd, 'TD')),
+            folio     = int(_text(dd, 'F')),
+            doc_type  = int(_text(id_doc, 'TipoDTE')),
+            doc_folio = int(_text(id_doc, 'Folio')),
+            signed    = _signed_bytes(dd),
+            frmt      = _text(ted, 'FRMT'),
+            caf       = parse_caf(_child(dd, 'CAF'))
+        ))
+
+    return stamps
+
+
+def verify_stamp(stamp, caf):
+    """ Whether the TED's FRMT is a valid signature of its <DD> by the key of `caf`. """
+    if stamp.signed is None or not stamp.frmt:
+        return False
+
+    return rsa_verify(stamp.signed, stamp.frmt, caf.modulus, caf.exponent)
+
+
+def _signed_bytes(dd):
+    """ <DD> as it was signed: tags without namespaces, nothing between them, texts as they are (with the
+    five XML special characters escaped) and ISO-8859-1.
+    """
+    return ''.join(_signed_parts(dd)).encode('ISO-8859-1', 'xmlcharrefreplace')
+
+
+def _signed_parts(elem):
+    name     = etree.QName(elem).localname
+    attrs    = ''.join(' {0}="{1}"'.format(etree.QName(key).localname, _escape(value)) for key, value in elem.attrib.items())
+    children = [child for child in elem if isinstance(child.tag, str)]
+
+    if not children and not elem.text:
+        yield '<{0}{1}/>'.format(name, attrs)
+        return
+
+    yield '<{0}{1}>'.format(name, attrs)
+
+    # only leaves carry text, whatever is around child elements is indentation
+    if children:
+        for child in children:
+            for part in _signed_parts(child):
+                yield part
+    else:
+        yield _escape(elem.text)
+
+    yield '</{0}>'.format(name)
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace("'", '&apos;')
+
+
+def _child(node, name):
+    for child in node:
+        if isinstance(child.tag, str) and etree.QName(child).localname == name:
+            return child
+
+    return None
+
+
+def _text(node, name):
+    child = _child(node, name)
+
+    if child is None or child.text is None:
+        raise ValueError("Expected <{0}> in <{1}>".format(name, etree.QName(node).localname))
+
+    return child.text.strip()
@@ -0,0 +1,366 @@
+""" Document Catalog (local sqlite index of the XML's below a set of directories)
+
+Per document: header (emitter, type, folio, dates and receivers) of every <DTE> of a file (an envelope has
+a row per DTE, by position) and the signature and schema status of the file. Files are only read again when
+their mtime or size changed since they were indexed.
+"""
+import os
+import time
+import collections
+
+from lxml import etree
+
+from sii.utils.accessors import DTES
+from sii.utils.dsig      import verify_signatures
+from sii.utils.headers   import header_of
+
+from .database import Database
+from .helpers  import read_xml, validate_schema
+from .pools    import process_pool
+
+__all__ = [
+    'Catalog',
+    'Entry',
+    'Summary',
+    'STATUS_GOOD',
+    'STATUS_BAD',
+    'STATUS_UNSIGNED',
+    'parse_query',
+    'select_paths'
+]
+
+STATUS_GOOD     = 'GOOD'
+STATUS_BAD      = 'BAD'
+STATUS_UNSIGNED = 'UNSIGNED'
+
+FLUSH_EVERY = 256  # indexed files per transaction
+
+# Catalogs of older versions are dropped (and rebuilt by the next update), they are only a cache
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    path         TEXT    NOT NULL,
+    position     INTEGER NOT NULL,
+    mtime_ns     INTEGER NOT NULL,
+    size         INTEGER NOT NULL,
+    kind         TEXT,
+    rut          TEXT,
+    dte_type     INTEGER,
+    folio        INTEGER,
+    issued       TEXT,
+    recpt_rut    TEXT,
+    envio_recpt  TEXT,
+    signature    TEXT,
+    schema       TEXT,
+    error        TEXT,
+    indexed      REAL    NOT NULL,
+    PRIMARY KEY (path, position)
+);
+CREATE INDEX IF NOT EXISTS documents_key      ON documents (rut, dte_type, folio);
+CREATE INDEX IF NOT EXISTS documents_issued   ON documents (issued);
+CREATE INDEX IF NOT EXISTS documents_receiver ON documents (recpt_rut);
+"""
+
+COLUMNS = (
+    'path', 'position', 'mtime_ns', 'size', 'kind', 'rut', 'dte_type', 'folio', 'issued', 'recpt_rut', 'envio_recpt',
+    'signature', 'schema', 'error', 'indexed'
+)
+
+Entry   = collections.namedtuple('Entry',   COLUMNS)
+Summary = collections.namedtuple('Summary', ['added', 'updated', 'removed', 'unchanged', 'failed'])
+
+# Query keys and the condition each of them adds
+_FILTERS = {
+    'rut':      "rut = ?",
+    'type':     "dte_type = ?",
+    'kind':     "kind = ?",
+    'receiver': "(recpt_rut = ? OR envio_recpt = ?)",
+    'from':     "issued >= ?",
+    'to':       "issued <= ?",
+    'path':     "path LIKE ? ESCAPE '\\'"
+}
+
+
+def parse_query(text):
+    """ Filters from a query like "rut=76000000-0,type=33,folio=100-200,from=2016-06-01,valid".
+
+    Keys are rut, type, folio (single or range), kind (DTE, EnvioDTE, ...), receiver, from and to (issue
+    dates, inclusive), path (prefix) and the flags valid (good signature and schema) and invalid.
+    """
+    filters = {}
+
+    for term in (term.strip() for term in (text or '').split(',')):
+        if not term:
+            continue
+
+        key, sep, value = term.partition('=')
+        key   = key.strip().lower()
+        value = value.strip()
+
+        if not sep:
+            if key not in ('valid', 'invalid'):
+                raise ValueError("Unknown catalog query flag: {0}".format(key))
+            filters[key] = True
+        elif key == 'folio':
+            first, _, last = value.partition('-')
+            filters['folio'] = (int(first), int(last or first))
+        elif key == 'type':
+            filters['type'] = int(value)
+        elif key in ('rut', 'receiver'):
+            filters[key] = value.upper()
+        elif key == 'path':
+            filters[key] = os.path.abspath(os.path.expanduser(value))
+        elif key in _FILTERS:
+            filters[key] = value
+        else:
+            raise ValueError("Unknown catalog query key: {0}".format(key))
+
+    return filters
+
+
+def select_paths(db_path, query):
+    """ Paths of the documents in the catalog at `db_path` matching `query`, for commands taking their
+    input files from the catalog instead of the command line.
+    """
+    with Catalog(db_path) as catalog:
+        paths = catalog.paths(parse_query(query))
+
+    if not paths:
+        raise SystemExit("No documents in the catalog match: {0}".format(query))
+
+    return paths
+
+
+class Catalog(Database):
+
+    def __init__(self, db_path):
+        super().__init__(db_path, SCHEMA, synchronous='NORMAL')
+
+    def _upgrade(self):
+        version, = self._conn.execute('PRAGMA user_version').fetchone()
+        if version < SCHEMA_VERSION:
+            self._conn.executescript(
+                "DROP TABLE IF EXISTS documents; PRAGMA user_version = {0:d};".format(SCHEMA_VERSION)
+            )
+
+    def update(self, roots, verify=True, workers=None, on_entry=None):
+        """ Brings the catalog up to date with every *.xml below `roots` (directories or files).
+
+        New or changed files (by mtime and size) are indexed in a process pool, those gone are dropped.
+        Without `verify` only headers are read, leaving signature and schema status unknown. `on_entry` is
+        called with every row stored, the summary counts files (once, however many `roots` reach them).
+        """
+        added  = updated = removed = unchanged = failed = 0
+        stale  = []
+        walked = set()
+
+        for root in roots:
+            root  = os.path.abspath(os.path.expanduser(root))
+            known = self._known(root)
+            seen  = set()
+
+            for fpath, stat in _walk(root):
+                seen.add(fpath)
+
+                if fpath in walked:
+                    continue  # below an earlier root too
+                walked.add(fpath)
+
+                if known.get(fpath, None) == (stat.st_mtime_ns, stat.st_size):
+                    unchanged += 1
+                else:
+                    stale.append((fpath, stat.st_mtime_ns, stat.st_size, fpath in known))
+
+            gone = [fpath for fpath in known if fpath not in seen]
+            if gone:
+                with self._conn:
+                    self._conn.executemany("DELETE FROM documents WHERE path = ?", [(fpath,) for fpath in gone])
+                removed += len(gone)
+
+        if not stale:
+            return Summary(added, updated, removed, unchanged, failed)
+
+        files = []
+        with process_pool(workers, len(stale)) as executor:
+            indexed = executor.map(_index_file, stale, [verify] * len(stale), chunksize=32)
+
+            for (_, _, _, existed), entries in zip(stale, indexed):
+                files.append(entries)
+
+                if any(entry.error for entry in entries):
+                    failed += 1
+                if existed:
+                    updated += 1
+                else:
+                    added += 1
+
+                if on_entry is not None:
+                    for entry in entries:
+                        on_entry(entry)
+
+                if len(files) >= FLUSH_EVERY:
+                    self._store(files)
+                    files = []
+
+        self._store(files)
+        return Summary(added, updated, removed, unchanged, failed)
+
+    def select(self, filters=None, limit=None):
+        """ Entries matching the filters of `parse_query`, ordered by emitter, type and folio. """
+        filters = filters or {}
+        wheres  = []
+        params  = []
+
+        for key, value in sorted(filters.items()):
+            if key == 'folio':
+                wheres.append("folio BETWEEN ? AND ?")
+                params.extend(value)
+            elif key == 'valid':
+                wheres.append("signature = ? AND schema = ?")
+                params.extend([STATUS_GOOD, STATUS_GOOD])
+            elif key == 'invalid':
+                wheres.append("(signature = ? OR schema = ? OR error IS NOT NULL)")
+                params.extend([STATUS_BAD, STATUS_BAD])
+            elif key == 'receiver':
+                wheres.append(_FILTERS[key])
+                params.extend([value, value])
+            elif key == 'path':
+                wheres.append(_FILTERS[key])
+                params.append(value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+            else:
+                wheres.append(_FILTERS[key])
+                params.append(value)
+
+        query = "SELECT {0} FROM documents".format(", ".join(COLUMNS))
+        if wheres:
+            query += " WHERE " + " AND ".join(wheres)
+
+        query += " ORDER BY rut, dte_type, folio, path, position"
+        if limit:
+            query += " LIMIT {0:d}".format(int(limit))
+
+        return [Entry(*row) for row in self._conn.execute(query, params)]
+
+    def paths(self, filters=None):
+        """ Files holding the matching documents, each once (an envelope may hold several of them). """
+        seen = set()
+        return [entry.path for entry in self.select(filters) if not (entry.path in seen or seen.add(entry.path))]
+
+    def stats(self):
+        """ (rut, dte_type, documents, bad signature, bad schema, unreadable) per emitter and type. """
+        return self._conn.execute(
+            "SELECT rut, dte_type, COUNT(*),"
+            " SUM(signature = ?), SUM(schema = ?), SUM(error IS NOT NULL)"
+            " FROM documents GROUP BY rut, dte_type ORDER BY rut, dte_type",
+            (STATUS_BAD, STATUS_BAD)
+        ).fetchall()
+
+    def _known(self, root):
+        """ (mtime_ns, size) of every file indexed below (or being) `root`. """
+        upper = root.rstrip(os.sep) + chr(ord(os.sep) + 1)
+        rows  = self._conn.execute(
+            "SELECT path, mtime_ns, size FROM documents WHERE path = ? OR (path >= ? AND path < ?)",
+            (root, root.rstrip(os.sep) + os.sep, upper)
+        )
+
+        return dict((path, (mtime_ns, size)) for path, mtime_ns, size in rows)
+
+    def _store(self, files):
+        """ Replaces the rows of every file indexed again (it may hold fewer documents than before). """
+        if not files:
+            return
+
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM documents WHERE path = ?", [(entries[0].path,) for entries in files]
+            )
+            self._conn.executemany(
+                "INSERT INTO documents ({0}) VALUES ({1})".format(", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+                [entry for entries in files for entry in entries]
+            )
+
+
+def _walk(root):
+    if os.path.isfile(root):
+        yield root, os.stat(root)
+        return
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+
+        for fname in sorted(filenames):
+            if not fname.lower().endswith('.xml'):
+                continue
+
+            fpath = os.path.join(dirpath, fname)
+            try:
+                yield fpath, os.stat(fpath)
+            except OSError:
+                continue  # vanished meanwhile
+
+
+def _index_file(stale, verify):
+    """ Entries of a file, one per <DTE> (by position) sharing the status of the file, a single one for a
+    file that could not be read or has none.
+    """
+    fpath, mtime_ns, size, _ = stale
+    fields = dict.fromkeys(COLUMNS)
+    fields.update(path=fpath, position=0, mtime_ns=mtime_ns, size=size, indexed=time.time())
+
+    try:
+        xml = read_xml(fpath)
+    except (OSError, etree.XMLSyntaxError) as exc:
+        fields['error'] = str(exc) or type(exc).__name__
+        return [Entry(**fields)]
+
+    try:
+        envelope = header_of(xml, fpath)
+        headers  = [header_of(dte, fpath) for dte in DTES(xml)] or [envelope]
+    except ValueError as exc:
+        fields.update(kind=etree.QName(xml).localname, error=str(exc))
+        return [Entry(**fields)]
+
+    fields.update(kind=envelope.kind, envio_recpt=envelope.envio_recpt)
+
+    if verify:
+        fields.update(_status(xml))
+
+    return [
+        Entry(**dict(
+            fields,
+            position  = position,
+            rut       = header.rut,
+            dte_type  = header.dte_type,
+            folio     = header.folio,
+            issued    = header.issued,
+            recpt_rut = header.recpt_rut
+        ))
+        for position, header in enumerate(headers)
+    ]
+
+
+def _status(xml):
+    """ Signature and schema status of a whole file. """
+    status = {}
+
+    try:
+        results = verify_signatures(xml)
+    except Exception:
+        status['signature'] = STATUS_BAD
+    else:
+        if not results:
+            status['signature'] = STATUS_UNSIGNED
+        elif all(validity for _, validity in results):
+            status['signature'] = STATUS_GOOD
+        else:
+            status['signature'] = STATUS_BAD
+
+    try:
+        validate_schema(xml)
+    except Exception:
+        status['schema'] = STATUS_BAD
+    else:
+        status['schema'] = STATUS_GOOD
+
+    return status
@@ -3,40 +3,87 @@ Usage:
     sii dte [options] bundle dte       [--inplace | --suffixed] <infile>...
     sii dte [options] bundle enviodte  (--sii | --exchange) <outfile> <infile>...
     sii dte [options] bundle lv        <outfile> <infile>...
+    sii dte [options] bundle lv        --select=<query> <outfile>
     sii dte [options] gen doc ack      <infile> <outfile>
     sii dte [options] gen doc ok       <infile> <outfile>
     sii dte [options] gen merch ack    <infile> <outfile>
-    sii dte [options] sign             [--all] [--inplace | --suffixed | <outfile>] <infile>...
+    sii dte [options] gen replies      [--only=<kinds>] [--unsigned] [--workers=<n>] <outdir> <infile>...
+    sii dte [options] sign             [--all | --incremental] [--inplace | --suffixed | <outfile>] <infile>...
     sii dte [options] verify signature <infile>...
     sii dte [options] verify schema    [--xsd=<file>] <infile>...
+    sii dte [options] verify caf       [--workers=<n>] <infile>...
+    sii dte [options] verify all       [--xsd=<file>] [--workers=<n>] <infile>...
     sii dte [options] void doc         <outfile> <infile>...
+    sii dte [options] folios           seed <path>...
+    sii dte [options] folios           [<rut>]
 
 Options:
     --inplace   # Will modify the same file it read with the processed output.
     --suffixed  # Will create a file right beside with an aditional extension suffix denoting the
                 # state it is in.
 
-    --key <file>   # Key (PEM) file to sign the document with (overrides config file).
-    --cert <file>  # Cert (PEM) file to sign the document with (overrides config file).
+    --key <file>   # Key (PEM) file to sign the document with (overrides config file, keyring included).
+    --cert <file>  # Cert (PEM) file to sign the document with (overrides config file, keyring included).
 
-    --all  # Signs all signodes in the document. Otherwise only the topmost will be signed.
+    --all          # Signs all signodes in the document. Otherwise only the topmost will be signed.
+    --incremental  # Like --all, but only (re)signs the signodes whose digests or signature no longer hold
+                   # (or are not by this key), and those enclosing them. Appending DTE's to a signed
+                   # <EnvioDTE> only signs those and the envelope.
 
     --xsd <file>  # XSD Schema definition file to check it against.
 
+    --workers <n>  # Processes to spread files over, 0 for one per CPU. [default: 0]
+
+    --only <kinds>  # Comma separated replies to generate: ack (envelope received), ok (contents approved) and
+                    # merch (merchandise received). [default: ack,ok,merch]
+    --unsigned      # Leave the replies unsigned.
+
+    --ledger <db>  # Folio ledger, updated when bundling DTE's and voiding. [default: ~/.local/share/sii/folios.db]
+
+    --select <query>  # Take the input documents from the catalog (see `sii index`) instead of arguments.
+    --catalog <db>    # Catalog to --select from. [default: ~/.local/share/sii/catalog.db]
+
 Notes:
     * There are currently no safeguards in place to avoid overwriting a file with nothing (emptying
       it) when something goes wrong and option --inplace is active. TODO.
+
+    * Documents (and replies) are signed with the key and cert of their emitter's (replier's) RUT under
+      auth.keyring in the config when it is there, otherwise with auth.key and auth.cert. Each RUT's
+      files are read once per run, so a batch may mix emitters.
+
+    * Verifying "caf" checks folios and TED stamps against the CAFs, and for duplicate folios across all
+      given files. Verifying "all" checks schema, signatures and CAF parsing each file once. One summary
+      line per file, exit code is 0 when all are good, otherwise the OR of 1 (schema), 2 (signature), 4
+      (CAF) and 8 (unreadable) over all files.
+
+    * "gen replies" generates the replies to received envelopes, each parsed once for all of them, and
+      signs them with a key read once. Written to <outdir> as <envelope name>.<kind>.xml, their paths are
+      printed.
+
+    * Voiding writes a credit note (unbundled) voiding each given document, folios are taken from the
+      ledger. With more than one document <outfile> has to be a directory. The ledger is kept up to date
+      when bundling DTE's, "folios" reports used, voided and free folios per CAF from it. "folios seed"
+      records the documents already issued (files, directories of *.xml, archives) and marks the ledger
+      complete for the RUT's and types of the CAFs, voiding refuses to take folios it was not seeded for.
 """
+import os
 import sys
-import tempfile
+import time
 
 import docopt
 from lxml import etree
 
-from sii.lib import schemas, signature
-from sii.lib import exchange
-from sii.lib import validation as validate
-
+from sii.lib             import exchange
+from sii.utils           import api
+from sii.utils.keyring   import Keyring
+from sii.utils.profiling import stage
+
+from . import cmd_folios
+from . import cmd_verify
+from . import cmd_xml
+from . import metrics
+from .catalog import select_paths
+from .folios  import FolioLedger, document_key
 from .helpers import print_xml, read_xml, read_xmls, stack_extension, write_xml
 
 
@@ -54,6 +101,11 @@ def handle(config, argv):
         handle_verify(args, config)
     elif args['void']:
         handle_void(args, config)
+    elif args['folios']:
+        if args['seed']:
+            cmd_folios.handle_seed(args, config)
+        else:
+            cmd_folios.handle_report(args, config)
     else:
         raise RuntimeError("Conditional Fallthrough")
 
@@ -70,29 +122,38 @@ def handle_bundling(args, config):
 
 
 def handle_bundling_dte(args, config):
-    cns_engine = connect_cns_db(args, config)
-    cns_sess   = session(cns_engine)
+    ledger = FolioLedger(args['--ledger'])
 
     for xml_fpath in args['<infile>']:
+        started = time.perf_counter()
+
         try:
             xml = read_xml(xml_fpath)
         except etree.XMLSyntaxError:
+            metrics.document('bundle', error='InvalidXML')
             print("Skipping invalid XML: {0}".format(xml_fpath), file=sys.stderr)
             continue
 
-        caf = cns.select_caf(xml, cns_sess)  # FIXME missing declaration swap with CAFPool from
-        dte = schemas.bundle_dte(xml, caf)
+        dte  = api.bundle_dte(xml, config.static.cafs)
+        sink = None
 
         if args['--inplace']:
-            write_xml(dte, xml_fpath, encoding='ISO-8859-1')
+            sink = xml_fpath
+            write_xml(dte, sink, encoding='ISO-8859-1')
         elif args['--suffixed']:
-            write_xml(dte, stack_extension(xml_fpath, 'dte'), encoding='ISO-8859-1')
+            sink = stack_extension(xml_fpath, 'dte')
+            write_xml(dte, sink, encoding='ISO-8859-1')
         else:
             print_xml(dte)
 
+        ledger.record_used(*document_key(dte), path=os.path.abspath(sink) if sink else None)
+        metrics.document('bundle', time.perf_counter() - started)
+
+    ledger.close()
+
 
 def handle_bundling_enviodte(args, config):
-    dte_lst  = list(read_xmls(args['<infile>']))
+    dte_lst = read_xmls(args['<infile>'])
 
     to_sii = None
     if args['--sii']:
@@ -102,7 +163,7 @@ def handle_bundling_enviodte(args, config):
 
     assert to_sii is not None, "Must provide --sii or --exchange for enviodte bundling!"
 
-    enviodte = schemas.bundle_enviodte(dte_lst, to_sii=to_sii)
+    enviodte = api.bundle_enviodte(dte_lst, config.static.companies, to_sii=to_sii)
 
     if args['<outfile>']:
         write_xml(enviodte, args['<outfile>'], encoding='ISO-8859-1')
@@ -111,8 +172,8 @@ def handle_bundling_enviodte(args, config):
 
 
 def handle_bundling_lv(args, config):
-    dte_lst  = list(read_xmls(args['<infile>']))
-    enviodte = schemas.bundle_libro_ventas(dte_lst)
+    paths    = select_paths(args['--catalog'], args['--select']) if args['--select'] else args['<infile>']
+    enviodte = api.bundle_libro_ventas(read_xmls(paths))
 
     if args['<outfile>']:
         write_xml(enviodte, args['<outfile>'], encoding='ISO-8859-1')
@@ -121,6 +182,10 @@ def handle_bundling_lv(args, config):
 
 
 def handle_generate(args, config):
+    if args['replies']:
+        cmd_xml.handle_generate_replies(args, config)
+        return
+
     xml = read_xml(args['<infile>'][0])
 
     reply_xml = None
@@ -147,36 +212,38 @@ def handle_sign(args, config):
         else:
             print("Skipping: {0}".format(path), file=sys.stderr)
 
+    keyring = Keyring.from_config(config, key=args['--key'], cert=args['--cert'])
+
+    mode = api.SIGN_TOP
+    if args['--all']:
+        mode = api.SIGN_ALL
+    elif args['--incremental']:
+        mode = api.SIGN_INCREMENTAL
+
     for xml_fpath in infiles:
+        started = time.perf_counter()
+
         try:
             doc_xml = read_xml(xml_fpath)
         except etree.XMLSyntaxError:
+            metrics.document('sign', error='InvalidXML')
             print("Skipping invalid XML: {0}".format(xml_fpath), file=sys.stderr)
             continue
 
-        # Load Sii key and certificate
-        with open(config.key, 'rb') as fh:
-            key_pem = fh.read()
-        with open(config.cert, 'rb') as fh:
-            cert_pem = fh.read()
-
-        # Workaround, make xmlsec read from file
-        key_fh  = tempfile.NamedTemporaryFile(mode='wb', buffering=0, delete=True)
-        cert_fh = tempfile.NamedTemporaryFile(mode='wb', buffering=0, delete=True)
-        key_fh.write(key_pem)
-        cert_fh.write(cert_pem)
+        # Key and certificate of the emitter (read once per run, kept for api.sign)
+        try:
+            keyring.signer_of(doc_xml)
+        except KeyError as exc:
+            metrics.document('sign', error='NoKey')
+            print("Skipping: {0} ({1})".format(xml_fpath, exc.args[0]), file=sys.stderr)
+            continue
 
         # Sign the <ds:Signature>
-        sigfunc    = signature.sign_document_all if args['--all'] else signature.sign_document
-        xml_signed = sigfunc(
-            xml       = doc_xml,
-            key_path  = key_fh.name,
-            cert_path = cert_fh.name
-        )
-
-        # Cleanup key and cert files
-        key_fh.close()
-        cert_fh.close()
+        try:
+            xml_signed = api.sign(doc_xml, keyring, mode)
+        except Exception as exc:
+            metrics.document('sign', time.perf_counter() - started, error=exc)
+            raise
 
         if args['--inplace']:
             write_xml(xml_signed, xml_fpath, encoding='ISO-8859-1')
@@ -188,12 +255,18 @@ def handle_sign(args, config):
         else:
             print_xml(xml_signed)
 
+        metrics.document('sign', time.perf_counter() - started)
+
 
 def handle_verify(args, config):
+    if args['all']:
+        cmd_verify.validate_all(args, config)
     if args['signature']:
         validate_signature(args, config)
     if args['schema']:
         validate_schema(args, config)
+    if args['caf']:
+        cmd_verify.validate_caf(args, config)
 
 
 def validate_signature(args, config):
@@ -205,28 +278,23 @@ def validate_signature(args, config):
             False: "Bad Signature."
         }
 
-        results = validate.validate_signatures(xml)
+        with stage('verify'):
+            results = api.verify_signatures(xml)
+
         for uri, validity in results:
             print("{0}: {1}: {2}".format(xml_fpath, uri, outcomes[validity]))
 
 
 def validate_schema(args, config):
-    xml_schema = None
-    if args['--xsd']:
-        with open(args['--xsd'], 'rb') as fh:
-            xml_schema = etree.parse(fh)
-
     for xml_fpath in args['<infile>']:
-        xml      = read_xml(xml_fpath)
+        problem  = api.verify_schema(read_xml(xml_fpath), args['--xsd'])
         path_str = xml_fpath + ":"
 
-        try:
-            validate.validate_schema(xml, xml_schema)
-        except etree.DocumentInvalid as exc:
-            print(path_str, "Bad Schema. " + str(exc))
+        if problem is not None:
+            print(path_str, "Bad Schema. " + problem)
         else:
             print(path_str, "Good Schema.")
 
 
 def handle_void(args, config):
-    raise NotImplementedError("You need to have reliable info on available doc ids... thus implementation defered")
+    cmd_folios.handle_void(args, config)
@@ -0,0 +1,128 @@
+""" Folio Management (voiding documents, usage reports, seeding the ledger)
+"""
+import os
+import sys
+
+from lxml import etree
+
+from sii.utils.accessors import DTES
+from sii.utils.headers   import header_of
+
+from . import archive
+from .annulment import TYPE_CREDIT_NOTE, create_annulment
+from .cafs      import CAFIndex
+from .folios    import AlreadyVoidedError, FolioLedger, document_key
+from .helpers   import print_table, read_xml, write_xml
+
+
+def handle_void(args, config):
+    """ Writes a credit note voiding each of `<infile>`, taking its folio from the ledger. """
+    infiles = args['<infile>']
+    outfile = args['<outfile>']
+    out_dir = os.path.isdir(outfile)
+
+    if len(infiles) > 1 and not out_dir:
+        raise SystemExit("Voiding more than one document requires <outfile> to be a directory.")
+
+    caf_index = _load_cafs(config)
+
+    with FolioLedger(args['--ledger']) as ledger:
+        for fpath in infiles:
+            dte = read_xml(fpath)
+            rut, dte_type, folio = document_key(dte)
+
+            def write(nc_folio):
+                try:
+                    annulment = create_annulment(dte, nc_folio)
+                except ValueError as exc:
+                    raise SystemExit("Cannot void {0}: {1}".format(fpath, str(exc)))
+
+                sink_path = _sink_path(outfile, out_dir, rut, nc_folio)
+                write_xml(annulment, sink_path, encoding='ISO-8859-1')
+                return os.path.abspath(sink_path)
+
+            try:
+                nc_folio = ledger.void(caf_index, (rut, dte_type, folio), TYPE_CREDIT_NOTE, write)
+            except AlreadyVoidedError:
+                print("Skipping already voided: {0} ({1}-{2})".format(fpath, dte_type, folio), file=sys.stderr)
+                continue
+            except LookupError as exc:
+                raise SystemExit(str(exc))
+
+            if nc_folio is None:
+                raise SystemExit("No credit note folios left for {0}, a new CAF is needed.".format(rut))
+
+            sink_path = _sink_path(outfile, out_dir, rut, nc_folio)
+            print("Voided {0}-{1} with {2}-{3}: {4}".format(dte_type, folio, TYPE_CREDIT_NOTE, nc_folio, sink_path), file=sys.stderr)
+
+
+def handle_seed(args, config):
+    """ Seeds the ledger with the documents already issued under `<path>` (files, directories, archives). """
+    caf_index = _load_cafs(config)
+
+    def headers():
+        for fpath in _document_paths(args['<path>']):
+            try:
+                xml = read_xml(fpath)
+            except (OSError, ValueError, etree.XMLSyntaxError) as exc:
+                print("Skipping unreadable: {0} ({1})".format(fpath, str(exc)), file=sys.stderr)
+                continue
+
+            for dte in DTES(xml):
+                try:
+                    yield header_of(dte, fpath)
+                except ValueError as exc:
+                    print("Skipping: {0} ({1})".format(fpath, str(exc)), file=sys.stderr)
+
+    with FolioLedger(args['--ledger']) as ledger:
+        recorded = ledger.seed(headers(), caf_index)
+
+    print("Seeded {0} documents, {1} CAFs".format(recorded, len(list(caf_index.cafs()))), file=sys.stderr)
+
+
+def handle_report(args, config):
+    """ Used/voided/free folios per CAF, straight from the ledger. """
+    caf_index = _load_cafs(config)
+
+    rows = [("RUT", "Type", "From", "To", "Used", "Voided", "Free")]
+
+    with FolioLedger(args['--ledger']) as ledger:
+        for usage in ledger.usage(caf_index, rut=args['<rut>']):
+            rows.append((
+                usage.caf.rut,
+                str(usage.caf.dte_type),
+                str(usage.caf.first),
+                str(usage.caf.last),
+                str(usage.used),
+                str(usage.voided),
+                str(usage.free)
+            ))
+
+    print_table(rows)
+
+
+def _sink_path(outfile, out_dir, rut, nc_folio):
+    if not out_dir:
+        return outfile
+
+    return os.path.join(outfile, "{0}_{1}_{2}.xml".format(rut.split('-')[0], TYPE_CREDIT_NOTE, nc_folio))
+
+
+def _document_paths(paths):
+    """ Files as given, *.xml below directories, and the documents of archives. """
+    for path in paths:
+        if os.path.isdir(path):
+            for dpath, _, fnames in os.walk(path):
+                for fname in sorted(fnames):
+                    if fname.lower().endswith('.xml'):
+                        yield os.path.join(dpath, fname)
+        else:
+            for fpath in archive.expand_paths([path]):
+                yield fpath
+
+
+def _load_cafs(config):
+    def skipped(fpath, exc):
+        print("Skipping malformed CAF: {0} ({1})".format(fpath, str(exc)), file=sys.stderr)
+
+    return CAFIndex.from_directory(config.static.cafs, on_error=skipped)
@@ -0,0 +1,93 @@
+""" Catalog of Documents (header metadata, signature and schema status of XML's below directories)
+
+Usage:
+    sii index [options] update [--no-verify] [--workers=<n>] <path>...
+    sii index [options] find   [--paths] [--limit=<n>] [<query>]
+    sii index [options] stats
+
+Options:
+    --catalog <db>  # Catalog database. [default: ~/.local/share/sii/catalog.db]
+
+    --no-verify    # Only read headers, leave signature and schema status unknown (much faster).
+    --workers <n>  # Processes indexing files, 0 for one per CPU. [default: 0]
+
+    --paths        # Only print the paths of files with matching documents, each once (e.g. to pipe into xargs).
+    --limit <n>    # Print at most <n> documents.
+
+Notes:
+    * Updating walks every *.xml below the given paths, (re-)indexing those new or changed (by mtime and
+      size) since last time and dropping those gone. Reruns over an unchanged tree only stat files. Every
+      <DTE> is a document of its own, envelopes have one per DTE they hold.
+
+    * Queries are comma separated filters, all of which have to match:
+        rut=<rut>, type=<type>, folio=<folio>[-<folio>], kind=<DTE|EnvioDTE|...>, receiver=<rut>,
+        from=<YYYY-MM-DD>, to=<YYYY-MM-DD>, path=<prefix>, valid, invalid
+      e.g. "rut=76000000-0,type=33,folio=12345". The same queries select the input documents of
+      `bundle lv`, `xch email` and `pdf create` with --select.
+"""
+import sys
+
+import docopt
+
+from .catalog import Catalog, parse_query
+from .helpers import print_table
+
+
+def handle(config, argv):
+    args = docopt.docopt(__doc__, argv=argv)
+
+    if args['update']:
+        handle_update(args, config)
+    elif args['find']:
+        handle_find(args, config)
+    elif args['stats']:
+        handle_stats(args, config)
+    else:
+        raise RuntimeError("Conditional Fallthrough")
+
+
+def handle_update(args, config):
+    def report(entry):
+        if entry.error:
+            print("Unindexable: {0} ({1})".format(entry.path, entry.error), file=sys.stderr)
+
+    with Catalog(args['--catalog']) as catalog:
+        summary = catalog.update(
+            roots    = args['<path>'],
+            verify   = not args['--no-verify'],
+            workers  = int(args['--workers']) or None,
+            on_entry = report
+        )
+
+    print("Added: {0}, Updated: {1}, Removed: {2}, Unchanged: {3}, Unindexable: {4}".format(*summary), file=sys.stderr)
+
+
+def handle_find(args, config):
+    filters = parse_query(args['<query>'])
+    limit   = int(args['--limit']) if args['--limit'] else None
+
+    with Catalog(args['--catalog']) as catalog:
+        entries = catalog.select(filters, limit=limit)
+
+    printed = set()
+    for entry in entries:
+        if args['--paths']:
+            if entry.path not in printed:
+                printed.add(entry.path)
+                print(entry.path)
+        else:
+            print("\t".join(str(col) if col is not None else "-" for col in (
+                entry.rut, entry.dte_type, entry.folio, entry.issued, entry.recpt_rut or entry.envio_recpt,
+                entry.signature, entry.schema, entry.path
+            )))
+
+
+def handle_stats(args, config):
+    with Catalog(args['--catalog']) as catalog:
+        stats = catalog.stats()
+
+    rows = [("RUT", "Type", "Documents", "Bad Signature", "Bad Schema", "Unindexable")]
+    for rut, dte_type, count, bad_sig, bad_schema, errors in stats:
+        rows.append((rut or "-", str(dte_type) if dte_type is not None else "-", str(count), str(bad_sig or 0), str(bad_schema or 0), str(errors or 0)))
+
+    print_table(rows)
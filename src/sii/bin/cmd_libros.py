@@ -0,0 +1,52 @@
+""" Incremental Libros (adding DTE's to their period as issued, writing the libro of a period)
+"""
+import sys
+
+from .catalog import select_paths
+from .helpers import print_table
+from .libros  import LibroState
+
+
+def handle_add(args, config):
+    """ Adds the given (or selected) DTE's to the state of their period, unchanged ones are skipped. """
+    paths = select_paths(args['--catalog'], args['--select']) if args['--select'] else args['<infile>']
+
+    def report(path, message):
+        print("Skipping: {0} ({1})".format(path, message), file=sys.stderr)
+
+    with LibroState(args['--libros']) as state:
+        summary = state.add(paths, on_error=report)
+
+    print("Added {0}, updated {1}, unchanged {2}, failed {3}.".format(*summary), file=sys.stderr)
+
+    if summary.failed:
+        raise SystemExit(1)
+
+
+def handle_write(args, config):
+    """ Streams the <LibroCompraVenta> of a period out of its state. """
+    with LibroState(args['--libros']) as state:
+        try:
+            count = state.write(
+                rut          = args['<rut>'],
+                period       = args['<period>'],
+                fpath        = args['<outfile>'],
+                resol_date   = args['<fch-resol>'],
+                resol_number = args['<nro-resol>'],
+                sender       = args['--sender']
+            )
+        except ValueError as exc:
+            raise SystemExit(str(exc))
+
+    print("Wrote {0} details to: {1}".format(count, args['<outfile>']), file=sys.stderr)
+
+
+def handle_status(args, config):
+    """ Documents and running totals per period and type. """
+    rows = [("RUT", "Period", "Type", "Docs", "Exempt", "Net", "VAT", "Total")]
+
+    with LibroState(args['--libros']) as state:
+        for period in state.periods(rut=args['<rut>']):
+            rows.append(tuple(str(col) for col in period))
+
+    print_table(rows)
@@ -5,6 +5,8 @@ Usage:
     sii pdf [options] list printers
     sii pdf [options] create tex [<outfile>] [-] | <infile>...
     sii pdf [options] create pdf [--progress] [--suffixed | --generate | <outfile>] [-] | <infile>...
+    sii pdf [options] create tex [<outfile>] --select=<query>
+    sii pdf [options] create pdf [--progress] [--suffixed | --generate | <outfile>] --select=<query>
     sii pdf [options] print <printer> <infile>...
 
 Options:
@@ -17,6 +19,9 @@ Options:
 
     -p --progress  # Output progress.
 
+    --select <query>  # Take the documents from the catalog (see `sii index`) instead of arguments.
+    --catalog <db>    # Catalog to --select from. [default: ~/.local/share/sii/catalog.db]
+
 Notes:
     Listing printers lists the available local printers as available/visible to the systems 'lp'.
 
@@ -25,17 +30,25 @@ Notes:
     directory per document approach. That is also what makes it mutually exclusive from --suffixed.
 
     Output will –unless otherwise explicitly specified– default to stdout.
+
+    Documents can be read from an archive (see `sii xml archive`), as <archive>.xmlz#<RUT>/<TipoDTE>/<Folio>
+    or all of them giving just <archive>.xmlz.
 """
 import sys
+import time
 import base64
 import os.path as path
 
 import docopt
+from lxml import etree
 
-from sii.lib       import printing
-from sii.lib.lib   import xml
-from sii.lib.types import CompanyPool
+from sii.lib             import printing
+from sii.utils           import api
+from sii.utils.profiling import stage
 
+from . import archive
+from . import metrics
+from .catalog import select_paths
 from .helpers import print_stderr, read_xml
 
 
@@ -73,40 +86,40 @@ def handle_create(args, config):
     template = None
     output   = None
 
-    if args['<infile>']:
-        source = ((pth, xml.read_xml(pth)) for pth in args['<infile>'])
-    else:
-        source = ((None, xml.load_xml(bstr)) for bstr in sys.stdin.buffer)
-
-        if args['--suffixed']:
-            raise SystemExit("Cannot --suffix if input comes from stdin!")
+    infiles = args['<infile>']
+    if args['--select']:
+        infiles = select_paths(args['--catalog'], args['--select'])
 
-    counter = 0
-    for pth, dte in source:
-        tree = xml.dump_etree(dte)
+    # an archive stands for all of its documents
+    infiles = list(archive.expand_paths(infiles))
 
-        dte_type = int(dte.Documento.Encabezado.IdDoc.TipoDTE)
-        dte_id   = int(dte.Documento.Encabezado.IdDoc.Folio)
-        dte_rut  = int(str(dte.Documento.Encabezado.Emisor.RUTEmisor).split('-')[0])
+    if args['--suffixed'] and any(archive.is_archive(pth) for pth in infiles):
+        raise SystemExit("Cannot --suffix documents of an archive, use --generate!")
 
-        if not args['--extern']:
-            company_pool = CompanyPool.from_file(config.static.companies)
-        else:
-            company_pool = None
+    # plain trees, neither the template nor the header needs objectify
+    if infiles:
+        source = ((pth, read_xml(pth)) for pth in infiles)
+    else:
+        source = ((None, etree.fromstring(bstr)) for bstr in sys.stdin.buffer)
 
-        if args['--cedible'] and dte_type in (56, 61):
-            raise SystemExit("NC and ND are not subject to the argument --cedible. Will not proceed...")
+        if args['--suffixed']:
+            raise SystemExit("Cannot --suffix if input comes from stdin!")
 
-        if args['--medium'] not in ('carta', 'oficio', 'thermal80mm'):
-            raise SystemExit("Unknown medium to generate printable template for: {0}".format(args['--medium']))
+    companies = config.static.companies if not args['--extern'] else None
 
-        template, resources = printing.create_template(
-            dte_xml = tree,
-            medium  = args['--medium'],
-            company = company_pool,
-            cedible = args['--cedible'],
-            draft   = args['--draft']
-        )
+    counter = 0
+    started = time.perf_counter()
+    for pth, tree in source:
+        try:
+            template, resources = api.render_tex(
+                tree,
+                companies = companies,
+                medium    = args['--medium'],
+                cedible   = args['--cedible'],
+                draft     = args['--draft']
+            )
+        except ValueError as exc:
+            raise SystemExit(str(exc))
 
         if args['tex']:
             if args['<outfile>']:
@@ -123,11 +136,13 @@ def handle_create(args, config):
                         fh.write(res.data)
 
         if args['pdf']:
-            b64pdf = printing.tex_to_pdf(template, resources)
+            with stage('tex'):
+                b64pdf = printing.tex_to_pdf(template, resources)
+
             output = base64.b64decode(b64pdf)
 
             if args['--progress']:
-                print_stderr("[{0}/{1}] Created PDF from {2}".format(counter + 1, len(args['<infile>']), pth))
+                print_stderr("[{0}/{1}] Created PDF from {2}".format(counter + 1, len(infiles), pth))
 
             if args['--suffixed']:
                 basepath = path.basename(pth).split('.')[0]
@@ -140,9 +155,7 @@ def handle_create(args, config):
                     fh.write(output)
 
             elif args['--generate']:
-                fname = "{0}_{1}_{2}.pdf".format(dte_rut, dte_type, dte_id)
-
-                with open(fname, 'wb') as fh:
+                with open(api.document_name(tree, 'pdf'), 'wb') as fh:
                     fh.write(output)
 
             elif args['<outfile>']:
@@ -154,7 +167,10 @@ def handle_create(args, config):
         else:
             raise RuntimeError("Conditional Fallthrough")
 
+        metrics.document('pdf' if args['pdf'] else 'tex', time.perf_counter() - started)
+
         counter += 1
+        started  = time.perf_counter()
 
 
 def handle_print(args, config):
@@ -1,10 +1,38 @@
 """ Verification/Validation
 """
+import sys
+import time
+import collections
+
 from lxml import etree
 
 from sii.lib import validation as validate
 
-from .helpers import read_xml
+from sii.utils.dsig      import verify_signatures
+from sii.utils.profiling import stage
+
+from . import metrics
+from .cafs    import CAFIndex, extract_stamps, verify_stamp
+from .pools   import process_pool
+from .helpers import read_xml, validate_schema as validate_schema_cached
+
+# Exit code bits of a combined verification, OR'ed over all files
+EXIT_SCHEMA     = 1
+EXIT_SIGNATURE  = 2
+EXIT_CAF        = 4
+EXIT_UNREADABLE = 8
+
+# Error types reported to the metrics per exit code bit
+ERROR_TYPES = (
+    (EXIT_UNREADABLE, 'Unreadable'),
+    (EXIT_SCHEMA,     'Schema'),
+    (EXIT_SIGNATURE,  'Signature'),
+    (EXIT_CAF,        'CAF')
+)
+
+Verdict = collections.namedtuple('Verdict', ['path', 'code', 'details', 'folios', 'seconds'])
+
+_CAF_INDEX = CAFIndex()
 
 
 def handle(args, config):
@@ -25,7 +53,9 @@ def validate_signature(args, config):
             False: "Bad Signature."
         }
 
-        results = validate.validate_signatures(xml)
+        with stage('verify'):
+            results = verify_signatures(xml)
+
         for uri, validity in results:
             print("{0}: {1}: {2}".format(xml_fpath, uri, outcomes[validity]))
 
@@ -41,7 +71,8 @@ def validate_schema(args, config):
         path_str = xml_fpath + ":"
 
         try:
-            validate.validate_schema(xml, xml_schema)
+            with stage('validate'):
+                validate.validate_schema(xml, xml_schema)
         except etree.DocumentInvalid as exc:
             print(path_str, "Bad Schema. " + str(exc))
         else:
@@ -49,4 +80,147 @@ def validate_schema(args, config):
 
 
 def validate_caf(args, config):
-    raise NotImplementedError
+    """ TED stamps and folios of every <DTE> against the CAFs in `config.static.cafs`, including duplicate
+    folios over the whole batch. Exits like `validate_all`.
+    """
+    code = _verify_files(args['<infile>'], None, config.static.cafs, int(args['--workers']), ('caf',))
+
+    if code:
+        sys.exit(code)
+
+
+def validate_all(args, config):
+    """ Schema, signatures and CAF/TED of every file from a single parse, files spread over processes.
+
+    Prints one line per file and exits with the OR of the `EXIT_*` bits of all files (0 if all good).
+    """
+    checks = ('schema', 'signature', 'caf')
+    code   = _verify_files(args['<infile>'], args['--xsd'], config.static.cafs, int(args['--workers']), checks)
+
+    if code:
+        sys.exit(code)
+
+
+def _verify_files(paths, xsd_path, cafs_dir, workers, checks):
+    code  = 0
+    seen  = {}
+    jobs  = len(paths)
+
+    with process_pool(workers, jobs, initializer=_init_worker, initargs=(cafs_dir,)) as executor:
+        verdicts = executor.map(_verify_file, paths, [xsd_path] * jobs, [checks] * jobs, chunksize=8)
+
+        for done, verdict in enumerate(verdicts, 1):
+            details = list(verdict.details)
+            v_code  = verdict.code
+
+            # Duplicates are only visible across the whole batch, thus checked here
+            for key in verdict.folios:
+                if key in seen:
+                    v_code |= EXIT_CAF
+                    details.append("Duplicate: {0} {1}-{2} (also in {3}).".format(key[0], key[1], key[2], seen[key]))
+                else:
+                    seen[key] = verdict.path
+
+            code  |= v_code
+            status = "Good." if v_code == 0 else "Bad."
+
+            errors = "+".join(etype for bit, etype in ERROR_TYPES if v_code & bit)
+            metrics.document('verify', verdict.seconds, error=errors or None)
+            metrics.queue_depth('verify', jobs - done)
+
+            print("{0}: {1} {2}".format(verdict.path, status, " ".join(details)))
+            sys.stdout.flush()
+
+    return code
+
+
+def _init_worker(cafs_dir):
+    global _CAF_INDEX
+    _CAF_INDEX = CAFIndex.from_directory(cafs_dir) if cafs_dir else CAFIndex()
+
+
+def _verify_file(xml_fpath, xsd_path=None, checks=('schema', 'signature')):
+    code    = 0
+    details = []
+    folios  = []
+    started = time.perf_counter()
+
+    try:
+        xml = read_xml(xml_fpath)
+    except (OSError, etree.XMLSyntaxError) as exc:
+        return Verdict(xml_fpath, EXIT_UNREADABLE, ["Unreadable: " + str(exc)], folios, time.perf_counter() - started)
+
+    if 'schema' in checks:
+        try:
+            validate_schema_cached(xml, xsd_path)
+        except etree.DocumentInvalid as exc:
+            code |= EXIT_SCHEMA
+            details.append("Schema: Bad ({0}).".format(str(exc)))
+        else:
+            details.append("Schema: Good.")
+
+    if 'signature' in checks:
+        with stage('verify'):
+            results = verify_signatures(xml)
+
+        bad = [str(uri) for uri, validity in results if not validity]
+
+        if bad:
+            code |= EXIT_SIGNATURE
+            details.append("Signatures: {0}/{1} Good (Bad: {2}).".format(len(results) - len(bad), len(results), ", ".join(bad)))
+        else:
+            details.append("Signatures: {0}/{0} Good.".format(len(results)))
+
+    if 'caf' in checks:
+        try:
+            stamps = extract_stamps(xml)
+        except (ValueError, TypeError) as exc:
+            code |= EXIT_CAF
+            details.append("CAF: Bad (Malformed document: {0}).".format(str(exc)))
+            stamps = []
+
+        bad = []
+        for stamp in stamps:
+            label = "{0}-{1}".format(stamp.doc_type, stamp.doc_folio)
+            folios.append((stamp.rut, stamp.doc_type, stamp.doc_folio))
+
+            problem = _check_stamp(stamp)
+            if problem:
+                bad.append("{0}: {1}".format(label, problem))
+
+        if bad:
+            code |= EXIT_CAF
+            details.append("CAF: {0}/{1} Good (Bad: {2}).".format(len(stamps) - len(bad), len(stamps), "; ".join(bad)))
+        elif stamps:
+            details.append("CAF: {0}/{0} Good.".format(len(stamps)))
+
+    return Verdict(xml_fpath, code, details, folios, time.perf_counter() - started)
+
+
+def _check_stamp(stamp):
+    """ Problem found with the stamp of a document, None if there is none. """
+    if stamp.signed is None:
+        return "Missing TED"
+
+    if (stamp.dte_type, stamp.folio) != (stamp.doc_type, stamp.doc_folio):
+        return "TED does not match document ({0}-{1})".format(stamp.dte_type, stamp.folio)
+
+    if not (stamp.caf.first <= stamp.folio <= stamp.caf.last):
+        return "Folio outside of the range of the embedded CAF"
+
+    # Documents of emitters we hold CAFs for must be covered by one of them, for others (received
+    # documents) the CAF embedded in the TED is all there is.
+    if (stamp.rut, stamp.dte_type) in _CAF_INDEX:
+        caf = _CAF_INDEX.lookup(stamp.rut, stamp.dte_type, stamp.folio)
+
+        if caf is None:
+            return "Folio not authorized by any CAF"
+        if (caf.modulus, caf.exponent) != (stamp.caf.modulus, stamp.caf.exponent):
+            return "Embedded CAF differs from {0}".format(caf.path)
+    else:
+        caf = stamp.caf
+
+    if not verify_stamp(stamp, caf):
+        return "Bad TED stamp"
+
+    return None
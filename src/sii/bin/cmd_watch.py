@@ -0,0 +1,213 @@
+""" Watch a Spool Directory (runs a pipeline on every DTE dropped into it, as soon as it appears)
+
+Usage:
+    sii watch [options] <spool> <outdir>
+
+Options:
+    --steps <steps>    # Comma separated pipeline run on each file, in this order: bundle, sign, pdf and
+                       # envelope. [default: bundle,sign]
+    --workers <n>      # Processes running pipelines, 0 for one per CPU. [default: 0]
+    --checkpoint <db>  # Files processed, restarts resume without redoing them. [default: ~/.local/share/sii/watch.db]
+    --ledger <db>      # Folio ledger, updated when bundling. [default: ~/.local/share/sii/folios.db]
+    --interval <s>     # Seconds between scans of the spool where inotify is not available. [default: 1]
+    --medium <medium>  # Paper size of the PDF's ('carta', 'oficio' or 'thermal80mm'). [default: carta]
+    --once             # Process what is in the spool and exit, instead of watching it.
+
+Notes:
+    * Outputs are written to <outdir> under the name of their spool file: the bundled and/or signed DTE
+      as is, its PDF with .pdf and its signed <EnvioDTE> (to the SII, with only that DTE) as .envio.xml.
+
+    * Files are picked up once completely written (closed or moved into the spool). Hidden ones, those
+      not ending in .xml and those with ".signed" in their name are ignored, as are those processed
+      before (by path, modification time and size, whether that failed or not).
+"""
+import os
+import sys
+import time
+import signal
+import collections
+
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import docopt
+from lxml import etree
+
+from sii.utils           import api
+from sii.utils.keyring   import Keyring
+from sii.utils.profiling import stage
+
+from . import metrics
+from .folios   import FolioLedger, document_key
+from .helpers  import read_xml, stack_extension, write_xml
+from .pools    import process_pool, worker_count
+from .replies  import load_signer, sign
+from .watching import Checkpoint, watcher
+
+STEPS = ('bundle', 'sign', 'pdf', 'envelope')
+
+STATUS_DONE   = 'DONE'
+STATUS_FAILED = 'FAILED'
+
+Processed = collections.namedtuple('Processed', ['path', 'outputs', 'key', 'error', 'seconds'])
+
+
+def handle(config, argv):
+    args = docopt.docopt(__doc__, argv=argv)
+
+    steps = [step.strip() for step in args['--steps'].split(',') if step.strip()]
+    for step in steps:
+        if step not in STEPS:
+            raise SystemExit("Unknown step: {0} (expected some of {1})".format(step, ", ".join(STEPS)))
+
+    if args['--medium'] not in api.MEDIUMS:
+        raise SystemExit("Unknown medium to generate printable template for: {0}".format(args['--medium']))
+
+    spool  = os.path.abspath(os.path.expanduser(args['<spool>']))
+    outdir = os.path.abspath(os.path.expanduser(args['<outdir>']))
+
+    if spool == outdir:
+        raise SystemExit("Outputs cannot go to the spool itself, they would be picked up again.")
+
+    os.makedirs(outdir, exist_ok=True)
+
+    # Workers load the key and certificate of each emitter they come across once
+    keyring = None
+    if 'sign' in steps or 'envelope' in steps:
+        keyring = Keyring.from_config(config)
+
+    options = {
+        'steps':     tuple(step for step in STEPS if step in steps),
+        'outdir':    outdir,
+        'cafs':      config.static.cafs if 'bundle' in steps else None,
+        'companies': config.static.companies if 'pdf' in steps or 'envelope' in steps else None,
+        'medium':    args['--medium']
+    }
+
+    workers    = worker_count(int(args['--workers']))
+    checkpoint = Checkpoint(args['--checkpoint'])
+    ledger     = FolioLedger(args['--ledger']) if 'bundle' in steps else None
+    watch      = watcher(spool, float(args['--interval']))
+
+    queued   = collections.OrderedDict()  # path -> stat, waiting for a worker
+    inflight = {}                         # future -> (path, stat)
+
+    try:
+        with process_pool(workers, initializer=_init_worker, initargs=(keyring,)) as executor:
+            while True:
+                # only block on the spool while there is nothing to collect
+                for name in watch.changes(timeout=0.05 if inflight else 1.0):
+                    fpath = os.path.join(spool, name)
+
+                    if not _wanted(name) or fpath in queued:
+                        continue
+
+                    try:
+                        stat = os.stat(fpath)
+                    except OSError:
+                        continue  # moved on already
+
+                    if not checkpoint.is_done(fpath, stat):
+                        queued[fpath] = stat
+
+                busy = set(path for path, _ in inflight.values())
+                for fpath in [fpath for fpath in queued if fpath not in busy]:
+                    if len(inflight) >= 2 * workers:
+                        break
+
+                    stat = queued.pop(fpath)
+                    inflight[executor.submit(_run_pipeline, fpath, options)] = (fpath, stat)
+
+                metrics.queue_depth('watch', len(queued))
+
+                if inflight:
+                    done, _ = wait(list(inflight), timeout=0, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        fpath, stat = inflight.pop(future)
+                        _report(future.result(), stat, checkpoint, ledger)
+
+                if args['--once'] and not queued and not inflight:
+                    break
+    except KeyboardInterrupt:
+        print("Interrupted, {0} files left for the next run.".format(len(queued) + len(inflight)), file=sys.stderr)
+    finally:
+        watch.close()
+        checkpoint.close()
+
+        if ledger is not None:
+            ledger.close()
+
+
+def _init_worker(keyring):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # interrupts are for the watcher, workers finish their file
+    load_signer(keyring)
+
+
+def _wanted(name):
+    return name.lower().endswith('.xml') and not name.startswith('.') and '.signed' not in name
+
+
+def _report(processed, stat, checkpoint, ledger):
+    metrics.document('watch', processed.seconds, error=processed.error.partition(':')[0] if processed.error else None)
+
+    if processed.error:
+        checkpoint.record(processed.path, stat, STATUS_FAILED, processed.error, processed.outputs)
+        print("Failed: {0} ({1})".format(processed.path, processed.error), file=sys.stderr)
+        return
+
+    if ledger is not None and processed.key is not None:
+        ledger.record_used(*processed.key, path=processed.outputs[0])
+
+    checkpoint.record(processed.path, stat, STATUS_DONE, outputs=processed.outputs)
+    print("{0} -> {1} ({2:.3f}s)".format(processed.path, ", ".join(processed.outputs), processed.seconds), file=sys.stderr)
+
+
+def _run_pipeline(xml_fpath, options):
+    started = time.perf_counter()
+    outputs = []
+    key     = None
+
+    try:
+        xml = read_xml(xml_fpath)
+    except etree.XMLSyntaxError as exc:
+        return Processed(xml_fpath, outputs, key, "InvalidXML: " + str(exc), time.perf_counter() - started)
+    except (OSError, ValueError) as exc:
+        # gone or unreadable since it was queued
+        return Processed(xml_fpath, outputs, key, "{0}: {1}".format(type(exc).__name__, str(exc)), time.perf_counter() - started)
+
+    steps    = options['steps']
+    dte_path = os.path.join(options['outdir'], os.path.basename(xml_fpath))
+
+    try:
+        if 'bundle' in steps:
+            xml = api.bundle_dte(xml, options['cafs'])
+            key = document_key(xml)
+
+        if 'sign' in steps:
+            with stage('sign'):
+                xml = sign(xml, top_only=True)
+
+        write_xml(xml, dte_path, encoding='ISO-8859-1')
+        outputs.append(dte_path)
+
+        if 'pdf' in steps:
+            pdf      = api.render_pdf(xml, options['companies'], medium=options['medium'])
+            pdf_path = os.path.splitext(dte_path)[0] + '.pdf'
+            with open(pdf_path, 'wb') as fh:
+                fh.write(pdf)
+            outputs.append(pdf_path)
+
+        if 'envelope' in steps:
+            with stage('bundle'):
+                enviodte = api.bundle_enviodte([xml], options['companies'], to_sii=True)
+
+            with stage('sign'):
+                enviodte = sign(enviodte, top_only=True)
+
+            envio_path = stack_extension(dte_path, 'envio')
+            write_xml(enviodte, envio_path, encoding='ISO-8859-1')
+            outputs.append(envio_path)
+    except Exception as exc:
+        return Processed(xml_fpath, outputs, key, "{0}: {1}".format(type(exc).__name__, str(exc)), time.perf_counter() - started)
+
+    return Processed(xml_fpath, outputs, key, None, time.perf_counter() - started)
@@ -1,23 +1,55 @@
 """ Interact with Sii Servers (Upload, verify states, ...)
 
 Usage:
-    sii ws test connect [--maullin] [--palena] [--key=<key>] [--cert=<cert>]
-    sii ws upload       (--maullin | --palena) [--dry-run] [--disable-ssl-verify] <infile>
+    sii ws test connect [--maullin] [--palena] [--key=<key>] [--cert=<cert>] [--repeat=<n>] [--disable-ssl-verify]
+    sii ws upload       (--maullin | --palena) [--dry-run] [--disable-ssl-verify] [--key=<key>] [--cert=<cert>]
+                        [--jobs=<db>] <infile>
+    sii ws status poll  (--maullin | --palena) [--disable-ssl-verify] [--jobs=<db>] [--concurrency=<n>] [--retries=<n>]
+                        [<trackid>...]
+    sii ws status list  [--pending] [--jobs=<db>]
 
 Options:
     --maullin  # Act on the SII official testing server.
     --palena   # Act on the SII official production server.
 
     --disable-ssl-verify  # Disables the SSL cert validity check.
+
+    --key <key>    # Key (PEM) file to authenticate with (overrides config file, keyring included).
+    --cert <cert>  # Cert (PEM) file to authenticate with (overrides config file, keyring included).
+    --repeat <n>   # Probes per server, more than one reports percentiles per stage. [default: 1]
+
+    --jobs <db>          # Local database keeping track of uploads. [default: ~/.local/share/sii/jobs.db]
+    --concurrency <n>    # Maximum of simultaneous state queries. [default: 16]
+    --retries <n>        # Re-polls (with exponential backoff) of uploads still in process. [default: 4]
+    --pending            # Only list uploads not yet in a final state.
+
+Notes:
+    * Testing connectivity probes both servers at once unless one is chosen. Timings are reported per
+      stage: DNS lookup, TCP connect, TLS handshake, seed request and token request.
+
+    * Every upload gets recorded with its track id in the jobs database. Polling without explicit track
+      ids reconciles all uploads to the given server that are not yet in a final state. Every upload is
+      sent, and queried with a token, by its emitter's certificate (see auth.keyring in the config file).
 """
 import os
 import sys
+import math
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 from sii.lib import upload
 
 from docopt import docopt
 from lxml   import etree
 
+from sii.utils.keyring   import Keyring
+from sii.utils.profiling import stage
+
+from . import metrics
+from . import wsclient
+from .jobs import JobDatabase, STATES_FINAL, poll_states
+
 fullpath = lambda pth: os.path.abspath(os.path.expanduser(pth))
 
 
@@ -28,37 +60,86 @@ def handle(config, argv):
         handle_test(args, config)
     elif args['upload']:
         handle_upload(args, config)
+    elif args['status']:
+        handle_status(args, config)
     else:
         raise RuntimeError("Conditional Fallthrough.")
 
 
 def handle_test(args, config):
     if args['connect']:
-        key_pth  = fullpath(config.auth.key)
-        cert_pth = fullpath(config.auth.cert)
+        try:
+            signer = Keyring.from_config(config, key=args['--key'], cert=args['--cert']).signer()
+        except KeyError as exc:
+            raise SystemExit(exc.args[0])
 
-        if args['--maullin']:
-            ret = upload.test_connection(key_pth, cert_pth, upload.HOST_TESTING)
+        key_pth  = signer.key_path
+        cert_pth = signer.cert_path
+        context  = wsclient.ssl_context(verify=not args['--disable-ssl-verify'])
+        repeat   = int(args['--repeat'])
 
-            if ret is True:
-                status = "Successful"
-            else:
-                status = "Failed with status: {0}".format(ret)
+        targets = []
+        if args['--maullin'] or not args['--palena']:
+            targets.append(("Maullin", wsclient.HOST_TESTING))
+        if args['--palena'] or not args['--maullin']:
+            targets.append(("Palena", wsclient.HOST_PRODUCTION))
+
+        def probe_host(host):
+            return [wsclient.probe(host, key_pth, cert_pth, context=context) for _ in range(repeat)]
 
-            print("Connection to Maullin:", status, file=sys.stderr)
+        # Hosts are probed at the same time, repetitions against one host one after the other
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            results = list(executor.map(probe_host, [host for _, host in targets]))
 
-        if args['--palena']:
-            ret = upload.test_connection(key_pth, cert_pth, upload.HOST_PRODUCTION)
+        for (name, _), probes in zip(targets, results):
+            failed = [probe for probe in probes if probe.error is not None]
 
-            if ret is True:
+            if not failed:
                 status = "Successful"
             else:
-                status = "Failed with status: {0}".format(ret)
+                status = "Failed with status: {0}".format(failed[-1].error)
+
+            if repeat > 1:
+                status += " ({0}/{1} probes succeeded)".format(repeat - len(failed), repeat)
+
+            print("Connection to {0}:".format(name), status, file=sys.stderr)
+            _print_timings(probes)
+
+        return
+
 
-            print("Connection to Palena:", status, file=sys.stderr)
+def _print_timings(probes):
+    if len(probes) == 1:
+        timings = probes[0].timings
 
+        for step in wsclient.PROBE_STAGES:
+            if step in timings:
+                print("    {0:<8} {1:>9.1f} ms".format(step, timings[step] * 1000), file=sys.stderr)
         return
 
+    print("    {0:<8} {1:>9} {2:>9} {3:>9} {4:>9} {5:>9}".format("stage", "min", "p50", "p90", "p99", "max"), file=sys.stderr)
+
+    for step in wsclient.PROBE_STAGES:
+        samples = sorted(probe.timings[step] * 1000 for probe in probes if step in probe.timings)
+
+        if not samples:
+            continue
+
+        print("    {0:<8} {1:>9.1f} {2:>9.1f} {3:>9.1f} {4:>9.1f} {5:>9.1f}".format(
+            step,
+            samples[0],
+            _percentile(samples, 50),
+            _percentile(samples, 90),
+            _percentile(samples, 99),
+            samples[-1]
+        ), file=sys.stderr)
+
+
+def _percentile(samples, pct):
+    """ Nearest-rank percentile over already sorted `samples`. """
+    rank = max(1, int(math.ceil(pct / 100.0 * len(samples))))
+    return samples[rank - 1]
+
 
 def handle_upload(args, config):
     server = None
@@ -74,14 +155,132 @@ def handle_upload(args, config):
     with open(args['<infile>'], 'rb') as fh:
         xml  = etree.parse(fh)
         root = xml.getroot()
+        rut  = _emitter_rut(root)  # before uploading, an upload is never left unrecorded
 
-        sii_id = upload.upload_document(
-            document = root,
-            key_pth  = fullpath(config.auth.key),
-            cert_pth = fullpath(config.auth.cert),
-            server   = server,
-            dryrun   = args['--dry-run'],
-            verify   = not args['--disable-ssl-verify']
-        )
+        try:
+            signer = Keyring.from_config(config, key=args['--key'], cert=args['--cert']).signer_of(root)
+        except KeyError as exc:
+            raise SystemExit(exc.args[0])
+
+        started = time.perf_counter()
+        try:
+            with stage('network'):
+                sii_id = upload.upload_document(
+                    document = root,
+                    key_pth  = signer.key_path,
+                    cert_pth = signer.cert_path,
+                    server   = server,
+                    dryrun   = args['--dry-run'],
+                    verify   = not args['--disable-ssl-verify']
+                )
+        except Exception as exc:
+            metrics.document('upload', time.perf_counter() - started, error=exc)
+            raise
+
+        metrics.document('upload', time.perf_counter() - started)
 
         print("Upload Number: {0}".format(sii_id))
+
+        if not args['--dry-run']:
+            with JobDatabase(args['--jobs']) as jobs:
+                jobs.record_upload(sii_id, server, rut, fullpath(args['<infile>']))
+
+
+def handle_status(args, config):
+    if args['poll']:
+        handle_status_poll(args, config)
+    elif args['list']:
+        handle_status_list(args, config)
+    else:
+        raise RuntimeError("Conditional Fallthrough.")
+
+
+def handle_status_poll(args, config):
+    if args['--maullin']:
+        server, host = upload.HOST_TESTING, wsclient.HOST_TESTING
+    elif args['--palena']:
+        server, host = upload.HOST_PRODUCTION, wsclient.HOST_PRODUCTION
+    else:
+        raise ValueError("Could not determine target server to query")
+
+    context = wsclient.ssl_context(verify=not args['--disable-ssl-verify'])
+
+    with JobDatabase(args['--jobs']) as jobs:
+        pending = jobs.jobs(server=server, track_ids=args['<trackid>'], pending=not args['<trackid>'])
+
+        if not pending:
+            print("Nothing to poll.", file=sys.stderr)
+            return
+
+        keyring    = Keyring.from_config(config)
+        tokens     = {}
+        job_tokens = {}
+
+        # One token per emitter's certificate for the whole run, every query is then a single request
+        for job in pending:
+            try:
+                signer = keyring.signer(job.rut)
+            except KeyError as exc:
+                print("{0}: Skipping: {1}".format(job.track_id, exc.args[0]), file=sys.stderr)
+                continue
+
+            if signer.cert_path not in tokens:
+                tokens[signer.cert_path] = wsclient.request_token(host, signer.key_path, signer.cert_path, context=context)
+
+            job_tokens[job.track_id] = tokens[signer.cert_path]
+
+        query = lambda job: wsclient.query_upload_state(host, job_tokens[job.track_id], job.rut, job.track_id, context=context)
+
+        counts = {'final': 0, 'pending': 0, 'failed': 0}
+
+        def persist(results):
+            states = []
+
+            for job, result, attempts in results:
+                if isinstance(result, Exception):
+                    counts['failed'] += 1
+                    print("{0}: Query failed: {1}".format(job.track_id, str(result)), file=sys.stderr)
+                    states.append((job.track_id, None, None, attempts))
+                    continue
+
+                if result.state in STATES_FINAL:
+                    counts['final'] += 1
+                else:
+                    counts['pending'] += 1
+
+                print("{0}: {1} {2}".format(job.track_id, result.state, result.glosa))
+                states.append((job.track_id, result.state, result.glosa, attempts))
+
+            jobs.update_states(states)
+
+        poll_states(
+            jobs        = [job for job in pending if job.track_id in job_tokens],
+            query       = query,
+            on_results  = persist,
+            concurrency = int(args['--concurrency']),
+            retries     = int(args['--retries'])
+        )
+
+        print("Final: {final} Pending: {pending} Failed: {failed}".format(**counts), file=sys.stderr)
+
+
+def handle_status_list(args, config):
+    with JobDatabase(args['--jobs']) as jobs:
+        for job in jobs.jobs(pending=args['--pending']):
+            print("{0}  {1:<16}  {2:>12}  {3:<4} {4}  {5}".format(
+                job.track_id,
+                job.server,
+                job.rut,
+                job.state,
+                job.glosa,
+                job.path or ''
+            ))
+
+
+def _emitter_rut(root):
+    found = root.xpath("//*[local-name() = 'RutEmisor' or local-name() = 'RutEmisorLibro']")
+
+    if not found:
+        raise ValueError("Could not find the emitter RUT in the uploaded document")
+
+    return found[0].text.strip()
@@ -4,7 +4,8 @@ Usage:
     sii xch [options] email --from <address> (--to <address> | --to-csv <csv> | --to-ws) [--bcc <>]
                             [--preamble <path> | --message <msg>]
                             [--batch]
-                            <enviodte>...
+                            (--select=<query> | <enviodte>...)
+    sii xch [options] ingest [--ack-queue=<dir>] <mailbox> <dest>
 
 Options:
     # SMTP Information and Options
@@ -31,6 +32,20 @@ Options:
     --batch  # Skip file on failure to lookup recipient. Useful when some recipients are no electronic contributors,
              # works with --to-csv and --to-ws.
 
+    --xsd <file>     # XSD Schema definition file to check envelopes against (compiled once).
+    --workers <n>    # Processes parsing and validating envelopes ahead of sending (or after receiving), 0 for one
+                     # per CPU. [default: 0]
+
+    --outbox <db>    # Ledger of sent envelopes, reruns skip those already delivered. [default: ~/.local/share/sii/outbox.db]
+    --resend         # Send again, even if the ledger has the envelope as delivered to the recipient.
+
+    --inbox <db>       # Ledger of ingested mail and documents, reruns only read new messages. [default: ~/.local/share/sii/inbox.db]
+    --ack-queue <dir>  # Also write signed receipt acknowledgements (<RespuestaDTE>) of the filed envelopes not
+                       # acknowledged yet below <dir>, to be sent back.
+
+    --select <query>  # Take the envelopes from the catalog (see `sii index`) instead of arguments.
+    --catalog <db>    # Catalog to --select from. [default: ~/.local/share/sii/catalog.db]
+
 Notes:
     * SII provides a list of all contributors/emitters, including their exchange email addresses
       at https://palena.sii.cl/cvc_cgi/dte/ce_empresas_dwnld (cert auth required).
@@ -38,13 +53,27 @@ Notes:
       The CSV headers are as follows:
         RUT; RAZON SOCIAL; NUMERO RESOLUCION; FECHA RESOLUCION; MAIL INTERCAMBIO; URL
       Separator as can be seen is ';', no string quotes.
+
+    * Envelopes are identified in the outbox by the hash of their content and their recipient. When a
+      run fails halfway, rerunning it with the same arguments only sends what is missing.
+
+    * Ingesting reads the Maildir (directory) or mbox (file) <mailbox> and files the XML attachments of
+      the messages not ingested before below <dest>: those with good signatures and schema as
+      <rut>/<type>/<folio>.xml, others in other/<kind>/ and invalid/. Documents already ingested (by
+      content hash) are not filed again.
 """
 import os
 import sys
 import csv
+import time
+import queue
 import smtplib
+import itertools
+import threading
 import collections
 
+from email                import encoders
+from email.mime.base      import MIMEBase
 from email.mime.text      import MIMEText
 from email.mime.multipart import MIMEMultipart
 
@@ -52,11 +81,28 @@ import docopt
 
 from lxml import etree
 
-from sii.lib     import validation as valid
-from sii.lib.lib import xml, output
+from sii.lib.lib import output
+
+from sii.utils.headers   import header_of
+from sii.utils.keyring   import Keyring
+from sii.utils.profiling import stage
+
+from . import metrics
+from .catalog import select_paths
+from .helpers import validate_schema
+from .pools   import process_pool
+from .outbox  import Outbox, STATUS_SENT, STATUS_FAILED, STATUS_SKIPPED, content_hash
+from .inbox   import Inbox, STATUS_FILED, STATUS_INVALID, STATUS_OTHER
+from .ingest  import STATUS_DUPLICATE, ingest
+from .replies import reply_files
+
+PIPELINE_DEPTH = 32
 
 _CSV_CACHE = {}
 _CSV_ROW   = collections.namedtuple('CsvRow', ['rut', 'rznsoc', 'url', 'mail', 'res', 'fchres'])
+Envelope   = collections.namedtuple('Envelope', ['path', 'payload', 'digest', 'encoding', 'recpt_rut', 'dte_rut', 'dte_type', 'dte_id'])
+
+_PIPELINE_END = object()
 
 pth_expand = lambda pth: os.path.abspath(os.path.expanduser(pth))
 
@@ -66,6 +112,8 @@ def handle(config, argv):
 
     if args['email']:
         handle_email(args, config)
+    elif args['ingest']:
+        handle_ingest(args, config)
     else:
         raise RuntimeError("Conditional Fallthrough")
 
@@ -80,70 +128,258 @@ def handle_email(args, config):
     sendr_addr = args['--from']
     recpt_bcc  = args['--bcc'] if args['--bcc'] else None
 
-    for fp in args['<enviodte>']:
+    if args['--select']:
+        enviodtes = select_paths(args['--catalog'], args['--select'])
+    else:
+        enviodtes = args['<enviodte>']
+
+    for fp in enviodtes:
         assert os.path.isfile(fp), "Could not find specified file: {0}".format(fp)
 
-        recpt_rut  = None
-        recpt_addr = None
+    if args['--to-ws']:
+        raise SystemExit("Querying WS for receiver email is not supported ...yet")
+
+    # read message header/body to go before attachment (once for all envelopes)
+    message = None
+
+    if args['--preamble']:
+        fpath = pth_expand(args['--preamble'])
+
+        if not os.path.isfile(fpath):
+            raise SystemExit("Could not read message from provided file: '{0}'".format(fpath))
+
+        with open(fpath, 'r') as fh:
+            message = fh.read()
+
+    if args['--message']:
+        message = args['--message']
+
+    xsd_path = pth_expand(args['--xsd']) if args['--xsd'] else None
+    workers  = int(args['--workers']) or None
+
+    server = None
+    outbox = Outbox(args['--outbox'])
+    try:
+        for envelope in _prepare_pipeline(enviodtes, xsd_path, workers):
+            fp      = envelope.path
+            started = time.perf_counter()
+
+            # resolve recipient email
+            if args['--to']:
+                recpt_addr = args['--to']
+            elif args['--to-csv']:
+                try:
+                    recpt      = _resolve_csv(envelope.recpt_rut, pth_expand(args['--to-csv']))
+                    recpt_addr = recpt.mail
+                except AssertionError as exc:
+                    metrics.document('email', error='NoRecipient')
+
+                    if args['--batch']:
+                        outbox.record(envelope.digest, None, STATUS_SKIPPED, path=fp, error=str(exc))
+                        print(output.cyan("SKIPPED") + " {0} - {1}".format(fp, str(exc)), file=sys.stderr)
+                        continue
+                    else:
+                        outbox.record(envelope.digest, None, STATUS_FAILED, path=fp, error=str(exc))
+                        raise
+            else:
+                raise RuntimeError("Conditional Fallthrough")
+
+            if not args['--resend'] and outbox.is_sent(envelope.digest, recpt_addr):
+                print(output.cyan("DONE   ") + " {0} - Already sent to: {1}".format(fp, recpt_addr), file=sys.stderr)
+                continue
+
+            # build email
+            msg = _create_mail(
+                sender    = sendr_addr,
+                recipient = recpt_addr,
+                bcc       = recpt_bcc,
+                subject   = _build_subject(envelope),
+                message   = message
+            )
+
+            _attach_xml(msg=msg, envelope=envelope)
 
-        # load xml
-        enviodte = xml.read_xml(fp)
-        tree     = xml.dump_etree(enviodte)
+            try:
+                if server is None:
+                    server = _connect_mail(user=mail_user, passwd=mail_passwd, host=mail_host, port=mail_port, tls=mail_tls)
+
+                with stage('network'):
+                    server.send_message(msg)
+            except Exception as exc:
+                metrics.document('email', time.perf_counter() - started, error=exc)
+                outbox.record(envelope.digest, recpt_addr, STATUS_FAILED, path=fp, error=str(exc))
+                raise
 
-        # validate schema
-        valid.validate_schema(tree)
+            outbox.record(envelope.digest, recpt_addr, STATUS_SENT, path=fp)
+            metrics.document('email', time.perf_counter() - started)
 
-        # extract recipient information
-        assert enviodte.__name__.endswith('EnvioDTE'), "Currently only <EnvioDTE> XML's supported!"
-        recpt_rut = str(enviodte.SetDTE.Caratula.RutReceptor)
+            out_bcc = "Bcc: {0}".format(recpt_bcc) if recpt_bcc else ""
+            print(output.green("SENT   ") + " {0} - From: {1} To: {2} {3}".format(fp, sendr_addr, recpt_addr, out_bcc), file=sys.stderr)
+    finally:
+        outbox.close()
 
-        # resolve recipient email
-        if args['--to']:
-            recpt_addr = args['--to']
-        elif args['--to-csv']:
+        if server is not None:
             try:
-                recpt      = _resolve_csv(recpt_rut, pth_expand(args['--to-csv']))
-                recpt_addr = recpt.mail
-            except AssertionError as exc:
-                if args['--batch']:
-                    print(output.cyan("SKIPPED") + " {0} - {1}".format(fp, str(exc)), file=sys.stderr)
-                    continue
+                server.quit()
+            except smtplib.SMTPException:
+                server.close()
+
+
+def handle_ingest(args, config):
+    xsd_path = pth_expand(args['--xsd']) if args['--xsd'] else None
+    workers  = int(args['--workers']) or None
+    dest     = pth_expand(args['<dest>'])
+    counts   = collections.Counter()
+
+    inbox = Inbox(args['--inbox'])
+    try:
+        try:
+            filings = ingest(inbox, args['<mailbox>'], dest, xsd_path, workers)
+
+            for filed in filings:
+                counts[filed.status] += 1
+                metrics.document('ingest', error=filed.error.partition(':')[0] if filed.error else None)
+
+                if filed.status == STATUS_DUPLICATE:
+                    print(output.cyan("DUPLICATE") + " {0} ({1})".format(filed.name, filed.msgid), file=sys.stderr)
+                elif filed.status == STATUS_INVALID:
+                    print(output.red("INVALID  ") + " {0} - {1}".format(filed.path, filed.error), file=sys.stderr)
                 else:
-                    raise
-        elif args['--to-ws']:
-            raise SystemExit("Querying WS for receiver email is not supported ...yet")
-        else:
-            raise RuntimeError("Conditional Fallthrough")
+                    print(output.green(filed.status.ljust(9)) + " {0}".format(filed.path), file=sys.stderr)
+        except ValueError as exc:
+            raise SystemExit(str(exc))
+
+        if args['--ack-queue']:
+            counts['ACKED'] = _queue_acks(inbox, pth_expand(args['--ack-queue']), dest, config, workers)
+    finally:
+        inbox.close()
 
-        # read message header/body to go before attachment
-        message = None
+    print(", ".join("{0}: {1}".format(status.title(), counts[status]) for status in (
+        STATUS_FILED, STATUS_OTHER, STATUS_INVALID, STATUS_DUPLICATE, 'ACKED'
+    )), file=sys.stderr)
 
-        if args['--preamble']:
-            fpath = pth_expand(args['--preamble'])
 
-            if not os.path.isfile(fpath):
-                raise SystemExit("Could not read message from provided file: '{0}'".format(fpath))
+def _queue_acks(inbox, ack_dir, dest, config, workers):
+    """ Signed <RespuestaDTE>'s of the filed envelopes not acknowledged yet, below `ack_dir` as they are
+    filed below `dest`. The inbox remembers the acknowledged ones.
+    """
+    unacked = inbox.unacked()
+    if not unacked:
+        return 0
 
-            with open(fpath, 'r') as fh:
-                message = fh.read()
+    acked   = 0
+    keyring = Keyring.from_config(config)
+    replies = reply_files([path for _, path in unacked], ['ack'], ack_dir, keyring, workers, root=dest)
 
-        if args['--message']:
-            message = args['--message']
+    for (digest, _), replied in zip(unacked, replies):
+        if replied.error:
+            print(output.red("NO ACK   ") + " {0} - {1}".format(replied.path, replied.error), file=sys.stderr)
+            continue
 
-        # build email
-        msg = _create_mail(
-            sender    = sendr_addr,
-            recipient = recpt_addr,
-            bcc       = recpt_bcc,
-            subject   = _build_subject(enviodte),
-            message   = message
-        )
+        inbox.record_ack(digest, replied.outputs[0])
+        acked += 1
 
-        _attach_xml(msg=msg, enviodte=enviodte)
-        _send_mail(msg=msg, user=mail_user, passwd=mail_passwd, host=mail_host, port=mail_port, tls=mail_tls)
+    return acked
 
-        out_bcc = "Bcc: {0}".format(recpt_bcc) if recpt_bcc else ""
-        print(output.green("SENT   ") + " {0} - From: {1} To: {2} {3}".format(fp, sendr_addr, recpt_addr, out_bcc), file=sys.stderr)
+
+def _prepare_pipeline(paths, xsd_path=None, workers=None, depth=PIPELINE_DEPTH):
+    """ Parses and validates the envelopes in a process pool, yielding them (in order) to the sending stage.
+
+    At most `depth` envelopes are in flight or waiting to be sent. A failure preparing an envelope is
+    raised when the sender reaches it, so everything before it still goes out.
+    """
+    ready = queue.Queue(maxsize=depth)
+    stop  = threading.Event()
+
+    def deliver(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce():
+        try:
+            with process_pool(workers, len(paths)) as executor:
+                inflight = collections.deque()
+                pending  = iter(paths)
+
+                for fpath in itertools.islice(pending, depth):
+                    inflight.append(executor.submit(_prepare_envelope, fpath, xsd_path))
+
+                while inflight and not stop.is_set():
+                    future = inflight.popleft()
+
+                    try:
+                        item = future.result()
+                    except Exception as exc:
+                        item = exc
+
+                    for fpath in itertools.islice(pending, 1):
+                        inflight.append(executor.submit(_prepare_envelope, fpath, xsd_path))
+
+                    deliver(item)
+
+                for future in inflight:
+                    future.cancel()
+        except Exception as exc:
+            deliver(exc)
+        finally:
+            deliver(_PIPELINE_END)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item = ready.get()
+            metrics.queue_depth('email', ready.qsize())
+
+            if item is _PIPELINE_END:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            yield item
+    finally:
+        stop.set()
+
+        # unblock the producer should it be waiting on a full queue
+        while producer.is_alive():
+            try:
+                ready.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def _prepare_envelope(fpath, xsd_path=None):
+    with open(fpath, 'rb') as fh:
+        payload = fh.read()
+
+    # lxml errors do not survive the trip back from the worker process, hand over their message instead
+    try:
+        root = etree.fromstring(payload)
+        validate_schema(root, xsd_path)
+    except etree.Error as exc:
+        raise ValueError("{0}: {1}".format(fpath, str(exc)))
+
+    # extract recipient and first document information (single pass over the header)
+    header = header_of(root, fpath)
+
+    assert header.kind == 'EnvioDTE', "Currently only <EnvioDTE> XML's supported!"
+    assert header.envio_recpt, "Could not find <RutReceptor> in: {0}".format(fpath)
+
+    return Envelope(
+        path      = fpath,
+        payload   = payload,
+        digest    = content_hash(payload),
+        encoding  = root.getroottree().docinfo.encoding or 'UTF-8',
+        recpt_rut = header.envio_recpt,
+        dte_rut   = header.rut_number,
+        dte_type  = header.dte_type,
+        dte_id    = header.folio
+    )
 
 
 def _resolve_csv(rut, csv_path):
@@ -199,46 +435,38 @@ def _create_mail(sender, recipient, bcc, subject, message):
     return msg
 
 
-def _attach_xml(msg, enviodte):
+def _attach_xml(msg, envelope):
     assert isinstance(msg, MIMEMultipart), "Programming Error!"
-    assert isinstance(enviodte, xml.XML),  "Programming Error!"
-
-    pthname = _build_pathname(enviodte)
-    payload = xml.dump_xml(enviodte, pretty_print=True, encoding='ISO-8859-1', xml_declaration=True)
+    assert isinstance(envelope, Envelope),"Programming Error!"
 
-    txt = MIMEText(payload, "xml", "ISO-8859-1")
-    txt['Content-Disposition'] = 'attachment; filename="{0}"'.format(pthname)
+    # attach the file as read, no re-serialization
+    att = MIMEBase("text", "xml", charset=envelope.encoding)
+    att.set_payload(envelope.payload)
+    encoders.encode_base64(att)
+    att['Content-Disposition'] = 'attachment; filename="{0}"'.format(_build_pathname(envelope))
 
-    msg.attach(txt)
-
-
-def _send_mail(msg, user, passwd, host, port=587, tls=True):
-    assert isinstance(msg, MIMEMultipart), "Programming Error!"
+    msg.attach(att)
 
-    server = smtplib.SMTP()
-    server.connect(host=host, port=port)
 
-    if tls:
-        server.starttls()
+def _connect_mail(user, passwd, host, port=587, tls=True):
+    with stage('network'):
+        server = smtplib.SMTP()
+        server.connect(host=host, port=port)
 
-    server.login(user=user, password=passwd)
-    server.send_message(msg)
+        if tls:
+            server.starttls()
 
+        server.login(user=user, password=passwd)
 
-def _build_subject(enviodte):
-    dte_rut    = str(enviodte.SetDTE.DTE.Documento.Encabezado.Emisor.RUTEmisor).split('-')[0]
-    dte_type   = int(enviodte.SetDTE.DTE.Documento.Encabezado.IdDoc.TipoDTE)
-    dte_serial = int(enviodte.SetDTE.DTE.Documento.Encabezado.IdDoc.Folio)
+    return server
 
-    return "EnvioDTE {0}-{1}-{2}".format(dte_rut, dte_type, dte_serial)
 
+def _build_subject(envelope):
+    return "EnvioDTE {0}-{1}-{2}".format(envelope.dte_rut, envelope.dte_type, envelope.dte_id)
 
-def _build_pathname(enviodte):
-    dte_rut    = str(enviodte.SetDTE.DTE.Documento.Encabezado.Emisor.RUTEmisor).split('-')[0]
-    dte_type   = int(enviodte.SetDTE.DTE.Documento.Encabezado.IdDoc.TipoDTE)
-    dte_serial = int(enviodte.SetDTE.DTE.Documento.Encabezado.IdDoc.Folio)
 
-    return "{0}_{1}_{2}.xml".format(dte_rut, dte_type, dte_serial)
+def _build_pathname(envelope):
+    return "{0}_{1}_{2}.xml".format(envelope.dte_rut, envelope.dte_type, envelope.dte_id)
 
 
 # def _extract_dte(enviodte):
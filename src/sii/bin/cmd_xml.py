@@ -1,51 +1,135 @@
 """
 Usage:
     sii xml [options] read              <infile>...
-    sii xml [options] bundle dte        [--inplace | --suffixed] <infile>...
+    sii xml [options] bundle dte        [--inplace | --suffixed] [--workers=<n>] <infile>...
     sii xml [options] bundle enviodte   (--sii | --exchange) <outfile> <infile>...
     sii xml [options] bundle lv         <outfile> <infile>...
-    sii xml [options] unbundle enviodte [--inplace] [--generate] <envio>
+    sii xml [options] bundle lv         --select=<query> <outfile>
+    sii xml [options] unbundle enviodte [--inplace] [--generate [--archive=<file>]] <envio>
+    sii xml [options] extract           [--count] <envio> [<index>...]
     sii xml [options] gen doc ack       <infile> <outfile>
     sii xml [options] gen doc ok        <infile> <outfile>
     sii xml [options] gen merch ack     <infile> <outfile>
-    sii xml [options] sign              [--all] [--inplace | --suffixed | <outfile>] <infile>...
+    sii xml [options] gen replies       [--only=<kinds>] [--unsigned] [--workers=<n>] <outdir> <infile>...
+    sii xml [options] sign              [--all | --incremental] [--inplace | --suffixed | <outfile>] <infile>...
     sii xml [options] verify signature  <infile>...
     sii xml [options] verify schema     [--xsd=<file>] <infile>...
+    sii xml [options] verify caf        [--workers=<n>] <infile>...
+    sii xml [options] verify all        [--xsd=<file>] [--workers=<n>] <infile>...
     sii xml [options] void doc          <outfile> <infile>...
+    sii xml [options] folios            seed <path>...
+    sii xml [options] folios            [<rut>]
+    sii xml [options] libro add         <infile>...
+    sii xml [options] libro add         --select=<query>
+    sii xml [options] libro write       [--sender=<rut>] <rut> <period> <fch-resol> <nro-resol> <outfile>
+    sii xml [options] libro status      [<rut>]
+    sii xml [options] archive           <archive> <infile>...
+    sii xml [options] archive           <archive> --select=<query>
 
 Options:
     --inplace   # Will modify the same file it read with the processed output.
     --suffixed  # Will create a file right beside with an aditional extension suffix denoting the
                 # state it is in.
 
-    --key <file>   # Key (PEM) file to sign the document with (overrides config file).
-    --cert <file>  # Cert (PEM) file to sign the document with (overrides config file).
+    --key <file>   # Key (PEM) file to sign the document with (overrides config file, keyring included).
+    --cert <file>  # Cert (PEM) file to sign the document with (overrides config file, keyring included).
 
-    --all  # Signs all signodes in the document. Otherwise only the topmost will be signed.
+    --all          # Signs all signodes in the document. Otherwise only the topmost will be signed.
+    --incremental  # Like --all, but only (re)signs the signodes whose digests or signature no longer hold
+                   # (or are not by this key), and those enclosing them. Appending DTE's to a signed
+                   # <EnvioDTE> only signs those and the envelope.
 
     --xsd <file>  # XSD Schema definition file to check it against.
 
+    --workers <n>  # Processes to spread files over (verifying, bundling DTE's, replying), 0 for one per CPU. [default: 0]
+
+    --only <kinds>  # Comma separated replies to generate: ack (envelope received), ok (contents approved) and
+                    # merch (merchandise received). [default: ack,ok,merch]
+    --unsigned      # Leave the replies unsigned.
+
+    --ledger <db>  # Folio ledger, updated when bundling DTE's and voiding. [default: ~/.local/share/sii/folios.db]
+
+    --select <query>  # Take the input documents from the catalog (see `sii index`) instead of arguments.
+    --catalog <db>    # Catalog to --select from. [default: ~/.local/share/sii/catalog.db]
+
+    --libros <db>   # Per period state of the incremental libros. [default: ~/.local/share/sii/libros.db]
+    --sender <rut>  # RUT sending the libro (<RutEnvia>), the emitter's if not given.
+
+    --archive <file>  # Archive (*.xmlz) the DTE's unbundled with --generate go into, instead of files named
+                      # after them.
+
 Commands:
-    read  # Reads files and condenses them to lines delimited by newline. Useful to feed via stdin.
+    read  # Reads files and condenses them to lines delimited by newline. Useful to feed via stdin. An
+          # archive streams all its documents.
+
+    extract  # Prints the <DTE>'s of an envelope (or <Detalle>'s of a libro) at the given 0-based positions
+             # (all if none given), or just how many there are with --count. Only the requested ones are
+             # parsed, the file is memory mapped.
+
+    verify caf  # Checks folios and TED stamps against the CAFs, and for duplicate folios across all given
+                # files.
+    verify all  # Checks schema, signatures and CAF parsing each file once. One summary line per file, exit
+                # code is 0 when all are good, otherwise the OR of 1 (schema), 2 (signature), 4 (CAF) and 8
+                # (unreadable) over all files.
+
+    gen replies  # Generates the replies to received envelopes, each parsed once for all of them, and signs
+                 # them with a key read once. Written to <outdir> as <envelope name>.<kind>.xml, their paths
+                 # are printed.
+
+    void doc  # Writes a credit note (unbundled) voiding each given document, folios are taken from the
+              # ledger. With more than one document <outfile> has to be a directory.
+    folios    # Reports used, voided and free folios per CAF from the ledger.
+
+    folios seed  # Records the documents already issued (files, directories of *.xml, archives) in the ledger
+                 # and marks it as complete for the RUT's and types of the CAFs, voiding refuses to take
+                 # folios it was not seeded for. Run once before the first void, or after issuing elsewhere.
+
+    libro add     # Adds issued DTE's to the Libro de Ventas of their period (by <FchEmis>), keeping its
+                  # running totals. Files added before are skipped unless they changed since, documents
+                  # added again (same emitter, type and folio) replace their previous row.
+    libro write   # Writes the <LibroCompraVenta> of <period> (YYYY-MM) in a single pass over its rows, no DTE
+                  # is read. <fch-resol> and <nro-resol> are those of the emitter's resolution, the libro is
+                  # left unsigned (see `sign`).
+    libro status  # Documents and running totals per period and type.
+
+    archive  # Moves documents into an archive (kept byte for byte, keyed by their header), the files are
+             # left as they are. Reports how many documents it holds and their compressed size.
 
 Notes:
     * There are currently no safeguards in place to avoid overwriting a file with nothing (emptying
       it) when something goes wrong and option --inplace is active. TODO.
+
+    * Documents (and replies) are signed with the key and cert of their emitter's (replier's) RUT under
+      auth.keyring in the config when it is there, otherwise with auth.key and auth.cert. Each RUT's
+      files are read once per run, so a batch may mix emitters.
+
+    * Wherever a file is read or written, a document in an archive can be given as
+      <archive>.xmlz#<RUT>/<TipoDTE>/<Folio> (/<kind> appended for envelopes). See `archive`.
 """
 import os
 import sys
+import time
 import tempfile
 
 import docopt
 from lxml import etree
 
-from sii.lib     import schemas, signature
-from sii.lib     import exchange
-from sii.lib     import validation as validate
-from sii.lib     import types
-from sii.lib.lib import xml
+from sii.lib             import exchange
+from sii.utils           import api
+from sii.utils.keyring   import Keyring
+from sii.utils.lazyxml   import LazyDocument
+from sii.utils.profiling import stage
 
-from .helpers import print_xml, read_xml, read_xmls, condense_xml, stack_extension, write_xml
+from . import archive
+from . import cmd_folios
+from . import cmd_libros
+from . import stamping
+from . import cmd_verify
+from . import metrics
+from .catalog import select_paths
+from .folios  import FolioLedger
+from .helpers import print_xml, read_bytes, read_xml, read_xmls, condense_xml, stack_extension, write_xml
+from .replies import REPLIES, reply_files
 
 
 def handle(config, argv):
@@ -57,6 +141,8 @@ def handle(config, argv):
         handle_bundling(args, config)
     elif args['unbundle']:
         handle_unbundling(args, config)
+    elif args['extract']:
+        handle_extract(args, config)
     elif args['gen']:
         handle_generate(args, config)
     elif args['sign']:
@@ -65,21 +151,29 @@ def handle(config, argv):
         handle_verify(args, config)
     elif args['void']:
         handle_void(args, config)
+    elif args['folios']:
+        if args['seed']:
+            cmd_folios.handle_seed(args, config)
+        else:
+            cmd_folios.handle_report(args, config)
+    elif args['libro']:
+        handle_libro(args, config)
+    elif args['archive']:
+        handle_archive(args, config)
     else:
         raise RuntimeError("Conditional Fallthrough")
 
 
 def handle_reading(args, config):
-    for fname in args['<infile>']:
-        with open(fname, 'rb') as fh:
-            raw   = fh.read()
-            clean = condense_xml(raw)
+    for fname in archive.expand_paths(args['<infile>']):
+        raw   = read_bytes(fname)
+        clean = condense_xml(raw)
 
-            try:
-                sys.stdout.buffer.write(clean + b"\n")
-                sys.stdout.buffer.flush()
-            except:
-                pass
+        try:
+            sys.stdout.buffer.write(clean + b"\n")
+            sys.stdout.buffer.flush()
+        except:
+            pass
 
 
 def handle_bundling(args, config):
@@ -94,27 +188,34 @@ def handle_bundling(args, config):
 
 
 def handle_bundling_dte(args, config):
-    for xml_fpath in args['<infile>']:
-        try:
-            xml = read_xml(xml_fpath)
-        except etree.XMLSyntaxError:
-            print("Skipping invalid XML: {0}".format(xml_fpath), file=sys.stderr)
+    if args['--inplace']:
+        mode = stamping.MODE_INPLACE
+    elif args['--suffixed']:
+        mode = stamping.MODE_SUFFIXED
+    else:
+        mode = stamping.MODE_PRINT
+
+    ledger  = FolioLedger(args['--ledger'])
+    workers = int(args['--workers']) or None
+
+    for done, stamped in enumerate(stamping.stamp_files(args['<infile>'], config.static.cafs, mode, workers), 1):
+        metrics.document('bundle', stamped.seconds, error='InvalidXML' if stamped.error else None)
+        metrics.queue_depth('bundle', len(args['<infile>']) - done)
+
+        if stamped.error:
+            print("Skipping invalid XML: {0}".format(stamped.path), file=sys.stderr)
             continue
 
-        caf_pool = types.CAFPool(config.static.cafs)
-        dte      = schemas.bundle_dte(xml, caf_pool)
+        if stamped.output:
+            sys.stdout.buffer.write(stamped.output)
 
-        if args['--inplace']:
-            write_xml(dte, xml_fpath, encoding='ISO-8859-1')
-        elif args['--suffixed']:
-            write_xml(dte, stack_extension(xml_fpath, 'dte'), encoding='ISO-8859-1')
-        else:
-            print_xml(dte)
+        ledger.record_used(*stamped.key, path=stamped.sink)
+
+    ledger.close()
 
 
 def handle_bundling_enviodte(args, config):
-    dte_lst      = list(read_xmls(args['<infile>']))
-    company_pool = types.CompanyPool.from_file(config.static.companies)
+    dte_lst = read_xmls(args['<infile>'])
 
     to_sii = None
     if args['--sii']:
@@ -124,7 +225,7 @@ def handle_bundling_enviodte(args, config):
 
     assert to_sii is not None, "Must provide --sii or --exchange for enviodte bundling!"
 
-    enviodte = schemas.bundle_enviodte(dte_lst, company_pool, to_sii=to_sii)
+    enviodte = api.bundle_enviodte(dte_lst, config.static.companies, to_sii=to_sii)
 
     if args['<outfile>']:
         write_xml(enviodte, args['<outfile>'], encoding='ISO-8859-1')
@@ -133,8 +234,8 @@ def handle_bundling_enviodte(args, config):
 
 
 def handle_bundling_lv(args, config):
-    dte_lst  = list(read_xmls(args['<infile>']))
-    enviodte = schemas.bundle_libro_ventas(dte_lst)
+    paths    = select_paths(args['--catalog'], args['--select']) if args['--select'] else args['<infile>']
+    enviodte = api.bundle_libro_ventas(read_xmls(paths))
 
     if args['<outfile>']:
         write_xml(enviodte, args['<outfile>'], encoding='ISO-8859-1')
@@ -142,6 +243,39 @@ def handle_bundling_lv(args, config):
         print_xml(enviodte)
 
 
+def handle_libro(args, config):
+    if args['add']:
+        cmd_libros.handle_add(args, config)
+    elif args['write']:
+        cmd_libros.handle_write(args, config)
+    elif args['status']:
+        cmd_libros.handle_status(args, config)
+    else:
+        raise RuntimeError("Conditional Fallthrough")
+
+
+def handle_archive(args, config):
+    if not archive.is_archive(args['<archive>']):
+        raise SystemExit("Archives are *{0} files: {1}".format(archive.ARCHIVE_EXT, args['<archive>']))
+
+    paths = select_paths(args['--catalog'], args['--select']) if args['--select'] else args['<infile>']
+    store = archive.open_archive(args['<archive>'], writable=True)
+    count = len(store)
+
+    for fpath in paths:
+        try:
+            store.add(read_bytes(fpath))
+        except (OSError, ValueError, etree.XMLSyntaxError) as exc:
+            print("Skipping: {0} ({1})".format(fpath, str(exc)), file=sys.stderr)
+
+    summary = store.summary()
+    store.close()
+
+    print("{0}: {1} documents ({2} new), {3} bytes stored for {4}".format(
+        args['<archive>'], summary.documents, summary.documents - count, summary.stored, summary.size
+    ), file=sys.stderr)
+
+
 def handle_unbundling(args, config):
     if args['enviodte']:
         handle_unbundling_enviodte(args, config)
@@ -150,31 +284,50 @@ def handle_unbundling(args, config):
 
 
 def handle_unbundling_enviodte(args, config):
-    enviodte = read_xml(args['<envio>'])
-    tree_lst = schemas.unbundle_enviodte(enviodte)
+    tree_lst = api.unbundle_enviodte(read_xml(args['<envio>']))
 
     if len(tree_lst) > 1 and args['--inplace']:
         raise SystemExit("<EnvioDTE> contains more than one <DTE>. Cannot unbundle --inplace.")
 
     for tree in tree_lst:
         if args['--generate']:
-            dte = xml.wrap_xml(tree)
-
-            dte_rut  = str(dte.Documento.Encabezado.Emisor.RUTEmisor).split('-')[0]
-            dte_type = int(dte.Documento.Encabezado.IdDoc.TipoDTE)
-            dte_id   = int(dte.Documento.Encabezado.IdDoc.Folio)
-
-            ftempl = "{company}_{type}_{id}.xml"
-            fname  = ftempl.format(company=dte_rut, type=dte_type, id=dte_id)
-
-            write_xml(tree, fname, encoding='ISO-8859-1')
+            write_xml(tree, args['--archive'] or api.document_name(tree), encoding='ISO-8859-1')
         elif args['--inplace']:
             write_xml(tree, args['<envio>'], encoding='ISO-8859-1')
         else:
             print_xml(tree)
 
 
+def handle_extract(args, config):
+    try:
+        document = LazyDocument(args['<envio>'])
+    except ValueError as exc:
+        raise SystemExit(str(exc))
+
+    with document:
+        if args['--count']:
+            print(len(document))
+            return
+
+        if not args['<index>']:
+            for item in document:
+                print_xml(item)
+            return
+
+        for idx in (int(idx) for idx in args['<index>']):
+            try:
+                item = document[idx]
+            except IndexError:
+                raise SystemExit("No item at position {0}, there are {1}.".format(idx, len(document)))
+
+            print_xml(item)
+
+
 def handle_generate(args, config):
+    if args['replies']:
+        handle_generate_replies(args, config)
+        return
+
     xml = read_xml(args['<infile>'][0])
 
     reply_xml = None
@@ -193,6 +346,37 @@ def handle_generate(args, config):
         write_xml(reply_xml, args['<outfile>'])
 
 
+def handle_generate_replies(args, config):
+    kinds = [kind.strip() for kind in args['--only'].split(',') if kind.strip()]
+    for kind in kinds:
+        if kind not in REPLIES:
+            raise SystemExit("Unknown reply: {0} (expected one of {1})".format(kind, ", ".join(REPLIES)))
+
+    keyring = None
+    if not args['--unsigned']:
+        keyring = Keyring.from_config(config, key=args['--key'], cert=args['--cert'])
+
+    os.makedirs(args['<outdir>'], exist_ok=True)
+
+    infiles = args['<infile>']
+    workers = int(args['--workers']) or None
+    failed  = 0
+
+    for done, replied in enumerate(reply_files(infiles, kinds, args['<outdir>'], keyring, workers), 1):
+        metrics.document('reply', replied.seconds, error=replied.error.partition(':')[0] if replied.error else None)
+        metrics.queue_depth('reply', len(infiles) - done)
+
+        if replied.error:
+            failed += 1
+            print("Failed replying to: {0} ({1})".format(replied.path, replied.error), file=sys.stderr)
+
+        for fpath in replied.outputs:
+            print(fpath)
+
+    if failed:
+        raise SystemExit("Failed replying to {0} of {1} envelopes.".format(failed, len(infiles)))
+
+
 def handle_sign(args, config):
     infiles = []
     for path in args['<infile>']:
@@ -201,23 +385,38 @@ def handle_sign(args, config):
         else:
             print("Skipping: {0}".format(path), file=sys.stderr)
 
+    keyring = Keyring.from_config(config, key=args['--key'], cert=args['--cert'])
+
+    mode = api.SIGN_TOP
+    if args['--all']:
+        mode = api.SIGN_ALL
+    elif args['--incremental']:
+        mode = api.SIGN_INCREMENTAL
+
     for xml_fpath in infiles:
+        started = time.perf_counter()
+
         try:
             doc_xml = read_xml(xml_fpath)
         except etree.XMLSyntaxError:
+            metrics.document('sign', error='InvalidXML')
             print("Skipping invalid XML: {0}".format(xml_fpath), file=sys.stderr)
             continue
 
-        key_path  = os.path.abspath(os.path.expanduser(config.auth.key))
-        cert_path = os.path.abspath(os.path.expanduser(config.auth.cert))
+        # Key and certificate of the emitter (read once per run, kept for api.sign)
+        try:
+            keyring.signer_of(doc_xml)
+        except KeyError as exc:
+            metrics.document('sign', error='NoKey')
+            print("Skipping: {0} ({1})".format(xml_fpath, exc.args[0]), file=sys.stderr)
+            continue
 
         # Sign the <ds:Signature>
-        sigfunc    = signature.sign_document_all if args['--all'] else signature.sign_document
-        xml_signed = sigfunc(
-            xml       = doc_xml,
-            key_path  = key_path,   #  key_fh.name,
-            cert_path = cert_path   #  cert_fh.name
-        )
+        try:
+            xml_signed = api.sign(doc_xml, keyring, mode)
+        except Exception as exc:
+            metrics.document('sign', time.perf_counter() - started, error=exc)
+            raise
 
         if args['--inplace']:
             write_xml(xml_signed, xml_fpath, encoding='ISO-8859-1')
@@ -229,12 +428,18 @@ def handle_sign(args, config):
         else:
             print_xml(xml_signed)
 
+        metrics.document('sign', time.perf_counter() - started)
+
 
 def handle_verify(args, config):
+    if args['all']:
+        cmd_verify.validate_all(args, config)
     if args['signature']:
         validate_signature(args, config)
     if args['schema']:
         validate_schema(args, config)
+    if args['caf']:
+        cmd_verify.validate_caf(args, config)
 
 
 def validate_signature(args, config):
@@ -246,28 +451,23 @@ def validate_signature(args, config):
             False: "Bad Signature."
         }
 
-        results = validate.validate_signatures(xml)
+        with stage('verify'):
+            results = api.verify_signatures(xml)
+
         for uri, validity in results:
             print("{0}: {1}: {2}".format(xml_fpath, uri, outcomes[validity]))
 
 
 def validate_schema(args, config):
-    xml_schema = None
-    if args['--xsd']:
-        with open(args['--xsd'], 'rb') as fh:
-            xml_schema = etree.parse(fh)
-
     for xml_fpath in args['<infile>']:
-        xml      = read_xml(xml_fpath)
+        problem  = api.verify_schema(read_xml(xml_fpath), args['--xsd'])
         path_str = xml_fpath + ":"
 
-        try:
-            validate.validate_schema(xml, xml_schema)
-        except etree.DocumentInvalid as exc:
-            print(path_str, "Bad Schema. " + str(exc))
+        if problem is not None:
+            print(path_str, "Bad Schema. " + problem)
         else:
             print(path_str, "Good Schema.")
 
 
 def handle_void(args, config):
-    raise NotImplementedError("You need to have reliable info on available doc ids... thus implementation defered")
+    cmd_folios.handle_void(args, config)
@@ -1,14 +1,31 @@
 """ Configuration File (see files/cfg_utils.yml in repository)
 """
 import io
+import os
+import json
+import hashlib
+import tempfile
 
-import yaml
 from sii.lib.lib import fileio
 
 __all__ = [
     'Configuration'
 ]
 
+# Sections and the parameters each of them must declare (values may still be empty), checked up front
+SCHEMA = {
+    'auth':   ('key', 'cert'),
+    'static': ('cafs', 'companies')
+}
+
+# Sections only some commands use, checked when one of them first reads it
+LAZY_SCHEMA = {
+    'mail': ('host', 'port', 'user', 'passwd')
+}
+
+SNAPSHOT_DIR     = '~/.cache/sii'
+SNAPSHOT_VERSION = 2
+
 
 class Configuration:
 
@@ -16,14 +33,28 @@ class Configuration:
         self._cfg_path  = cfg_path
         self._cfg_templ = cfg_templ
 
-        buff = io.StringIO(fileio.read_create(cfg_path, cfg_templ))
-        yml  = yaml.load(buff)
+        yml = _load(cfg_path, cfg_templ)
 
+        self._lazy = {}
         for section, data in yml.items():
             name = str(section)
-            self.__dict__[name] = Section(name, data)
+
+            if name in LAZY_SCHEMA:
+                self._lazy[name] = data
+            else:
+                self.__dict__[name] = Section(name, data or {})
 
     def __getattr__(self, key):
+        lazy = self.__dict__.get('_lazy', {})
+
+        if key in lazy:
+            problems = _section_problems(key, lazy[key], LAZY_SCHEMA[key])
+            if problems:
+                raise ValueError("Config file <{0}> is invalid: {1}".format(self._cfg_path, "; ".join(problems)))
+
+            self.__dict__[key] = Section(key, lazy.pop(key) or {})
+            return self.__dict__[key]
+
         if key not in self.__dict__:
             raise KeyError("Config expected and could not find section: <{0}>".format(key))
         else:
@@ -50,4 +81,118 @@ class Section:
             if value is None:
                 raise ValueError("Config section <{0}> parameter <{1}> unexpected a value!".format(self._name, key))
 
-            return value
\ No newline at end of file
+            return value
+
+
+def _load(cfg_path, cfg_templ):
+    """ Parsed and validated config, from the snapshot of a previous run if the file did not change since. """
+    fpath = os.path.abspath(os.path.expanduser(cfg_path))
+
+    try:
+        stat = os.stat(fpath)
+    except OSError:
+        stat = None
+
+    snap_path = os.path.join(
+        os.path.expanduser(SNAPSHOT_DIR),
+        "cfg_{0}.json".format(hashlib.sha1(fpath.encode('UTF-8')).hexdigest())
+    )
+
+    if stat is not None:
+        snap_key = [SNAPSHOT_VERSION, fpath, stat.st_mtime_ns, stat.st_size]
+
+        try:
+            with open(snap_path, 'r', encoding='UTF-8') as fh:
+                key, yml = json.load(fh)
+
+            if key == snap_key:
+                return yml
+        except Exception:
+            pass  # no, stale or unreadable snapshot
+
+    yml = _parse(cfg_path, cfg_templ)
+    _validate(yml, fpath)
+
+    # stat again, the file could just have been created from the template
+    try:
+        stat = os.stat(fpath)
+        _dump_snapshot(snap_path, [SNAPSHOT_VERSION, fpath, stat.st_mtime_ns, stat.st_size], yml)
+    except OSError:
+        pass  # snapshots are an optimization only
+
+    return yml
+
+
+def _parse(cfg_path, cfg_templ):
+    import yaml  # only needed when there is no usable snapshot
+
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    buff   = io.StringIO(fileio.read_create(cfg_path, cfg_templ))
+
+    return yaml.load(buff, Loader=loader) or {}
+
+
+def _validate(yml, fpath):
+    """ Checks all sections and parameters at once, reporting every problem found. Those of `LAZY_SCHEMA`
+    are left to the commands reading them.
+    """
+    problems = []
+
+    if not isinstance(yml, dict):
+        raise ValueError("Config file <{0}> is expected to contain sections!".format(fpath))
+
+    for section, params in sorted(SCHEMA.items()):
+        if section not in yml:
+            problems.append("missing section <{0}>".format(section))
+        else:
+            problems.extend(_section_problems(section, yml[section], params))
+
+    # optional, RUT -> key and cert of its own (see keyring.py)
+    keyring = (yml.get('auth') or {}).get('keyring', None)
+    if keyring is not None and not isinstance(keyring, dict):
+        problems.append("section <auth> parameter <keyring> is expected to map RUT's to a key and cert")
+    for rut, entry in sorted((keyring or {}).items(), key=lambda item: str(item[0])):
+        if not isinstance(entry, dict) or not entry.get('key', None) or not entry.get('cert', None):
+            problems.append("section <auth> keyring entry <{0}> is expected to set a key and cert".format(rut))
+
+    if problems:
+        raise ValueError("Config file <{0}> is invalid: {1}".format(fpath, "; ".join(problems)))
+
+
+def _section_problems(section, data, params):
+    if data is None:
+        return []  # empty section, reported lazily if ever needed
+    if not isinstance(data, dict):
+        return ["section <{0}> is expected to contain parameters".format(section)]
+
+    problems = [
+        "section <{0}> is missing parameter <{1}>".format(section, param) for param in params if param not in data
+    ]
+
+    if section == 'mail' and data.get('port', None) is not None and not isinstance(data['port'], int):
+        problems.append("section <mail> parameter <port> is expected to be a number")
+
+    return problems
+
+
+def _dump_snapshot(snap_path, key, yml):
+    """ Only configs JSON keeps as they are (no dates, no non-string keys) are snapshotted. """
+    try:
+        buff = json.dumps([key, yml])
+    except (TypeError, ValueError):
+        return
+
+    if json.loads(buff)[1] != yml:
+        return
+
+    snap_dir = os.path.dirname(snap_path)
+    os.makedirs(snap_dir, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=snap_dir, prefix='.cfg_')
+    try:
+        with os.fdopen(fd, 'w', encoding='UTF-8') as fh:
+            fh.write(buff)
+
+        os.replace(tmp_path, snap_path)
+    except OSError:
+        os.unlink(tmp_path)
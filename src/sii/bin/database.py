@@ -0,0 +1,40 @@
+""" Local SQLite Databases (ledgers, checkpoints and indexes kept by the commands)
+"""
+import os
+import sqlite3
+
+__all__ = [
+    'Database'
+]
+
+
+class Database:
+    """ Connection to the database at `db_path` (its directory created if missing) in WAL mode, `schema`
+    applied. `synchronous` is the PRAGMA of that name (sqlite's FULL if None), `isolation_level` that of
+    sqlite3.connect (None for explicit transactions only). Subclasses may `_upgrade` the database before
+    the schema is applied.
+    """
+
+    def __init__(self, db_path, schema, synchronous=None, isolation_level=''):
+        self._db_path = os.path.abspath(os.path.expanduser(db_path))
+        os.makedirs(os.path.dirname(self._db_path), exist_ok=True)
+
+        self._conn = sqlite3.connect(self._db_path, isolation_level=isolation_level)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        if synchronous is not None:
+            self._conn.execute('PRAGMA synchronous={0}'.format(synchronous))
+
+        self._upgrade()
+        self._conn.executescript(schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def _upgrade(self):
+        pass
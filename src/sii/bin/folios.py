@@ -0,0 +1,215 @@
+""" Folio Ledger (local sqlite record of consumed and voided folios)
+"""
+import time
+import contextlib
+import collections
+
+from sii.utils.headers import header_of
+
+from .database import Database
+
+__all__ = [
+    'AlreadyVoidedError',
+    'FolioLedger',
+    'STATE_USED',
+    'STATE_VOIDED',
+    'document_key'
+]
+
+STATE_USED   = 'USED'
+STATE_VOIDED = 'VOIDED'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folios (
+    rut        TEXT    NOT NULL,
+    dte_type   INTEGER NOT NULL,
+    folio      INTEGER NOT NULL,
+    state      TEXT    NOT NULL,
+    path       TEXT,
+    voided_by  INTEGER,
+    updated    REAL    NOT NULL,
+    PRIMARY KEY (rut, dte_type, folio)
+);
+
+CREATE TABLE IF NOT EXISTS seeded (
+    rut       TEXT    NOT NULL,
+    dte_type  INTEGER NOT NULL,
+    seeded    REAL    NOT NULL,
+    PRIMARY KEY (rut, dte_type)
+);
+"""
+
+Usage = collections.namedtuple('Usage', ['caf', 'used', 'voided', 'free'])
+
+
+class AlreadyVoidedError(ValueError):
+    """ The document to void was voided before. """
+    pass
+
+
+def document_key(xml):
+    """ (RUT, TipoDTE, Folio) of a <DTE> (bundled or not). """
+    return header_of(xml).key
+
+
+class FolioLedger(Database):
+
+    def __init__(self, db_path):
+        super().__init__(db_path, SCHEMA, synchronous='NORMAL', isolation_level=None)
+
+    def state(self, rut, dte_type, folio):
+        row = self._conn.execute(
+            "SELECT state FROM folios WHERE rut = ? AND dte_type = ? AND folio = ?",
+            (rut.upper(), int(dte_type), int(folio))
+        ).fetchone()
+
+        return row[0] if row else None
+
+    def record_used(self, rut, dte_type, folio, path=None):
+        """ Consuming a folio again (e.g. re-bundling) only updates its path, it never un-voids. """
+        with self._transaction():
+            self._insert_used(rut, dte_type, folio, path)
+
+    def record_voided(self, rut, dte_type, folio, voided_by):
+        with self._transaction():
+            self._insert_voided(rut, dte_type, folio, voided_by)
+
+    def seeded(self, rut, dte_type):
+        """ Whether the ledger was seeded with the documents already issued for (RUT, TipoDTE). """
+        row = self._conn.execute(
+            "SELECT 1 FROM seeded WHERE rut = ? AND dte_type = ?", (rut.upper(), int(dte_type))
+        ).fetchone()
+
+        return row is not None
+
+    def seed(self, headers, caf_index):
+        """ Records the already issued documents (`Header`'s) as used, voided ones stay voided, and marks
+        the (RUT, TipoDTE) of every CAF in `caf_index` as seeded. All in one transaction, returns how many
+        documents were recorded.
+        """
+        recorded = 0
+
+        with self._transaction():
+            for header in headers:
+                self._insert_used(header.rut, header.dte_type, header.folio, header.path)
+                recorded += 1
+
+            for caf in caf_index.cafs():
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO seeded (rut, dte_type, seeded) VALUES (?, ?, ?)",
+                    (caf.rut, caf.dte_type, time.time())
+                )
+
+        return recorded
+
+    def next_free(self, caf_index, rut, dte_type):
+        """ Next folio after the highest consumed one within the CAFs of (RUT, TipoDTE), None if exhausted.
+
+        Folios are consumed in order, so this is an index lookup per CAF instead of a scan. Only a hint, to
+        take a folio use `reserve` (or `void`).
+        """
+        for caf in caf_index.cafs(rut, dte_type):
+            highest, = self._conn.execute(
+                "SELECT MAX(folio) FROM folios WHERE rut = ? AND dte_type = ? AND folio BETWEEN ? AND ?",
+                (caf.rut, caf.dte_type, caf.first, caf.last)
+            ).fetchone()
+
+            candidate = caf.first if highest is None else highest + 1
+            if candidate <= caf.last:
+                return candidate
+
+        return None
+
+    def reserve(self, caf_index, rut, dte_type, path=None):
+        """ Takes the next free folio of (RUT, TipoDTE) and records it as used, under the ledger's write
+        lock so concurrent runs never get the same one. None if exhausted, raises `LookupError` if the
+        ledger was never seeded for it (it would hand out folios already issued, see `seed`).
+        """
+        with self._transaction(immediate=True):
+            folio = self._take(caf_index, rut, dte_type)
+
+            if folio is not None:
+                self._insert_used(rut, dte_type, folio, path)
+
+        return folio
+
+    def void(self, caf_index, voided, by_type, write):
+        """ Voids `voided` (RUT, TipoDTE, Folio) with the next free folio of `by_type`, in one transaction
+        under the ledger's write lock: `write(folio)` writes the voiding document and returns its path, both
+        folios are recorded only once it returned (nothing is if it raised). Returns the folio taken, None
+        if exhausted. Raises `LookupError` like `reserve`, `AlreadyVoidedError` if already voided.
+        """
+        rut, dte_type, folio = voided
+
+        with self._transaction(immediate=True):
+            if self.state(rut, dte_type, folio) == STATE_VOIDED:
+                raise AlreadyVoidedError("{0}-{1} of {2} is already voided".format(dte_type, folio, rut))
+
+            by_folio = self._take(caf_index, rut, by_type)
+            if by_folio is None:
+                return None
+
+            path = write(by_folio)
+
+            self._insert_used(rut, by_type, by_folio, path)
+            self._insert_voided(rut, dte_type, folio, by_folio)
+
+        return by_folio
+
+    def usage(self, caf_index, rut=None, dte_type=None):
+        """ Used/voided/free counts per CAF, free being the folios after the highest one taken (gaps below it
+        are never handed out, see `next_free`).
+        """
+        for caf in caf_index.cafs(rut, dte_type):
+            params = (caf.rut, caf.dte_type, caf.first, caf.last)
+            counts = dict(self._conn.execute(
+                "SELECT state, COUNT(*) FROM folios WHERE rut = ? AND dte_type = ? AND folio BETWEEN ? AND ? GROUP BY state",
+                params
+            ).fetchall())
+            highest, = self._conn.execute(
+                "SELECT MAX(folio) FROM folios WHERE rut = ? AND dte_type = ? AND folio BETWEEN ? AND ?", params
+            ).fetchone()
+
+            used   = counts.get(STATE_USED,   0)
+            voided = counts.get(STATE_VOIDED, 0)
+            free   = caf.last - (caf.first - 1 if highest is None else highest)
+
+            yield Usage(caf=caf, used=used, voided=voided, free=free)
+
+    def _take(self, caf_index, rut, dte_type):
+        if not self.seeded(rut, dte_type):
+            raise LookupError(
+                "Folio ledger was never seeded for {0} type {1}, seed it with the documents issued so far "
+                "(`folios seed`)".format(rut, dte_type)
+            )
+
+        return self.next_free(caf_index, rut, dte_type)
+
+    def _insert_used(self, rut, dte_type, folio, path):
+        self._conn.execute(
+            "INSERT INTO folios (rut, dte_type, folio, state, path, updated) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (rut, dte_type, folio) DO UPDATE SET path = excluded.path, updated = excluded.updated",
+            (rut.upper(), int(dte_type), int(folio), STATE_USED, path, time.time())
+        )
+
+    def _insert_voided(self, rut, dte_type, folio, voided_by):
+        self._conn.execute(
+            "INSERT INTO folios (rut, dte_type, folio, state, voided_by, updated) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (rut, dte_type, folio) DO UPDATE SET "
+            "state = excluded.state, voided_by = excluded.voided_by, updated = excluded.updated",
+            (rut.upper(), int(dte_type), int(folio), STATE_VOIDED, int(voided_by), time.time())
+        )
+
+    @contextlib.contextmanager
+    def _transaction(self, immediate=False):
+        """ IMMEDIATE takes the write lock up front, so what is read inside can not change before the
+        writes land (another run waits, see `timeout` of sqlite3.connect).
+        """
+        self._conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        else:
+            self._conn.execute('COMMIT')
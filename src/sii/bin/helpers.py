@@ -7,29 +7,49 @@ import os.path as path
 
 from lxml import etree
 
-from sii.lib.lib import xml
+from sii.lib.lib         import xml
+from sii.utils.documents import XML_DECL, format_xml, load_schema, validate_schema
+from sii.utils.profiling import stage
 
+from . import archive
 
 __all__ = [
+    'read_bytes',
     'read_xml',
     'read_xmls',
     'write_xml',
     'print_xml',
+    'format_xml',
     'print_stderr',
     'print_exit',
+    'print_table',
     'condense_xml',
-    'stack_extension'
+    'stack_extension',
+    'load_schema',
+    'validate_schema'
 ]
 
-XML_DECL = lambda enc: b'<?xml version="1.0" encoding="' + bytes(enc, enc) + b'"?>'
+
+def read_bytes(fpath):
+    """ Contents of a file, or of a document in an archive (<archive>#<member>, see `archive`). """
+    with stage('read'):
+        arch_path, member = archive.split_ref(fpath)
+
+        if arch_path is None:
+            with open(fpath, 'rb') as fh:
+                return fh.read()
+
+        if member is None:
+            raise ValueError("{0} is an archive, address one of its documents as {0}#RUT/TipoDTE/Folio".format(fpath))
+
+        return archive.open_archive(arch_path).read(member)
 
 
 def read_xml(xml_fpath):
-    with open(xml_fpath, 'rb') as fh:
-        xtree = etree.parse(fh)
-        root  = xtree.getroot()
+    buff = read_bytes(xml_fpath)
 
-        return root
+    with stage('parse'):
+        return etree.fromstring(buff, base_url=xml_fpath)
 
 
 def read_xmls(xml_fpaths):
@@ -45,7 +65,7 @@ def write_xml(xtree, fpath, end='\n', encoding='ISO-8859-1', append=False):
     else:
         mode = 'wb'
 
-    with open(fpath, mode) as fh:
+    with stage('serialize'):
         bytebuff = etree.tostring(
             xtree,
             pretty_print    = True,
@@ -59,20 +79,25 @@ def write_xml(xtree, fpath, end='\n', encoding='ISO-8859-1', append=False):
             modified = re.sub('\n', end, decoded)
             bytebuff = bytes(modified, encoding)
 
+    arch_path, member = archive.split_ref(fpath)
+
+    # documents go into an archive keyed by their header (or the member written to), never appended to
+    if arch_path is not None:
+        with stage('write'):
+            archive.open_archive(arch_path, writable=True).add(
+                XML_DECL(encoding) + bytes(end, encoding) + bytebuff, member or archive.key_of(xtree)
+            )
+        return
+
+    with stage('write'), open(fpath, mode) as fh:
         fh.write(XML_DECL(encoding) + bytes(end, encoding) + bytebuff)
 
 
 def print_xml(xtree, file=sys.stdout, end='\n', encoding='UTF-8'):
-    bytebuff = etree.tostring(
-        xtree,
-        pretty_print    = True,
-        method          = 'xml',
-        encoding        = encoding,
-        xml_declaration = False
-    )
+    buff = format_xml(xtree, end, encoding)
 
-    encoded_end = bytes(end, encoding)
-    file.buffer.write(XML_DECL(encoding) + encoded_end + bytebuff + encoded_end)
+    with stage('write'):
+        file.buffer.write(buff)
 
 
 def print_stderr(string):
@@ -84,6 +109,17 @@ def print_exit(string, code=0):
     sys.exit(code)
 
 
+def print_table(rows, file=sys.stdout):
+    """ Rows of strings right aligned in columns, the first one (headings) underlined. """
+    widths = [max(len(row[idx]) for row in rows) for idx in range(len(rows[0]))]
+
+    for idx, row in enumerate(rows):
+        print("  ".join("{0:>{1}}".format(col, width) for col, width in zip(row, widths)), file=file)
+
+        if idx == 0:
+            print("-" * (sum(widths) + 2 * (len(widths) - 1)), file=file)
+
+
 def condense_xml(xmlbytestr):
     # (1) - Remove heading and trailing spaces
     strip_lspaces = re.sub(b'^[\t\s]*', b'', xmlbytestr,    flags=re.MULTILINE)
@@ -0,0 +1,86 @@
+""" Exchange Inbox (local sqlite ledger of ingested mail and the documents it carried)
+"""
+import time
+
+from .database import Database
+
+__all__ = [
+    'Inbox',
+    'STATUS_FILED',
+    'STATUS_INVALID',
+    'STATUS_OTHER'
+]
+
+STATUS_FILED   = 'FILED'    # good signature and schema, filed by emitter, type and folio
+STATUS_INVALID = 'INVALID'  # unreadable, bad signature or bad schema
+STATUS_OTHER   = 'OTHER'    # readable, but no DTE (replies, receipts, ...)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    source     TEXT    NOT NULL,
+    msgid      TEXT    NOT NULL,
+    documents  INTEGER NOT NULL,
+    ingested   REAL    NOT NULL,
+    PRIMARY KEY (source, msgid)
+);
+CREATE TABLE IF NOT EXISTS documents (
+    hash       TEXT    PRIMARY KEY,
+    path       TEXT    NOT NULL,
+    status     TEXT    NOT NULL,
+    kind       TEXT,
+    rut        TEXT,
+    dte_type   INTEGER,
+    folio      INTEGER,
+    error      TEXT    NOT NULL DEFAULT '',
+    msgid      TEXT,
+    acked      TEXT,
+    ingested   REAL    NOT NULL
+);
+"""
+
+
+class Inbox(Database):
+
+    def __init__(self, db_path):
+        super().__init__(db_path, SCHEMA)
+
+    def seen_messages(self, source):
+        """ Ids of the messages of `source` (a mailbox path) ingested before. """
+        rows = self._conn.execute("SELECT msgid FROM messages WHERE source = ?", (source,))
+        return set(msgid for msgid, in rows)
+
+    def record_message(self, source, msgid, documents):
+        """ Committed right away, only once all of its documents are filed. """
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO messages (source, msgid, documents, ingested) VALUES (?, ?, ?, ?)",
+                (source, msgid, documents, time.time())
+            )
+
+    def has_document(self, digest):
+        return self._conn.execute("SELECT 1 FROM documents WHERE hash = ?", (digest,)).fetchone() is not None
+
+    def record_document(self, digest, path, status, kind=None, header=None, error='', msgid=None):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (hash, path, status, kind, rut, dte_type, folio, error, msgid, ingested)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    digest, path, status, kind,
+                    header.rut if header else None,
+                    header.dte_type if header else None,
+                    header.folio if header else None,
+                    error, msgid, time.time()
+                )
+            )
+
+    def unacked(self):
+        """ (hash, path) of the filed envelopes not acknowledged yet. """
+        return self._conn.execute(
+            "SELECT hash, path FROM documents WHERE status = ? AND kind = ? AND acked IS NULL ORDER BY ingested",
+            (STATUS_FILED, 'EnvioDTE')
+        ).fetchall()
+
+    def record_ack(self, digest, ack_path):
+        with self._conn:
+            self._conn.execute("UPDATE documents SET acked = ? WHERE hash = ?", (ack_path, digest))
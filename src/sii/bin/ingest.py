@@ -0,0 +1,253 @@
+""" Mail Ingestion (received exchange documents from a Maildir or mbox into a directory tree)
+
+Only messages not ingested before are read (Maildir ones are skipped by their key without opening them).
+XML attachments are decoded from messages fed to the parser in chunks, deduplicated by content hash,
+verified (schema and signatures) in a pool of processes and filed below the destination directory:
+
+    <rut>/<type>/<folio>.xml  documents with good signatures and schema, by their (first) DTE
+    other/<kind>/<hash>.xml   readable ones without a DTE (replies, receipts, ...)
+    invalid/<hash>.xml        the rest (an emitter RUT not fit for a path among them)
+
+Signatures are checked against the certificate embedded in each of them: a good one means the document was
+not altered since it was signed, not that it was signed by its emitter. Neither the certificate chain nor
+the RUT a certificate was issued to are checked, a forged document signed with any certificate is filed as
+good (by the emitter RUT it claims).
+"""
+import os
+import re
+import mailbox
+import tempfile
+import collections
+
+from email.parser import BytesFeedParser, BytesHeaderParser
+
+from lxml import etree
+
+from sii.utils.dsig      import verify_signatures
+from sii.utils.headers   import header_of
+from sii.utils.profiling import stage
+
+from .helpers import stack_extension, validate_schema
+from .inbox   import STATUS_FILED, STATUS_INVALID, STATUS_OTHER
+from .outbox  import content_hash
+from .pools   import process_pool
+
+__all__ = [
+    'STATUS_DUPLICATE',
+    'Filed',
+    'ingest',
+    'open_mailbox'
+]
+
+STATUS_DUPLICATE = 'DUPLICATE'  # same content ingested before, not filed again
+
+PIPELINE_DEPTH = 32         # attachments being verified or waiting to be filed
+CHUNK_SIZE     = 64 * 1024  # bytes fed to the mail parser at a time
+
+XML_TYPES = ('text/xml', 'application/xml')
+
+# Emitter RUT's as they go in paths: without dots, with a dash before the verifier digit
+RUT_PATTERN = re.compile(r'^[0-9]{1,8}-[0-9K]$')
+
+Filed = collections.namedtuple('Filed', ['msgid', 'name', 'digest', 'path', 'status', 'error'])
+
+_Attachment = collections.namedtuple('_Attachment', ['msgid', 'name', 'digest', 'payload'])
+_MessageEnd = collections.namedtuple('_MessageEnd', ['msgid', 'documents'])
+_Verified   = collections.namedtuple('_Verified',   ['kind', 'header', 'error'])
+
+
+def open_mailbox(path):
+    """ Maildir if `path` is a directory, mbox file otherwise. """
+    path = os.path.abspath(os.path.expanduser(path))
+
+    if os.path.isdir(path):
+        return mailbox.Maildir(path, factory=None, create=False)
+    if os.path.isfile(path):
+        return mailbox.mbox(path, create=False)
+
+    raise ValueError("No Maildir or mbox at: {0}".format(path))
+
+
+def ingest(inbox, source, dest, xsd_path=None, workers=None, depth=PIPELINE_DEPTH):
+    """ Ingests the messages of the mailbox at `source` not in the `inbox` ledger yet, yielding a `Filed` per
+    XML attachment in order. A message is recorded as ingested once all of its attachments are filed.
+    """
+    source = os.path.abspath(os.path.expanduser(source))
+    box    = open_mailbox(source)
+    seen   = inbox.seen_messages(source)
+
+    pending  = set()  # digests being verified, attached more than once within this run
+    inflight = collections.deque()
+
+    try:
+        with process_pool(workers, len(box)) as executor:
+            for item in _attachments(box, seen):
+                if isinstance(item, _MessageEnd) or item.digest in pending or inbox.has_document(item.digest):
+                    inflight.append((item, None))
+                else:
+                    pending.add(item.digest)
+                    inflight.append((item, executor.submit(_verify, item.payload, xsd_path)))
+
+                while len(inflight) > depth:
+                    filed = _settle(inbox, source, dest, *inflight.popleft())
+                    if filed is not None:
+                        yield filed
+
+            while inflight:
+                filed = _settle(inbox, source, dest, *inflight.popleft())
+                if filed is not None:
+                    yield filed
+    finally:
+        box.close()
+
+
+def _attachments(box, seen):
+    """ XML attachments of the messages not `seen` before, the ones of each message followed by its end. """
+    is_maildir = isinstance(box, mailbox.Maildir)
+
+    for key in box.iterkeys():
+        if is_maildir and key in seen:
+            continue  # Maildir keys are stable, mbox ones are positions
+
+        with box.get_file(key) as fh:
+            head = _read_head(fh)
+
+            if is_maildir:
+                msgid = key
+            else:
+                msgid = (BytesHeaderParser().parsebytes(head).get('Message-ID', None) or '').strip()
+                msgid = msgid or content_hash(head)
+
+                if msgid in seen:
+                    continue
+
+            parser = BytesFeedParser()
+            parser.feed(head)
+
+            for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+                parser.feed(chunk)
+
+            message = parser.close()
+
+        documents = 0
+        for part in message.walk():
+            name = part.get_filename() or ''
+
+            if part.get_content_type() not in XML_TYPES and not name.lower().endswith('.xml'):
+                continue
+
+            payload = part.get_payload(decode=True)
+            if not payload:
+                continue
+
+            documents += 1
+            yield _Attachment(msgid, name, content_hash(payload), payload)
+
+        yield _MessageEnd(msgid, documents)
+
+
+def _read_head(fh):
+    """ Header lines of a message, up to and including the blank line ending them. """
+    lines = []
+
+    for line in iter(fh.readline, b''):
+        lines.append(line)
+
+        if line in (b'\n', b'\r\n'):
+            break
+
+    return b''.join(lines)
+
+
+def _verify(payload, xsd_path=None):
+    # lxml errors do not survive the trip back from the worker process, hand over their message instead
+    try:
+        root = etree.fromstring(payload)
+    except etree.XMLSyntaxError as exc:
+        return _Verified(None, None, "Unreadable: " + str(exc))
+
+    kind = etree.QName(root).localname
+
+    try:
+        header = header_of(root)
+    except ValueError:
+        header = None  # no DTE in there
+
+    errors = []
+
+    if header is not None and not RUT_PATTERN.match(header.rut or ''):
+        errors.append("Bad RUT: {0!r}".format(header.rut))
+
+    try:
+        validate_schema(root, xsd_path)
+    except Exception as exc:
+        errors.append("Bad Schema: " + str(exc))
+
+    try:
+        # by the embedded certificates, whoever they belong to (see above)
+        with stage('verify'):
+            results = verify_signatures(root)
+    except Exception as exc:
+        errors.append("Bad Signature: " + (str(exc) or type(exc).__name__))
+    else:
+        if header is not None and not results:
+            errors.append("Unsigned")
+        elif not all(validity for _, validity in results):
+            errors.append("Bad Signature: " + ", ".join(uri for uri, validity in results if not validity))
+
+    return _Verified(kind, header, "; ".join(errors) or None)
+
+
+def _settle(inbox, source, dest, item, future):
+    if isinstance(item, _MessageEnd):
+        inbox.record_message(source, item.msgid, item.documents)
+        return None
+
+    if future is None:
+        return Filed(item.msgid, item.name, item.digest, None, STATUS_DUPLICATE, None)
+
+    verified = future.result()
+
+    if verified.error:
+        status = STATUS_INVALID
+        fpath  = os.path.join(dest, 'invalid', item.digest + '.xml')
+    elif verified.header is None:
+        status = STATUS_OTHER
+        fpath  = os.path.join(dest, 'other', verified.kind, item.digest + '.xml')
+    else:
+        header = verified.header
+        status = STATUS_FILED
+        fpath  = os.path.join(dest, header.rut, str(header.dte_type), "{0}.xml".format(header.folio))
+
+        if os.path.exists(fpath):  # a different document under the same key, keep both
+            fpath = stack_extension(fpath, item.digest[:12])
+
+    fpath = os.path.abspath(fpath)
+    _write_atomic(fpath, item.payload)
+
+    inbox.record_document(
+        item.digest, fpath, status,
+        kind   = verified.kind,
+        header = verified.header,
+        error  = verified.error or '',
+        msgid  = item.msgid
+    )
+
+    return Filed(item.msgid, item.name, item.digest, fpath, status, verified.error)
+
+
+def _write_atomic(fpath, payload):
+    """ Filed as received, byte for byte (signatures), and never seen partially written. """
+    dirpath = os.path.dirname(fpath)
+    os.makedirs(dirpath, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=dirpath, prefix='.ingest_')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(payload)
+
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, fpath)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,154 @@
+""" Upload Job Tracking (local sqlite database of SII track ids and their states)
+"""
+import time
+import random
+import asyncio
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .database import Database
+
+__all__ = [
+    'Job',
+    'JobDatabase',
+    'STATES_FINAL',
+    'poll_states'
+]
+
+# States the SII documents as the outcome of an upload: processed, accepted with objections, or rejected
+# (envelopes), and squared or rejected (libros). Anything else is still pending and gets polled again.
+STATES_FINAL = (
+    'EPR', 'RPR', 'RLV', 'RCH', 'RCT', 'RFR', 'RSC', 'RPT',
+    'LOK', 'LNC', 'LRH', 'LRF', 'LRS', 'LRC'
+)
+
+BACKOFF_BASE = 1.0   # seconds
+BACKOFF_MAX  = 60.0  # seconds
+FLUSH_EVERY  = 256   # results per bulk update
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    track_id  TEXT    PRIMARY KEY,
+    server    TEXT    NOT NULL,
+    rut       TEXT    NOT NULL,
+    path      TEXT,
+    state     TEXT    NOT NULL DEFAULT 'UPL',
+    glosa     TEXT    NOT NULL DEFAULT '',
+    uploaded  REAL    NOT NULL,
+    polled    REAL,
+    attempts  INTEGER NOT NULL DEFAULT 0,
+    final     INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS uploads_pending ON uploads (final, server);
+"""
+
+Job = collections.namedtuple('Job', ['track_id', 'server', 'rut', 'path', 'state', 'glosa', 'uploaded', 'polled', 'attempts'])
+
+
+class JobDatabase(Database):
+
+    def __init__(self, db_path):
+        super().__init__(db_path, SCHEMA)
+
+    def record_upload(self, track_id, server, rut, path=None):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO uploads (track_id, server, rut, path, uploaded) VALUES (?, ?, ?, ?, ?)",
+                (str(track_id), str(server), rut, path, time.time())
+            )
+
+    def jobs(self, server=None, track_ids=None, pending=False):
+        query  = "SELECT track_id, server, rut, path, state, glosa, uploaded, polled, attempts FROM uploads"
+        wheres = []
+        params = []
+
+        if pending:
+            wheres.append("final = 0")
+        if server:
+            wheres.append("server = ?")
+            params.append(str(server))
+        if track_ids:
+            wheres.append("track_id IN ({0})".format(", ".join("?" * len(track_ids))))
+            params.extend(str(tid) for tid in track_ids)
+
+        if wheres:
+            query += " WHERE " + " AND ".join(wheres)
+
+        return [Job(*row) for row in self._conn.execute(query + " ORDER BY uploaded", params)]
+
+    def update_states(self, states):
+        """ Bulk update from an iterable of `(track_id, state, glosa, attempts)` in a single transaction. A
+        `None` state is a query that failed, only its attempts are counted and the job stays as it was.
+        """
+        now     = time.time()
+        updates = []
+        failed  = []
+
+        for track_id, state, glosa, attempts in states:
+            if state is None:
+                failed.append((now, attempts, str(track_id)))
+            else:
+                updates.append((state, glosa, now, attempts, 1 if state in STATES_FINAL else 0, str(track_id)))
+
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE uploads SET state = ?, glosa = ?, polled = ?, attempts = attempts + ?, final = ? WHERE track_id = ?",
+                updates
+            )
+            self._conn.executemany(
+                "UPDATE uploads SET polled = ?, attempts = attempts + ? WHERE track_id = ?",
+                failed
+            )
+
+        return len(updates) + len(failed)
+
+
+def poll_states(jobs, query, on_results, concurrency=16, retries=4):
+    """ Concurrently polls the state of all `jobs` by calling the (blocking) `query(job)` in a thread pool.
+
+    Jobs the SII still has in process, and failed queries, are re-polled up to `retries` times with exponential backoff (with
+    jitter). Results are passed to `on_results` in chunks of (job, state-or-exception, attempts) tuples,
+    to be persisted in bulk.
+    """
+    loop = asyncio.new_event_loop()
+
+    try:
+        loop.run_until_complete(_poll_all(loop, jobs, query, on_results, concurrency, retries))
+    finally:
+        loop.close()
+
+
+async def _poll_all(loop, jobs, query, on_results, concurrency, retries):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        async def poll_one(job):
+            delay  = BACKOFF_BASE
+            result = None
+
+            for attempt in range(1, retries + 2):
+                async with semaphore:
+                    try:
+                        result = await loop.run_in_executor(executor, query, job)
+                    except Exception as exc:
+                        result = exc
+
+                pending = isinstance(result, Exception) or result.state not in STATES_FINAL
+                if not pending or attempt > retries:
+                    return job, result, attempt
+
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, BACKOFF_MAX)
+
+        chunk = []
+        for future in asyncio.as_completed([poll_one(job) for job in jobs]):
+            chunk.append(await future)
+
+            if len(chunk) >= FLUSH_EVERY:
+                on_results(chunk)
+                chunk = []
+
+        if chunk:
+            on_results(chunk)
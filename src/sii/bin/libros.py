@@ -0,0 +1,353 @@
+""" Incremental Libro de Ventas (per period state of detail rows and running totals, in a local sqlite)
+
+DTE's are added as they are issued, each file read only once (unless it changes, its rows are then replaced
+by the ones it holds now). Files may be envelopes, every <DTE> in them is a row. Adding keeps the
+<TotalesPeriodo> of its period up to date, so writing the <LibroCompraVenta> is a single streaming pass over
+the stored rows, whatever the size of the period.
+"""
+import os
+import json
+import time
+import collections
+
+from lxml import etree
+
+from sii.utils           import accessors as acc
+from sii.utils.profiling import stage
+
+from .database import Database
+from .helpers  import read_xml
+
+__all__ = [
+    'LibroState',
+    'Detail',
+    'Summary',
+    'detail_of',
+    'details_of'
+]
+
+SII_NS = 'http://www.sii.cl/SiiDte'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS details (
+    rut        TEXT    NOT NULL,
+    period     TEXT    NOT NULL,
+    dte_type   INTEGER NOT NULL,
+    folio      INTEGER NOT NULL,
+    issued     TEXT    NOT NULL,
+    recpt_rut  TEXT    NOT NULL,
+    recpt_name TEXT    NOT NULL,
+    vat_rate   TEXT,
+    exempt     INTEGER NOT NULL,
+    net        INTEGER NOT NULL,
+    vat        INTEGER NOT NULL,
+    total      INTEGER NOT NULL,
+    taxes      TEXT    NOT NULL,
+    path       TEXT,
+    PRIMARY KEY (rut, dte_type, folio)
+);
+CREATE INDEX IF NOT EXISTS details_period ON details (rut, period, dte_type, folio);
+CREATE INDEX IF NOT EXISTS details_path ON details (path);
+CREATE TABLE IF NOT EXISTS totals (
+    rut        TEXT    NOT NULL,
+    period     TEXT    NOT NULL,
+    dte_type   INTEGER NOT NULL,
+    documents  INTEGER NOT NULL,
+    exempt     INTEGER NOT NULL,
+    net        INTEGER NOT NULL,
+    vat        INTEGER NOT NULL,
+    total      INTEGER NOT NULL,
+    PRIMARY KEY (rut, period, dte_type)
+);
+CREATE TABLE IF NOT EXISTS tax_totals (
+    rut        TEXT    NOT NULL,
+    period     TEXT    NOT NULL,
+    dte_type   INTEGER NOT NULL,
+    code       INTEGER NOT NULL,
+    amount     INTEGER NOT NULL,
+    PRIMARY KEY (rut, period, dte_type, code)
+);
+CREATE TABLE IF NOT EXISTS files (
+    path       TEXT    PRIMARY KEY,
+    mtime_ns   INTEGER NOT NULL,
+    size       INTEGER NOT NULL
+);
+"""
+
+DETAIL_COLUMNS = (
+    'rut', 'period', 'dte_type', 'folio', 'issued', 'recpt_rut', 'recpt_name', 'vat_rate', 'exempt', 'net',
+    'vat', 'total', 'taxes', 'path'
+)
+
+# `taxes` are (code, rate, amount) of the <ImptoReten>'s of the document
+Detail  = collections.namedtuple('Detail',  DETAIL_COLUMNS)
+Summary = collections.namedtuple('Summary', ['added', 'updated', 'unchanged', 'failed'])
+
+
+def detail_of(xml, path=None):
+    """ Libro row of a <DTE> (bundled or not), raises `ValueError` if it lacks what a row needs. Only the
+    first <Encabezado> of `xml` is read, see `details_of` for envelopes.
+    """
+    where      = path or "document"
+    encabezado = acc.ENCABEZADOS.first(xml)
+
+    if encabezado is None:
+        raise ValueError("Could not find <Encabezado> in: {0}".format(where))
+
+    fields = acc.ENCABEZADO(encabezado)
+    id_doc = fields.id_doc
+
+    if None in fields[:4]:
+        raise ValueError("Missing <IdDoc>, <Emisor>, <Receptor> or <Totales> in: {0}".format(where))
+    if not (id_doc.dte_type and id_doc.folio and id_doc.issued and fields.emitter.rut and fields.receiver.rut):
+        raise ValueError("Missing <TipoDTE>, <Folio>, <FchEmis>, <RUTEmisor> or <RUTRecep> in: {0}".format(where))
+
+    totals = fields.totals
+
+    return Detail(
+        rut        = fields.emitter.rut.upper(),
+        period     = id_doc.issued[:7],
+        dte_type   = id_doc.dte_type,
+        folio      = id_doc.folio,
+        issued     = id_doc.issued,
+        recpt_rut  = fields.receiver.rut.upper(),
+        recpt_name = fields.receiver.name or '',
+        vat_rate   = totals.vat_rate,
+        exempt     = totals.exempt or 0,
+        net        = totals.net or 0,
+        vat        = totals.vat or 0,
+        total      = totals.gross or 0,
+        taxes      = tuple((tax.code, tax.rate, tax.amount or 0) for tax in totals.taxes if tax.code),
+        path       = path
+    )
+
+
+def details_of(xml, path=None):
+    """ Libro rows of every <DTE> of a document (one or an envelope of them), raises `ValueError` if any
+    lacks what a row needs.
+    """
+    return [detail_of(dte, path) for dte in acc.DTES(xml)] or [detail_of(xml, path)]
+
+
+class LibroState(Database):
+
+    def __init__(self, db_path):
+        super().__init__(db_path, SCHEMA, synchronous='NORMAL')
+
+    def add(self, paths, on_error=None):
+        """ Adds (or updates) the rows of the DTE's in `paths`, skipping files added before and unchanged
+        since without reading them. `on_error(path, message)` is called for the ones that cannot be added.
+        Counts are of rows, but for `failed` (files).
+        """
+        added = updated = unchanged = failed = 0
+
+        for path in paths:
+            path = os.path.abspath(path)
+
+            try:
+                stat = os.stat(path)
+
+                known = self._conn.execute("SELECT mtime_ns, size FROM files WHERE path = ?", (path,)).fetchone()
+                if known is not None and tuple(known) == (stat.st_mtime_ns, stat.st_size):
+                    unchanged += 1
+                    continue
+
+                details = details_of(read_xml(path), path)
+            except (OSError, etree.XMLSyntaxError, ValueError) as exc:
+                failed += 1
+                if on_error is not None:
+                    on_error(path, str(exc) or type(exc).__name__)
+                continue
+
+            with self._conn:
+                replaced = self._remove(path)
+
+                for detail in details:
+                    if self._replace(detail) or (detail.rut, detail.dte_type, detail.folio) in replaced:
+                        updated += 1
+                    else:
+                        added += 1
+
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO files (path, mtime_ns, size) VALUES (?, ?, ?)",
+                    (path, stat.st_mtime_ns, stat.st_size)
+                )
+
+        return Summary(added, updated, unchanged, failed)
+
+    def periods(self, rut=None):
+        """ (rut, period, dte_type, documents, exempt, net, vat, total) per period and type. """
+        query  = "SELECT rut, period, dte_type, documents, exempt, net, vat, total FROM totals WHERE documents > 0"
+        params = []
+
+        if rut:
+            query += " AND rut = ?"
+            params.append(rut.upper())
+
+        return self._conn.execute(query + " ORDER BY rut, period, dte_type", params).fetchall()
+
+    def write(self, rut, period, fpath, resol_date, resol_number, sender=None):
+        """ Writes the (unsigned) <LibroCompraVenta> of `rut` for `period` (YYYY-MM) to `fpath`, streaming
+        its <Detalle>'s straight from the database. Returns the number of them.
+        """
+        rut    = rut.upper()
+        totals = self._conn.execute(
+            "SELECT dte_type, documents, exempt, net, vat, total FROM totals"
+            " WHERE rut = ? AND period = ? AND documents > 0 ORDER BY dte_type",
+            (rut, period)
+        ).fetchall()
+
+        if not totals:
+            raise ValueError("No documents of {0} in period {1}".format(rut, period))
+
+        taxes = collections.defaultdict(list)
+        for dte_type, code, amount in self._conn.execute(
+            "SELECT dte_type, code, amount FROM tax_totals WHERE rut = ? AND period = ? AND amount != 0"
+            " ORDER BY dte_type, code",
+            (rut, period)
+        ):
+            taxes[dte_type].append((code, amount))
+
+        count = 0
+        with stage('write'), etree.xmlfile(fpath, encoding='ISO-8859-1') as xf:
+            xf.write_declaration()
+
+            with xf.element(_E('LibroCompraVenta'), nsmap={None: SII_NS}, version="1.0"):
+                with xf.element(_E('EnvioLibro'), ID="LV{0}".format(period.replace('-', ''))):
+                    _write_caratula(xf, rut, period, resol_date, resol_number, sender or rut)
+                    _write_resumen(xf, totals, taxes)
+
+                    rows = self._conn.execute(
+                        "SELECT {0} FROM details WHERE rut = ? AND period = ? ORDER BY dte_type, folio".format(
+                            ", ".join(DETAIL_COLUMNS)
+                        ),
+                        (rut, period)
+                    )
+
+                    for row in rows:
+                        _write_detalle(xf, Detail(*row))
+                        count += 1
+
+                    _write_leaf(xf, 'TmstFirma', time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+        return count
+
+    def _remove(self, path):
+        """ Drops the rows added from `path` (and their totals), returns their keys. """
+        removed = [_stored(row) for row in self._conn.execute(
+            "SELECT {0} FROM details WHERE path = ?".format(", ".join(DETAIL_COLUMNS)), (path,)
+        )]
+
+        for detail in removed:
+            self._count(detail, -1)
+
+        self._conn.execute("DELETE FROM details WHERE path = ?", (path,))
+
+        return set((detail.rut, detail.dte_type, detail.folio) for detail in removed)
+
+    def _replace(self, detail):
+        """ Stores `detail`, moving the totals from the row it replaces (if any) over to it. """
+        old = self._conn.execute(
+            "SELECT {0} FROM details WHERE rut = ? AND dte_type = ? AND folio = ?".format(", ".join(DETAIL_COLUMNS)),
+            (detail.rut, detail.dte_type, detail.folio)
+        ).fetchone()
+
+        if old is not None:
+            self._count(_stored(old), -1)
+
+        self._conn.execute(
+            "INSERT OR REPLACE INTO details ({0}) VALUES ({1})".format(
+                ", ".join(DETAIL_COLUMNS), ", ".join("?" * len(DETAIL_COLUMNS))
+            ),
+            detail._replace(taxes=json.dumps(detail.taxes))
+        )
+        self._count(detail, 1)
+
+        return old is not None
+
+    def _count(self, detail, sign):
+        self._conn.execute(
+            "INSERT INTO totals (rut, period, dte_type, documents, exempt, net, vat, total)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (rut, period, dte_type) DO UPDATE SET"
+            " documents = documents + excluded.documents, exempt = exempt + excluded.exempt,"
+            " net = net + excluded.net, vat = vat + excluded.vat, total = total + excluded.total",
+            (
+                detail.rut, detail.period, detail.dte_type,
+                sign, sign * detail.exempt, sign * detail.net, sign * detail.vat, sign * detail.total
+            )
+        )
+
+        for code, _, amount in detail.taxes:
+            self._conn.execute(
+                "INSERT INTO tax_totals (rut, period, dte_type, code, amount) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (rut, period, dte_type, code) DO UPDATE SET amount = amount + excluded.amount",
+                (detail.rut, detail.period, detail.dte_type, code, sign * amount)
+            )
+
+
+def _stored(row):
+    """ `Detail` of a row of the details table, its taxes decoded. """
+    detail = Detail(*row)
+    return detail._replace(taxes=json.loads(detail.taxes))
+
+
+def _write_caratula(xf, rut, period, resol_date, resol_number, sender):
+    with xf.element(_E('Caratula')):
+        _write_leaf(xf, 'RutEmisorLibro',    rut)
+        _write_leaf(xf, 'RutEnvia',          sender.upper())
+        _write_leaf(xf, 'PeriodoTributario', period)
+        _write_leaf(xf, 'FchResol',          resol_date)
+        _write_leaf(xf, 'NroResol',          resol_number)
+        _write_leaf(xf, 'TipoOperacion',     'VENTA')
+        _write_leaf(xf, 'TipoLibro',         'MENSUAL')
+        _write_leaf(xf, 'TipoEnvio',         'TOTAL')
+
+
+def _write_resumen(xf, totals, taxes):
+    with xf.element(_E('ResumenPeriodo')):
+        for dte_type, documents, exempt, net, vat, total in totals:
+            with xf.element(_E('TotalesPeriodo')):
+                _write_leaf(xf, 'TpoDoc',     dte_type)
+                _write_leaf(xf, 'TotDoc',     documents)
+                _write_leaf(xf, 'TotMntExe',  exempt)
+                _write_leaf(xf, 'TotMntNeto', net)
+                _write_leaf(xf, 'TotMntIVA',  vat)
+
+                for code, amount in taxes.get(dte_type, ()):
+                    with xf.element(_E('TotOtrosImp')):
+                        _write_leaf(xf, 'CodImp',    code)
+                        _write_leaf(xf, 'TotMntImp', amount)
+
+                _write_leaf(xf, 'TotMntTotal', total)
+
+
+def _write_detalle(xf, detail):
+    with xf.element(_E('Detalle')):
+        _write_leaf(xf, 'TpoDoc', detail.dte_type)
+        _write_leaf(xf, 'NroDoc', detail.folio)
+        if detail.vat_rate:
+            _write_leaf(xf, 'TasaImp', detail.vat_rate)
+        _write_leaf(xf, 'FchDoc',  detail.issued)
+        _write_leaf(xf, 'RUTDoc',  detail.recpt_rut)
+        _write_leaf(xf, 'RznSoc',  detail.recpt_name)
+        _write_leaf(xf, 'MntExe',  detail.exempt)
+        _write_leaf(xf, 'MntNeto', detail.net)
+        _write_leaf(xf, 'MntIVA',  detail.vat)
+
+        for code, rate, amount in json.loads(detail.taxes):
+            with xf.element(_E('OtrosImp')):
+                _write_leaf(xf, 'CodImp',  code)
+                _write_leaf(xf, 'TasaImp', rate or 0)
+                _write_leaf(xf, 'MntImp',  amount)
+
+        _write_leaf(xf, 'MntTotal', detail.total)
+
+
+def _E(name):
+    return '{' + SII_NS + '}' + name
+
+
+def _write_leaf(xf, name, value):
+    with xf.element(_E(name)):
+        xf.write(str(value))
+
@@ -4,35 +4,48 @@ Usage:
     sii [options] <command> [<args>...]
 
 Commands:
-    dte  Tools for generation, manipulation and instrospection of SII documents.
-    xml  Tools for manipulation and checking of XML files according to SII schemas.
-    pdf  Tools for the PDF subsystem; creation of PDF's from XML's or printing them.
-    ws   Tools for interactions with the SII Web Services, their protocols etc.
-    xch  Tools for mailing/exchange of DTE's between Emitters.
-    lcv  Tools for introspection and manipulation of LC's and LV's.
+    dte    Tools for generation, manipulation and instrospection of SII documents.
+    xml    Tools for manipulation and checking of XML files according to SII schemas.
+    pdf    Tools for the PDF subsystem; creation of PDF's from XML's or printing them.
+    ws     Tools for interactions with the SII Web Services, their protocols etc.
+    xch    Tools for mailing/exchange of DTE's between Emitters.
+    lcv    Tools for introspection and manipulation of LC's and LV's.
+    index  Catalog of documents below directories, to look them up and select inputs by query.
+    watch  Processing (bundle, sign, PDF, envelope) of DTE's dropped into a spool directory as they appear.
 
     help     This message.
     version  Display version number.
 
 Common Options:
-    --config <cfg>  # Configuration file to read from. [default: ~/.config/sii/cfg_utils.yml]
-    --debug         # Drop to post-mortem debugging instead of failing with a message.
-    --help          # This message.
-    --version       # Display version number.
+    --config <cfg>          # Configuration file to read from. [default: ~/.config/sii/cfg_utils.yml]
+    --debug                 # Drop to post-mortem debugging instead of failing with a message.
+    --timings               # Print wall/CPU time spent per stage (read, parse, sign, network, ...) to stderr.
+    --profile <out>         # Dump cProfile statistics (pstats) to <out>, implies --timings.
+    --trace <out>           # Dump a Chrome trace (chrome://tracing, Perfetto) of every stage run to <out>.
+    --metrics <out>         # Write run metrics to <out>; Prometheus textfile if named *.prom, JSONL otherwise.
+    --metrics-interval <s>  # Seconds between metric writes while running (0 at the end only). [default: 30]
+    --help                  # This message.
+    --version               # Display version number.
 """
 import pdb
 import sys
+import cProfile
 import traceback
 
 import docopt
 import pkg_resources
 
+from sii.utils import profiling
+
 from . import cmd_dte
+from . import cmd_index
 from . import cmd_lcv
 from . import cmd_pdf
 from . import cmd_ws
+from . import cmd_watch
 from . import cmd_xch
 from . import cmd_xml
+from . import metrics
 
 from .config import Configuration
 
@@ -40,12 +53,14 @@ DEFAULT_CONFIG_PATH = '/usr/share/doc/python3-sii-utils/templ_config.yml'
 VERSION             = pkg_resources.get_distribution("python-sii-utils").version
 
 ACTIONS = {
-    'dte': cmd_dte,
-    'lcv': cmd_lcv,
-    'pdf': cmd_pdf,
-    'ws' : cmd_ws,
-    'xch': cmd_xch,
-    'xml': cmd_xml
+    'dte':   cmd_dte,
+    'index': cmd_index,
+    'lcv':   cmd_lcv,
+    'pdf':   cmd_pdf,
+    'watch': cmd_watch,
+    'ws':    cmd_ws,
+    'xch':   cmd_xch,
+    'xml':   cmd_xml
 }
 
 
@@ -67,13 +82,50 @@ def cmd(args, config):
 def main():
     args = docopt.docopt(__doc__, options_first=True, version=VERSION)
 
+    profiler = cProfile.Profile() if args['--profile'] else None
+
+    if args['--timings'] or args['--profile'] or args['--trace']:
+        profiling.enable(trace=bool(args['--trace']))
+
+    if args['--metrics']:
+        metrics.enable(
+            fpath    = args['--metrics'],
+            interval = float(args['--metrics-interval']),
+            command  = " ".join([args['<command>']] + args['<args>'][:1])
+        )
+
     try:
-        config = Configuration(cfg_path=args['--config'], cfg_templ=DEFAULT_CONFIG_PATH)
-        cmd(args, config)
+        with profiling.stage('config'):
+            config = Configuration(cfg_path=args['--config'], cfg_templ=DEFAULT_CONFIG_PATH)
+
+        if profiler is None:
+            cmd(args, config)
+        else:
+            profiler.runcall(cmd, args, config)
     except KeyboardInterrupt:
         _error_handling(args, "Interrupted...")
     except Exception as exc:
         _error_handling(args, "Failed with message (introspect with --debug): \"{0}\"".format(str(exc)))
+    finally:
+        metrics.close()
+        _profiling_output(args, profiler)
+
+
+def _profiling_output(args, profiler):
+    if not profiling.enabled():
+        return
+
+    try:
+        if profiler is not None:
+            profiler.dump_stats(args['--profile'])
+
+        if args['--timings'] or args['--profile']:
+            profiling.report()
+
+        if args['--trace']:
+            profiling.dump_trace(args['--trace'])
+    finally:
+        profiling.cleanup()
 
 
 def _error_handling(args, msg):
@@ -0,0 +1,290 @@
+""" Run Metrics Export (--metrics, --metrics-interval)
+
+Per document latency histograms, document and error counters, throughput and queue depth of a run. Written
+as a Prometheus textfile collector file (`*.prom`) or appended as JSONL snapshots (anything else), every
+`--metrics-interval` seconds while running and once more at its end.
+
+Counted in the process driving the batch, workers of process pools return the time a document took them.
+"""
+import os
+import json
+import time
+import bisect
+import tempfile
+import threading
+import collections
+
+__all__ = [
+    'BUCKETS',
+    'enable',
+    'enabled',
+    'document',
+    'queue_depth',
+    'snapshot',
+    'flush',
+    'close'
+]
+
+# Upper bounds (seconds) of the latency histogram buckets, +Inf is implicit
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+FORMAT_PROMETHEUS = 'prometheus'
+FORMAT_JSONL      = 'jsonl'
+
+_STATE = {
+    'enabled':  False,
+    'fpath':    None,
+    'format':   None,
+    'command':  None,
+    'start':    None,
+    'started':  None,  # wall clock (epoch) of start
+    'stop':     None,
+    'thread':   None
+}
+
+_LATENCY   = {}                           # kind -> Histogram
+_DOCUMENTS = collections.Counter()        # (kind, outcome) -> count
+_ERRORS    = collections.Counter()        # (kind, error type) -> count
+_DEPTH     = {}                           # kind -> last seen queue depth
+_LOCK      = threading.Lock()
+
+
+class Histogram:
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total  = 0.0
+        self.count  = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def cumulative(self):
+        acc = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            acc += count
+            yield bound, acc
+
+    def quantile(self, q):
+        """ Upper bound of the bucket the `q` quantile falls in (what Prometheus would estimate at best). """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        for bound, acc in self.cumulative():
+            if acc >= rank:
+                return bound if bound != float('inf') else BUCKETS[-1]
+
+
+def enable(fpath, interval=30, command=None):
+    fpath = os.path.abspath(os.path.expanduser(fpath))
+    fmt   = FORMAT_PROMETHEUS if fpath.endswith('.prom') else FORMAT_JSONL
+
+    _STATE.update(
+        enabled = True,
+        fpath   = fpath,
+        format  = fmt,
+        command = command or '',
+        start   = time.perf_counter(),
+        started = time.time(),
+        stop    = threading.Event()
+    )
+
+    if interval and interval > 0:
+        thread = threading.Thread(target=_periodic, args=(interval,), name='sii-metrics', daemon=True)
+        thread.start()
+        _STATE['thread'] = thread
+
+
+def enabled():
+    return _STATE['enabled']
+
+
+def document(kind, seconds=None, error=None):
+    """ One document of `kind` (sign, bundle, verify, email, upload, pdf, ...) done, or failed with `error`
+    (an exception or a short error type).
+    """
+    if not _STATE['enabled']:
+        return
+
+    if isinstance(error, BaseException):
+        error = type(error).__name__
+
+    with _LOCK:
+        _DOCUMENTS[(kind, 'error' if error else 'ok')] += 1
+
+        if error:
+            _ERRORS[(kind, str(error))] += 1
+
+        if seconds is not None:
+            if kind not in _LATENCY:
+                _LATENCY[kind] = Histogram()
+
+            _LATENCY[kind].observe(seconds)
+
+
+def queue_depth(kind, depth):
+    if not _STATE['enabled']:
+        return
+
+    with _LOCK:
+        _DEPTH[kind] = depth
+
+
+def snapshot(final=False):
+    """ Current state of all metrics as a JSON serializable dict. """
+    with _LOCK:
+        elapsed = time.perf_counter() - _STATE['start']
+        kinds   = sorted(set(kind for kind, _ in _DOCUMENTS) | set(_LATENCY) | set(_DEPTH))
+        result  = {}
+
+        for kind in kinds:
+            done = _DOCUMENTS[(kind, 'ok')] + _DOCUMENTS[(kind, 'error')]
+            hist = _LATENCY.get(kind, None)
+
+            result[kind] = {
+                'documents':   done,
+                'failed':      _DOCUMENTS[(kind, 'error')],
+                'throughput':  done / elapsed if elapsed else 0.0,
+                'errors':      dict((etype, count) for (knd, etype), count in _ERRORS.items() if knd == kind),
+                'queue_depth': _DEPTH.get(kind, None),
+                'latency':     None if hist is None else {
+                    'count':   hist.count,
+                    'sum':     hist.total,
+                    'p50':     hist.quantile(0.50),
+                    'p95':     hist.quantile(0.95),
+                    'p99':     hist.quantile(0.99),
+                    'buckets': [[_bound_label(bound), acc] for bound, acc in hist.cumulative()]
+                }
+            }
+
+    return {
+        'time':    time.time(),
+        'command': _STATE['command'],
+        'pid':     os.getpid(),
+        'elapsed': elapsed,
+        'final':   final,
+        'kinds':   result
+    }
+
+
+def flush(final=False):
+    if not _STATE['enabled']:
+        return
+
+    snap = snapshot(final)
+
+    if _STATE['format'] == FORMAT_PROMETHEUS:
+        _write_atomic(_STATE['fpath'], _prometheus(snap))
+    else:
+        with open(_STATE['fpath'], 'a') as fh:
+            fh.write(json.dumps(snap, sort_keys=True) + '\n')
+
+
+def close():
+    """ Stops periodic flushing and writes the final metrics of the run. """
+    if not _STATE['enabled']:
+        return
+
+    _STATE['stop'].set()
+    if _STATE['thread'] is not None:
+        _STATE['thread'].join()
+
+    flush(final=True)
+    _STATE['enabled'] = False
+
+
+def _periodic(interval):
+    while not _STATE['stop'].wait(interval):
+        try:
+            flush()
+        except OSError:
+            pass  # metrics must never break a run, the final flush reports for real
+
+
+def _prometheus(snap):
+    command = snap['command']
+    lines   = []
+
+    def family(name, mtype, helptext):
+        lines.append("# HELP {0} {1}".format(name, helptext))
+        lines.append("# TYPE {0} {1}".format(name, mtype))
+
+    def sample(name, labels, value):
+        rendered = ",".join('{0}="{1}"'.format(key, _escape(str(val))) for key, val in [('command', command)] + labels)
+        lines.append("{0}{{{1}}} {2}".format(name, rendered, _number(value)))
+
+    family('sii_run_start_time_seconds', 'gauge', "Start of the run, seconds since epoch.")
+    sample('sii_run_start_time_seconds', [], _STATE['started'])
+
+    family('sii_run_elapsed_seconds', 'gauge', "Time the run has been going on.")
+    sample('sii_run_elapsed_seconds', [], snap['elapsed'])
+
+    family('sii_run_finished', 'gauge', "Whether the run has ended (1) or is still going on (0).")
+    sample('sii_run_finished', [], 1 if snap['final'] else 0)
+
+    family('sii_documents_total', 'counter', "Documents processed, by kind of processing and outcome.")
+    for kind, data in sorted(snap['kinds'].items()):
+        sample('sii_documents_total', [('kind', kind), ('outcome', 'ok')],    data['documents'] - data['failed'])
+        sample('sii_documents_total', [('kind', kind), ('outcome', 'error')], data['failed'])
+
+    family('sii_errors_total', 'counter', "Failed documents, by kind of processing and error type.")
+    for kind, data in sorted(snap['kinds'].items()):
+        for etype, count in sorted(data['errors'].items()):
+            sample('sii_errors_total', [('kind', kind), ('type', etype)], count)
+
+    family('sii_throughput_documents_per_second', 'gauge', "Documents processed per second of the run.")
+    for kind, data in sorted(snap['kinds'].items()):
+        sample('sii_throughput_documents_per_second', [('kind', kind)], data['throughput'])
+
+    family('sii_queue_depth', 'gauge', "Documents waiting in the processing queue when last sampled.")
+    for kind, data in sorted(snap['kinds'].items()):
+        if data['queue_depth'] is not None:
+            sample('sii_queue_depth', [('kind', kind)], data['queue_depth'])
+
+    family('sii_document_duration_seconds', 'histogram', "Time spent processing a single document.")
+    for kind, data in sorted(snap['kinds'].items()):
+        latency = data['latency']
+        if latency is None:
+            continue
+
+        for bound, acc in latency['buckets']:
+            sample('sii_document_duration_seconds_bucket', [('kind', kind), ('le', bound)], acc)
+
+        sample('sii_document_duration_seconds_sum',   [('kind', kind)], latency['sum'])
+        sample('sii_document_duration_seconds_count', [('kind', kind)], latency['count'])
+
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomic(fpath, text):
+    """ Textfile collectors may read at any moment, never let them see a partial file. """
+    dirpath = os.path.dirname(fpath)
+    os.makedirs(dirpath, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=dirpath, prefix='.metrics_')
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(text)
+
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, fpath)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+def _bound_label(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
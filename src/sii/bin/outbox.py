@@ -0,0 +1,63 @@
+""" Exchange Outbox (local sqlite ledger of sent envelopes, makes reruns idempotent)
+"""
+import time
+import hashlib
+
+from .database import Database
+
+__all__ = [
+    'Outbox',
+    'STATUS_SENT',
+    'STATUS_FAILED',
+    'STATUS_SKIPPED',
+    'content_hash'
+]
+
+STATUS_SENT    = 'SENT'
+STATUS_FAILED  = 'FAILED'
+STATUS_SKIPPED = 'SKIPPED'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sends (
+    hash       TEXT    NOT NULL,
+    recipient  TEXT    NOT NULL,
+    path       TEXT,
+    status     TEXT    NOT NULL,
+    error      TEXT    NOT NULL DEFAULT '',
+    attempts   INTEGER NOT NULL DEFAULT 0,
+    updated    REAL    NOT NULL,
+    PRIMARY KEY (hash, recipient)
+);
+"""
+
+
+def content_hash(payload):
+    return hashlib.sha256(payload).hexdigest()
+
+
+class Outbox(Database):
+
+    def __init__(self, db_path):
+        super().__init__(db_path, SCHEMA)
+
+    def status(self, digest, recipient):
+        row = self._conn.execute(
+            "SELECT status FROM sends WHERE hash = ? AND recipient = ?",
+            (digest, recipient or '')
+        ).fetchone()
+
+        return row[0] if row else None
+
+    def is_sent(self, digest, recipient):
+        return self.status(digest, recipient) == STATUS_SENT
+
+    def record(self, digest, recipient, status, path=None, error=''):
+        """ Committed right away, a crash right after a send must not lose it. """
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO sends (hash, recipient, path, status, error, attempts, updated) VALUES (?, ?, ?, ?, ?, 1, ?) "
+                "ON CONFLICT (hash, recipient) DO UPDATE SET "
+                "path = excluded.path, status = excluded.status, error = excluded.error, "
+                "attempts = attempts + 1, updated = excluded.updated",
+                (digest, recipient or '', path, status, error, time.time())
+            )
@@ -0,0 +1,56 @@
+""" Process Pools (sized to the work, or none at all when one process would do)
+
+Every pool worker loads what it needs once when starting (CAFs, keys), so a pool bigger than the batch
+only costs start up time. `process_pool` never starts more workers than there are jobs, and with a single
+one the work is done in this process, initializer included.
+"""
+import os
+
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+
+__all__ = [
+    'InlineExecutor',
+    'worker_count',
+    'process_pool'
+]
+
+
+class InlineExecutor(Executor):
+    """ Runs everything in this process: `submit` as it is called, `map` lazily as results are consumed. """
+
+    def __init__(self, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+
+        return future
+
+    def map(self, fn, *iterables, timeout=None, chunksize=1):
+        return map(fn, *iterables)
+
+
+def worker_count(workers=None, jobs=None):
+    """ Processes for `jobs` items (unknown if None) given a --workers count, 0 or None for one per CPU. """
+    count = workers or os.cpu_count() or 1
+
+    if jobs is not None:
+        count = min(count, jobs)
+
+    return max(count, 1)
+
+
+def process_pool(workers=None, jobs=None, initializer=None, initargs=()):
+    """ ProcessPoolExecutor of `worker_count(workers, jobs)` processes, an `InlineExecutor` if that is one. """
+    count = worker_count(workers, jobs)
+
+    if count == 1:
+        return InlineExecutor(initializer, initargs)
+
+    return ProcessPoolExecutor(max_workers=count, initializer=initializer, initargs=initargs)
@@ -0,0 +1,116 @@
+""" Batch Exchange Replies (acknowledgements, approvals and merchandise receipts for received envelopes)
+
+Every received envelope is parsed once for all the replies wanted of it. Replies are signed and written by
+a pool of processes, each getting the keyring when starting and loading a RUT's key and certificate once
+(for the first reply it signs) instead of once per reply. That takes python-xmlsec, without it replies are
+signed by sii.lib, which reads them again for every reply.
+"""
+import os
+import time
+import itertools
+import collections
+
+from lxml import etree
+
+from sii.lib import exchange, signature
+
+from sii.utils           import dsig
+from sii.utils.profiling import stage
+
+from .helpers import read_xml, stack_extension, write_xml
+from .pools   import process_pool
+
+__all__ = [
+    'REPLIES',
+    'Replied',
+    'load_signer',
+    'signer',
+    'sign',
+    'reply_files'
+]
+
+# Reply kind -> generator, in the order they are sent
+REPLIES = collections.OrderedDict((
+    ('ack',   exchange.create_exchange_response),    # <RespuestaDTE> receipt of the envelope
+    ('ok',    exchange.create_document_approval),    # <RespuestaDTE> approval of its contents
+    ('merch', exchange.create_merchandise_receipt)   # <EnvioRecibos> receipt of the merchandise
+))
+
+Replied = collections.namedtuple('Replied', ['path', 'outputs', 'error', 'seconds'])
+
+_KEYRING = None  # `Keyring` of this process, see `load_signer`
+
+
+def load_signer(keyring):
+    """ Signs with `keyring` in this process from now on, without one replies are left unsigned. """
+    global _KEYRING
+    _KEYRING = keyring
+
+
+def signer(xml):
+    """ Keyword arguments (key_path, cert_path) for sii.lib's signing of `xml`, by the keyring entry of its
+    `signing_rut`. Empty without a `load_signer` keyring.
+    """
+    if _KEYRING is None:
+        return {}
+
+    found = _KEYRING.signer_of(xml)
+    return {'key_path': found.key_path, 'cert_path': found.cert_path}
+
+
+def sign(xml, top_only=False):
+    """ `xml` signed (all of its signatures, or the topmost one) by the `load_signer` keyring entry of its
+    `signing_rut`, with the key it loaded once for this process.
+    """
+    if dsig.xmlsec is None or _KEYRING is None:
+        sigfunc = signature.sign_document if top_only else signature.sign_document_all
+        return sigfunc(xml=xml, **signer(xml))
+
+    found = _KEYRING.signer_of(xml)
+    dsig.sign_all(xml, dsig.signing_key(found.key_pem, found.cert_pem), top_only=top_only)
+
+    return xml
+
+
+def reply_files(paths, kinds, outdir, keyring=None, workers=None, root=None):
+    """ Generates the replies of `kinds` to every envelope in `paths`, yielding a `Replied` per file in
+    order. Replies are written to `outdir` as <envelope name>.<kind>.xml (at the same relative location as
+    the envelope, for envelopes below `root`), signed by the `keyring` entry of the replying RUT unless no
+    keyring is given. With a single worker (or envelope) everything happens in this process.
+    """
+    with process_pool(workers, len(paths), initializer=load_signer, initargs=(keyring,)) as executor:
+        replies = executor.map(
+            _reply_file, paths, itertools.repeat(kinds), itertools.repeat(outdir), itertools.repeat(root), chunksize=8
+        )
+
+        for replied in replies:
+            yield replied
+
+
+def _reply_file(xml_fpath, kinds, outdir, root=None):
+    started = time.perf_counter()
+    outputs = []
+    relpath = os.path.relpath(xml_fpath, root) if root else os.path.basename(xml_fpath)
+
+    try:
+        xml = read_xml(xml_fpath)
+    except etree.XMLSyntaxError as exc:
+        return Replied(xml_fpath, outputs, "Invalid XML: " + str(exc), time.perf_counter() - started)
+
+    for kind in kinds:
+        try:
+            reply = REPLIES[kind](xml)
+
+            if _KEYRING is not None:
+                # <EnvioRecibos> carries a signature per <Recibo> besides its own
+                with stage('sign'):
+                    reply = sign(reply)
+        except Exception as exc:
+            return Replied(xml_fpath, outputs, "{0}: {1}".format(kind, str(exc) or type(exc).__name__), time.perf_counter() - started)
+
+        fpath = stack_extension(os.path.join(outdir, relpath), kind)
+        os.makedirs(os.path.dirname(fpath) or '.', exist_ok=True)
+        write_xml(reply, fpath, encoding='ISO-8859-1')
+        outputs.append(os.path.abspath(fpath))
+
+    return Replied(xml_fpath, outputs, None, time.perf_counter() - started)
@@ -0,0 +1,71 @@
+""" Batch Stamping (bundling DTE's with their TED over a pool of processes)
+"""
+import os
+import time
+import itertools
+import collections
+
+from lxml import etree
+
+from sii.utils.api import bundle_dte, caf_pool
+
+from .folios  import document_key
+from .helpers import format_xml, read_xml, stack_extension, write_xml
+from .pools   import process_pool
+
+__all__ = [
+    'MODE_INPLACE',
+    'MODE_SUFFIXED',
+    'MODE_PRINT',
+    'Stamped',
+    'stamp_files'
+]
+
+MODE_INPLACE  = 'inplace'
+MODE_SUFFIXED = 'suffixed'
+MODE_PRINT    = 'print'
+
+Stamped = collections.namedtuple('Stamped', ['path', 'sink', 'key', 'output', 'error', 'seconds'])
+
+
+def stamp_files(paths, cafs_dir, mode, workers=None):
+    """ Bundles (stamps) every DTE in `paths`, yielding a `Stamped` per file in order.
+
+    Files are processed and written by the workers, each loading the CAFs once when starting. Only printed
+    output travels back. With a single worker (or file) everything happens in this process.
+    """
+    with process_pool(workers, len(paths), initializer=caf_pool, initargs=(cafs_dir,)) as executor:
+        for stamped in executor.map(_stamp_file, paths, itertools.repeat(cafs_dir), itertools.repeat(mode), chunksize=16):
+            yield stamped
+
+
+def _stamp_file(xml_fpath, cafs_dir, mode):
+    started = time.perf_counter()
+
+    try:
+        xml = read_xml(xml_fpath)
+    except etree.XMLSyntaxError as exc:
+        return Stamped(xml_fpath, None, None, None, "Invalid XML: " + str(exc), time.perf_counter() - started)
+
+    dte = bundle_dte(xml, cafs_dir)
+
+    sink   = None
+    output = None
+
+    if mode == MODE_INPLACE:
+        sink = xml_fpath
+        write_xml(dte, sink, encoding='ISO-8859-1')
+    elif mode == MODE_SUFFIXED:
+        sink = stack_extension(xml_fpath, 'dte')
+        write_xml(dte, sink, encoding='ISO-8859-1')
+    else:
+        output = format_xml(dte)
+
+    return Stamped(
+        path    = xml_fpath,
+        sink    = os.path.abspath(sink) if sink else None,
+        key     = document_key(dte),
+        output  = output,
+        error   = None,
+        seconds = time.perf_counter() - started
+    )
@@ -0,0 +1,201 @@
+""" Spool Directory Watching (inotify through ctypes, polling where that is not available)
+
+Watchers report the names of files in a directory once they are completely written: closed after
+writing or moved in (inotify), or unchanged since the previous scan (polling). Their first report is
+everything already in there (as soon as it is unchanged for a scan too, when polling). The checkpoint
+remembers what was processed, by modification time and size.
+"""
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import collections
+
+from .database import Database
+
+__all__ = [
+    'Checkpoint',
+    'InotifyWatcher',
+    'PollingWatcher',
+    'watcher'
+]
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_Q_OVERFLOW  = 0x00004000
+
+READ_SIZE = 64 * 1024  # bytes of events read at once
+
+_EVENT = struct.Struct('iIII')  # struct inotify_event without its name: wd, mask, cookie, len
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path      TEXT    PRIMARY KEY,
+    mtime_ns  INTEGER NOT NULL,
+    size      INTEGER NOT NULL,
+    status    TEXT    NOT NULL,
+    error     TEXT    NOT NULL DEFAULT '',
+    outputs   TEXT    NOT NULL DEFAULT '',
+    done      REAL    NOT NULL
+);
+"""
+
+
+def watcher(dirpath, interval=1.0):
+    """ Inotify watcher of `dirpath` where the kernel supports it, polling one otherwise. """
+    try:
+        return InotifyWatcher(dirpath)
+    except OSError:
+        return PollingWatcher(dirpath, interval)
+
+
+class InotifyWatcher:
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        self._rescan = True  # first report is a listing, also after the kernel dropped events
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            init = libc.inotify_init1
+        except (OSError, AttributeError) as exc:
+            raise OSError(errno.ENOSYS, "No inotify: {0}".format(str(exc)))
+
+        self._fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        if libc.inotify_add_watch(self._fd, os.fsencode(dirpath), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, "inotify_add_watch failed: {0}".format(dirpath))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def changes(self, timeout=None):
+        """ Names of the files completed since the last call, waiting up to `timeout` seconds for some. """
+        if self._rescan:
+            self._rescan = False
+            return _listing(self.dirpath)
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            buff = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        names  = []
+        offset = 0
+        while offset < len(buff):
+            _, mask, _, length = _EVENT.unpack_from(buff, offset)
+            offset += _EVENT.size
+
+            if mask & IN_Q_OVERFLOW:
+                self._rescan = True
+            elif length:
+                names.append(os.fsdecode(buff[offset:offset + length].rstrip(b'\0')))
+
+            offset += length
+
+        return list(collections.OrderedDict.fromkeys(names))
+
+
+class PollingWatcher:
+
+    def __init__(self, dirpath, interval=1.0):
+        self.dirpath   = dirpath
+        self.interval  = interval
+        self._previous = None  # name -> (mtime_ns, size) of the previous scan
+        self._reported = {}    # name -> (mtime_ns, size) when last reported
+        self._scanned  = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+    def changes(self, timeout=None):
+        if self._previous is None:
+            # what is already in there may be being written too, it is reported once settled as well
+            self._previous = self._scan()
+            self._scanned  = time.monotonic()
+
+        wait = self._scanned + self.interval - time.monotonic()
+        if wait > 0:
+            if timeout is not None and timeout < wait:
+                time.sleep(timeout)
+                return []
+            time.sleep(wait)
+
+        current = self._scan()
+        names   = []
+
+        for name, state in sorted(current.items()):
+            # settled: unchanged since the previous scan, and not reported as is already
+            if self._previous.get(name, None) == state and self._reported.get(name, None) != state:
+                self._reported[name] = state
+                names.append(name)
+
+        for name in set(self._reported) - set(current):
+            del self._reported[name]
+
+        self._previous = current
+        self._scanned  = time.monotonic()
+        return names
+
+    def _scan(self):
+        states = {}
+
+        with os.scandir(self.dirpath) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        states[entry.name] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    continue  # vanished meanwhile
+
+        return states
+
+
+class Checkpoint(Database):
+
+    def __init__(self, db_path):
+        super().__init__(db_path, SCHEMA)
+
+    def is_done(self, fpath, stat):
+        """ Whether `fpath` was processed (successfully or not) as it is now, changed files are not. """
+        row = self._conn.execute("SELECT mtime_ns, size FROM files WHERE path = ?", (fpath,)).fetchone()
+        return row is not None and tuple(row) == (stat.st_mtime_ns, stat.st_size)
+
+    def record(self, fpath, stat, status, error='', outputs=()):
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, mtime_ns, size, status, error, outputs, done)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (fpath, stat.st_mtime_ns, stat.st_size, status, error or '', "\n".join(outputs), time.time())
+            )
+
+
+def _listing(dirpath):
+    with os.scandir(dirpath) as entries:
+        return sorted(entry.name for entry in entries if entry.is_file())
@@ -0,0 +1,262 @@
+""" Minimal SII Web Service Client (seed, token and upload state queries)
+"""
+import ssl
+import time
+import socket
+import collections
+import http.client as client
+
+from xml.sax.saxutils import escape
+
+from lxml import etree
+
+from sii.lib import signature
+
+from sii.utils.profiling import stage
+
+
+__all__ = [
+    'HOST_TESTING',
+    'HOST_PRODUCTION',
+    'SoapError',
+    'UploadState',
+    'Probe',
+    'PROBE_STAGES',
+    'ssl_context',
+    'probe',
+    'request_seed',
+    'request_token',
+    'query_upload_state'
+]
+
+HOST_TESTING    = 'maullin.sii.cl'
+HOST_PRODUCTION = 'palena.sii.cl'
+
+PATH_SEED   = '/DTEWS/CrSeed.jws'
+PATH_TOKEN  = '/DTEWS/GetTokenFromSeed.jws'
+PATH_STATUS = '/DTEWS/QueryEstUp.jws'
+
+SOAP_ENVELOPE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<soapenv:Header/>'
+    '<soapenv:Body>{body}</soapenv:Body>'
+    '</soapenv:Envelope>'
+)
+
+TOKEN_TEMPL = (
+    '<getToken>'
+    '<item><Semilla>{seed}</Semilla></item>'
+    '<Signature xmlns="http://www.w3.org/2000/09/xmldsig#">'
+    '<SignedInfo>'
+    '<CanonicalizationMethod Algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315"/>'
+    '<SignatureMethod Algorithm="http://www.w3.org/2000/09/xmldsig#rsa-sha1"/>'
+    '<Reference URI="">'
+    '<Transforms><Transform Algorithm="http://www.w3.org/2000/09/xmldsig#enveloped-signature"/></Transforms>'
+    '<DigestMethod Algorithm="http://www.w3.org/2000/09/xmldsig#sha1"/>'
+    '<DigestValue/>'
+    '</Reference>'
+    '</SignedInfo>'
+    '<SignatureValue/>'
+    '<KeyInfo><KeyValue/><X509Data><X509Certificate/></X509Data></KeyInfo>'
+    '</Signature>'
+    '</getToken>'
+)
+
+PROBE_STAGES = ('dns', 'connect', 'tls', 'seed', 'token')
+
+Probe       = collections.namedtuple('Probe', ['host', 'timings', 'error'])
+UploadState = collections.namedtuple('UploadState', ['track_id', 'state', 'glosa', 'informed', 'accepted', 'rejected', 'objected'])
+
+
+class SoapError(Exception):
+    """ SII answered, but with an error status or an unparseable response. """
+    pass
+
+
+def ssl_context(verify=True):
+    context = ssl.create_default_context()
+
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode    = ssl.CERT_NONE
+
+    return context
+
+
+def probe(host, key_path, cert_path, context=None, timeout=30):
+    """ Walks through a full authentication against `host`, timing every stage on its own.
+
+    The seed and token are requested over the very connection whose DNS, connect and TLS stages were timed,
+    so (as long as the server keeps it alive) their timings are the SII's own. Returns a `Probe` with an
+    ordered mapping of stage to seconds for every stage that completed, and the exception that aborted it
+    (if any).
+    """
+    context = context or ssl_context()
+    timings = collections.OrderedDict()
+
+    hostname, _, port = host.partition(':')
+    port = int(port) if port else 443
+
+    try:
+        start = time.perf_counter()
+        addrs = socket.getaddrinfo(hostname, port, type=socket.SOCK_STREAM)
+        timings['dns'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sock  = socket.create_connection(addrs[0][4][:2], timeout=timeout)
+        timings['connect'] = time.perf_counter() - start
+
+        try:
+            start = time.perf_counter()
+            tls   = context.wrap_socket(sock, server_hostname=hostname)
+            timings['tls'] = time.perf_counter() - start
+        except Exception:
+            sock.close()
+            raise
+
+        connection      = _connection(host, context, timeout)
+        connection.sock = tls
+
+        try:
+            start = time.perf_counter()
+            seed  = request_seed(host, context, timeout, connection=connection)
+            timings['seed'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            request_token(host, key_path, cert_path, seed=seed, context=context, timeout=timeout, connection=connection)
+            timings['token'] = time.perf_counter() - start
+        finally:
+            connection.close()
+    except Exception as exc:
+        return Probe(host=host, timings=timings, error=exc)
+
+    return Probe(host=host, timings=timings, error=None)
+
+
+def request_seed(host, context=None, timeout=30, connection=None):
+    resp = _call(host, PATH_SEED, '<getSeed/>', context, timeout, connection)
+
+    state = _find_text(resp, 'ESTADO')
+    seed  = _find_text(resp, 'SEMILLA')
+
+    if state != '00' or not seed:
+        raise SoapError("Seed request to {0} failed with status: {1}".format(host, state))
+
+    return seed
+
+
+def request_token(host, key_path, cert_path, seed=None, context=None, timeout=30, connection=None):
+    if seed is None:
+        seed = request_seed(host, context, timeout, connection)
+
+    unsigned = etree.fromstring(TOKEN_TEMPL.format(seed=escape(seed)))
+
+    with stage('sign'):
+        signed = signature.sign_document(xml=unsigned, key_path=key_path, cert_path=cert_path)
+
+    payload = etree.tostring(signed, encoding='UTF-8', xml_declaration=True).decode('UTF-8')
+
+    body = '<getToken><pszXml>{0}</pszXml></getToken>'.format(escape(payload))
+    resp = _call(host, PATH_TOKEN, body, context, timeout, connection)
+
+    state = _find_text(resp, 'ESTADO')
+    token = _find_text(resp, 'TOKEN')
+
+    if state != '00' or not token:
+        raise SoapError("Token request to {0} failed with status: {1}".format(host, state))
+
+    return token
+
+
+def query_upload_state(host, token, rut, track_id, context=None, timeout=30):
+    rut_num, rut_dv = rut.upper().split('-')
+
+    body = (
+        '<getEstUp>'
+        '<RutCompania>{0}</RutCompania>'
+        '<DvCompania>{1}</DvCompania>'
+        '<TrackId>{2}</TrackId>'
+        '<Token>{3}</Token>'
+        '</getEstUp>'
+    ).format(escape(rut_num), escape(rut_dv), escape(str(track_id)), escape(token))
+
+    resp = _call(host, PATH_STATUS, body, context, timeout)
+
+    state = _find_text(resp, 'ESTADO')
+    if state is None:
+        raise SoapError("Could not find <ESTADO> in state response for track id {0}".format(track_id))
+
+    # Numeric codes (-3, -11, 001, ...) are errors of the query itself (token, RUT, SII internals), no state
+    if state.lstrip('-').isdigit():
+        raise SoapError("State query for track id {0} failed with status: {1} {2}".format(
+            track_id, state, _find_text(resp, 'GLOSA') or ''
+        ).strip())
+
+    return UploadState(
+        track_id = str(track_id),
+        state    = state,
+        glosa    = _find_text(resp, 'GLOSA') or '',
+        informed = _find_int(resp, 'INFORMADOS'),
+        accepted = _find_int(resp, 'ACEPTADOS'),
+        rejected = _find_int(resp, 'RECHAZADOS'),
+        objected = _find_int(resp, 'REPAROS')
+    )
+
+
+def _connection(host, context, timeout):
+    hostname, _, port = host.partition(':')
+    return client.HTTPSConnection(hostname, int(port) if port else 443, timeout=timeout, context=context or ssl_context())
+
+
+def _call(host, path, body, context, timeout, connection=None):
+    """ POST a SOAP envelope and return the parsed inner SII response (which comes escaped inside the
+    <*Return> element of the SOAP body). Over `connection` if given, which is kept open, else a new one.
+    """
+    url  = 'https://{0}{1}'.format(host, path)
+    data = SOAP_ENVELOPE.format(body=body).encode('UTF-8')
+    conn = connection or _connection(host, context, timeout)
+
+    try:
+        with stage('network'):
+            conn.request('POST', path, body=data, headers={
+                'Content-Type': 'text/xml; charset=UTF-8',
+                'SOAPAction':   ''
+            })
+            resp = conn.getresponse()
+            buff = resp.read()
+    finally:
+        if connection is None:
+            conn.close()
+
+    if resp.status != 200:
+        raise SoapError("HTTP {0} {1} from {2}".format(resp.status, resp.reason, url))
+
+    envelope = etree.fromstring(buff)
+
+    returns = envelope.xpath("//*[substring(local-name(), string-length(local-name()) - 5) = 'Return']")
+    if not returns or not returns[0].text:
+        raise SoapError("Unexpected SOAP response from {0}".format(url))
+
+    try:
+        return etree.fromstring(returns[0].text.strip().encode('UTF-8'))
+    except etree.XMLSyntaxError as exc:
+        raise SoapError("Unparseable SII response from {0}: {1}".format(url, str(exc)))
+
+
+def _find_text(tree, name):
+    found = tree.xpath("//*[local-name() = $name]", name=name)
+
+    if not found or found[0].text is None:
+        return None
+
+    return found[0].text.strip()
+
+
+def _find_int(tree, name):
+    text = _find_text(tree, name)
+
+    try:
+        return int(text) if text else 0
+    except ValueError:
+        return 0
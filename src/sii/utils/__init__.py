@@ -0,0 +1,2 @@
+""" CNS SII Utilities as a Library (see `api`)
+"""
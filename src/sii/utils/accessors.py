@@ -0,0 +1,211 @@
+""" SII Field Accessors (precompiled paths over plain etree trees, with or without the SII namespace)
+
+Nothing here needs objectify parsing, so bulk paths can stay on plain `etree`. A `Field` or `Nodes` is an
+XPath compiled once, at import, for one-off reads (the <Caratula> of a libro). A `Record` reads all of its
+fields from a single pass over the children of an element, several times cheaper per field than either
+that or objectify attribute chains, for what is read per item (<Encabezado>, <Detalle>). Names are matched
+by local name, namespaced documents or not alike.
+"""
+import collections
+
+from lxml import etree
+
+__all__ = [
+    'Field',
+    'Nodes',
+    'Record',
+
+    'DTES',
+    'ENCABEZADOS',
+    'ENCABEZADO',
+
+    'LIBRO_RUT',
+    'LIBRO_SENDER',
+    'LIBRO_OPERATION',
+    'LIBRO_INTERVAL',
+    'LIBRO_SUBMISSION',
+    'LIBRO_PERIOD',
+    'LIBRO_TOTALS',
+    'LIBRO_DETALLES',
+    'TOTALES_PERIODO',
+    'DETALLE'
+]
+
+
+class Field:
+    """ Stripped text of the first element at `path` (relative to the element it is called with), converted
+    with `convert`. Missing or empty ones read as `default`.
+    """
+
+    __slots__ = ('path', 'convert', '_xpath')
+
+    def __init__(self, path, convert=str):
+        self.path    = path
+        self.convert = convert
+        self._xpath  = etree.XPath("string({0})".format(_steps(path)))
+
+    def __call__(self, elem, default=None):
+        text = self._xpath(elem).strip()
+        return self.convert(text) if text else default
+
+    def __repr__(self):
+        return "Field({0!r})".format(self.path)
+
+
+class Nodes:
+    """ Elements at `path`, relative to the element it is called with. """
+
+    __slots__ = ('path', '_xpath')
+
+    def __init__(self, path):
+        self.path   = path
+        self._xpath = etree.XPath(_steps(path))
+
+    def __call__(self, elem):
+        return self._xpath(elem)
+
+    def __repr__(self):
+        return "Nodes({0!r})".format(self.path)
+
+    def first(self, elem):
+        found = self._xpath(elem)
+        return found[0] if found else None
+
+
+class Record:
+    """ Fields of an element read from its children at once, as a namedtuple `typename`. Each field is
+    `(name, convert)`: the stripped text of the first child `name` converted (`None` if missing or empty),
+    or that child read as a `Record` when `convert` is one. A trailing `*` in `name` reads all of those
+    children as a tuple instead.
+    """
+
+    __slots__ = ('type', '_fields')
+
+    def __init__(self, typename, **fields):
+        self.type    = collections.namedtuple(typename, list(fields))
+        self._fields = [
+            (name.rstrip('*'), name.endswith('*'), convert) for name, convert in fields.values()
+        ]
+
+    def __call__(self, elem):
+        children = {}
+        for child in elem.iterchildren(tag=etree.Element):
+            tag = child.tag
+            children.setdefault(tag[tag.find('}') + 1:], child)
+
+        values = []
+        for name, many, convert in self._fields:
+            if many:
+                values.append(tuple(
+                    _convert(child, convert) for child in elem.iterchildren('{*}' + name)
+                ))
+            else:
+                child = children.get(name, None)
+                values.append(_convert(child, convert) if child is not None else None)
+
+        return self.type(*values)
+
+    def __repr__(self):
+        return "Record({0})".format(self.type.__name__)
+
+
+def _convert(elem, convert):
+    if isinstance(convert, Record):
+        return convert(elem)
+
+    text = elem.text
+    return convert(text.strip()) if text and text.strip() else None
+
+
+def _steps(path):
+    """ XPath of a slash separated path of local names, a leading // also matches the context element. """
+    axis = ''
+    if path.startswith('//'):
+        axis = 'descendant-or-self::'
+        path = path[2:]
+
+    return axis + "/".join("*[local-name() = '{0}']".format(name) for name in path.split('/'))
+
+
+# <DTE>'s of a document (itself one or any envelope of them) and their <Encabezado>'s
+DTES        = Nodes('//DTE')
+ENCABEZADOS = Nodes('//Encabezado')
+
+ENCABEZADO = Record(
+    'Encabezado',
+    id_doc   = ('IdDoc', Record(
+        'IdDoc',
+        dte_type = ('TipoDTE', int),
+        folio    = ('Folio',   int),
+        issued   = ('FchEmis', str)
+    )),
+    emitter  = ('Emisor', Record(
+        'Emisor',
+        rut  = ('RUTEmisor', str),
+        name = ('RznSoc',    str)
+    )),
+    receiver = ('Receptor', Record(
+        'Receptor',
+        rut  = ('RUTRecep',    str),
+        name = ('RznSocRecep', str)
+    )),
+    totals   = ('Totales', Record(
+        'Totales',
+        net      = ('MntNeto',  int),
+        exempt   = ('MntExe',   int),
+        vat_rate = ('TasaIVA',  str),
+        vat      = ('IVA',      int),
+        gross    = ('MntTotal', int),
+        taxes    = ('ImptoReten*', Record(
+            'ImptoReten',
+            code   = ('TipoImp',  int),
+            rate   = ('TasaImp',  str),
+            amount = ('MontoImp', int)
+        ))
+    ))
+)
+
+# <Caratula> of a <LibroCompraVenta>
+LIBRO_RUT        = Field('EnvioLibro/Caratula/RutEmisorLibro')
+LIBRO_SENDER     = Field('EnvioLibro/Caratula/RutEnvia')
+LIBRO_OPERATION  = Field('EnvioLibro/Caratula/TipoOperacion')
+LIBRO_INTERVAL   = Field('EnvioLibro/Caratula/TipoLibro')
+LIBRO_SUBMISSION = Field('EnvioLibro/Caratula/TipoEnvio')
+LIBRO_PERIOD     = Field('EnvioLibro/Caratula/PeriodoTributario')
+LIBRO_TOTALS     = Nodes('EnvioLibro/ResumenPeriodo/TotalesPeriodo')
+LIBRO_DETALLES   = Nodes('EnvioLibro/Detalle')
+
+TOTALES_PERIODO = Record(
+    'TotalesPeriodo',
+    dte_type  = ('TpoDoc',      int),
+    documents = ('TotDoc',      int),
+    exempt    = ('TotMntExe',   int),
+    net       = ('TotMntNeto',  int),
+    vat       = ('TotMntIVA',   int),
+    gross     = ('TotMntTotal', int),
+    taxes     = ('TotOtrosImp*', Record(
+        'TotOtrosImp',
+        code   = ('CodImp',    int),
+        amount = ('TotMntImp', int)
+    ))
+)
+
+# <Detalle> of a libro
+DETALLE = Record(
+    'Detalle',
+    dte_type = ('TpoDoc',   str),
+    folio    = ('NroDoc',   str),
+    issued   = ('FchDoc',   str),
+    rut      = ('RUTDoc',   str),
+    name     = ('RznSoc',   str),
+    exempt   = ('MntExe',   int),
+    net      = ('MntNeto',  int),
+    vat      = ('MntIVA',   int),
+    gross    = ('MntTotal', int),
+    taxes    = ('OtrosImp*', Record(
+        'OtrosImp',
+        code   = ('CodImp',  int),
+        rate   = ('TasaImp', float),
+        amount = ('MntImp',  int)
+    ))
+)
@@ -0,0 +1,315 @@
+""" In-process API (bundling, signing, verification, unbundling, libro stats and PDF's without the CLI)
+
+What the `sii` commands do, for Python services: no docopt, nothing printed or written and no `SystemExit`.
+Documents go in as parsed trees or bytes (see `parse`) and come out as trees (see `serialize`), the batch
+functions take and lazily yield iterables of them. Bad input raises `ValueError`, a missing key for a RUT
+`KeyError`. CAF's, companies files and keys are loaded once per process and kept, so calling these per
+document costs no more than the work itself. The `sii` commands are thin wrappers around them.
+"""
+import base64
+import collections
+import copy
+
+from lxml import etree
+
+from sii.lib import printing, schemas, signature
+from sii.lib import types
+
+from . import accessors as acc
+from .documents import format_xml, validate_schema
+from .dsig      import sign_stale, verify_signatures
+from .headers   import header_of
+from .keyring   import Keyring
+from .lazyxml   import LazyDocument
+from .profiling import stage
+
+__all__ = [
+    'MEDIUMS',
+    'SIGN_TOP',
+    'SIGN_ALL',
+    'SIGN_INCREMENTAL',
+    'TAX_ADVANCE',
+    'TAX_RETENTION',
+
+    'LibroSummary',
+    'LibroTotals',
+    'LibroItem',
+
+    'Keyring',
+
+    'parse',
+    'serialize',
+    'document_name',
+    'company_pool',
+    'caf_pool',
+
+    'bundle_dte',
+    'bundle_dtes',
+    'bundle_enviodte',
+    'bundle_libro_ventas',
+    'unbundle_enviodte',
+
+    'sign',
+    'sign_all',
+
+    'verify_signatures',
+    'verify_schema',
+
+    'libro_summary',
+    'libro_items',
+
+    'render_tex',
+    'render_pdf',
+    'render_pdfs'
+]
+
+MEDIUMS = ('carta', 'oficio', 'thermal80mm')
+
+# What `sign` signs: the topmost signode, all of them, or only those no longer valid (see `dsig.sign_stale`)
+SIGN_TOP         = 'top'
+SIGN_ALL         = 'all'
+SIGN_INCREMENTAL = 'incremental'
+
+# Codes of the other taxes (<OtrosImp>) of a libro, by whether they are withheld or paid in advance
+TAX_ADVANCE   = (19,)
+TAX_RETENTION = (15, 33, 331, 34, 39)
+
+LibroSummary = collections.namedtuple('LibroSummary', [
+    'rut', 'sender', 'operation', 'interval', 'submission', 'period', 'totals'
+])
+LibroTotals = collections.namedtuple('LibroTotals', [
+    'dte_type', 'documents', 'net', 'exempt', 'vat', 'retained', 'advanced', 'gross', 'taxes'
+])
+LibroItem = collections.namedtuple('LibroItem', [
+    'dte_type', 'folio', 'issued', 'rut', 'name', 'net', 'exempt', 'vat', 'gross', 'retained', 'advanced'
+])
+
+_COMPANY_POOLS = {}
+_CAF_POOLS     = {}
+
+
+def parse(source):
+    """ Root element of `source`: XML as bytes, or an already parsed tree (returned as it is). """
+    if isinstance(source, etree._ElementTree):
+        return source.getroot()
+    if isinstance(source, etree._Element):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        try:
+            return etree.fromstring(bytes(source))
+        except etree.XMLSyntaxError as exc:
+            raise ValueError("Invalid XML: {0}".format(exc)) from exc
+
+    raise ValueError("Expected XML as bytes or a parsed tree, got: {0}".format(type(source).__name__))
+
+
+def serialize(xml, encoding='ISO-8859-1'):
+    """ Bytes of a document as the commands write it (declaration included). """
+    return format_xml(parse(xml), encoding=encoding)
+
+
+def document_name(xml, extension='xml'):
+    """ <RUT>_<TipoDTE>_<Folio>.<extension>, the name a document is written as when generating names. """
+    header = header_of(parse(xml))
+    return "{0}_{1}_{2}.{3}".format(header.rut_number, header.dte_type, header.folio, extension)
+
+
+def company_pool(companies):
+    """ CompanyPool of the `companies` file, read only once per process (pools are returned as they are). """
+    if companies is None or isinstance(companies, types.CompanyPool):
+        return companies
+
+    pool = _COMPANY_POOLS.get(companies, None)
+
+    if pool is None:
+        pool = types.CompanyPool.from_file(companies)
+        _COMPANY_POOLS[companies] = pool
+
+    return pool
+
+
+def caf_pool(cafs_dir):
+    """ CAFPool of `cafs_dir`, read (and its RSASK keys loaded) only once per process. """
+    pool = _CAF_POOLS.get(cafs_dir, None)
+
+    if pool is None:
+        pool = types.CAFPool(cafs_dir)
+        _CAF_POOLS[cafs_dir] = pool
+
+    return pool
+
+
+def bundle_dte(xml, cafs):
+    """ <DTE> stamped with its TED, by the CAF's of the `cafs` directory (or a CAFPool). """
+    pool = cafs if isinstance(cafs, types.CAFPool) else caf_pool(cafs)
+
+    with stage('bundle'):
+        return schemas.bundle_dte(parse(xml), pool)
+
+
+def bundle_dtes(xmls, cafs):
+    for xml in xmls:
+        yield bundle_dte(xml, cafs)
+
+
+def bundle_enviodte(dtes, companies, to_sii):
+    """ <EnvioDTE> of `dtes`, to the SII or for exchange with the receiver (`to_sii` false). """
+    return schemas.bundle_enviodte([parse(dte) for dte in dtes], company_pool(companies), to_sii=to_sii)
+
+
+def bundle_libro_ventas(dtes):
+    return schemas.bundle_libro_ventas([parse(dte) for dte in dtes])
+
+
+def unbundle_enviodte(enviodte):
+    """ <DTE>'s of an envelope, as documents of their own. """
+    return schemas.unbundle_enviodte(parse(enviodte))
+
+
+def sign(xml, keyring, mode=SIGN_TOP):
+    """ Signed copy of a document, by the key and certificate of its emitter in `keyring` (the given tree is
+    left as it is, whatever the `mode`).
+    """
+    if mode not in (SIGN_TOP, SIGN_ALL, SIGN_INCREMENTAL):
+        raise ValueError("Unknown signing mode: {0}".format(mode))
+
+    xml    = parse(xml)
+    signer = keyring.signer_of(xml)
+
+    with stage('sign'):
+        if mode == SIGN_INCREMENTAL:
+            signed = copy.deepcopy(xml)
+            if sign_stale(signed, signer.key_pem, signer.cert_pem) is not None:
+                return signed
+
+        sigfunc = signature.sign_document if mode == SIGN_TOP else signature.sign_document_all
+        return sigfunc(xml=xml, key_path=signer.key_path, cert_path=signer.cert_path)
+
+
+def sign_all(xmls, keyring, mode=SIGN_TOP):
+    for xml in xmls:
+        yield sign(xml, keyring, mode)
+
+
+def verify_schema(xml, xsd=None):
+    """ Why a document does not validate against the `xsd` file (the library's own schema for its type if
+    not given), `None` if it does.
+    """
+    try:
+        validate_schema(parse(xml), xsd)
+    except etree.DocumentInvalid as exc:
+        return str(exc)
+
+    return None
+
+
+def libro_summary(lcv):
+    """ `LibroSummary` of a <LibroCompraVenta> (bytes, tree or a `LazyDocument`, of which only what comes
+    before the first <Detalle> is parsed).
+    """
+    head = lcv.head() if isinstance(lcv, LazyDocument) else parse(lcv)
+
+    totals = []
+    for total in (acc.TOTALES_PERIODO(node) for node in acc.LIBRO_TOTALS(head)):
+        taxes = collections.defaultdict(lambda: 0)
+        for tax in total.taxes:
+            taxes[tax.code] += tax.amount
+
+        retained, advanced = _split_taxes(taxes.items())
+
+        totals.append(LibroTotals(
+            dte_type  = total.dte_type,
+            documents = total.documents,
+            net       = total.net or 0,
+            exempt    = total.exempt or 0,
+            vat       = total.vat or 0,
+            retained  = retained,
+            advanced  = advanced,
+            gross     = total.gross or 0,
+            taxes     = collections.OrderedDict(sorted(taxes.items()))
+        ))
+
+    return LibroSummary(
+        rut        = acc.LIBRO_RUT(head),
+        sender     = acc.LIBRO_SENDER(head),
+        operation  = acc.LIBRO_OPERATION(head),
+        interval   = acc.LIBRO_INTERVAL(head),
+        submission = acc.LIBRO_SUBMISSION(head),
+        period     = acc.LIBRO_PERIOD(head),
+        totals     = totals
+    )
+
+
+def libro_items(lcv):
+    """ `LibroItem` per <Detalle> of a libro, in order. A `LazyDocument` is parsed one <Detalle> at a time. """
+    nodes = iter(lcv) if isinstance(lcv, LazyDocument) else acc.LIBRO_DETALLES(parse(lcv))
+
+    for item in (acc.DETALLE(node) for node in nodes):
+        retained, advanced = _split_taxes((tax.code, tax.amount) for tax in item.taxes)
+
+        yield LibroItem(
+            dte_type = int(item.dte_type),
+            folio    = int(item.folio),
+            issued   = item.issued,
+            rut      = item.rut,
+            name     = item.name,
+            net      = item.net or 0,
+            exempt   = item.exempt or 0,
+            vat      = item.vat or 0,
+            gross    = item.gross or 0,
+            retained = retained,
+            advanced = advanced
+        )
+
+
+def render_tex(xml, companies=None, medium='carta', cedible=False, draft=False):
+    """ (template, resources) of the printable version of a <DTE>. Without `companies` (a file or pool) it
+    is printed as received from a third party.
+    """
+    xml = parse(xml)
+
+    if medium not in MEDIUMS:
+        raise ValueError("Unknown medium to generate printable template for: {0}".format(medium))
+
+    if cedible and header_of(xml).dte_type in (56, 61):
+        raise ValueError("NC and ND are not subject to the argument --cedible. Will not proceed...")
+
+    pool = company_pool(companies)
+
+    with stage('template'):
+        return printing.create_template(
+            dte_xml = xml,
+            medium  = medium,
+            company = pool,
+            cedible = cedible,
+            draft   = draft
+        )
+
+
+def render_pdf(xml, companies=None, medium='carta', cedible=False, draft=False):
+    """ PDF (bytes) of a <DTE>, see `render_tex`. """
+    template, resources = render_tex(xml, companies, medium, cedible, draft)
+
+    with stage('tex'):
+        return base64.b64decode(printing.tex_to_pdf(template, resources))
+
+
+def render_pdfs(xmls, companies=None, medium='carta', cedible=False, draft=False):
+    for xml in xmls:
+        yield render_pdf(xml, companies, medium, cedible, draft)
+
+
+def _split_taxes(taxes):
+    """ (withheld, paid in advance) sums of (code, amount) pairs. """
+    retained = 0
+    advanced = 0
+
+    for code, amount in taxes:
+        if code in TAX_RETENTION:
+            retained += amount
+        elif code in TAX_ADVANCE:
+            advanced += amount
+        else:
+            raise ValueError("Missing Retention/Advance information for Tax code: {0}".format(code))
+
+    return retained, advanced
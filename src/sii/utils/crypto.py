@@ -0,0 +1,43 @@
+""" Plain RSA (PKCS#1 v1.5 with SHA1, or SHA256) as used by the SII for TED stamps and XML signatures
+
+Only verification: signing is left to xmlsec (see `dsig`) and sii.lib.
+"""
+import hmac
+import base64
+import hashlib
+
+__all__ = [
+    'rsa_verify'
+]
+
+# DER encoded DigestInfo prefixes, the digest itself follows
+_DIGESTINFOS = {
+    'sha1':   bytes.fromhex('3021300906052b0e03021a05000414'),
+    'sha256': bytes.fromhex('3031300d060960864801650304020105000420')
+}
+
+
+def rsa_verify(message, signature, modulus, exponent, digest='sha1'):
+    """ Verifies a RSASSA-PKCS1-v1_5 `signature` (bytes or base64 str) of `message` (bytes) hashed with
+    `digest` ('sha1' or 'sha256').
+    """
+    if isinstance(signature, str):
+        signature = base64.b64decode(signature)
+
+    size = (modulus.bit_length() + 7) // 8
+    if len(signature) != size:
+        return False
+
+    sig_int = int.from_bytes(signature, 'big')
+    if sig_int >= modulus:
+        return False
+
+    encoded  = pow(sig_int, exponent, modulus).to_bytes(size, 'big')
+    expected = _pad(message, size, digest)
+
+    return hmac.compare_digest(encoded, expected)
+
+
+def _pad(message, size, digest):
+    digest_info = _DIGESTINFOS[digest] + hashlib.new(digest, message).digest()
+    return b'\x00\x01' + b'\xff' * (size - len(digest_info) - 3) + b'\x00' + digest_info
@@ -0,0 +1,60 @@
+""" Documents as Bytes (serialized as the commands write them) and their Schema Validation
+"""
+import os
+
+from lxml import etree
+
+from sii.lib import validation
+
+from .profiling import stage
+
+__all__ = [
+    'XML_DECL',
+    'format_xml',
+    'load_schema',
+    'validate_schema'
+]
+
+_SCHEMA_CACHE = {}
+
+XML_DECL = lambda enc: b'<?xml version="1.0" encoding="' + bytes(enc, enc) + b'"?>'
+
+
+def format_xml(xtree, end='\n', encoding='UTF-8'):
+    """ Bytes of a document as `helpers.print_xml` outputs it, e.g. to print from another process. """
+    with stage('serialize'):
+        bytebuff = etree.tostring(
+            xtree,
+            pretty_print    = True,
+            method          = 'xml',
+            encoding        = encoding,
+            xml_declaration = False
+        )
+
+    encoded_end = bytes(end, encoding)
+    return XML_DECL(encoding) + encoded_end + bytebuff + encoded_end
+
+
+def load_schema(xsd_fpath):
+    """ Parses and compiles an XSD only once per process. """
+    xsd_fpath = os.path.abspath(xsd_fpath)
+    schema    = _SCHEMA_CACHE.get(xsd_fpath, None)
+
+    if schema is None:
+        with open(xsd_fpath, 'rb') as fh:
+            schema = etree.XMLSchema(etree.parse(fh))
+
+        _SCHEMA_CACHE[xsd_fpath] = schema
+
+    return schema
+
+
+def validate_schema(xtree, xsd_fpath=None):
+    """ Raises `etree.DocumentInvalid` if not valid. Without an explicit XSD the one known to the library
+    for the document type is used.
+    """
+    with stage('validate'):
+        if xsd_fpath is None:
+            validation.validate_schema(xtree)
+        else:
+            load_schema(xsd_fpath).assertValid(xtree)
@@ -0,0 +1,585 @@
+""" XML Signatures (reference digests first, RSA only where they match, certificates parsed once)
+
+`verify_signatures` is a drop-in for sii.lib's `validate_signatures`, one (uri, validity) per <Signature>.
+The <DigestValue> of every reference is recomputed first, which is only canonicalization and hashing, so
+tampered documents fail there without any RSA. The <SignatureValue> is checked only where all digests
+match, against the key of the embedded certificate, parsed once per process and then looked up by its
+fingerprint. What this does not handle (algorithms, references or keys) is left to xmlsec, as before.
+
+`sign_all` fills the <Signature>'s of a document with python-xmlsec, with a key loaded once per process by
+`signing_key` instead of once per document as sii.lib's signing (by key and cert paths) does. `sign_stale`
+signs, the same way, only the signatures that do not hold (anymore), innermost first so enclosing ones are
+digested over their updated contents, and verifies each once signed. Nothing is signed here without xmlsec.
+"""
+import re
+import copy
+import hmac
+import base64
+import hashlib
+import binascii
+import itertools
+import collections
+
+from lxml import etree
+
+from sii.lib import validation
+
+try:
+    import xmlsec
+except ImportError:  # only needed for signing, callers fall back to sii.lib's signing without it
+    xmlsec = None
+
+from .crypto import rsa_verify
+
+__all__ = [
+    'verify_signatures',
+    'sign_stale',
+    'sign_all',
+    'signing_key',
+    'certificate_key',
+    'load_certificate'
+]
+
+DS_NS = 'http://www.w3.org/2000/09/xmldsig#'
+
+ENVELOPED = 'http://www.w3.org/2000/09/xmldsig#enveloped-signature'
+
+# Canonicalizations (as transforms too) by algorithm URI, as lxml's c14n arguments
+C14NS = {
+    'http://www.w3.org/TR/2001/REC-xml-c14n-20010315':              {'exclusive': False, 'with_comments': False},
+    'http://www.w3.org/TR/2001/REC-xml-c14n-20010315#WithComments': {'exclusive': False, 'with_comments': True},
+    'http://www.w3.org/2001/10/xml-exc-c14n#':                      {'exclusive': True,  'with_comments': False},
+    'http://www.w3.org/2001/10/xml-exc-c14n#WithComments':          {'exclusive': True,  'with_comments': True}
+}
+
+DIGESTS = {
+    'http://www.w3.org/2000/09/xmldsig#sha1':  'sha1',
+    'http://www.w3.org/2001/04/xmlenc#sha256': 'sha256'
+}
+
+SIGNATURE_METHODS = {
+    'http://www.w3.org/2000/09/xmldsig#rsa-sha1':        'sha1',
+    'http://www.w3.org/2001/04/xmldsig-more#rsa-sha256': 'sha256'
+}
+
+CERTIFICATE_CACHE_SIZE = 256  # keys of certificates kept per process, by fingerprint
+
+_RSA_OID = bytes.fromhex('06092a864886f70d010101')  # rsaEncryption, DER encoded
+
+_PEM    = re.compile(br'-----BEGIN ([A-Z ]+)-----(.*?)-----END \1-----', re.DOTALL)
+_SPACES = re.compile(r'\s+')
+
+_SIGNATURES = etree.XPath('//ds:Signature', namespaces={'ds': DS_NS})
+_IDS        = etree.XPath('//*[@ID]')
+
+_CERTIFICATES = collections.OrderedDict()  # fingerprint -> (modulus, exponent), None if not an RSA key
+_KEYS         = {}                         # fingerprint of key and cert PEMs -> xmlsec key
+
+
+def verify_signatures(xml):
+    """ (uri, validity) of every <Signature> in `xml`, in document order. """
+    root = xml.getroot() if isinstance(xml, etree._ElementTree) else xml
+    ids  = _IdIndex(root)
+
+    signatures = _SIGNATURES(root)
+    verdicts   = [_check_references(signature, root, ids) for signature in signatures]
+
+    # RSA only for the ones whose digests all match
+    for idx, (signature, (uri, verdict)) in enumerate(zip(signatures, verdicts)):
+        if verdict:
+            verdicts[idx] = (uri, _check_value(signature))
+
+    if all(verdict is not None for _, verdict in verdicts):
+        return verdicts
+
+    full = validation.validate_signatures(xml)
+    if len(full) != len(verdicts):
+        return full
+
+    return [mine if mine[1] is not None else theirs for mine, theirs in zip(verdicts, full)]
+
+
+def certificate_key(der):
+    """ (modulus, exponent) of the RSA key of a DER certificate, None if it has none. Cached by fingerprint. """
+    fingerprint = hashlib.sha1(der).digest()
+
+    if fingerprint in _CERTIFICATES:
+        _CERTIFICATES.move_to_end(fingerprint)
+        return _CERTIFICATES[fingerprint]
+
+    try:
+        key = _parse_certificate_key(der)
+    except (IndexError, ValueError):
+        key = None
+
+    _CERTIFICATES[fingerprint] = key
+    if len(_CERTIFICATES) > CERTIFICATE_CACHE_SIZE:
+        _CERTIFICATES.popitem(last=False)
+
+    return key
+
+
+def sign_stale(xml, key_pem, cert_pem):
+    """ Signs, in place, the signatures of `xml` whose digests or signature value do not hold, or that are
+    not by `cert_pem`, and those enclosing them. Returns how many were signed, or None without touching
+    anything when some signature cannot be signed here or there is no python-xmlsec (sign the document with
+    sii.lib then). Raises `ValueError` if a signature does not hold once signed (a key not of `cert_pem`).
+    """
+    if xmlsec is None:
+        return None
+
+    root = xml.getroot() if isinstance(xml, etree._ElementTree) else xml
+    ids  = _IdIndex(root)
+
+    try:
+        cert = load_certificate(cert_pem)
+    except ValueError:
+        return None
+
+    if certificate_key(cert) is None:
+        return None
+
+    signatures = _SIGNATURES(root)
+    plans      = []
+
+    for signature in signatures:
+        references = _sign_plan(signature, root, ids)
+        if references is None:
+            return None
+
+        node, _, _, _ = references[0][1]
+        plans.append((_depth(node), signature, references))
+
+    if not plans:
+        return None
+
+    # innermost first (deepest referenced node), the document order of siblings kept
+    plans.sort(key=lambda plan: -plan[0])
+
+    # those not holding and those enclosing them
+    stale = []
+    for _, signature, references in plans:
+        nodes    = [resolved[0] for _, resolved in references]
+        encloses = any(_within(other, node) for other, _ in stale for node in nodes)
+
+        if encloses or not _holds(signature, references, cert):
+            stale.append((signature, references))
+
+    if stale:
+        context = _signing_context(root, signing_key(key_pem, cert_pem))
+
+    for signature, references in stale:
+        context.sign(signature)
+
+        if not _holds(signature, references, cert):
+            raise ValueError("Signature of {0} does not hold once signed, is the key that of the certificate?".format(
+                references[0][0].get('URI')
+            ))
+
+    return len(stale)
+
+
+def signing_key(key_pem, cert_pem):
+    """ xmlsec key of a PEM key and certificate, loaded once per process. Raises `RuntimeError` without
+    python-xmlsec.
+    """
+    if xmlsec is None:
+        raise RuntimeError("Signing with loaded keys needs python-xmlsec")
+
+    fingerprint = hashlib.sha1(key_pem + b'\0' + cert_pem).digest()
+
+    key = _KEYS.get(fingerprint, None)
+    if key is None:
+        key = xmlsec.Key.from_memory(key_pem, xmlsec.constants.KeyDataFormatPem)
+        key.load_cert_from_memory(cert_pem, xmlsec.constants.KeyDataFormatPem)
+        _KEYS[fingerprint] = key
+
+    return key
+
+
+def sign_all(xml, key, top_only=False):
+    """ Signs, in place, every <Signature> of `xml` (only the topmost one with `top_only`, as sii.lib's
+    `sign_document`) with a `signing_key`, innermost first so enclosing ones are digested over their signed
+    contents. Returns how many were signed.
+    """
+    root = xml.getroot() if isinstance(xml, etree._ElementTree) else xml
+
+    if top_only:
+        signatures = sorted(_SIGNATURES(root), key=_depth)[:1]
+    else:
+        signatures = sorted(_SIGNATURES(root), key=_depth, reverse=True)
+
+    context = _signing_context(root, key)
+
+    for signature in signatures:
+        context.sign(signature)
+
+    return len(signatures)
+
+
+def load_certificate(pem):
+    """ DER of a PEM certificate. Raises `ValueError` without one. """
+    return _pem(pem, (b'CERTIFICATE',))[1]
+
+
+class _IdIndex:
+    """ Elements by their ID attribute, indexed on first use (not at all for signatures of the whole document).
+    `get` raises `ValueError` for an ID on more than one element: which one a reference to it was digested
+    over is anybody's guess, a signature would hold by one while the document is read by another (wrapping).
+    """
+
+    def __init__(self, root):
+        self._root       = root
+        self._ids        = None
+        self._duplicates = set()
+
+    def get(self, value):
+        if self._ids is None:
+            self._ids = {}
+            for elem in _IDS(self._root):
+                elem_id = elem.get('ID')
+                if elem_id in self._ids:
+                    self._duplicates.add(elem_id)
+                self._ids[elem_id] = elem
+
+        if value in self._duplicates:
+            raise ValueError("Duplicate ID: {0}".format(value))
+
+        return self._ids.get(value, None)
+
+
+def _check_references(signature, root, ids):
+    """ (uri, verdict) of the digests of a signature, verdict being None where they cannot be checked here. """
+    references = signature.findall(_DS('SignedInfo') + '/' + _DS('Reference'))
+    if not references:
+        return None, None
+
+    uri     = references[0].get('URI', None)
+    verdict = True
+
+    for reference in references:
+        matches = _digest_matches(reference, signature, root, ids)
+
+        if matches is False:
+            return uri, False  # fail fast
+        if matches is None:
+            verdict = None
+
+    return uri, verdict
+
+
+def _digest_matches(reference, signature, root, ids):
+    value = reference.findtext(_DS('DigestValue'))
+
+    try:
+        resolved = _resolve(reference, signature, root, ids)
+    except ValueError:
+        return False  # ambiguous reference, see `_IdIndex`
+
+    if resolved is None or not value:
+        return None
+
+    try:
+        expected = _b64decode(value)
+    except (binascii.Error, ValueError):
+        return False
+
+    return hmac.compare_digest(_digest(resolved), expected)
+
+
+def _resolve(reference, signature, root, ids):
+    """ (node, c14n, enveloped signature or None, digest) of a reference, None where it cannot be handled
+    here: unknown algorithms, parameterized transforms or references other than the whole document or an ID.
+    """
+    uri    = reference.get('URI', None)
+    method = reference.find(_DS('DigestMethod'))
+    method = DIGESTS.get(method.get('Algorithm', None), None) if method is not None else None
+
+    if uri is None or method is None:
+        return None
+
+    if uri == '':
+        node = root.getroottree().getroot()
+    elif uri.startswith('#') and not uri.startswith('#xpointer('):
+        node = ids.get(uri[1:])
+    else:
+        node = None
+
+    if node is None:
+        return None
+
+    c14n      = C14NS['http://www.w3.org/TR/2001/REC-xml-c14n-20010315']
+    enveloped = None
+
+    for transform in reference.iterfind(_DS('Transforms') + '/' + _DS('Transform')):
+        algorithm = transform.get('Algorithm', None)
+
+        if len(transform):
+            return None  # parameterized (XPath, inclusive namespace prefixes, ...)
+        elif algorithm == ENVELOPED:
+            enveloped = signature
+        elif algorithm in C14NS:
+            c14n = C14NS[algorithm]
+        else:
+            return None
+
+    if enveloped is not None and not _within(enveloped, node):
+        enveloped = None
+    elif enveloped is not None and node.getparent() is not None:
+        return None  # a copy without the signature would lose the namespaces its ancestors declare
+
+    return node, c14n, enveloped, method
+
+
+def _digest(resolved):
+    node, c14n, enveloped, method = resolved
+    return hashlib.new(method, _canonical(node, c14n, enveloped)).digest()
+
+
+def _canonical(node, c14n, enveloped=None):
+    """ Canonical form of `node`, without the `enveloped` signature within it (`node` being a root then). """
+    if enveloped is None:
+        return etree.tostring(node, method='c14n', **c14n)
+
+    # positions from `node` down to the signature, to find it again in the copy
+    positions = []
+    child     = enveloped
+    while child is not node:
+        parent = child.getparent()
+        positions.append(parent.index(child))
+        child  = parent
+
+    clone  = copy.deepcopy(node)
+    target = clone
+    for idx in reversed(positions):
+        target = next(itertools.islice(target.iterchildren(), idx, None))
+
+    # the transform removes the element, not the text after it
+    parent = target.getparent()
+    if target.tail:
+        previous = target.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + target.tail
+        else:
+            parent.text = (parent.text or '') + target.tail
+    parent.remove(target)
+
+    return etree.tostring(clone, method='c14n', **c14n)
+
+
+def _sign_plan(signature, root, ids):
+    """ [(reference, resolved)] of a signature that can be signed here, None otherwise. """
+    signed_info = signature.find(_DS('SignedInfo'))
+    if signed_info is None or signature.find(_DS('SignatureValue')) is None:
+        return None
+
+    c14n_method = signed_info.find(_DS('CanonicalizationMethod'))
+    sig_method  = signed_info.find(_DS('SignatureMethod'))
+
+    if c14n_method is None or len(c14n_method) or c14n_method.get('Algorithm', None) not in C14NS:
+        return None
+    if sig_method is None or sig_method.get('Algorithm', None) not in SIGNATURE_METHODS:
+        return None
+
+    key_info = signature.find(_DS('KeyInfo'))
+    if key_info is None or not (_key_value(key_info) is not None or _certificate(key_info) is not None):
+        return None
+
+    references = []
+    for reference in signed_info.iterfind(_DS('Reference')):
+        try:
+            resolved = _resolve(reference, signature, root, ids)
+        except ValueError:
+            return None
+
+        if resolved is None or reference.find(_DS('DigestValue')) is None:
+            return None
+
+        references.append((reference, resolved))
+
+    return references or None
+
+
+def _signing_context(root, key):
+    """ xmlsec signature context of `key` for the document of `root`, its ID attributes registered. """
+    xmlsec.tree.add_ids(root, ['ID'])
+
+    context     = xmlsec.SignatureContext()
+    context.key = key
+
+    return context
+
+
+def _holds(signature, references, cert):
+    """ Whether the digests and value of a signature hold, by `cert` (DER). """
+    for reference, resolved in references:
+        if _decoded(reference.findtext(_DS('DigestValue'))) != _digest(resolved):
+            return False
+
+    return (
+        _check_value(signature) is True and
+        _signature_key(signature) == certificate_key(cert) and
+        _owns(signature, cert)
+    )
+
+
+def _owns(signature, cert):
+    certificate = _certificate(signature.find(_DS('KeyInfo')))
+    return certificate is None or _decoded(certificate.text) == cert
+
+
+def _key_value(key_info):
+    """ <RSAKeyValue> with its <Modulus> and <Exponent>, None without. """
+    rsa_value = key_info.find(_DS('KeyValue') + '/' + _DS('RSAKeyValue'))
+
+    if rsa_value is None or rsa_value.find(_DS('Modulus')) is None or rsa_value.find(_DS('Exponent')) is None:
+        return None
+
+    return rsa_value
+
+
+def _certificate(key_info):
+    return key_info.find(_DS('X509Data') + '/' + _DS('X509Certificate'))
+
+
+def _within(elem, node):
+    return any(ancestor is node for ancestor in elem.iterancestors())
+
+
+def _depth(node):
+    return sum(1 for _ in node.iterancestors())
+
+
+def _decoded(text):
+    try:
+        return _b64decode(text or '')
+    except (binascii.Error, ValueError):
+        return None
+
+
+def _b64decode(text):
+    """ Bytes of base64 `text`, line breaks and all. Raises `binascii.Error` where it is malformed. """
+    return base64.b64decode(_SPACES.sub('', text), validate=True)
+
+
+def _pem(pem, kinds):
+    """ (kind, DER) of the first PEM block of one of `kinds` in `pem` (bytes or str). """
+    if isinstance(pem, str):
+        pem = pem.encode('ascii')
+
+    for match in _PEM.finditer(pem):
+        if match.group(1) in kinds:
+            if b'ENCRYPTED' in match.group(2)[:64]:
+                raise ValueError("Encrypted PEM")
+
+            return match.group(1), base64.b64decode(match.group(2))
+
+    raise ValueError("No {0} in PEM".format(" or ".join(kind.decode('ascii') for kind in kinds)))
+
+
+def _check_value(signature):
+    """ Whether the <SignatureValue> is that of the <SignedInfo>, None where it cannot be checked here. """
+    signed_info = signature.find(_DS('SignedInfo'))
+    c14n_method = signed_info.find(_DS('CanonicalizationMethod'))
+    sig_method  = signed_info.find(_DS('SignatureMethod'))
+    value       = signature.findtext(_DS('SignatureValue'))
+
+    if c14n_method is None or sig_method is None or len(c14n_method) or not value:
+        return None
+
+    c14n   = C14NS.get(c14n_method.get('Algorithm', None), None)
+    digest = SIGNATURE_METHODS.get(sig_method.get('Algorithm', None), None)
+
+    try:
+        key   = _signature_key(signature)
+        value = _b64decode(value)
+    except (binascii.Error, ValueError):
+        return False
+
+    if c14n is None or digest is None or key is None:
+        return None
+
+    data = etree.tostring(signed_info, method='c14n', **c14n)
+    return rsa_verify(data, value, key[0], key[1], digest=digest)
+
+
+def _signature_key(signature):
+    """ (modulus, exponent) from the <KeyInfo>, the certificate's if there is one. None where the
+    certificate is unusable or disagrees with the <RSAKeyValue> (xmlsec decides then). Raises `ValueError`
+    where they are not base64.
+    """
+    key_info = signature.find(_DS('KeyInfo'))
+    if key_info is None:
+        return None
+
+    key_value = None
+    rsa_value = key_info.find(_DS('KeyValue') + '/' + _DS('RSAKeyValue'))
+    if rsa_value is not None:
+        modulus  = rsa_value.findtext(_DS('Modulus'))
+        exponent = rsa_value.findtext(_DS('Exponent'))
+
+        if modulus and exponent:
+            key_value = (
+                int.from_bytes(_b64decode(modulus), 'big'),
+                int.from_bytes(_b64decode(exponent), 'big')
+            )
+
+    cert = key_info.findtext(_DS('X509Data') + '/' + _DS('X509Certificate'))
+    if not cert:
+        return key_value
+
+    cert_key = certificate_key(_b64decode(cert))
+    if cert_key is None or (key_value is not None and key_value != cert_key):
+        return None
+
+    return cert_key
+
+
+def _parse_certificate_key(der):
+    """ RSA key out of the subjectPublicKeyInfo of an X.509 certificate, just enough DER for that. """
+    _, start, end = _der(der, 0)                # Certificate
+    _, start, end = _der(der, start)            # TBSCertificate
+    fields        = list(_der_items(der, start, end))
+
+    if fields[0][0] == 0xa0:                    # [0] version, absent in v1 certificates
+        fields = fields[1:]
+
+    # serialNumber, signature, issuer, validity, subject, subjectPublicKeyInfo
+    _, start, end = fields[5]
+    (_, alg_start, _), (tag, bits_start, _) = list(_der_items(der, start, end))[:2]
+
+    if der[alg_start:alg_start + len(_RSA_OID)] != _RSA_OID or tag != 0x03:
+        return None
+
+    _, start, end = _der(der, bits_start + 1)   # RSAPublicKey, after the unused bits count
+    (_, mod_start, mod_end), (_, exp_start, exp_end) = list(_der_items(der, start, end))[:2]
+
+    return int.from_bytes(der[mod_start:mod_end], 'big'), int.from_bytes(der[exp_start:exp_end], 'big')
+
+
+def _der(buff, offset):
+    """ (tag, start, end) of the DER element at `offset`, its contents being buff[start:end]. """
+    tag    = buff[offset]
+    length = buff[offset + 1]
+    start  = offset + 2
+
+    if length & 0x80:
+        count  = length & 0x7f
+        length = int.from_bytes(buff[start:start + count], 'big')
+        start += count
+
+    if start + length > len(buff):
+        raise ValueError("Truncated DER element at {0}".format(offset))
+
+    return tag, start, start + length
+
+
+def _der_items(buff, start, end):
+    while start < end:
+        item = _der(buff, start)
+        yield item
+        start = item[2]
+
+
+def _DS(name):
+    return '{' + DS_NS + '}' + name
@@ -0,0 +1,151 @@
+""" Header Extraction (emitter, type, folio, ... of DTE's and EnvioDTE's without parsing them whole)
+
+`read_header` parses a large file only up to the first <Encabezado> and stops reading there, usually after
+its first few KB (small ones are cheaper to parse whole in one go). `header_of` does the same on an already
+parsed tree, bundled or not, plain or objectified.
+"""
+from lxml import etree
+
+__all__ = [
+    'Header',
+    'read_header',
+    'read_headers',
+    'header_of'
+]
+
+# Files up to this size are parsed whole, incremental parsing only pays off above it
+WHOLE_PARSE_SIZE = 64 * 1024
+
+# Ends of elements the header is taken from, <Caratula> comes before any <DTE> in an <EnvioDTE>
+_TAGS = ('{*}Caratula', '{*}Encabezado')
+
+# Local names (unique within an <Encabezado>) of the fields taken from it
+_FIELDS = {
+    'TipoDTE':   'dte_type',
+    'Folio':     'folio',
+    'FchEmis':   'issued',
+    'RUTEmisor': 'rut',
+    'RUTRecep':  'recpt_rut'
+}
+
+_FIELD_TAGS = tuple('{*}' + name for name in _FIELDS)
+
+
+class Header:
+    """ What is needed to name, sort or route a document, `kind` is the local name of its root element
+    (DTE, EnvioDTE, ...). `envio_recpt` is the <RutReceptor> of the <Caratula> of an envelope.
+    """
+
+    __slots__ = ('path', 'kind', 'rut', 'dte_type', 'folio', 'issued', 'recpt_rut', 'envio_recpt')
+
+    def __init__(self, path=None, kind=None, rut=None, dte_type=None, folio=None, issued=None, recpt_rut=None,
+                 envio_recpt=None):
+        self.path        = path
+        self.kind        = kind
+        self.rut         = rut
+        self.dte_type    = dte_type
+        self.folio       = folio
+        self.issued      = issued
+        self.recpt_rut   = recpt_rut
+        self.envio_recpt = envio_recpt
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __eq__(self, other):
+        return isinstance(other, Header) and self.__getstate__() == other.__getstate__()
+
+    def __repr__(self):
+        return "Header({0})".format(", ".join(
+            "{0}={1!r}".format(name, getattr(self, name)) for name in self.__slots__
+        ))
+
+    @property
+    def key(self):
+        """ (RUT, TipoDTE, Folio) as in the folio ledger. """
+        return self.rut, self.dte_type, self.folio
+
+    @property
+    def rut_number(self):
+        """ RUT of the emitter without its verifier digit (as used in file names and subjects). """
+        return self.rut.split('-')[0] if self.rut else None
+
+
+def read_header(fpath):
+    """ Header of the (first) document in the file, raises `ValueError` if it has no <Encabezado>. """
+    with open(fpath, 'rb') as fh:
+        buff = fh.read(WHOLE_PARSE_SIZE)
+
+        if len(buff) < WHOLE_PARSE_SIZE:
+            try:
+                return header_of(etree.fromstring(buff), fpath)
+            except etree.XMLSyntaxError as exc:
+                raise ValueError("Could not read header of: {0} ({1})".format(fpath, str(exc)))
+
+        fh.seek(0)
+        return _parse_header(fh, fpath)
+
+
+def read_headers(fpaths):
+    for fpath in fpaths:
+        yield read_header(fpath)
+
+
+def header_of(xml, path=None):
+    """ Header of the (first) document in an already parsed tree. """
+    if isinstance(xml, etree._ElementTree):
+        xml = xml.getroot()
+
+    header = Header(path=path, kind=etree.QName(xml).localname)
+
+    for elem in xml.iter(*_TAGS):
+        if etree.QName(elem).localname == 'Caratula':
+            header.envio_recpt = _text(elem, '{*}RutReceptor')
+        else:
+            _fill(header, elem)
+            return header
+
+    raise ValueError("Could not find <Encabezado> in document{0}".format(": " + path if path else ""))
+
+
+def _parse_header(source, path):
+    header = Header(path=path)
+    events = etree.iterparse(source, events=('end',), tag=_TAGS, remove_blank_text=True)
+
+    try:
+        for _, elem in events:
+            if etree.QName(elem).localname == 'Caratula':
+                header.envio_recpt = _text(elem, '{*}RutReceptor')
+            else:
+                header.kind = etree.QName(elem.getroottree().getroot()).localname
+                _fill(header, elem)
+                return header
+    except etree.XMLSyntaxError as exc:
+        raise ValueError("Could not read header of: {0} ({1})".format(path, str(exc)))
+
+    raise ValueError("Could not find <Encabezado> in: {0}".format(path))
+
+
+def _fill(header, encabezado):
+    """ Single (C level filtered) walk over the <Encabezado>, cheaper than a path lookup per field. """
+    for elem in encabezado.iter(*_FIELD_TAGS):
+        attr = _FIELDS[elem.tag.rpartition('}')[2]]
+
+        if getattr(header, attr) is None and elem.text and elem.text.strip():
+            setattr(header, attr, elem.text.strip())
+
+    if not (header.rut and header.dte_type and header.folio):
+        raise ValueError("Could not find <RUTEmisor>, <TipoDTE> and <Folio> in <Encabezado>")
+
+    header.rut      = header.rut.upper()
+    header.dte_type = int(header.dte_type)
+    header.folio    = int(header.folio)
+
+
+def _text(elem, path):
+    text = elem.findtext(path)
+    return text.strip() if text and text.strip() else None
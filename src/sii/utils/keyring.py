@@ -0,0 +1,128 @@
+""" Signing Keyring (key and certificate per emitter RUT, for issuing on behalf of several companies)
+
+`auth.keyring` in the config maps RUT's to their own `key` and `cert`, documents of any other RUT are
+signed with `auth.key` and `auth.cert`. A RUT's PEMs are read when its first document is signed and kept
+for the life of the process. A `Keyring` pickles as just its paths, so every pool worker loads only the
+RUT's it comes across, and a single run can sign a batch mixing many emitters.
+"""
+import os
+import collections
+
+from lxml import etree
+
+__all__ = [
+    'Keyring',
+    'Signer',
+    'normalize_rut',
+    'signing_rut'
+]
+
+Signer = collections.namedtuple('Signer', ['rut', 'key_path', 'cert_path', 'key_pem', 'cert_pem'])
+
+# Who signs a document, by the first of these in it: the emitter of an envelope, libro or <DTE>, the one
+# replying of a reply. The <Caratula> comes first in any envelope.
+_SIGNING_TAGS = ('{*}RutEmisor', '{*}RutEmisorLibro', '{*}RutResponde', '{*}RUTEmisor')
+
+
+class Keyring:
+    """ Key and certificate paths of each RUT in `entries` (RUT -> (key, cert)), `default` ones for any
+    other (or `None` to only sign for those).
+    """
+
+    def __init__(self, entries=None, default=None):
+        self._entries = {
+            normalize_rut(rut): _expand(paths) for rut, paths in (entries or {}).items()
+        }
+        self._default = _expand(default) if default is not None else None
+        self._signers = {}
+
+    def __getstate__(self):
+        return self._entries, self._default
+
+    def __setstate__(self, state):
+        self._entries, self._default = state
+        self._signers = {}
+
+    def __contains__(self, rut):
+        return normalize_rut(rut) in self._entries
+
+    def __repr__(self):
+        return "Keyring({0} RUT's{1})".format(len(self._entries), ", default" if self._default else "")
+
+    @classmethod
+    def from_config(cls, config, key=None, cert=None):
+        """ Keyring of the `auth` section. A `key` or `cert` given (from the command line) overrides it all,
+        every document is then signed with those.
+        """
+        auth = config.auth.__dict__
+
+        if key or cert:
+            default = (key or auth.get('key', None), cert or auth.get('cert', None))
+            return cls(None, default if all(default) else None)
+
+        entries = {
+            str(rut): (entry['key'], entry['cert']) for rut, entry in (auth.get('keyring', None) or {}).items()
+        }
+
+        key  = auth.get('key',  None)
+        cert = auth.get('cert', None)
+
+        return cls(entries, (key, cert) if key and cert else None)
+
+    def ruts(self):
+        return sorted(self._entries)
+
+    def signer(self, rut=None):
+        """ `Signer` of `rut` (the default one for `None` or a RUT not in the keyring), read once. Raises
+        `KeyError` if there is none.
+        """
+        rut   = normalize_rut(rut) if rut else None
+        paths = self._entries.get(rut, None) if rut else None
+        cache = rut if paths is not None else None
+
+        found = self._signers.get(cache, None)
+        if found is not None:
+            return found
+
+        if paths is None:
+            paths = self._default
+
+        if paths is None:
+            raise KeyError("No key and certificate in the keyring for RUT: <{0}>".format(rut))
+
+        key_path, cert_path = paths
+
+        with open(key_path, 'rb') as fh:
+            key_pem = fh.read()
+        with open(cert_path, 'rb') as fh:
+            cert_pem = fh.read()
+
+        found = Signer(cache, key_path, cert_path, key_pem, cert_pem)
+        self._signers[cache] = found
+
+        return found
+
+    def signer_of(self, xml):
+        """ `Signer` of a document, by its `signing_rut`. """
+        return self.signer(signing_rut(xml))
+
+
+def normalize_rut(rut):
+    """ RUT as the SII writes it: without dots or blanks and with an upper case verifier digit. """
+    return str(rut).replace('.', '').replace(' ', '').strip().upper()
+
+
+def signing_rut(xml):
+    """ RUT whose signature goes on a document (see `_SIGNING_TAGS`), or `None` if it has none. """
+    if isinstance(xml, etree._ElementTree):
+        xml = xml.getroot()
+
+    for elem in xml.iter(*_SIGNING_TAGS):
+        if elem.text and elem.text.strip():
+            return elem.text.strip()
+
+    return None
+
+
+def _expand(paths):
+    return tuple(os.path.abspath(os.path.expanduser(path)) for path in paths)
@@ -0,0 +1,187 @@
+""" Lazy Access to Large Envelopes (EnvioDTE, LibroCompraVenta, ...)
+
+The file is memory mapped and pre-scanned once for the byte offsets of its items (<DTE>'s of an envelope,
+<Detalle>'s of a libro). Items are parsed one at a time, only when accessed, so reading the 10.000th DTE
+of a 500MB envelope parses just that one.
+
+Items are found by their tags alone: they must not nest into each other and must not appear inside
+comments or CDATA sections, which holds for the SII documents. Namespaces declared on the root element
+are in scope when parsing an item, those declared on elements in between are not.
+"""
+import re
+import copy
+import mmap
+import collections
+
+from lxml import etree, objectify
+
+__all__ = [
+    'LazyDocument',
+    'ITEM_TAGS'
+]
+
+# Item element per root element
+ITEM_TAGS = {
+    'EnvioDTE':         'DTE',
+    'EnvioBOLETA':      'DTE',
+    'LibroCompraVenta': 'Detalle',
+    'LibroGuia':        'Detalle',
+    'LibroBoleta':      'Detalle'
+}
+
+CACHE_SIZE = 64   # parsed items kept per document
+BATCH_SIZE = 256  # items parsed together when iterating
+
+_DECL = re.compile(br'^\s*<\?xml[^>]*\?>')
+_ROOT = re.compile(br'<(?![?!])((?:[\w.-]+:)?([\w.-]+))(?:\s[^>]*)?>', re.DOTALL)
+_TAG  = re.compile(br'<(/?)(?:[\w.-]+:)?')  # what has to come right before an item's name
+
+
+class LazyDocument:
+    """ Sequence of the items of the XML at `fpath`, parsed on access (as plain or objectified elements). """
+
+    def __init__(self, fpath, item_tag=None, objectified=False):
+        self._fh = open(fpath, 'rb')
+
+        try:
+            self._map = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._map = b''  # empty file, mmap refuses those
+
+        self.path        = fpath
+        self.objectified = objectified
+
+        decl = _DECL.match(self._map)
+        root = _ROOT.search(self._map, decl.end() if decl else 0)
+
+        if root is None:
+            self.close()
+            raise ValueError("Could not find a root element in: {0}".format(fpath))
+
+        self.root_tag = root.group(2).decode('ascii')
+        self.item_tag = item_tag or ITEM_TAGS.get(self.root_tag, None)
+
+        if self.item_tag is None:
+            self.close()
+            raise ValueError("Do not know the items of <{0}>, give them explicitly".format(self.root_tag))
+
+        self._decl   = decl.group(0) if decl else b''
+        self._open   = root.group(0)
+        self._close  = b'</' + root.group(1) + b'>'
+        self._start  = root.end()
+        self._found  = None
+        self._cache  = collections.OrderedDict()
+        self._parser = objectify.makeparser(remove_blank_text=True) if objectified else etree.XMLParser(remove_blank_text=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def _spans(self):
+        """ Spans of all items, scanned for on first use (head() does not need them). """
+        if self._found is None:
+            self._found = list(_scan(self._map, self.item_tag.encode('ascii'), self._start))
+        return self._found
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[pos] for pos in range(*idx.indices(len(self)))]
+
+        if idx < 0:
+            idx += len(self)
+
+        item = self._cache.get(idx, None)
+        if item is None:
+            item = self._parse(self.raw(idx))
+
+            self._cache[idx] = item
+            if len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(idx)
+
+        return item
+
+    def __iter__(self):
+        """ Every item in order, parsed in batches of consecutive items and without filling the cache.
+        Only one batch is alive at a time as long as the caller does not keep the items around.
+        """
+        tag = '{*}' + self.item_tag
+
+        for first in range(0, len(self._spans), BATCH_SIZE):
+            last = min(first + BATCH_SIZE, len(self._spans)) - 1
+            root = self._wrap(self._map[self._spans[first][0]:self._spans[last][1]])
+
+            for item in root.iterchildren(tag):
+                yield item
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._fh.close()
+
+    def span(self, idx):
+        """ (start, end) byte offsets of the item in the file. """
+        return self._spans[idx]
+
+    def raw(self, idx):
+        start, end = self._spans[idx]
+        return self._map[start:end]
+
+    def head(self):
+        """ Everything before the first item (<Caratula>, <ResumenPeriodo>, ...), with the elements still
+        open at that point closed.
+        """
+        if self._found is None:
+            first = next(_scan(self._map, self.item_tag.encode('ascii'), self._start), None)
+        else:
+            first = self._found[0] if self._found else None
+
+        end    = first[0] if first else len(self._map)
+        parser = objectify.makeparser(recover=True) if self.objectified else etree.XMLParser(recover=True)
+        return etree.fromstring(self._map[:end], parser)
+
+    def _wrap(self, buff):
+        """ Parses `buff` inside a copy of the root element, for its namespace declarations to apply. """
+        return etree.fromstring(self._decl + self._open + buff + self._close, self._parser)
+
+    def _parse(self, buff):
+        root = self._wrap(buff)
+        # detached by copy, removing it would rename the default namespace to a ns0: prefix
+        return copy.deepcopy(next(root.iterchildren()))
+
+
+def _scan(buff, tag, start):
+    """ Byte spans of every <tag> element (prefixed or not) from `start` on, in order.
+
+    Looks for the bare name and checks what precedes it, several times faster than a pattern starting
+    at every '<'.
+    """
+    pattern = re.compile(re.escape(tag) + br'[\s/>]')
+    opened  = None
+
+    for match in pattern.finditer(buff, start):
+        pos   = match.start()
+        front = max(pos - 64, 0)
+        tag   = _TAG.fullmatch(buff[front:pos], buff.rfind(b'<', front, pos) - front)
+
+        if tag is None:
+            continue  # text or an attribute value, or a longer name ending the same
+
+        end = buff.find(b'>', pos)
+
+        if not tag.group(1):
+            if opened is None:
+                if buff[end - 1:end] == b'/':
+                    yield front + tag.start(), end + 1  # empty element
+                else:
+                    opened = front + tag.start()
+        elif opened is not None:  # otherwise a stray end tag
+            yield opened, end + 1
+            opened = None
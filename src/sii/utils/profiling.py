@@ -0,0 +1,207 @@
+""" Per-Stage Timing Instrumentation (--timings, --profile, --trace)
+
+Code marks its stages (read, parse, validate, sign, serialize, write, network, ...) with `stage(name)`.
+That is a no-op unless enabled. Enabled, it accumulates count, wall and CPU time per stage. Worker processes
+(of process pools) inherit the setting through the environment and hand their numbers over on exit.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import contextlib
+import collections
+import multiprocessing.util
+
+__all__ = [
+    'enable',
+    'enabled',
+    'stage',
+    'record',
+    'totals',
+    'report',
+    'dump_trace',
+    'cleanup'
+]
+
+ENV_DIR = 'SII_PROFILE_DIR'
+
+_STATE = {
+    'enabled': False,
+    'trace':   False,
+    'dir':     None,
+    'owner':   None,  # pid of the process that enabled profiling
+    'dumper':  None,  # pid of the worker process that registered its hand over
+    'start':   None
+}
+
+_STATS  = collections.defaultdict(lambda: [0, 0.0, 0.0])  # stage -> [count, wall, cpu]
+_EVENTS = []
+_LOCK   = threading.Lock()
+
+
+def enable(trace=False):
+    work_dir = tempfile.mkdtemp(prefix='sii_profile_')
+
+    os.environ[ENV_DIR] = work_dir + (':trace' if trace else '')
+
+    _STATE.update(enabled=True, trace=trace, dir=work_dir, owner=os.getpid(), start=time.perf_counter())
+
+
+def enabled():
+    return _STATE['enabled']
+
+
+@contextlib.contextmanager
+def stage(name):
+    if not _STATE['enabled']:
+        yield
+        return
+
+    wall = time.perf_counter()
+    cpu  = time.process_time()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - wall, time.process_time() - cpu, wall)
+
+
+def record(name, wall, cpu, started=None):
+    pid = os.getpid()
+
+    # Registered on first use, multiprocessing clears finalizers while bootstrapping a worker
+    if pid != _STATE['owner'] and pid != _STATE['dumper']:
+        _STATE['dumper'] = pid
+        multiprocessing.util.Finalize(None, _dump_worker, exitpriority=10)
+
+    with _LOCK:
+        stats = _STATS[name]
+        stats[0] += 1
+        stats[1] += wall
+        stats[2] += cpu
+
+        if _STATE['trace'] and started is not None:
+            _EVENTS.append((name, started, wall, pid, threading.get_ident()))
+
+
+def totals():
+    """ Stage stats of this process merged with those handed over by finished worker processes. """
+    merged = collections.defaultdict(lambda: [0, 0.0, 0.0])
+    events = list(_EVENTS)
+
+    for stats, evts in [(_STATS, [])] + list(_worker_dumps()):
+        for name, (count, wall, cpu) in stats.items():
+            merged[name][0] += count
+            merged[name][1] += wall
+            merged[name][2] += cpu
+
+        events.extend(evts)
+
+    return merged, events
+
+
+def report(file=sys.stderr):
+    if not _STATE['enabled']:
+        return
+
+    merged, _ = totals()
+    elapsed   = time.perf_counter() - _STATE['start']
+
+    rows = sorted(merged.items(), key=lambda item: item[1][1], reverse=True)
+
+    print("", file=file)
+    print("{0:<12} {1:>8} {2:>10} {3:>10} {4:>7}".format("stage", "count", "wall s", "cpu s", "wall %"), file=file)
+    print("-" * 51, file=file)
+
+    for name, (count, wall, cpu) in rows:
+        share = wall / elapsed * 100 if elapsed else 0.0
+        print("{0:<12} {1:>8} {2:>10.3f} {3:>10.3f} {4:>6.1f}%".format(name, count, wall, cpu, share), file=file)
+
+    print("-" * 51, file=file)
+    print("{0:<12} {1:>8} {2:>10.3f}".format("elapsed", "", elapsed), file=file)
+
+    if any(pid != _STATE['owner'] for pid in _worker_pids()):
+        print("(stages of worker processes are summed up, wall % can exceed 100)", file=file)
+
+
+def dump_trace(fpath):
+    """ Chrome trace event JSON (chrome://tracing, Perfetto) of every stage run. """
+    _, events = totals()
+    origin    = min([evt[1] for evt in events] + [_STATE['start']])
+
+    with open(fpath, 'w') as fh:
+        json.dump({
+            'traceEvents': [
+                {
+                    'name': name,
+                    'cat':  'sii',
+                    'ph':   'X',
+                    'ts':   (started - origin) * 1e6,
+                    'dur':  wall * 1e6,
+                    'pid':  pid,
+                    'tid':  tid
+                }
+                for name, started, wall, pid, tid in events
+            ],
+            'displayTimeUnit': 'ms'
+        }, fh)
+
+
+def cleanup():
+    if _STATE['dir'] and os.getpid() == _STATE['owner']:
+        shutil.rmtree(_STATE['dir'], ignore_errors=True)
+        os.environ.pop(ENV_DIR, None)
+
+
+def _worker_dumps():
+    if not _STATE['dir'] or not os.path.isdir(_STATE['dir']):
+        return
+
+    for fname in sorted(os.listdir(_STATE['dir'])):
+        try:
+            with open(os.path.join(_STATE['dir'], fname), 'r') as fh:
+                dump = json.load(fh)
+        except (OSError, ValueError):
+            continue
+
+        yield dump['stats'], [tuple(evt) for evt in dump['events']]
+
+
+def _worker_pids():
+    if not _STATE['dir'] or not os.path.isdir(_STATE['dir']):
+        return []
+
+    return [int(fname.split('.')[0]) for fname in os.listdir(_STATE['dir'])]
+
+
+def _dump_worker():
+    """ Runs when a worker process exits, hands its stats over to the owning process. """
+    if not _STATS:
+        return
+
+    fpath = os.path.join(_STATE['dir'], "{0}.json".format(os.getpid()))
+    with open(fpath, 'w') as fh:
+        json.dump({'stats': dict(_STATS), 'events': _EVENTS}, fh)
+
+
+def _init_worker():
+    """ Forked children start with a copy of the parents numbers, spawned ones with nothing enabled. """
+    env = os.environ.get(ENV_DIR, None)
+    if not env:
+        return
+
+    work_dir, _, trace = env.partition(':')
+
+    _STATS.clear()
+    del _EVENTS[:]
+
+    if os.getpid() != _STATE['owner']:
+        _STATE.update(enabled=True, trace=bool(trace), dir=work_dir, start=time.perf_counter())
+
+
+if os.environ.get(ENV_DIR, None):
+    _init_worker()  # spawned worker, imported fresh
+
+os.register_at_fork(after_in_child=_init_worker)
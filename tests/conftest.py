@@ -0,0 +1,335 @@
+""" Shared Fixtures (keys and certificates, synthetic documents, local TLS stub of the SII web services)
+"""
+import os
+import ssl
+import sys
+import base64
+import shutil
+import threading
+import subprocess
+import collections
+
+from http import server
+from xml.sax.saxutils import escape
+
+import pytest
+
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+KeyPair = collections.namedtuple('KeyPair', ['key', 'cert'])
+
+SOAP_RESPONSE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<soapenv:Body><callResponse><callReturn>{0}</callReturn></callResponse></soapenv:Body>'
+    '</soapenv:Envelope>'
+)
+
+SII_RESPONSE = (
+    '<SII:RESPUESTA xmlns:SII="http://www.sii.cl/XMLSchema">'
+    '<SII:RESP_BODY>{body}</SII:RESP_BODY>'
+    '<SII:RESP_HDR><ESTADO>{state}</ESTADO><GLOSA>{glosa}</GLOSA></SII:RESP_HDR>'
+    '</SII:RESPUESTA>'
+)
+
+
+def make_keypair(directory, name='signer', subject='/CN=sii-utils test'):
+    """ Self signed RSA key and certificate (PEM paths) made with the openssl binary. """
+    if shutil.which('openssl') is None:
+        pytest.skip("openssl binary not available")
+
+    os.makedirs(directory, exist_ok=True)
+
+    key  = os.path.join(str(directory), name + '.key.pem')
+    cert = os.path.join(str(directory), name + '.cert.pem')
+
+    subprocess.check_call([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-sha256', '-days', '2',
+        '-subj', subject, '-keyout', key, '-out', cert
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return KeyPair(key, cert)
+
+
+def sii_response(state='00', glosa='', **fields):
+    """ SII response XML of the given header `state` and body `fields`. """
+    body = ''.join('<{0}>{1}</{0}>'.format(name, escape(str(value))) for name, value in sorted(fields.items()))
+    return SII_RESPONSE.format(body=body, state=escape(state), glosa=escape(glosa))
+
+
+class StubServer(server.ThreadingHTTPServer):
+    """ HTTPS server answering SOAP calls by path, through `routes` (path -> callable(body) -> SII response).
+    Counts the connections it accepts and keeps every request it answers.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, keypair, routes):
+        super().__init__(('127.0.0.1', 0), _StubHandler)
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(keypair.cert, keypair.key)
+
+        self.socket      = context.wrap_socket(self.socket, server_side=True)
+        self.routes      = routes
+        self.requests    = []
+        self.connections = 0
+
+    @property
+    def host(self):
+        return '127.0.0.1:{0}'.format(self.server_address[1])
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+
+class _StubHandler(server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the SII does
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests.append((self.path, body))
+
+        route = self.server.routes.get(self.path, None)
+        if route is None:
+            self.send_error(404)
+            return
+
+        payload = SOAP_RESPONSE.format(escape(route(body))).encode('UTF-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=UTF-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='session')
+def keypair(tmp_path_factory):
+    return make_keypair(tmp_path_factory.mktemp('keys'))
+
+
+@pytest.fixture
+def stub_server(keypair):
+    """ Starts a `StubServer` on the `routes` given, shut down after the test. """
+    servers = []
+
+    def start(routes):
+        stub   = StubServer(keypair, routes)
+        thread = threading.Thread(target=stub.serve_forever, daemon=True)
+        thread.start()
+
+        servers.append(stub)
+        return stub
+
+    yield start
+
+    for stub in servers:
+        stub.shutdown()
+        stub.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_loaded_cafs(monkeypatch):
+    """ Verifying in-process loads the CAFs of the run into module state, each test starts without. """
+    from sii.bin import cafs, cmd_verify
+    monkeypatch.setattr(cmd_verify, '_CAF_INDEX', cafs.CAFIndex())
+
+
+SII_NS = 'http://www.sii.cl/SiiDte'
+
+RUT_EMISOR   = '76000000-0'
+RUT_RECEPTOR = '11111111-1'
+
+PERMISSIVE_XSD = (
+    '<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" targetNamespace="{ns}" elementFormDefault="qualified">'
+    '<xs:element name="{root}"><xs:complexType>'
+    '<xs:sequence><xs:any processContents="skip" minOccurs="0" maxOccurs="unbounded"/></xs:sequence>'
+    '<xs:anyAttribute processContents="skip"/>'
+    '</xs:complexType></xs:element>'
+    '</xs:schema>'
+)
+
+
+def sii(name):
+    return '{' + SII_NS + '}' + name
+
+
+def sub(parent, name, text=None, **attrs):
+    node = etree.SubElement(parent, sii(name), **attrs)
+
+    if text is not None:
+        node.text = str(text)
+
+    return node
+
+
+def dte(folio, dte_type=33, rut=RUT_EMISOR, recpt=RUT_RECEPTOR, net=1000, issued='2016-06-01'):
+    """ Unbundled (no TED, unsigned) <DTE>. """
+    root = etree.Element(sii('DTE'), nsmap={None: SII_NS}, version="1.0")
+    doc  = sub(root, 'Documento', ID="F{0}T{1}".format(folio, dte_type))
+    enc  = sub(doc, 'Encabezado')
+
+    iddoc = sub(enc, 'IdDoc')
+    sub(iddoc, 'TipoDTE', dte_type)
+    sub(iddoc, 'Folio',   folio)
+    sub(iddoc, 'FchEmis', issued)
+
+    emisor = sub(enc, 'Emisor')
+    sub(emisor, 'RUTEmisor', rut)
+    sub(emisor, 'RznSoc',    "Empresa de Prueba SpA")
+
+    receptor = sub(enc, 'Receptor')
+    sub(receptor, 'RUTRecep',    recpt)
+    sub(receptor, 'RznSocRecep', "Cliente de Prueba Ltda")
+
+    vat = int(round(net * 0.19))
+
+    totales = sub(enc, 'Totales')
+    sub(totales, 'MntNeto',  net)
+    sub(totales, 'TasaIVA',  19)
+    sub(totales, 'IVA',      vat)
+    sub(totales, 'MntTotal', net + vat)
+
+    det = sub(doc, 'Detalle')
+    sub(det, 'NroLinDet', 1)
+    sub(det, 'NmbItem',   "Item")
+    sub(det, 'MontoItem', net)
+
+    return root
+
+
+def enviodte(dtes, rut=RUT_EMISOR, recpt=RUT_RECEPTOR):
+    root = etree.Element(sii('EnvioDTE'), nsmap={None: SII_NS}, version="1.0")
+    sdte = sub(root, 'SetDTE', ID="SetDoc")
+    car  = sub(sdte, 'Caratula', version="1.0")
+
+    sub(car, 'RutEmisor',   rut)
+    sub(car, 'RutEnvia',    rut)
+    sub(car, 'RutReceptor', recpt)
+
+    for doc in dtes:
+        sdte.append(doc)
+
+    return root
+
+
+def write(xml, fpath, encoding='ISO-8859-1'):
+    """ Writes a tree as the commands do, returns the path (as a string). """
+    fpath = str(fpath)
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+
+    with open(fpath, 'wb') as fh:
+        fh.write(etree.tostring(xml, pretty_print=True, encoding=encoding, xml_declaration=True))
+
+    return fpath
+
+
+def permissive_xsd(directory, root):
+    """ XSD accepting any <root> of the SII namespace, so tests do not depend on the library's schemas. """
+    fpath = os.path.join(str(directory), root + '.xsd')
+
+    with open(fpath, 'w') as fh:
+        fh.write(PERMISSIVE_XSD.format(ns=SII_NS, root=root))
+
+    return fpath
+
+
+Caf = collections.namedtuple('Caf', ['path', 'key', 'rut', 'dte_type', 'first', 'last', 'node'])
+
+CAF_TEMPL = (
+    '<AUTORIZACION><CAF version="1.0"><DA>'
+    '<RE>{rut}</RE><RS>Empresa de Prueba SpA</RS><TD>{dte_type}</TD>'
+    '<RNG><D>{first}</D><H>{last}</H></RNG><FA>2016-06-01</FA>'
+    '<RSAPK><M>{modulus}</M><E>AQAB</E></RSAPK><IDK>100</IDK>'
+    '</DA><FRMA algoritmo="SHA1withRSA">{frma}</FRMA></CAF>'
+    '<RSASK>{key}</RSASK><RSAPUBK>{pub}</RSAPUBK></AUTORIZACION>'
+)
+
+DD_TEMPL = (
+    '<DD><RE>{rut}</RE><TD>{dte_type}</TD><F>{folio}</F><FE>2016-06-01</FE><RR>{recpt}</RR>'
+    '<RSR>{name}</RSR><MNT>{amount}</MNT><IT1>{item}</IT1>{caf}<TSTED>2016-06-01T12:00:00</TSTED></DD>'
+)
+
+
+def openssl(*args, **kwargs):
+    if shutil.which('openssl') is None:
+        pytest.skip("openssl binary not available")
+
+    return subprocess.check_output(('openssl',) + args, stderr=subprocess.DEVNULL, **kwargs)
+
+
+def make_caf(directory, first, last, dte_type=33, rut=RUT_EMISOR):
+    """ CAF file authorizing folios `first` to `last`, with a fresh key. The SII's <FRMA> is fake. """
+    os.makedirs(str(directory), exist_ok=True)
+
+    key     = openssl('genrsa', '1024')
+    pub     = openssl('rsa', '-pubout', input=key)
+    modulus = openssl('rsa', '-noout', '-modulus', input=key).decode('ascii').strip().split('=', 1)[1]
+
+    fpath = os.path.join(str(directory), "caf_{0}_{1}_{2}_{3}.xml".format(rut, dte_type, first, last))
+    with open(fpath, 'w', encoding='ISO-8859-1') as fh:
+        fh.write('<?xml version="1.0" encoding="ISO-8859-1"?>\n' + CAF_TEMPL.format(
+            rut      = rut,
+            dte_type = dte_type,
+            first    = first,
+            last     = last,
+            modulus  = base64.b64encode(bytes.fromhex(modulus)).decode('ascii'),
+            frma     = base64.b64encode(b'\0' * 64).decode('ascii'),
+            key      = key.decode('ascii').strip(),
+            pub      = pub.decode('ascii').strip()
+        ))
+
+    key_path = fpath + '.key'
+    with open(key_path, 'wb') as fh:
+        fh.write(key)
+
+    node = etree.parse(fpath).getroot().find('CAF')
+    return Caf(fpath, key_path, rut, dte_type, first, last, node)
+
+
+def dd_bytes(caf, folio, dte_type=None, recpt=RUT_RECEPTOR, name="Cliente de Prueba Ltda", amount=1190, item="Item"):
+    """ <DD> of a TED as the SII signs it, built by hand: no namespaces, nothing between tags, ISO-8859-1,
+    the five XML special characters escaped in text.
+    """
+    escape_all = lambda text: escape(text, {'"': '&quot;', "'": '&apos;'})
+
+    return DD_TEMPL.format(
+        rut      = caf.rut,
+        dte_type = dte_type or caf.dte_type,
+        folio    = folio,
+        recpt    = recpt,
+        name     = escape_all(name),
+        amount   = amount,
+        item     = escape_all(item),
+        caf      = etree.tostring(caf.node, encoding='unicode')
+    ).encode('ISO-8859-1')
+
+
+def stamp(doc, caf, dd=None, frmt=None):
+    """ Adds a TED to `doc` (an unbundled <DTE>), its <DD> being `dd` (see `dd_bytes`) signed with the key
+    of `caf`, unless a `frmt` is given.
+    """
+    folio = int(doc.findtext('.//' + sii('Folio')))
+    dd    = dd or dd_bytes(caf, folio)
+
+    if frmt is None:
+        frmt = base64.b64encode(openssl('dgst', '-sha1', '-sign', caf.key, input=dd)).decode('ascii')
+
+    ted = etree.fromstring(
+        b'<TED version="1.0">' + dd + b'<FRMT algoritmo="SHA1withRSA">' + frmt.encode('ascii') + b'</FRMT></TED>',
+        etree.XMLParser(encoding='ISO-8859-1')
+    )
+
+    for elem in ted.iter():
+        elem.tag = sii(elem.tag)
+
+    doc.find(sii('Documento')).append(ted)
+    return doc
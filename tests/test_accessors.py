@@ -0,0 +1,108 @@
+""" Field accessors: fields, node lists and records, namespaced documents or not alike
+"""
+import pytest
+
+from lxml import etree
+
+from conftest import RUT_EMISOR, RUT_RECEPTOR, dte, enviodte
+
+from sii.utils import accessors as acc
+
+LIBRO = """<LibroCompraVenta{ns} version="1.0">
+  <EnvioLibro ID="LV201606">
+    <Caratula>
+      <RutEmisorLibro> 76000000-0 </RutEmisorLibro>
+      <RutEnvia>11111111-1</RutEnvia>
+      <PeriodoTributario>2016-06</PeriodoTributario>
+      <TipoOperacion>VENTA</TipoOperacion>
+      <TipoLibro>MENSUAL</TipoLibro>
+      <TipoEnvio>TOTAL</TipoEnvio>
+    </Caratula>
+    <ResumenPeriodo>
+      <TotalesPeriodo>
+        <TpoDoc>33</TpoDoc><TotDoc>2</TotDoc><TotMntExe>0</TotMntExe><TotMntNeto>3000</TotMntNeto>
+        <TotMntIVA>570</TotMntIVA>
+        <TotOtrosImp><CodImp>15</CodImp><TotMntImp>100</TotMntImp></TotOtrosImp>
+        <TotOtrosImp><CodImp>19</CodImp><TotMntImp>50</TotMntImp></TotOtrosImp>
+        <TotMntTotal>3570</TotMntTotal>
+      </TotalesPeriodo>
+    </ResumenPeriodo>
+    <Detalle>
+      <TpoDoc>33</TpoDoc><NroDoc>1</NroDoc><FchDoc>2016-06-01</FchDoc><RUTDoc>11111111-1</RUTDoc>
+      <RznSoc>Cliente</RznSoc><MntNeto>1000</MntNeto><MntIVA>190</MntIVA>
+      <OtrosImp><CodImp>15</CodImp><TasaImp>10.5</TasaImp><MntImp>100</MntImp></OtrosImp>
+      <MntTotal>1190</MntTotal>
+    </Detalle>
+    <Detalle>
+      <TpoDoc>33</TpoDoc><NroDoc>2</NroDoc><MntExe></MntExe><MntTotal>2380</MntTotal>
+    </Detalle>
+  </EnvioLibro>
+</LibroCompraVenta>"""
+
+
+@pytest.fixture(params=['', ' xmlns="http://www.sii.cl/SiiDte"'], ids=['plain', 'namespaced'])
+def libro(request):
+    return etree.fromstring(LIBRO.format(ns=request.param))
+
+
+class TestField:
+
+    def test_stripped_and_converted(self, libro):
+        assert acc.LIBRO_RUT(libro) == RUT_EMISOR
+        assert acc.LIBRO_PERIOD(libro) == '2016-06'
+        assert acc.Field('EnvioLibro/ResumenPeriodo/TotalesPeriodo/TotDoc', int)(libro) == 2
+
+    def test_missing_or_empty_is_the_default(self, libro):
+        assert acc.Field('EnvioLibro/Caratula/FchResol')(libro) is None
+        assert acc.Field('EnvioLibro/Caratula/FchResol')(libro, default='-') == '-'
+        assert acc.Field('MntExe', int)(acc.LIBRO_DETALLES(libro)[1], default=0) == 0
+
+
+class TestNodes:
+
+    def test_relative_paths(self, libro):
+        assert len(acc.LIBRO_DETALLES(libro)) == 2
+        assert len(acc.LIBRO_TOTALS(libro)) == 1
+        assert acc.Nodes('EnvioLibro/Nada').first(libro) is None
+
+    def test_descendants_include_the_element_itself(self):
+        single = dte(7)
+        envelope = enviodte([dte(1), dte(2)])
+
+        assert acc.DTES(single) == [single]
+        assert [acc.ENCABEZADO(enc).id_doc.folio for enc in acc.ENCABEZADOS(envelope)] == [1, 2]
+        assert acc.ENCABEZADOS.first(acc.DTES(envelope)[1]) is acc.ENCABEZADOS(envelope)[1]
+
+
+class TestRecord:
+
+    def test_encabezado(self):
+        fields = acc.ENCABEZADO(acc.ENCABEZADOS.first(dte(7, dte_type=34, net=2000)))
+
+        assert (fields.id_doc.dte_type, fields.id_doc.folio, fields.id_doc.issued) == (34, 7, '2016-06-01')
+        assert (fields.emitter.rut, fields.receiver.rut) == (RUT_EMISOR, RUT_RECEPTOR)
+        assert (fields.totals.net, fields.totals.vat, fields.totals.gross) == (2000, 380, 2380)
+        assert fields.totals.vat_rate == '19'
+        assert fields.totals.exempt is None and fields.totals.taxes == ()
+
+    def test_repeated_and_nested(self, libro):
+        totals = acc.TOTALES_PERIODO(acc.LIBRO_TOTALS.first(libro))
+
+        assert (totals.dte_type, totals.documents, totals.gross) == (33, 2, 3570)
+        assert [(tax.code, tax.amount) for tax in totals.taxes] == [(15, 100), (19, 50)]
+
+    def test_missing_and_empty_children_are_none(self, libro):
+        first, second = (acc.DETALLE(elem) for elem in acc.LIBRO_DETALLES(libro))
+
+        assert (first.folio, first.name, first.net) == ('1', 'Cliente', 1000)
+        assert len(first.taxes) == 1
+        assert (first.taxes[0].code, first.taxes[0].rate, first.taxes[0].amount) == (15, 10.5, 100)
+
+        assert (second.folio, second.exempt, second.net, second.gross) == ('2', None, None, 2380)
+        assert second.taxes == ()
+
+    def test_first_child_of_a_name_wins(self):
+        record = acc.Record('Pair', value=('Value', int))
+        elem   = etree.fromstring('<Pair><Value>1</Value><Value>2</Value></Pair>')
+
+        assert record(elem) == record.type(1)
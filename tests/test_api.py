@@ -0,0 +1,76 @@
+""" Library API: parsing, signing and pools, as used by the commands
+"""
+import types
+
+import pytest
+
+from lxml import etree
+
+from conftest import dte, write
+
+from sii.bin   import cmd_dte
+from sii.utils import api, keyring
+
+
+class TestParse:
+
+    def test_trees_returned_as_they_are(self):
+        root = dte(1)
+
+        assert api.parse(root) is root
+        assert api.parse(etree.ElementTree(root)) is root
+        assert api.parse(etree.tostring(root)).tag == root.tag
+
+    @pytest.mark.parametrize('source', [b'<DTE><Documento></DTE>', b'', bytearray(b'not xml')])
+    def test_bad_xml_is_a_value_error(self, source):
+        with pytest.raises(ValueError, match='Invalid XML'):
+            api.parse(source)
+
+    def test_other_types_are_a_value_error(self):
+        with pytest.raises(ValueError, match='str'):
+            api.parse('<DTE/>')
+
+
+class TestSign:
+
+    def test_incremental_signs_a_copy(self, keypair, monkeypatch):
+        def sign_stale(xml, key_pem, cert_pem):
+            xml.set('signed', 'yes')
+            return 1
+
+        monkeypatch.setattr(api, 'sign_stale', sign_stale)
+        root   = dte(1)
+        signed = api.sign(root, keyring.Keyring(default=(keypair.key, keypair.cert)), api.SIGN_INCREMENTAL)
+
+        assert signed is not root
+        assert signed.get('signed') == 'yes'
+        assert root.get('signed') is None
+
+    def test_unknown_mode(self, keypair):
+        with pytest.raises(ValueError):
+            api.sign(dte(1), keyring.Keyring(default=(keypair.key, keypair.cert)), 'some')
+
+
+def test_caf_pool_read_once(monkeypatch):
+    monkeypatch.setattr(api, '_CAF_POOLS', {})
+    monkeypatch.setattr(api.types, 'CAFPool', lambda cafs_dir: object())
+
+    assert api.caf_pool('cafs') is api.caf_pool('cafs')
+    assert api.caf_pool('cafs') is not api.caf_pool('other')
+
+
+def test_dte_commands_bundle_through_the_api(tmp_path, monkeypatch):
+    bundled = []
+
+    def bundle_dte(xml, cafs):
+        bundled.append(cafs)
+        return xml
+
+    monkeypatch.setattr(api, 'bundle_dte', bundle_dte)
+    write(dte(1), tmp_path / 'f1.xml')
+
+    config = types.SimpleNamespace(static=types.SimpleNamespace(cafs='cafs'), update=lambda args: None)
+    cmd_dte.handle(config, ['dte', '--ledger', str(tmp_path / 'folios.db'), 'bundle', 'dte', '--suffixed', str(tmp_path / 'f1.xml')])
+
+    assert bundled == ['cafs']
+    assert (tmp_path / 'f1.dte.xml').exists()
@@ -0,0 +1,55 @@
+""" XML archive: created by writing only, read-only otherwise
+"""
+import os
+
+import pytest
+
+from lxml import etree
+
+from conftest import RUT_EMISOR, dte
+
+from sii.bin import archive, helpers
+
+
+@pytest.fixture
+def arch_path(tmp_path):
+    yield str(tmp_path / 'docs.xmlz')
+
+    for found in list(archive._ARCHIVES.values()):
+        found.close()
+
+
+class TestArchive:
+
+    def test_reading_a_missing_archive_creates_nothing(self, arch_path):
+        with pytest.raises(FileNotFoundError, match='No such archive'):
+            archive.Archive(arch_path)
+
+        with pytest.raises(FileNotFoundError):
+            helpers.read_bytes(arch_path + '#' + RUT_EMISOR + '/33/1')
+
+        assert not os.path.exists(arch_path)
+        assert not os.path.exists(arch_path + '.idx')
+
+    def test_written_then_read(self, arch_path):
+        helpers.write_xml(dte(1), arch_path)
+        reader = archive.Archive(arch_path)
+
+        assert reader.keys() == [archive.Key(RUT_EMISOR, 33, 1, 'DTE')]
+        assert etree.fromstring(reader.read(RUT_EMISOR + '/33/1')).tag == dte(1).tag
+
+        with pytest.raises(ValueError, match='read-only'):
+            reader.add(etree.tostring(dte(2)))
+
+        reader.close()
+
+    def test_reopened_for_writing(self, arch_path):
+        helpers.write_xml(dte(1), arch_path)
+        archive.open_archive(arch_path).close()
+
+        reader = archive.open_archive(arch_path)
+        assert not reader.writable
+
+        helpers.write_xml(dte(2), arch_path)
+        assert archive.open_archive(arch_path).writable
+        assert len(archive.open_archive(arch_path)) == 2
@@ -0,0 +1,77 @@
+""" Benchmark suite: synthetic inputs the real readers accept, and the baseline comparison
+"""
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+
+import cases  # noqa: E402
+import run    # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def data(tmp_path_factory):
+    return cases.prepare(str(tmp_path_factory.mktemp('bench')), 5)
+
+
+def bench(monkeypatch, *argv):
+    monkeypatch.setattr(sys, 'argv', ['run.py'] + list(argv))
+
+    try:
+        run.main()
+    except SystemExit as exc:
+        return exc.code
+
+    return 0
+
+
+def test_inputs_are_generated_once(data):
+    marker = os.path.join(data, '.complete')
+    before = os.stat(marker).st_mtime_ns
+
+    cases.prepare(data, 5)
+
+    assert os.stat(marker).st_mtime_ns == before
+    assert len(os.listdir(os.path.join(data, 'dtes'))) == 5
+
+
+@pytest.mark.parametrize('name', ['read_xml', 'read_header', 'read_envelope'])
+def test_cases_process_every_item(data, name):
+    case   = cases.CASES[name]
+    result = run._run_case(name, data, 5, 1)
+
+    assert case.sized
+    assert result['items'] >= 5 and result['rate'] > 0
+
+
+def test_regressions_fail_the_run(tmp_path, data, monkeypatch):
+    baseline = str(tmp_path / 'baseline.json')
+    argv     = ['--sizes', '5', '--repeat', '1', '--workdir', os.path.dirname(data), '--baseline', baseline]
+
+    os.rename(data, os.path.join(os.path.dirname(data), '5'))
+    try:
+        assert bench(monkeypatch, '--save', 'read_header', *argv) == 0
+
+        with open(baseline) as fh:
+            stored = json.load(fh)
+
+        assert stored['version'] == run.BASELINE_VERSION
+        assert stored['results']['read_header']['5']['items'] == 6
+
+        stored['results']['read_header']['5']['rate'] *= 1000
+        with open(baseline, 'w') as fh:
+            json.dump(stored, fh)
+
+        assert bench(monkeypatch, 'read_header', *argv) == 1
+    finally:
+        os.rename(os.path.join(os.path.dirname(data), '5'), data)
+
+
+def test_baselines_of_other_versions_are_ignored(tmp_path):
+    fpath = tmp_path / 'baseline.json'
+    fpath.write_text(json.dumps({'version': run.BASELINE_VERSION + 1, 'results': {'read_xml': {}}}))
+
+    assert run._load_baseline(str(fpath)) == {}
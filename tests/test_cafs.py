@@ -0,0 +1,140 @@
+""" CAF index, TED stamp verification and `sii xml verify caf`
+"""
+import types
+
+import pytest
+
+from lxml import etree
+
+from conftest import dd_bytes, dte, make_caf, stamp, write
+
+from sii.bin import cafs, cmd_xml
+
+
+@pytest.fixture(scope='module')
+def caf_dir(tmp_path_factory):
+    return tmp_path_factory.mktemp('cafs')
+
+
+@pytest.fixture(scope='module')
+def caf(caf_dir):
+    return make_caf(caf_dir, 1, 100)
+
+
+@pytest.fixture(scope='module')
+def caf_next(caf_dir):
+    return make_caf(caf_dir, 101, 200)
+
+
+def record(first, last, rut='76000000-0', dte_type=33):
+    return cafs.CAF(None, rut, dte_type, first, last, 1, 3)
+
+
+def verify_caf(paths, cafs_dir):
+    config = types.SimpleNamespace(static=types.SimpleNamespace(cafs=str(cafs_dir)))
+
+    try:
+        cmd_xml.handle(config, ['xml', 'verify', 'caf', '--workers', '1'] + list(paths))
+    except SystemExit as exc:
+        return exc.code
+
+    return 0
+
+
+class TestCAFIndex:
+
+    def test_lookup(self):
+        index = cafs.CAFIndex([record(101, 200), record(1, 100), record(301, 400), record(1, 50, dte_type=61)])
+
+        assert index.lookup('76000000-0', 33, 1).first == 1
+        assert index.lookup('76000000-0', 33, 100).first == 1
+        assert index.lookup('76000000-0', 33, 101).first == 101
+        assert index.lookup('76000000-0', 33, 250) is None
+        assert index.lookup('76000000-0', 33, 401) is None
+        assert index.lookup('76000000-0', 61, 60) is None
+        assert index.lookup('76000000-0', 34, 1) is None
+
+        assert ('76000000-0', 33) in index and ('76000000-0', 34) not in index
+        assert len(index) == 4
+
+    def test_from_directory(self, tmp_path, caf):
+        write(etree.fromstring(b'<AUTORIZACION><RSASK/></AUTORIZACION>'), tmp_path / 'nocaf.xml')
+        write(etree.fromstring(b'<AUTORIZACION><CAF><DA><RE>1-9</RE></DA></CAF></AUTORIZACION>'), tmp_path / 'partial.xml')
+        write(etree.fromstring(b'<Other/>'), tmp_path / 'other.xml')
+        (tmp_path / 'notes.txt').write_text("not xml")
+        (tmp_path / 'caf.xml').write_bytes(open(caf.path, 'rb').read())
+
+        errors = []
+        index  = cafs.CAFIndex.from_directory(str(tmp_path), on_error=lambda path, exc: errors.append(path))
+
+        assert len(index) == 1
+        assert index.lookup(caf.rut, caf.dte_type, 50).last == 100
+        assert sorted(errors) == [str(tmp_path / 'nocaf.xml'), str(tmp_path / 'partial.xml')]
+
+
+class TestStamp:
+
+    def verified(self, tmp_path, doc, caf):
+        # written pretty printed and read back, as stamps are verified
+        fpath = write(doc, tmp_path / 'dte.xml')
+        stamp, = cafs.extract_stamps(etree.parse(fpath).getroot())
+
+        return cafs.verify_stamp(stamp, cafs.parse_caf(caf.node))
+
+    def test_signed_bytes_are_the_dd_as_signed(self, tmp_path, caf):
+        dd = dd_bytes(caf, 1, name="P\xe9rez & Hijos 'Ltda' <Sur>", item="Servicio\n    mensual")
+
+        assert self.verified(tmp_path, stamp(dte(1), caf, dd), caf)
+
+    def test_tampered_dd(self, tmp_path, caf):
+        doc = stamp(dte(1), caf)
+        doc.find('.//{*}TED/{*}DD/{*}MNT').text = '1'
+
+        assert not self.verified(tmp_path, doc, caf)
+
+    def test_other_key(self, tmp_path, caf, caf_next):
+        assert not self.verified(tmp_path, stamp(dte(1), caf), caf_next)
+
+    def test_missing_ted(self):
+        stamp, = cafs.extract_stamps(dte(1))
+
+        assert stamp.signed is None
+        assert not cafs.verify_stamp(stamp, None)
+
+
+class TestVerifyCAF:
+
+    def test_good(self, tmp_path, caf_dir, caf, caf_next):
+        paths = [
+            write(stamp(dte(5), caf), tmp_path / 'a.xml'),
+            write(stamp(dte(150), caf_next), tmp_path / 'b.xml')
+        ]
+
+        assert verify_caf(paths, caf_dir) == 0
+
+    def test_duplicates_across_the_batch(self, tmp_path, caf_dir, caf, capsys):
+        paths = [
+            write(stamp(dte(5), caf), tmp_path / 'a.xml'),
+            write(stamp(dte(6), caf), tmp_path / 'b.xml'),
+            write(stamp(dte(5, net=2000), caf), tmp_path / 'c.xml')
+        ]
+
+        assert verify_caf(paths, caf_dir) == 4
+
+        lines = capsys.readouterr().out.splitlines()
+        assert "Duplicate: 76000000-0 33-5 (also in {0}).".format(paths[0]) in lines[2]
+
+    def test_folio_not_authorized(self, tmp_path, caf_dir, caf, capsys):
+        # stamped by a CAF of its own, but the emitter's CAFs do not cover the folio
+        other = make_caf(tmp_path / 'other', 300, 400)
+        fpath = write(stamp(dte(350), other), tmp_path / 'a.xml')
+
+        assert verify_caf([fpath], caf_dir) == 4
+        assert "Folio not authorized by any CAF" in capsys.readouterr().out
+
+    def test_embedded_caf_differs(self, tmp_path, caf_dir, caf, capsys):
+        other = make_caf(tmp_path / 'other', 1, 100)
+        fpath = write(stamp(dte(10), other), tmp_path / 'a.xml')
+
+        assert verify_caf([fpath], caf_dir) == 4
+        assert "Embedded CAF differs from" in capsys.readouterr().out
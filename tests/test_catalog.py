@@ -0,0 +1,102 @@
+""" Catalog: a row per DTE (envelopes included), incremental updates, queries and `sii index`
+"""
+import os
+import sqlite3
+
+import pytest
+
+from conftest import RUT_EMISOR, dte, enviodte, write
+
+from sii.bin import catalog, cmd_index
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'docs'
+
+    write(dte(1), root / 'f1.xml')
+    write(enviodte([dte(2), dte(3), dte(10, dte_type=61)], recpt='60803000-K'), root / 'sub' / 'envio.xml')
+    (root / 'broken.xml').write_bytes(b'<DTE><Documento>')
+
+    return root
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / 'catalog.db')
+
+
+def update(db_path, *roots):
+    with catalog.Catalog(db_path) as cat:
+        return cat.update([str(root) for root in roots], verify=False, workers=1)
+
+
+def find(db_path, query=None):
+    with catalog.Catalog(db_path) as cat:
+        return cat.select(catalog.parse_query(query))
+
+
+class TestCatalog:
+
+    def test_a_row_per_dte(self, tree, db_path):
+        summary = update(db_path, tree)
+
+        assert (summary.added, summary.failed) == (3, 1)
+
+        rows = [(entry.dte_type, entry.folio, entry.position, entry.kind) for entry in find(db_path, 'rut=' + RUT_EMISOR)]
+        assert rows == [(33, 1, 0, 'DTE'), (33, 2, 0, 'EnvioDTE'), (33, 3, 1, 'EnvioDTE'), (61, 10, 2, 'EnvioDTE')]
+
+        entry, = find(db_path, 'folio=3')
+        assert (entry.envio_recpt, entry.path) == ('60803000-K', str(tree / 'sub' / 'envio.xml'))
+
+    def test_envelopes_are_selected_once(self, tree, db_path):
+        update(db_path, tree)
+
+        with catalog.Catalog(db_path) as cat:
+            assert cat.paths(catalog.parse_query('folio=2-3')) == [str(tree / 'sub' / 'envio.xml')]
+
+    def test_changed_files_replace_their_rows(self, tree, db_path):
+        update(db_path, tree)
+
+        envio = tree / 'sub' / 'envio.xml'
+        write(enviodte([dte(2)]), envio)
+        os.utime(str(envio), ns=(0, 0))
+
+        summary = update(db_path, tree)
+
+        assert (summary.updated, summary.unchanged) == (1, 2)
+        assert [entry.folio for entry in find(db_path, 'kind=EnvioDTE')] == [2]
+
+    def test_removed_files_are_dropped(self, tree, db_path):
+        update(db_path, tree)
+        os.unlink(str(tree / 'sub' / 'envio.xml'))
+
+        assert update(db_path, tree).removed == 1
+        assert [entry.folio for entry in find(db_path, 'rut=' + RUT_EMISOR)] == [1]
+
+    def test_overlapping_roots(self, tree, db_path):
+        summary = update(db_path, tree, tree / 'sub', tree / 'f1.xml', tree)
+
+        assert (summary.added, summary.failed) == (3, 1)
+        assert len(find(db_path)) == 5
+
+    def test_catalogs_of_older_versions_are_rebuilt(self, tree, db_path):
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE documents (path TEXT PRIMARY KEY, mtime_ns INTEGER)")
+        conn.execute("INSERT INTO documents VALUES ('/gone.xml', 0)")
+        conn.commit()
+        conn.close()
+
+        assert update(db_path, tree).added == 3
+        assert '/gone.xml' not in [entry.path for entry in find(db_path)]
+
+    def test_unknown_query_keys(self):
+        with pytest.raises(ValueError):
+            catalog.parse_query('colour=red')
+
+
+def test_find_paths(tree, db_path, capsys):
+    cmd_index.handle(None, ['index', '--catalog', db_path, 'update', '--no-verify', '--workers', '1', str(tree)])
+    cmd_index.handle(None, ['index', '--catalog', db_path, 'find', '--paths', 'kind=EnvioDTE'])
+
+    assert capsys.readouterr().out.splitlines() == [str(tree / 'sub' / 'envio.xml')]
@@ -0,0 +1,95 @@
+""" Configuration: validation up front (but of `mail` only when read) and the JSON snapshot
+"""
+import os
+import json
+
+import pytest
+
+from sii.bin import config as cfg
+
+
+BASE = """
+auth:
+    key: /keys/key.pem
+    cert: /keys/cert.pem
+static:
+    cafs: /cafs
+    companies: /companies.yml
+"""
+
+
+@pytest.fixture(autouse=True)
+def snapshots(tmp_path, monkeypatch):
+    snap_dir = tmp_path / 'cache'
+    monkeypatch.setattr(cfg, 'SNAPSHOT_DIR', str(snap_dir))
+
+    return snap_dir
+
+
+def load(tmp_path, text):
+    fpath = tmp_path / 'cfg.yml'
+    fpath.write_text(text)
+
+    return cfg.Configuration(str(fpath), str(fpath))
+
+
+def test_mail_is_not_required(tmp_path):
+    config = load(tmp_path, BASE)
+
+    assert config.static.cafs == '/cafs'
+    with pytest.raises(KeyError):
+        config.mail
+
+
+def test_broken_mail_only_fails_when_read(tmp_path):
+    config = load(tmp_path, BASE + "mail:\n    host: smtp.example.com\n    port: twenty-five\n")
+
+    assert config.auth.key == '/keys/key.pem'
+
+    with pytest.raises(ValueError) as exc:
+        config.mail
+
+    assert 'passwd' in str(exc.value) and 'port' in str(exc.value)
+
+
+def test_complete_mail(tmp_path):
+    config = load(tmp_path, BASE + "mail:\n    host: smtp.example.com\n    port: 25\n    user: u\n    passwd: p\n")
+
+    assert (config.mail.host, config.mail.port) == ('smtp.example.com', 25)
+
+
+def test_required_sections_are_checked_up_front(tmp_path):
+    with pytest.raises(ValueError) as exc:
+        load(tmp_path, "auth:\n    key: /keys/key.pem\n")
+
+    assert 'cert' in str(exc.value) and '<static>' in str(exc.value)
+
+
+def test_snapshot_is_json_and_reused(tmp_path, snapshots, monkeypatch):
+    load(tmp_path, BASE)
+
+    snap, = snapshots.iterdir()
+    with open(str(snap)) as fh:
+        key, yml = json.load(fh)
+
+    assert yml['static']['cafs'] == '/cafs'
+
+    monkeypatch.setattr(cfg, '_parse', lambda *args: pytest.fail("parsed again"))
+    fpath = str(tmp_path / 'cfg.yml')
+    assert cfg.Configuration(fpath, fpath).auth.cert == '/keys/cert.pem'
+
+
+def test_changed_file_is_parsed_again(tmp_path):
+    load(tmp_path, BASE)
+
+    fpath = tmp_path / 'cfg.yml'
+    fpath.write_text(BASE.replace('/cafs', '/other/cafs'))
+    os.utime(str(fpath), ns=(0, 0))
+
+    assert cfg.Configuration(str(fpath), str(fpath)).static.cafs == '/other/cafs'
+
+
+def test_configs_json_can_not_keep_are_not_snapshotted(tmp_path, snapshots):
+    load(tmp_path, BASE + "    since: 2016-06-01\n")
+
+    assert not snapshots.exists() or not list(snapshots.iterdir())
@@ -0,0 +1,56 @@
+""" RSA verification against signatures and keys made by openssl
+"""
+import base64
+
+import pytest
+
+from conftest import openssl
+
+from sii.utils import crypto, dsig
+
+MESSAGE = b'<DD><RE>76000000-0</RE><TD>33</TD><F>7</F></DD>'
+
+
+@pytest.fixture
+def public_key(keypair):
+    """ (modulus, exponent) of the keypair as openssl reads it. """
+    modulus = openssl('x509', '-noout', '-modulus', '-in', keypair.cert).decode('ascii').strip()
+    return int(modulus.split('=')[1], 16), 65537
+
+
+def signed(keypair, digest, message=MESSAGE):
+    return openssl('dgst', '-' + digest, '-sign', keypair.key, input=message)
+
+
+class TestRsaVerify:
+
+    @pytest.mark.parametrize('digest', ['sha1', 'sha256'])
+    def test_openssl_signatures(self, keypair, public_key, digest):
+        signature = signed(keypair, digest)
+
+        assert crypto.rsa_verify(MESSAGE, signature, *public_key, digest=digest)
+        assert crypto.rsa_verify(MESSAGE, base64.b64encode(signature).decode('ascii'), *public_key, digest=digest)
+
+    def test_other_message_or_digest(self, keypair, public_key):
+        signature = signed(keypair, 'sha1')
+
+        assert not crypto.rsa_verify(MESSAGE + b' ', signature, *public_key)
+        assert not crypto.rsa_verify(MESSAGE, signature, *public_key, digest='sha256')
+
+    def test_malformed_signatures(self, keypair, public_key):
+        signature = signed(keypair, 'sha1')
+        modulus   = public_key[0]
+
+        assert not crypto.rsa_verify(MESSAGE, signature[1:], *public_key)
+        assert not crypto.rsa_verify(MESSAGE, modulus.to_bytes(len(signature), 'big'), *public_key)
+        assert not crypto.rsa_verify(MESSAGE, bytes(len(signature)), *public_key)
+
+
+class TestCertificateKey:
+
+    def test_same_key_as_openssl(self, keypair, public_key):
+        with open(keypair.cert, 'rb') as fh:
+            assert dsig.certificate_key(dsig.load_certificate(fh.read())) == public_key
+
+    def test_not_a_certificate(self):
+        assert dsig.certificate_key(b'\x30\x03\x02\x01\x00') is None
@@ -0,0 +1,59 @@
+""" Shared sqlite setup of the local databases and the table printing of their reports
+"""
+import io
+
+from sii.bin import database, helpers
+
+SCHEMA = "CREATE TABLE IF NOT EXISTS items (name TEXT PRIMARY KEY);"
+
+
+class Versioned(database.Database):
+
+    def __init__(self, db_path):
+        super().__init__(db_path, SCHEMA, synchronous='NORMAL', isolation_level=None)
+
+    def _upgrade(self):
+        self._conn.execute("DROP TABLE IF EXISTS items")
+        self._conn.execute("PRAGMA user_version = 2")
+
+
+class TestDatabase:
+
+    def test_created_with_its_directory(self, tmp_path):
+        db_path = tmp_path / 'state' / 'nested' / 'items.db'
+
+        with database.Database(str(db_path), SCHEMA) as db:
+            db._conn.execute("INSERT INTO items VALUES ('a')")
+            db._conn.commit()
+
+            assert db._conn.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+
+        with database.Database(str(db_path), SCHEMA) as db:
+            assert db._conn.execute("SELECT name FROM items").fetchall() == [('a',)]
+
+    def test_upgraded_before_the_schema(self, tmp_path):
+        db_path = str(tmp_path / 'items.db')
+
+        with database.Database(db_path, SCHEMA) as db:
+            db._conn.execute("INSERT INTO items VALUES ('a')")
+            db._conn.commit()
+
+        with Versioned(db_path) as db:
+            assert db._conn.execute("SELECT name FROM items").fetchall() == []
+            assert db._conn.execute('PRAGMA user_version').fetchone() == (2,)
+            assert db._conn.execute('PRAGMA synchronous').fetchone() == (1,)
+            assert db._conn.isolation_level is None
+
+
+class TestPrintTable:
+
+    def test_columns_are_aligned(self):
+        out = io.StringIO()
+        helpers.print_table([("RUT", "Docs"), ("76000000-0", "7"), ("1-9", "1234")], file=out)
+
+        assert out.getvalue().splitlines() == [
+            "       RUT  Docs",
+            "----------------",
+            "76000000-0     7",
+            "       1-9  1234"
+        ]
@@ -0,0 +1,163 @@
+""" XML signature verification: digests and values checked here, against signatures made by openssl
+"""
+import base64
+import hashlib
+
+import pytest
+
+from lxml import etree
+
+from conftest import SII_NS, dte, enviodte, openssl
+
+from sii.utils import dsig
+
+DS  = '{' + dsig.DS_NS + '}'
+SII = '{' + SII_NS + '}'
+
+C14N     = 'http://www.w3.org/TR/2001/REC-xml-c14n-20010315'
+RSA_SHA1 = 'http://www.w3.org/2000/09/xmldsig#rsa-sha1'
+SHA1     = 'http://www.w3.org/2000/09/xmldsig#sha1'
+
+
+def pem_body(fpath):
+    with open(fpath, 'rb') as fh:
+        lines = fh.read().strip().splitlines()
+
+    return b''.join(lines[1:-1])
+
+
+def sign(parent, node, keypair):
+    """ Appends to `parent` a <Signature> of `node` (by its ID), digest and value made by openssl. """
+    signature   = etree.SubElement(parent, DS + 'Signature', nsmap={None: dsig.DS_NS})
+    signed_info = etree.SubElement(signature, DS + 'SignedInfo')
+
+    etree.SubElement(signed_info, DS + 'CanonicalizationMethod', Algorithm=C14N)
+    etree.SubElement(signed_info, DS + 'SignatureMethod', Algorithm=RSA_SHA1)
+
+    reference = etree.SubElement(signed_info, DS + 'Reference', URI='#' + node.get('ID'))
+    etree.SubElement(reference, DS + 'DigestMethod', Algorithm=SHA1)
+    etree.SubElement(reference, DS + 'DigestValue').text = base64.b64encode(
+        hashlib.sha1(etree.tostring(node, method='c14n')).digest()
+    )
+
+    value    = etree.SubElement(signature, DS + 'SignatureValue')
+    key_info = etree.SubElement(signature, DS + 'KeyInfo')
+    x509     = etree.SubElement(key_info, DS + 'X509Data')
+    etree.SubElement(x509, DS + 'X509Certificate').text = pem_body(keypair.cert)
+
+    value.text = base64.b64encode(
+        openssl('dgst', '-sha1', '-sign', keypair.key, input=etree.tostring(signed_info, method='c14n'))
+    )
+
+    return signature
+
+
+def verdicts(xml):
+    return [validity for _, validity in dsig.verify_signatures(xml)]
+
+
+@pytest.fixture
+def signed_dte(keypair):
+    root = dte(7)
+    sign(root, root[0], keypair)
+    return root
+
+
+class TestVerifySignatures:
+
+    def test_good(self, signed_dte):
+        assert verdicts(signed_dte) == [True]
+        assert dsig.verify_signatures(signed_dte)[0][0] == '#F7T33'
+
+    def test_tampered_contents(self, signed_dte):
+        signed_dte.find('.//{*}MntTotal').text = '1'
+
+        assert verdicts(signed_dte) == [False]
+
+    def test_tampered_value(self, signed_dte):
+        value = signed_dte.find('.//' + DS + 'SignatureValue')
+        value.text = base64.b64encode(bytes(reversed(base64.b64decode(value.text))))
+
+        assert verdicts(signed_dte) == [False]
+
+    def test_nested(self, keypair):
+        envelope = enviodte([dte(1), dte(2)])
+
+        for doc in envelope.iter('{*}DTE'):
+            sign(doc, doc[0], keypair)
+        sign(envelope, envelope[0], keypair)
+
+        assert verdicts(envelope) == [True, True, True]
+
+
+    @pytest.mark.parametrize('field', ['DigestValue', 'SignatureValue', 'X509Certificate'])
+    def test_malformed_base64(self, signed_dte, field):
+        signed_dte.find('.//' + DS + field).text = 'abc'
+
+        assert verdicts(signed_dte) == [False]
+
+    def test_base64_line_breaks(self, signed_dte):
+        cert = signed_dte.find('.//' + DS + 'X509Certificate')
+        cert.text = '\n'.join(cert.text[idx:idx + 76] for idx in range(0, len(cert.text), 76))
+
+        assert verdicts(signed_dte) == [True]
+
+
+class TestDuplicateIds:
+
+    def test_wrapped_document_does_not_verify(self, signed_dte):
+        # the signed original moved out of the way, an altered copy read in its place
+        wrapper  = etree.Element(SII + 'Wrapper', nsmap={None: SII_NS})
+        hidden   = etree.SubElement(wrapper, SII + 'Hidden')
+        original = signed_dte[0]
+
+        forged = etree.fromstring(etree.tostring(original))
+        forged.find('.//{*}MntTotal').text = '1'
+
+        hidden.append(original)
+        signed_dte.insert(0, forged)
+        wrapper.append(signed_dte)
+
+        assert verdicts(wrapper) == [False]
+
+    def test_lookup_of_a_duplicate_id_raises(self):
+        root = etree.fromstring('<Root><A ID="x"/><B ID="x"/><C ID="y"/></Root>')
+        ids  = dsig._IdIndex(root)
+
+        assert ids.get('y').tag == 'C'
+        assert ids.get('z') is None
+
+        with pytest.raises(ValueError):
+            ids.get('x')
+
+
+class TestSignStale:
+
+    def test_nothing_without_xmlsec(self, signed_dte, keypair, monkeypatch):
+        monkeypatch.setattr(dsig, 'xmlsec', None)
+        signed_dte.find('.//{*}MntTotal').text = '1'
+
+        with open(keypair.key, 'rb') as key, open(keypair.cert, 'rb') as cert:
+            assert dsig.sign_stale(signed_dte, key.read(), cert.read()) is None
+
+        assert verdicts(signed_dte) == [False]
+
+    def test_only_stale_signatures_are_signed(self, keypair):
+        pytest.importorskip('xmlsec')
+
+        envelope = enviodte([dte(1), dte(2)])
+        for doc in envelope.iter('{*}DTE'):
+            sign(doc, doc[0], keypair)
+        sign(envelope, envelope[0], keypair)
+
+        with open(keypair.key, 'rb') as key, open(keypair.cert, 'rb') as cert:
+            key_pem, cert_pem = key.read(), cert.read()
+
+        assert dsig.sign_stale(envelope, key_pem, cert_pem) == 0
+
+        envelope.find('.//{*}DTE[2]//{*}MntTotal').text = '1'
+        first = envelope.find('.//{*}DTE//{*}SignatureValue').text
+
+        assert dsig.sign_stale(envelope, key_pem, cert_pem) == 2
+        assert verdicts(envelope) == [True, True, True]
+        assert envelope.find('.//{*}DTE//{*}SignatureValue').text == first
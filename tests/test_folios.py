@@ -0,0 +1,170 @@
+""" Folio ledger seeding, reservation and `sii xml void doc`/`sii xml folios seed`
+"""
+import sqlite3
+import types
+
+import pytest
+
+from conftest import RUT_EMISOR, dte, enviodte, make_caf, write
+
+from sii.bin import cafs, cmd_folios, cmd_xml, folios
+
+
+@pytest.fixture(scope='module')
+def caf_dir(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('cafs')
+
+    make_caf(directory, 1, 100)
+    make_caf(directory, 1, 3, dte_type=61)
+
+    return directory
+
+
+@pytest.fixture
+def caf_index(caf_dir):
+    return cafs.CAFIndex.from_directory(str(caf_dir))
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    with folios.FolioLedger(str(tmp_path / 'folios.db')) as ledger:
+        yield ledger
+
+
+def run(caf_dir, tmp_path, *argv):
+    config = types.SimpleNamespace(static=types.SimpleNamespace(cafs=str(caf_dir)))
+    cmd_xml.handle(config, ['xml', '--ledger', str(tmp_path / 'folios.db')] + list(argv))
+
+
+class TestFolioLedger:
+
+    def test_unseeded_ledger_hands_out_nothing(self, ledger, caf_index):
+        with pytest.raises(LookupError):
+            ledger.reserve(caf_index, RUT_EMISOR, 61)
+
+        assert ledger.state(RUT_EMISOR, 61, 1) is None
+
+    def test_seeded_from_issued_documents(self, ledger, caf_index):
+        issued = [
+            types.SimpleNamespace(rut=RUT_EMISOR, dte_type=61, folio=1, path='nc1.xml'),
+            types.SimpleNamespace(rut=RUT_EMISOR, dte_type=33, folio=7, path='f7.xml')
+        ]
+
+        assert ledger.seed(issued, caf_index) == 2
+        assert ledger.seeded(RUT_EMISOR, 33) and ledger.seeded(RUT_EMISOR, 61)
+        assert ledger.reserve(caf_index, RUT_EMISOR, 61) == 2
+        assert ledger.reserve(caf_index, RUT_EMISOR, 33) == 8
+
+    def test_reserved_folios_are_taken(self, ledger, caf_index):
+        ledger.seed([], caf_index)
+
+        taken = [ledger.reserve(caf_index, RUT_EMISOR, 61) for _ in range(4)]
+
+        assert taken == [1, 2, 3, None]
+        assert ledger.state(RUT_EMISOR, 61, 3) == folios.STATE_USED
+
+    def test_concurrent_ledgers_never_share_a_folio(self, tmp_path, caf_index):
+        db_path = str(tmp_path / 'folios.db')
+
+        with folios.FolioLedger(db_path) as first, folios.FolioLedger(db_path) as second:
+            first.seed([], caf_index)
+
+            assert first.reserve(caf_index, RUT_EMISOR, 61) == 1
+            assert second.reserve(caf_index, RUT_EMISOR, 61) == 2
+
+    def test_void_records_both_folios(self, ledger, caf_index):
+        ledger.seed([], caf_index)
+
+        nc_folio = ledger.void(caf_index, (RUT_EMISOR, 33, 5), 61, lambda folio: 'nc.xml')
+
+        assert nc_folio == 1
+        assert ledger.state(RUT_EMISOR, 33, 5) == folios.STATE_VOIDED
+        assert ledger.state(RUT_EMISOR, 61, 1) == folios.STATE_USED
+
+        with pytest.raises(folios.AlreadyVoidedError):
+            ledger.void(caf_index, (RUT_EMISOR, 33, 5), 61, lambda folio: 'nc.xml')
+
+    def test_failed_write_records_nothing(self, ledger, caf_index):
+        ledger.seed([], caf_index)
+
+        def write(folio):
+            raise OSError("disk full")
+
+        with pytest.raises(OSError):
+            ledger.void(caf_index, (RUT_EMISOR, 33, 5), 61, write)
+
+        assert ledger.state(RUT_EMISOR, 33, 5) is None
+        assert ledger.state(RUT_EMISOR, 61, 1) is None
+
+    def test_free_folios_follow_the_highest_taken(self, ledger, caf_index):
+        ledger.seed([types.SimpleNamespace(rut=RUT_EMISOR, dte_type=61, folio=2, path='nc2.xml')], caf_index)
+
+        usage, = ledger.usage(caf_index, RUT_EMISOR, 61)
+
+        assert (usage.used, usage.voided, usage.free) == (1, 0, 1)
+        assert ledger.reserve(caf_index, RUT_EMISOR, 61) == 3
+        assert ledger.reserve(caf_index, RUT_EMISOR, 61) is None
+
+    def test_reserve_takes_the_write_lock(self, tmp_path, caf_index):
+        db_path = str(tmp_path / 'folios.db')
+
+        with folios.FolioLedger(db_path) as ledger:
+            ledger.seed([], caf_index)
+
+            other = sqlite3.connect(db_path, timeout=0, isolation_level=None)
+            other.execute('BEGIN IMMEDIATE')
+
+            ledger._conn.execute('PRAGMA busy_timeout = 0')
+            with pytest.raises(sqlite3.OperationalError):
+                ledger.reserve(caf_index, RUT_EMISOR, 61)
+
+            other.execute('ROLLBACK')
+            other.close()
+
+            assert ledger.reserve(caf_index, RUT_EMISOR, 61) == 1
+
+
+class TestCommands:
+
+    def test_void_requires_a_seeded_ledger(self, caf_dir, tmp_path):
+        infile = write(dte(5), tmp_path / 'f5.xml')
+
+        with pytest.raises(SystemExit) as exc:
+            run(caf_dir, tmp_path, 'void', 'doc', str(tmp_path / 'nc.xml'), infile)
+
+        assert 'seeded' in str(exc.value)
+        assert not (tmp_path / 'nc.xml').exists()
+
+    def test_failed_writes_are_not_taken_for_voided(self, caf_dir, tmp_path, monkeypatch):
+        issued = write(dte(6), tmp_path / 'f6.xml')
+        run(caf_dir, tmp_path, 'folios', 'seed', issued)
+
+        def write_xml(xml, fpath, encoding):
+            raise ValueError("no room in the archive")
+
+        monkeypatch.setattr(cmd_folios, 'write_xml', write_xml)
+
+        with pytest.raises(ValueError, match='no room'):
+            run(caf_dir, tmp_path, 'void', 'doc', str(tmp_path / 'nc.xml'), issued)
+
+    def test_seed_then_void(self, caf_dir, tmp_path):
+        issued = tmp_path / 'issued'
+        write(enviodte([dte(5), dte(1, dte_type=61)]), issued / 'envio.xml')
+        write(dte(6), issued / 'sub' / 'f6.xml')
+
+        run(caf_dir, tmp_path, 'folios', 'seed', str(issued))
+
+        with folios.FolioLedger(str(tmp_path / 'folios.db')) as ledger:
+            assert ledger.state(RUT_EMISOR, 33, 5) == folios.STATE_USED
+            assert ledger.state(RUT_EMISOR, 33, 6) == folios.STATE_USED
+            assert ledger.state(RUT_EMISOR, 61, 1) == folios.STATE_USED
+
+        outdir = tmp_path / 'out'
+        outdir.mkdir()
+        run(caf_dir, tmp_path, 'void', 'doc', str(outdir), str(issued / 'sub' / 'f6.xml'))
+
+        assert [path.name for path in outdir.iterdir()] == ['76000000_61_2.xml']
+
+        with folios.FolioLedger(str(tmp_path / 'folios.db')) as ledger:
+            assert ledger.state(RUT_EMISOR, 33, 6) == folios.STATE_VOIDED
+            assert ledger.state(RUT_EMISOR, 61, 2) == folios.STATE_USED
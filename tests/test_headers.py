@@ -0,0 +1,61 @@
+""" Header extraction: whole parse of small files, incremental parse of large ones, same result
+"""
+import pickle
+
+import pytest
+
+from lxml import etree
+
+from conftest import RUT_EMISOR, RUT_RECEPTOR, dte, enviodte, write
+
+from sii.utils import headers
+
+
+def large(count):
+    """ Envelope past `WHOLE_PARSE_SIZE`, so its header is read incrementally. """
+    return enviodte([dte(folio, net=1000 * folio) for folio in range(1, count + 1)], recpt='60803000-K')
+
+
+def test_dte(tmp_path):
+    header = headers.read_header(write(dte(7, dte_type=34), tmp_path / 'dte.xml'))
+
+    assert header.kind == 'DTE'
+    assert header.key == (RUT_EMISOR, 34, 7)
+    assert (header.issued, header.recpt_rut, header.envio_recpt) == ('2016-06-01', RUT_RECEPTOR, None)
+    assert header.rut_number == '76000000'
+
+
+def test_large_envelope_reads_the_first_dte(tmp_path):
+    fpath = write(large(400), tmp_path / 'envio.xml')
+
+    with open(fpath, 'rb') as fh:
+        assert len(fh.read()) > headers.WHOLE_PARSE_SIZE
+
+    header = headers.read_header(fpath)
+
+    assert (header.kind, header.key, header.envio_recpt) == ('EnvioDTE', (RUT_EMISOR, 33, 1), '60803000-K')
+    assert header == headers.header_of(etree.parse(fpath), fpath)
+
+
+def test_large_file_stops_at_the_header(tmp_path):
+    fpath = tmp_path / 'envio.xml'
+    buff  = etree.tostring(large(400), encoding='ISO-8859-1', xml_declaration=True)
+
+    fpath.write_bytes(buff[:len(buff) * 3 // 4])  # truncated well after the first <Encabezado>
+
+    assert headers.read_header(str(fpath)).folio == 1
+
+
+@pytest.mark.parametrize('content', [b'<DTE><Documento/></DTE>', b'<DTE><Documento>'])
+def test_unreadable(tmp_path, content):
+    fpath = tmp_path / 'bad.xml'
+    fpath.write_bytes(content)
+
+    with pytest.raises(ValueError):
+        headers.read_header(str(fpath))
+
+
+def test_headers_pickle():
+    header = headers.header_of(dte(3), 'dte.xml')
+
+    assert pickle.loads(pickle.dumps(header)) == header
@@ -0,0 +1,69 @@
+""" Mail ingestion: filing received documents by their header, never outside the destination directory
+"""
+import mailbox
+
+from email.message import EmailMessage
+
+import pytest
+
+from lxml import etree
+
+from conftest import dte, enviodte, permissive_xsd
+
+from sii.bin import inbox, ingest
+
+
+@pytest.fixture(autouse=True)
+def good_signatures(monkeypatch):
+    monkeypatch.setattr(ingest, 'verify_signatures', lambda root: [('', True)])
+
+
+def mbox_of(fpath, *documents):
+    box = mailbox.mbox(str(fpath))
+
+    for idx, xml in enumerate(documents):
+        message = EmailMessage()
+        message['Message-ID'] = '<{0}@example.com>'.format(idx)
+        message.set_content("DTE adjunto")
+        message.add_attachment(
+            etree.tostring(xml, encoding='ISO-8859-1', xml_declaration=True),
+            maintype='application', subtype='xml', filename='envio_{0}.xml'.format(idx)
+        )
+        box.add(message)
+
+    box.close()
+    return str(fpath)
+
+
+def run(tmp_path, source):
+    with inbox.Inbox(str(tmp_path / 'inbox.db')) as ledger:
+        return list(ingest.ingest(
+            ledger, source, str(tmp_path / 'dest'), xsd_path=permissive_xsd(tmp_path, 'EnvioDTE'), workers=1
+        ))
+
+
+class TestIngest:
+
+    def test_filed_by_header(self, tmp_path):
+        source = mbox_of(tmp_path / 'mbox', enviodte([dte(7)]))
+
+        filed, = run(tmp_path, source)
+
+        assert filed.status == inbox.STATUS_FILED
+        assert filed.path == str(tmp_path / 'dest' / '76000000-0' / '33' / '7.xml')
+
+    @pytest.mark.parametrize('rut', ['../../../tmp/evil', '/etc', '76000000-0/..', '76.000.000-0'])
+    def test_rut_unfit_for_a_path_is_invalid(self, tmp_path, rut):
+        source = mbox_of(tmp_path / 'mbox', enviodte([dte(7, rut=rut)]))
+
+        filed, = run(tmp_path, source)
+
+        assert filed.status == inbox.STATUS_INVALID
+        assert filed.error.startswith('Bad RUT')
+        assert filed.path == str(tmp_path / 'dest' / 'invalid' / (filed.digest + '.xml'))
+
+    def test_messages_are_ingested_once(self, tmp_path):
+        source = mbox_of(tmp_path / 'mbox', enviodte([dte(7)]), enviodte([dte(8)]))
+
+        assert len(run(tmp_path, source)) == 2
+        assert run(tmp_path, source) == []
@@ -0,0 +1,213 @@
+""" Upload job database, state polling and `sii ws upload`/`sii ws status poll` against a stub SII
+"""
+import re
+import types
+
+import pytest
+
+from conftest import make_keypair, sii_response
+
+from sii.bin import cmd_ws, jobs, wsclient
+
+
+def config_of(keypair, keyring=None):
+    auth = {'key': keypair.key, 'cert': keypair.cert}
+    if keyring is not None:
+        auth['keyring'] = keyring
+
+    return types.SimpleNamespace(auth=types.SimpleNamespace(**auth))
+
+
+def sii_routes(states, tokens=None):
+    """ Seed, token and state routes, states by track id (a list is answered one after the other). """
+    issued = tokens if tokens is not None else []
+
+    def seed(body):
+        return sii_response(SEMILLA='0123456789')
+
+    def token(body):
+        issued.append(body)
+        return sii_response(TOKEN='TOKEN{0}'.format(len(issued)))
+
+    def state(body):
+        track_id = re.search(br'<TrackId>(\w+)</TrackId>', body).group(1).decode('ascii')
+        answer   = states[track_id]
+
+        if isinstance(answer, list):
+            answer = answer.pop(0) if len(answer) > 1 else answer[0]
+
+        return sii_response(answer, glosa='Glosa ' + answer)
+
+    return {wsclient.PATH_SEED: seed, wsclient.PATH_TOKEN: token, wsclient.PATH_STATUS: state}
+
+
+@pytest.fixture
+def database(tmp_path):
+    with jobs.JobDatabase(str(tmp_path / 'jobs.db')) as database:
+        yield database
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(jobs, 'BACKOFF_BASE', 0.0)
+
+
+class TestJobDatabase:
+
+    def test_only_documented_states_are_final(self, database):
+        for track_id in ('1', '2', '3', '4'):
+            database.record_upload(track_id, 'maullin', '76123456-7')
+
+        database.update_states([
+            ('1', 'EPR', 'Envio Procesado', 1),
+            ('2', 'RSC', 'Rechazado por Error en Schema', 1),
+            ('3', 'SOK', 'Schema Validado', 1),
+            ('4', 'XYZ', 'Desconocido', 1)
+        ])
+
+        assert sorted(job.track_id for job in database.jobs(pending=True)) == ['3', '4']
+
+    def test_failed_queries_keep_the_state(self, database):
+        database.record_upload('1', 'maullin', '76123456-7')
+        database.update_states([('1', 'PDR', 'En proceso', 1)])
+        database.update_states([('1', None, None, 3)])
+
+        job, = database.jobs(pending=True)
+
+        assert (job.state, job.glosa, job.attempts) == ('PDR', 'En proceso', 4)
+        assert job.polled is not None
+
+    def test_jobs_filters(self, database):
+        database.record_upload('1', 'maullin', '76123456-7')
+        database.record_upload('2', 'palena', '76123456-7')
+
+        assert [job.track_id for job in database.jobs(server='palena')] == ['2']
+        assert [job.track_id for job in database.jobs(track_ids=['1'])] == ['1']
+
+
+class TestPollStates:
+
+    def test_pending_and_failed_are_polled_again(self):
+        answers = {
+            'done':    ['EPR'],
+            'slow':    ['PDR', 'SOK', 'EPR'],
+            'flaky':   [RuntimeError('boom'), 'RCT'],
+            'stuck':   ['PDR'] * 10
+        }
+
+        def query(job):
+            answer = answers[job.track_id].pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+
+            return wsclient.UploadState(job.track_id, answer, '', 0, 0, 0, 0)
+
+        chunks = []
+        pending = [types.SimpleNamespace(track_id=track_id) for track_id in answers]
+        jobs.poll_states(pending, query, chunks.append, concurrency=4, retries=3)
+
+        results = {job.track_id: (result, attempts) for chunk in chunks for job, result, attempts in chunk}
+
+        assert results['done'][0].state == 'EPR' and results['done'][1] == 1
+        assert results['slow'][0].state == 'EPR' and results['slow'][1] == 3
+        assert results['flaky'][0].state == 'RCT' and results['flaky'][1] == 2
+        assert results['stuck'][0].state == 'PDR' and results['stuck'][1] == 4
+
+    def test_results_are_flushed_in_chunks(self, monkeypatch):
+        monkeypatch.setattr(jobs, 'FLUSH_EVERY', 2)
+
+        chunks  = []
+        pending = [types.SimpleNamespace(track_id=str(idx)) for idx in range(5)]
+        query   = lambda job: wsclient.UploadState(job.track_id, 'EPR', '', 0, 0, 0, 0)
+
+        jobs.poll_states(pending, query, chunks.append)
+
+        assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+
+
+class TestQueryUploadState:
+
+    def test_state(self, stub_server):
+        stub  = stub_server(sii_routes({'42': 'EPR'}))
+        state = wsclient.query_upload_state(stub.host, 'TOKEN', '76123456-7', 42, context=wsclient.ssl_context(verify=False))
+
+        assert (state.track_id, state.state, state.glosa) == ('42', 'EPR', 'Glosa EPR')
+
+    def test_query_errors_are_not_states(self, stub_server):
+        stub = stub_server(sii_routes({'42': '-3'}))
+
+        with pytest.raises(wsclient.SoapError):
+            wsclient.query_upload_state(stub.host, 'TOKEN', '76123456-7', 42, context=wsclient.ssl_context(verify=False))
+
+
+class TestCommands:
+
+    def test_upload_without_emitter_is_not_sent(self, tmp_path, keypair, monkeypatch):
+        sent = []
+        monkeypatch.setattr(cmd_ws.upload, 'upload_document', lambda **kwargs: sent.append(kwargs) or 1, raising=False)
+
+        infile = tmp_path / 'envio.xml'
+        infile.write_bytes(b'<EnvioDTE><SetDTE/></EnvioDTE>')
+
+        with pytest.raises(ValueError):
+            cmd_ws.handle(config_of(keypair), ['ws', 'upload', '--maullin', '--jobs', str(tmp_path / 'jobs.db'), str(infile)])
+
+        assert sent == []
+
+    def test_upload_is_recorded(self, tmp_path, keypair, monkeypatch):
+        monkeypatch.setattr(cmd_ws.upload, 'upload_document', lambda **kwargs: 4242, raising=False)
+
+        infile = tmp_path / 'envio.xml'
+        infile.write_bytes(b'<EnvioDTE><SetDTE><Caratula><RutEmisor>76123456-7</RutEmisor></Caratula></SetDTE></EnvioDTE>')
+
+        cmd_ws.handle(config_of(keypair), ['ws', 'upload', '--maullin', '--jobs', str(tmp_path / 'jobs.db'), str(infile)])
+
+        with jobs.JobDatabase(str(tmp_path / 'jobs.db')) as database:
+            job, = database.jobs()
+
+        assert (job.track_id, job.rut, job.state) == ('4242', '76123456-7', 'UPL')
+
+    def test_upload_signed_by_the_emitter(self, tmp_path, keypair, monkeypatch):
+        other = make_keypair(str(tmp_path / 'keys'), name='other')
+        sent  = []
+        monkeypatch.setattr(cmd_ws.upload, 'upload_document', lambda **kwargs: sent.append(kwargs) or len(sent), raising=False)
+
+        infile = tmp_path / 'envio.xml'
+        infile.write_bytes(b'<EnvioDTE><SetDTE><Caratula><RutEmisor>77000000-0</RutEmisor></Caratula></SetDTE></EnvioDTE>')
+
+        config = config_of(keypair, keyring={'77000000-0': {'key': other.key, 'cert': other.cert}})
+        argv   = ['ws', 'upload', '--maullin', '--jobs', str(tmp_path / 'jobs.db')]
+
+        cmd_ws.handle(config, argv + [str(infile)])
+        cmd_ws.handle(config, argv + ['--key', keypair.key, str(infile)])
+
+        assert [(kwargs['key_pth'], kwargs['cert_pth']) for kwargs in sent] == [
+            (other.key, other.cert), (keypair.key, keypair.cert)
+        ]
+
+    def test_poll_with_a_token_per_emitter(self, tmp_path, keypair, stub_server, monkeypatch):
+        other = make_keypair(str(tmp_path / 'keys'), name='other')
+
+        tokens = []
+        stub   = stub_server(sii_routes({'1': 'EPR', '2': 'PDR', '3': '-11'}, tokens))
+        monkeypatch.setattr(wsclient, 'HOST_TESTING', stub.host)
+
+        db_path = str(tmp_path / 'jobs.db')
+        with jobs.JobDatabase(db_path) as database:
+            database.record_upload('1', cmd_ws.upload.HOST_TESTING, '76123456-7')
+            database.record_upload('2', cmd_ws.upload.HOST_TESTING, '77000000-0')
+            database.record_upload('3', cmd_ws.upload.HOST_TESTING, '76123456-7')
+
+        config = config_of(keypair, keyring={'77000000-0': {'key': other.key, 'cert': other.cert}})
+        cmd_ws.handle(config, [
+            'ws', 'status', 'poll', '--maullin', '--disable-ssl-verify', '--jobs', db_path, '--retries', '1'
+        ])
+
+        assert len(tokens) == 2
+
+        with jobs.JobDatabase(db_path) as database:
+            states = {job.track_id: (job.state, job.attempts) for job in database.jobs()}
+            pending = sorted(job.track_id for job in database.jobs(pending=True))
+
+        assert states == {'1': ('EPR', 1), '2': ('PDR', 2), '3': ('UPL', 2)}
+        assert pending == ['2', '3']
@@ -0,0 +1,106 @@
+""" Keyring: signing keys by RUT, read once per process, from the config or the command line
+"""
+import pickle
+import types
+
+import pytest
+
+from lxml import etree
+
+from conftest import RUT_EMISOR, dte, enviodte, make_keypair
+
+from sii.utils import keyring
+
+
+@pytest.fixture
+def other(tmp_path):
+    return make_keypair(str(tmp_path / 'other'), name='other')
+
+
+def config_of(**auth):
+    return types.SimpleNamespace(auth=types.SimpleNamespace(**auth))
+
+
+class TestKeyring:
+
+    def test_entries_by_normalized_rut(self, keypair, other):
+        ring = keyring.Keyring({'76.000.000-k': (other.key, other.cert)}, default=(keypair.key, keypair.cert))
+
+        assert '76000000-K' in ring and ' 76.000.000-k ' in ring
+        assert ring.ruts() == ['76000000-K']
+        assert ring.signer('76000000-k').key_path == other.key
+        assert ring.signer('11111111-1').key_path == keypair.key
+        assert ring.signer().cert_path == keypair.cert
+
+    def test_no_default(self, other):
+        ring = keyring.Keyring({RUT_EMISOR: (other.key, other.cert)})
+
+        with pytest.raises(KeyError):
+            ring.signer('11111111-1')
+
+    def test_read_once(self, keypair):
+        ring  = keyring.Keyring(default=(keypair.key, keypair.cert))
+        found = ring.signer(RUT_EMISOR)
+
+        with open(keypair.key, 'rb') as fh:
+            assert found.key_pem == fh.read()
+
+        assert ring.signer() is found
+        assert ring.signer('11111111-1') is found
+
+    def test_pickled_without_keys(self, keypair):
+        ring = keyring.Keyring(default=(keypair.key, keypair.cert))
+        ring.signer()
+
+        state = pickle.dumps(ring)
+        assert b'PRIVATE KEY' not in state
+
+        copy = pickle.loads(state)
+        assert copy.signer().key_pem == ring.signer().key_pem
+
+    def test_signer_of_a_document(self, keypair, other):
+        ring = keyring.Keyring({RUT_EMISOR: (other.key, other.cert)}, default=(keypair.key, keypair.cert))
+
+        assert ring.signer_of(dte(1)).key_path == other.key
+        assert ring.signer_of(etree.ElementTree(enviodte([dte(1)], rut='11111111-1'))).key_path == keypair.key
+
+
+class TestFromConfig:
+
+    def test_keyring_and_default(self, keypair, other):
+        ring = keyring.Keyring.from_config(config_of(
+            key=keypair.key, cert=keypair.cert, keyring={76000000: {'key': other.key, 'cert': other.cert}}
+        ))
+
+        assert ring.ruts() == ['76000000']
+        assert ring.signer('76000000').key_path == other.key
+        assert ring.signer(RUT_EMISOR).key_path == keypair.key
+
+    def test_command_line_overrides_everything(self, keypair, other):
+        config = config_of(key=keypair.key, cert=keypair.cert, keyring={RUT_EMISOR: {'key': other.key, 'cert': other.cert}})
+        ring   = keyring.Keyring.from_config(config, key=other.key)
+
+        assert ring.ruts() == []
+        assert (ring.signer(RUT_EMISOR).key_path, ring.signer(RUT_EMISOR).cert_path) == (other.key, keypair.cert)
+
+    def test_incomplete_default_is_none(self, keypair):
+        ring = keyring.Keyring.from_config(config_of(key=keypair.key))
+
+        with pytest.raises(KeyError):
+            ring.signer()
+
+
+class TestSigningRut:
+
+    @pytest.mark.parametrize('xml, rut', [
+        ('<DTE><Documento><Encabezado><Emisor><RUTEmisor> 76000000-0 </RUTEmisor></Emisor></Encabezado></Documento></DTE>', '76000000-0'),
+        ('<EnvioDTE><SetDTE><Caratula><RutEmisor>1-9</RutEmisor></Caratula></SetDTE></EnvioDTE>', '1-9'),
+        ('<LibroCompraVenta><EnvioLibro><Caratula><RutEmisorLibro>2-7</RutEmisorLibro></Caratula></EnvioLibro></LibroCompraVenta>', '2-7'),
+        ('<RespuestaDTE><Resultado><Caratula><RutResponde>3-5</RutResponde></Caratula></Resultado></RespuestaDTE>', '3-5'),
+        ('<Other><RutEmisor> </RutEmisor></Other>', None)
+    ])
+    def test_signing_rut(self, xml, rut):
+        assert keyring.signing_rut(etree.fromstring(xml)) == rut
+
+    def test_normalize_rut(self):
+        assert keyring.normalize_rut(' 76.000.000-k') == '76000000-K'
@@ -0,0 +1,82 @@
+""" Lazy envelope access: item spans from the memory mapped file, items parsed only when read
+"""
+import pytest
+
+from lxml import etree
+
+from conftest import SII_NS, dte, enviodte, sii, write
+
+from sii.utils import lazyxml
+
+
+@pytest.fixture
+def envelope(tmp_path):
+    return write(enviodte([dte(folio) for folio in range(1, 601)]), tmp_path / 'envio.xml')
+
+
+def folio(item):
+    return int(item.findtext('.//' + sii('Folio')))
+
+
+def test_random_access(envelope):
+    with lazyxml.LazyDocument(envelope) as document:
+        assert (document.root_tag, document.item_tag, len(document)) == ('EnvioDTE', 'DTE', 600)
+        assert [folio(document[idx]) for idx in (0, 299, -1)] == [1, 300, 600]
+        assert [folio(item) for item in document[10:13]] == [11, 12, 13]
+
+        # parsed within the root, the default namespace still applies and is not renamed
+        assert document[5].tag == sii('DTE')
+        assert etree.tostring(document[5]).startswith(b'<DTE xmlns="' + SII_NS.encode('ascii') + b'"')
+
+
+def test_iteration_matches_a_whole_parse(envelope, monkeypatch):
+    monkeypatch.setattr(lazyxml, 'BATCH_SIZE', 7)
+
+    whole = etree.parse(envelope).getroot().findall('.//' + sii('DTE'))
+
+    with lazyxml.LazyDocument(envelope) as document:
+        assert [folio(item) for item in document] == [folio(item) for item in whole]
+        assert not document._cache
+
+
+def test_raw_items_are_the_file_bytes(envelope):
+    with open(envelope, 'rb') as fh:
+        buff = fh.read()
+
+    with lazyxml.LazyDocument(envelope) as document:
+        start, end = document.span(41)
+
+        assert document.raw(41) == buff[start:end]
+        assert buff[start:end].startswith(b'<DTE') and buff[start:end].endswith(b'</DTE>')
+
+
+def test_head_without_scanning(envelope):
+    with lazyxml.LazyDocument(envelope) as document:
+        head = document.head()
+
+        assert head.findtext('.//' + sii('RutEmisor')) == '76000000-0'
+        assert document._found is None
+
+
+def test_prefixed_and_lookalike_tags(tmp_path):
+    fpath = tmp_path / 'envio.xml'
+    fpath.write_bytes(
+        b'<?xml version="1.0"?><s:EnvioDTE xmlns:s="' + SII_NS.encode('ascii') + b'"><s:SetDTE>'
+        b'<s:DTE><s:Glosa>DTE text &lt;DTE&gt;</s:Glosa><s:DTEx/></s:DTE>'
+        b'<s:DTE version="1.0"/>'
+        b'</s:SetDTE></s:EnvioDTE>'
+    )
+
+    with lazyxml.LazyDocument(str(fpath)) as document:
+        assert len(document) == 2
+        assert document[0].findtext(sii('Glosa')) == 'DTE text <DTE>'
+        assert document[1].get('version') == '1.0'
+
+
+@pytest.mark.parametrize('content', [b'', b'<Unknown><Item/></Unknown>'])
+def test_unusable_files(tmp_path, content):
+    fpath = tmp_path / 'file.xml'
+    fpath.write_bytes(content)
+
+    with pytest.raises(ValueError):
+        lazyxml.LazyDocument(str(fpath))
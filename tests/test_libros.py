@@ -0,0 +1,77 @@
+""" Incremental libro de ventas: rows per DTE, running totals and `sii lcv` style writing
+"""
+import os
+
+import pytest
+
+from lxml import etree
+
+from conftest import RUT_EMISOR, dte, enviodte, write
+
+from sii.bin import libros
+
+
+@pytest.fixture
+def state(tmp_path):
+    with libros.LibroState(str(tmp_path / 'libros.db')) as state:
+        yield state
+
+
+def totals(state):
+    return [tuple(row[2:5]) for row in state.periods()]
+
+
+def rewrite(xml, fpath):
+    """ Writes `xml` over `fpath`, with another modification time whatever the clock resolution. """
+    mtime_ns = os.stat(fpath).st_mtime_ns
+    write(xml, fpath)
+    os.utime(fpath, ns=(mtime_ns + 10 ** 9, mtime_ns + 10 ** 9))
+
+
+class TestLibroState:
+
+    def test_every_dte_of_an_envelope_is_a_row(self, tmp_path, state):
+        fpath = write(enviodte([dte(1), dte(2, net=2000), dte(1, dte_type=61)]), tmp_path / 'envio.xml')
+
+        assert state.add([fpath]) == libros.Summary(3, 0, 0, 0)
+        assert totals(state) == [(33, 2, 0), (61, 1, 0)]
+        assert [row[5] for row in state.periods()] == [3000, 1000]
+
+    def test_unchanged_files_are_not_read(self, tmp_path, state):
+        fpath = write(dte(1), tmp_path / 'f1.xml')
+        state.add([fpath])
+
+        assert state.add([fpath]) == libros.Summary(0, 0, 1, 0)
+
+    def test_rows_gone_from_a_changed_file_are_removed(self, tmp_path, state):
+        fpath = write(enviodte([dte(1), dte(2)]), tmp_path / 'envio.xml')
+        state.add([fpath])
+
+        rewrite(enviodte([dte(2, net=5000)]), fpath)
+
+        assert state.add([fpath]) == libros.Summary(0, 1, 0, 0)
+        assert totals(state) == [(33, 1, 0)]
+        assert [row[5] for row in state.periods()] == [5000]
+
+    def test_unreadable_files_are_reported(self, tmp_path, state):
+        broken = tmp_path / 'broken.xml'
+        broken.write_bytes(b'<DTE>')
+
+        errors = []
+        summary = state.add([str(tmp_path / 'missing.xml'), str(broken)], on_error=lambda *args: errors.append(args))
+
+        assert summary == libros.Summary(0, 0, 0, 2)
+        assert [os.path.basename(path) for path, _ in errors] == ['missing.xml', 'broken.xml']
+
+    def test_write(self, tmp_path, state):
+        state.add([write(enviodte([dte(2), dte(1)]), tmp_path / 'envio.xml')])
+
+        outfile = str(tmp_path / 'libro.xml')
+        assert state.write(RUT_EMISOR, '2016-06', outfile, '2014-08-22', '80') == 2
+
+        libro = etree.parse(outfile)
+        assert [elem.text for elem in libro.iter('{*}NroDoc')] == ['1', '2']
+        assert libro.findtext('.//{*}TotDoc') == '2'
+
+        with pytest.raises(ValueError):
+            state.write(RUT_EMISOR, '2016-07', outfile, '2014-08-22', '80')
@@ -0,0 +1,78 @@
+""" Run metrics: histograms, counters and the Prometheus textfile / JSONL outputs
+"""
+import json
+
+import pytest
+
+from sii.bin import metrics
+
+
+@pytest.fixture
+def run(monkeypatch):
+    """ Enables metrics (no periodic flushing) into `<tmp>/<name>`, fresh state per test. """
+    monkeypatch.setattr(metrics, '_STATE', dict(metrics._STATE))
+    monkeypatch.setattr(metrics, '_LATENCY', {})
+    monkeypatch.setattr(metrics, '_DOCUMENTS', metrics.collections.Counter())
+    monkeypatch.setattr(metrics, '_ERRORS', metrics.collections.Counter())
+    monkeypatch.setattr(metrics, '_DEPTH', {})
+
+    def start(fpath):
+        metrics.enable(str(fpath), interval=0, command='xml verify')
+
+    return start
+
+
+def test_histogram_quantiles():
+    hist = metrics.Histogram()
+    for seconds in [0.001] * 90 + [0.2] * 9 + [60.0]:
+        hist.observe(seconds)
+
+    assert hist.count == 100
+    assert hist.quantile(0.50) == 0.005
+    assert hist.quantile(0.95) == 0.25
+    assert hist.quantile(1.00) == metrics.BUCKETS[-1]
+    assert list(hist.cumulative())[-1] == (float('inf'), 100)
+
+
+def test_disabled_counts_nothing(run):
+    metrics.document('sign', 0.1)
+
+    assert not metrics.enabled()
+    assert not metrics._DOCUMENTS and not metrics._LATENCY
+
+
+def test_jsonl_snapshots(run, tmp_path):
+    fpath = tmp_path / 'run.jsonl'
+    run(fpath)
+
+    metrics.document('verify', 0.02)
+    metrics.document('verify', 0.03, error=ValueError("bad"))
+    metrics.queue_depth('verify', 7)
+    metrics.flush()
+    metrics.close()
+
+    first, last = [json.loads(line) for line in fpath.read_text().splitlines()]
+    verify      = last['kinds']['verify']
+
+    assert (first['final'], last['final']) == (False, True)
+    assert (verify['documents'], verify['failed'], verify['queue_depth']) == (2, 1, 7)
+    assert verify['errors'] == {'ValueError': 1}
+    assert verify['latency']['count'] == 2 and verify['latency']['p50'] == 0.025
+
+
+def test_prometheus_textfile(run, tmp_path):
+    fpath = tmp_path / 'textfile' / 'sii.prom'
+    run(fpath)
+
+    metrics.document('bundle', 0.004)
+    metrics.document('bundle', None, error='InvalidXML')
+    metrics.close()
+
+    lines = fpath.read_text().splitlines()
+
+    assert 'sii_documents_total{command="xml verify",kind="bundle",outcome="ok"} 1' in lines
+    assert 'sii_errors_total{command="xml verify",kind="bundle",type="InvalidXML"} 1' in lines
+    assert 'sii_document_duration_seconds_bucket{command="xml verify",kind="bundle",le="0.005"} 1' in lines
+    assert 'sii_document_duration_seconds_bucket{command="xml verify",kind="bundle",le="+Inf"} 1' in lines
+    assert 'sii_run_finished{command="xml verify"} 1' in lines
+    assert not [path for path in fpath.parent.iterdir() if path.name.startswith('.metrics_')]
@@ -0,0 +1,112 @@
+""" Exchange outbox ledger and resuming `sii xch email` after a failure
+"""
+import pytest
+
+from conftest import dte, enviodte, permissive_xsd, write
+
+from sii.bin import cmd_xch, outbox
+
+from test_xch_email import FakeSMTP, envelopes, send
+
+
+class FailingSMTP(FakeSMTP):
+    """ Fails sending the `fail_at`-th message (1 based), once. """
+
+    def __init__(self, fail_at):
+        super().__init__()
+        self.fail_at = fail_at
+        self.calls   = 0
+
+    def send_message(self, msg):
+        self.calls += 1
+        if self.calls == self.fail_at:
+            raise OSError("connection reset")
+
+        super().send_message(msg)
+
+
+def attached(server):
+    return [msg.get_payload()[-1].get_filename() for msg in server.sent]
+
+
+class TestOutbox:
+
+    def test_record_and_status(self, tmp_path):
+        with outbox.Outbox(str(tmp_path / 'outbox.db')) as ledger:
+            digest = outbox.content_hash(b'<EnvioDTE/>')
+
+            assert ledger.status(digest, 'a@example.com') is None
+
+            ledger.record(digest, 'a@example.com', outbox.STATUS_FAILED, error='boom')
+            ledger.record(digest, 'a@example.com', outbox.STATUS_SENT)
+
+            assert ledger.is_sent(digest, 'a@example.com')
+            assert not ledger.is_sent(digest, 'b@example.com')
+
+            attempts, = ledger._conn.execute("SELECT attempts FROM sends").fetchone()
+            assert attempts == 2
+
+
+class TestResume:
+
+    def test_rerun_only_sends_what_failed(self, tmp_path, monkeypatch):
+        paths  = envelopes(tmp_path, 4)
+        server = FailingSMTP(fail_at=3)
+        monkeypatch.setattr(cmd_xch, '_connect_mail', lambda **kwargs: server)
+
+        with pytest.raises(OSError):
+            send(tmp_path, paths, '--workers', '1')
+
+        assert attached(server) == ['76000000_33_1.xml', '76000000_33_2.xml']
+
+        send(tmp_path, paths, '--workers', '1')
+
+        assert attached(server) == ['76000000_33_{0}.xml'.format(folio) for folio in (1, 2, 3, 4)]
+
+    def test_resend(self, tmp_path, monkeypatch):
+        paths  = envelopes(tmp_path, 2)
+        server = FakeSMTP()
+        monkeypatch.setattr(cmd_xch, '_connect_mail', lambda **kwargs: server)
+
+        send(tmp_path, paths, '--workers', '1')
+        send(tmp_path, paths, '--workers', '1')
+        assert len(server.sent) == 2
+
+        send(tmp_path, paths, '--workers', '1', '--resend')
+        assert len(server.sent) == 4
+
+    def test_changed_envelope_is_sent_again(self, tmp_path, monkeypatch):
+        paths  = envelopes(tmp_path, 1)
+        server = FakeSMTP()
+        monkeypatch.setattr(cmd_xch, '_connect_mail', lambda **kwargs: server)
+
+        send(tmp_path, paths, '--workers', '1')
+        write(enviodte([dte(1, net=2000)]), paths[0])
+        send(tmp_path, paths, '--workers', '1')
+
+        assert len(server.sent) == 2
+
+    def test_batch_skips_unknown_recipients(self, tmp_path, monkeypatch):
+        paths  = envelopes(tmp_path, 1)
+        server = FakeSMTP()
+        monkeypatch.setattr(cmd_xch, '_connect_mail', lambda **kwargs: server)
+
+        listing = tmp_path / 'contribuyentes.csv'
+        listing.write_text(
+            "RUT;RAZON SOCIAL;NUMERO RESOLUCION;FECHA RESOLUCION;MAIL INTERCAMBIO;URL\n"
+            "22222222-2;Otra SpA;0;2016-01-01;otra@example.com;\n",
+            encoding='ISO-8859-1'
+        )
+
+        argv = [
+            'xch', 'email', '--from', 'dte@example.com', '--to-csv', str(listing), '--batch',
+            '--outbox', str(tmp_path / 'outbox.db'), '--xsd', permissive_xsd(tmp_path, 'EnvioDTE')
+        ]
+        cmd_xch.handle(None, argv + paths)
+
+        assert server.sent == []
+
+        with outbox.Outbox(str(tmp_path / 'outbox.db')) as ledger:
+            status, = ledger._conn.execute("SELECT status FROM sends").fetchone()
+
+        assert status == outbox.STATUS_SKIPPED
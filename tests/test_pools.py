@@ -0,0 +1,53 @@
+""" Pool sizing: no more workers than jobs, and no pool at all for a single one
+"""
+import os
+
+import pytest
+
+from concurrent.futures import ProcessPoolExecutor
+
+from sii.bin import pools, stamping
+
+
+def test_worker_count(monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+
+    assert pools.worker_count(0) == 8
+    assert pools.worker_count(None, jobs=3) == 3
+    assert pools.worker_count(4, jobs=100) == 4
+    assert pools.worker_count(0, jobs=0) == 1
+
+
+def test_single_job_runs_in_process(monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 8)
+    started = []
+
+    with pools.process_pool(0, jobs=1, initializer=started.append, initargs=('loaded',)) as executor:
+        assert isinstance(executor, pools.InlineExecutor)
+        assert list(executor.map(os.getpid, [])) == []
+        assert executor.submit(os.getpid).result() == os.getpid()
+
+    assert started == ['loaded']
+
+
+def test_inline_futures_carry_exceptions():
+    future = pools.InlineExecutor().submit(int, 'not a number')
+
+    with pytest.raises(ValueError):
+        future.result()
+
+
+def test_several_jobs_get_a_pool():
+    with pools.process_pool(2, jobs=5) as executor:
+        assert isinstance(executor, ProcessPoolExecutor)
+
+
+def test_stamping_one_file_loads_cafs_in_process(monkeypatch):
+    loaded = []
+    monkeypatch.setattr(stamping, 'caf_pool', loaded.append)
+    monkeypatch.setattr(stamping, '_stamp_file', lambda path, cafs_dir, mode: (path, os.getpid()))
+
+    stamped = list(stamping.stamp_files(['one.xml'], 'cafs', stamping.MODE_PRINT, workers=None))
+
+    assert stamped == [('one.xml', os.getpid())]
+    assert loaded == ['cafs']
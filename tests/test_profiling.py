@@ -0,0 +1,90 @@
+""" Per-stage timings: disabled by default, merged over worker processes, Chrome trace output
+"""
+import io
+import json
+import time
+
+import pytest
+
+from concurrent.futures import ProcessPoolExecutor
+
+from sii.bin   import cmd_ws, wsclient
+from sii.utils import profiling
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(profiling, '_STATE', dict(profiling._STATE))
+    monkeypatch.setattr(profiling, '_EVENTS', [])
+    profiling._STATS.clear()
+
+    profiling.enable(trace=True)
+    yield
+    profiling.cleanup()
+
+    profiling._STATS.clear()
+
+
+def staged(name):
+    with profiling.stage(name):
+        time.sleep(0.01)
+
+    return name
+
+
+def test_disabled_records_nothing():
+    staged('parse')
+
+    assert not profiling.enabled()
+    assert 'parse' not in profiling.totals()[0]
+
+
+def test_stages_are_accumulated(enabled):
+    staged('parse')
+    staged('parse')
+    staged('sign')
+
+    merged, events = profiling.totals()
+
+    assert merged['parse'][0] == 2 and merged['sign'][0] == 1
+    assert merged['parse'][1] >= 0.02
+    assert [event[0] for event in events] == ['parse', 'parse', 'sign']
+
+
+def test_worker_stages_are_handed_over(enabled):
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert list(executor.map(staged, ['read'] * 4)) == ['read'] * 4
+
+    merged, events = profiling.totals()
+
+    assert merged['read'][0] == 4
+    assert len(events) == 4
+
+
+def test_report_and_trace(enabled, tmp_path):
+    staged('write')
+
+    out = io.StringIO()
+    profiling.report(file=out)
+    assert any(line.startswith('write') for line in out.getvalue().splitlines())
+
+    profiling.dump_trace(str(tmp_path / 'trace.json'))
+    with open(str(tmp_path / 'trace.json')) as fh:
+        trace = json.load(fh)
+
+    event, = trace['traceEvents']
+    assert (event['name'], event['ph']) == ('write', 'X') and event['dur'] >= 10000
+
+
+def test_probe_timings(capsys):
+    probes = [
+        wsclient.Probe('maullin.sii.cl', {step: 0.001 * idx for step in wsclient.PROBE_STAGES}, None)
+        for idx in range(1, 11)
+    ]
+
+    cmd_ws._print_timings(probes)
+
+    lines = capsys.readouterr().err.splitlines()
+    assert lines[0].split() == ['stage', 'min', 'p50', 'p90', 'p99', 'max']
+    assert [line.split()[0] for line in lines[1:]] == list(wsclient.PROBE_STAGES)
+    assert lines[1].split()[1:] == ['1.0', '5.0', '9.0', '10.0', '10.0']
@@ -0,0 +1,94 @@
+""" Batch exchange replies and their signing with keys loaded once per process
+"""
+import pytest
+
+from lxml import etree
+
+from conftest import RUT_RECEPTOR, dte, enviodte, make_keypair, write
+
+from sii.bin   import replies
+from sii.utils import dsig, keyring
+
+
+@pytest.fixture(autouse=True)
+def no_signer():
+    yield
+    replies.load_signer(None)
+
+
+def envelope(*signed_ids):
+    """ <EnvioRecibos> like document: a template <Signature> per `signed_ids`, nested in that order. """
+    xmlsec = pytest.importorskip('xmlsec')
+
+    root   = etree.Element('EnvioRecibos')
+    parent = root
+
+    for elem_id in signed_ids:
+        node = etree.SubElement(parent, 'Recibo' if parent is not root else 'SetRecibos', ID=elem_id)
+        etree.SubElement(node, 'RutResponde').text = RUT_RECEPTOR
+
+        template  = xmlsec.template.create(root, xmlsec.constants.TransformInclC14N, xmlsec.constants.TransformRsaSha1)
+        reference = xmlsec.template.add_reference(template, xmlsec.constants.TransformSha1, uri='#' + elem_id)
+        xmlsec.template.add_transform(reference, xmlsec.constants.TransformEnveloped)
+        key_info  = xmlsec.template.ensure_key_info(template)
+        xmlsec.template.add_key_value(key_info)
+        xmlsec.template.add_x509_data(key_info)
+
+        parent.append(template)
+        parent = node
+
+    return root
+
+
+class TestReplyFiles:
+
+    def test_unsigned_replies(self, tmp_path):
+        infile = write(enviodte([dte(1)]), tmp_path / 'in' / 'envio.xml')
+
+        done, = replies.reply_files([infile], ['ack', 'merch'], str(tmp_path / 'out'), workers=1)
+
+        assert done.error is None
+        assert sorted(path.name for path in (tmp_path / 'out').iterdir()) == ['envio.ack.xml', 'envio.merch.xml']
+        assert [etree.parse(fpath).getroot().tag for fpath in done.outputs] == ['RespuestaDTE', 'EnvioRecibos']
+
+    def test_unknown_signer_is_a_reply_error(self, tmp_path):
+        infile = write(enviodte([dte(1)]), tmp_path / 'envio.xml')
+
+        done, = replies.reply_files([infile], ['ack'], str(tmp_path / 'out'), keyring=keyring.Keyring(), workers=1)
+
+        assert done.error.startswith('ack: ')
+        assert done.outputs == []
+
+
+class TestSign:
+
+    def test_every_signature_is_signed_and_verifies(self, tmp_path):
+        keypair = make_keypair(str(tmp_path))
+        replies.load_signer(keyring.Keyring(default=(keypair.key, keypair.cert)))
+
+        signed = replies.sign(envelope('SetDoc', 'R1'))
+
+        assert [validity for _, validity in dsig.verify_signatures(signed)] == [True, True]
+
+    def test_top_only(self, tmp_path):
+        keypair = make_keypair(str(tmp_path))
+        replies.load_signer(keyring.Keyring(default=(keypair.key, keypair.cert)))
+
+        signed = replies.sign(envelope('SetDoc', 'R1'), top_only=True)
+        values = [elem.text for elem in signed.iter('{*}SignatureValue')]
+
+        assert bool(values[0]) and not values[1]
+
+    def test_keys_are_loaded_once_per_process(self, tmp_path, monkeypatch):
+        keypair = make_keypair(str(tmp_path))
+        signers = keyring.Keyring(default=(keypair.key, keypair.cert))
+        replies.load_signer(signers)
+        monkeypatch.setattr(dsig, '_KEYS', {})
+
+        for _ in range(3):
+            replies.sign(envelope('SetDoc', 'R1'))
+
+        found = signers.signer()
+
+        assert list(dsig._KEYS.values()) == [dsig.signing_key(found.key_pem, found.cert_pem)]
+        assert signers.signer() is found
@@ -0,0 +1,86 @@
+""" `sii xml verify all`: schema, signatures and CAF/TED from one parse, one line and exit bits per file
+"""
+import types
+
+import pytest
+
+from conftest import dte, make_caf, permissive_xsd, stamp, write
+
+from sii.bin import cmd_verify, cmd_xml
+
+
+@pytest.fixture(scope='module')
+def caf(tmp_path_factory):
+    return make_caf(tmp_path_factory.mktemp('cafs'), 1, 100)
+
+
+def verify_all(tmp_path, paths, cafs_dir=None):
+    """ (exit code, output lines) of verifying `paths`. """
+    config = types.SimpleNamespace(static=types.SimpleNamespace(cafs=cafs_dir))
+    argv   = ['xml', 'verify', 'all', '--xsd', permissive_xsd(tmp_path, 'DTE'), '--workers', '2'] + list(paths)
+
+    try:
+        cmd_xml.handle(config, argv)
+    except SystemExit as exc:
+        return exc.code
+
+    return 0
+
+
+class TestVerifyFile:
+
+    def test_good(self, tmp_path, caf):
+        fpath   = write(stamp(dte(1), caf), tmp_path / 'dte.xml')
+        verdict = cmd_verify._verify_file(fpath, permissive_xsd(tmp_path, 'DTE'), ('schema', 'signature', 'caf'))
+
+        assert verdict.code == 0
+        assert verdict.details == ["Schema: Good.", "Signatures: 0/0 Good.", "CAF: 1/1 Good."]
+        assert verdict.folios == [('76000000-0', 33, 1)]
+
+    def test_unreadable(self, tmp_path):
+        fpath = tmp_path / 'broken.xml'
+        fpath.write_bytes(b'<DTE><Documento>')
+
+        verdict = cmd_verify._verify_file(str(fpath), None, ('schema', 'signature', 'caf'))
+
+        assert verdict.code == cmd_verify.EXIT_UNREADABLE
+
+    def test_bad_schema_and_missing_ted(self, tmp_path):
+        fpath   = write(dte(1), tmp_path / 'dte.xml')
+        verdict = cmd_verify._verify_file(fpath, permissive_xsd(tmp_path, 'EnvioDTE'), ('schema', 'signature', 'caf'))
+
+        assert verdict.code == cmd_verify.EXIT_SCHEMA | cmd_verify.EXIT_CAF
+        assert "CAF: 0/1 Good (Bad: 33-1: Missing TED)." in verdict.details
+
+    def test_only_requested_checks(self, tmp_path):
+        fpath   = write(dte(1), tmp_path / 'dte.xml')
+        verdict = cmd_verify._verify_file(fpath, permissive_xsd(tmp_path, 'DTE'), ('schema',))
+
+        assert verdict.code == 0
+        assert verdict.details == ["Schema: Good."]
+
+
+class TestVerifyAll:
+
+    def test_exit_code_and_one_line_per_file(self, tmp_path, caf, capsys):
+        good   = write(stamp(dte(1), caf), tmp_path / 'good.xml')
+        tamper = stamp(dte(2), caf)
+        tamper.find('.//{*}MntTotal').text = '1'
+        tamper.find('.//{*}TED/{*}DD/{*}F').text = '3'
+        bad    = write(tamper, tmp_path / 'bad.xml')
+        broken = tmp_path / 'broken.xml'
+        broken.write_bytes(b'<DTE>')
+
+        code  = verify_all(tmp_path, [good, bad, str(broken)])
+        lines = capsys.readouterr().out.splitlines()
+
+        assert code == cmd_verify.EXIT_CAF | cmd_verify.EXIT_UNREADABLE
+        assert [line.split(':')[0] for line in lines] == [good, bad, str(broken)]
+        assert lines[0].startswith(good + ": Good.")
+        assert lines[1].startswith(bad + ": Bad.")
+
+    def test_all_good_exits_zero(self, tmp_path, caf, capsys):
+        paths = [write(stamp(dte(folio), caf), tmp_path / 'dte_{0}.xml'.format(folio)) for folio in (1, 2, 3)]
+
+        assert verify_all(tmp_path, paths) == 0
+        assert len(capsys.readouterr().out.splitlines()) == 3
@@ -0,0 +1,83 @@
+""" Spool watchers: files are reported once completely written, those already there included
+"""
+import os
+
+import pytest
+
+from sii.bin import cmd_watch, watching
+
+
+def append(fpath, data):
+    with open(str(fpath), 'ab') as fh:
+        fh.write(data)
+
+
+@pytest.fixture
+def polling(tmp_path):
+    with watching.PollingWatcher(str(tmp_path), interval=0.01) as watch:
+        yield watch
+
+
+class TestPollingWatcher:
+
+    def test_files_already_there_are_reported_once_settled(self, tmp_path, polling):
+        append(tmp_path / 'done.xml', b'<DTE/>')
+        append(tmp_path / 'growing.xml', b'<DTE>')
+
+        scans = iter([
+            {'done.xml': (1, 6), 'growing.xml': (1, 5)},
+            {'done.xml': (1, 6), 'growing.xml': (2, 9)},
+            {'done.xml': (1, 6), 'growing.xml': (2, 9)}
+        ])
+        polling._scan = lambda: next(scans)
+
+        assert polling.changes() == ['done.xml']
+        assert polling.changes() == ['growing.xml']
+
+    def test_changed_files_are_reported_again(self, tmp_path, polling):
+        append(tmp_path / 'a.xml', b'<DTE/>')
+
+        assert polling.changes() == ['a.xml']
+        assert polling.changes() == []
+
+        os.utime(str(tmp_path / 'a.xml'), ns=(0, 10 ** 9))
+        assert polling.changes() == []
+        assert polling.changes() == ['a.xml']
+
+    def test_timeout_before_the_next_scan(self, tmp_path):
+        append(tmp_path / 'a.xml', b'<DTE/>')
+
+        with watching.PollingWatcher(str(tmp_path), interval=60) as watch:
+            assert watch.changes(timeout=0) == []
+
+
+class TestCheckpoint:
+
+    def test_changed_files_are_not_done(self, tmp_path):
+        fpath = tmp_path / 'a.xml'
+        append(fpath, b'<DTE/>')
+
+        with watching.Checkpoint(str(tmp_path / 'state' / 'watch.db')) as checkpoint:
+            checkpoint.record(str(fpath), os.stat(str(fpath)), 'DONE', outputs=['a.pdf'])
+            assert checkpoint.is_done(str(fpath), os.stat(str(fpath)))
+
+            append(fpath, b'\n')
+            assert not checkpoint.is_done(str(fpath), os.stat(str(fpath)))
+
+
+class TestPipeline:
+
+    def test_written_as_is_without_steps(self, tmp_path):
+        append(tmp_path / 'a.xml', b'<DTE/>')
+        (tmp_path / 'out').mkdir()
+
+        processed = cmd_watch._run_pipeline(str(tmp_path / 'a.xml'), {'steps': (), 'outdir': str(tmp_path / 'out')})
+
+        assert processed.error is None
+        assert processed.outputs == [str(tmp_path / 'out' / 'a.xml')]
+
+    def test_files_gone_since_queued_fail(self, tmp_path):
+        processed = cmd_watch._run_pipeline(str(tmp_path / 'gone.xml'), {'steps': (), 'outdir': str(tmp_path)})
+
+        assert processed.error.startswith('FileNotFoundError: ')
+        assert processed.outputs == []
@@ -0,0 +1,77 @@
+""" SII web service client: connection probing and its stage timings, against a local TLS stub
+"""
+import types
+
+from conftest import sii_response
+
+from sii.bin import cmd_ws, wsclient
+
+
+def routes():
+    return {
+        wsclient.PATH_SEED:  lambda body: sii_response(SEMILLA='0123456789'),
+        wsclient.PATH_TOKEN: lambda body: sii_response(TOKEN='TOKEN')
+    }
+
+
+class TestProbe:
+
+    def test_stages_over_one_connection(self, stub_server, keypair):
+        stub  = stub_server(routes())
+        probe = wsclient.probe(stub.host, keypair.key, keypair.cert, context=wsclient.ssl_context(verify=False))
+
+        assert probe.error is None
+        assert list(probe.timings) == list(wsclient.PROBE_STAGES)
+        assert all(seconds >= 0 for seconds in probe.timings.values())
+
+        # seed and token went over the connection whose setup was timed
+        assert stub.connections == 1
+        assert [path for path, _ in stub.requests] == [wsclient.PATH_SEED, wsclient.PATH_TOKEN]
+
+    def test_failed_stage_is_reported(self, stub_server, keypair):
+        stub = stub_server({
+            wsclient.PATH_SEED:  lambda body: sii_response(SEMILLA='0123456789'),
+            wsclient.PATH_TOKEN: lambda body: sii_response('-07', glosa='Firma no valida')
+        })
+
+        probe = wsclient.probe(stub.host, keypair.key, keypair.cert, context=wsclient.ssl_context(verify=False))
+
+        assert isinstance(probe.error, wsclient.SoapError)
+        assert list(probe.timings) == ['dns', 'connect', 'tls', 'seed']
+
+    def test_untrusted_certificate_fails_at_tls(self, stub_server, keypair):
+        stub  = stub_server(routes())
+        probe = wsclient.probe(stub.host, keypair.key, keypair.cert)
+
+        assert probe.error is not None
+        assert list(probe.timings) == ['dns', 'connect']
+
+    def test_requests_without_connection(self, stub_server, keypair):
+        stub    = stub_server(routes())
+        context = wsclient.ssl_context(verify=False)
+
+        assert wsclient.request_token(stub.host, keypair.key, keypair.cert, context=context) == 'TOKEN'
+        assert stub.connections == 2
+
+
+class TestTestConnect:
+
+    def test_percentiles(self):
+        samples = [float(value) for value in range(1, 101)]
+
+        assert cmd_ws._percentile(samples, 50) == 50.0
+        assert cmd_ws._percentile(samples, 99) == 99.0
+        assert cmd_ws._percentile([7.0], 90) == 7.0
+
+    def test_repeated_probes(self, stub_server, keypair, monkeypatch, capsys):
+        stub = stub_server(routes())
+        monkeypatch.setattr(wsclient, 'HOST_TESTING', stub.host)
+
+        config = types.SimpleNamespace(auth=types.SimpleNamespace(key=keypair.key, cert=keypair.cert))
+        cmd_ws.handle(config, ['ws', 'test', 'connect', '--maullin', '--repeat', '3', '--disable-ssl-verify'])
+
+        err = capsys.readouterr().err
+
+        assert "Connection to Maullin: Successful (3/3 probes succeeded)" in err
+        assert all(stage in err for stage in wsclient.PROBE_STAGES)
+        assert stub.connections == 3
@@ -0,0 +1,107 @@
+""" `sii xch email`: envelope preparation pipeline and what gets sent (through a fake SMTP server)
+"""
+import email
+import types
+
+import pytest
+
+from conftest import dte, enviodte, permissive_xsd, write, RUT_RECEPTOR
+
+from sii.bin import cmd_xch
+
+
+class FakeSMTP:
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, msg):
+        self.sent.append(email.message_from_bytes(msg.as_bytes()))
+
+    def quit(self):
+        pass
+
+
+@pytest.fixture
+def smtp(monkeypatch):
+    server = FakeSMTP()
+    monkeypatch.setattr(cmd_xch, '_connect_mail', lambda **kwargs: server)
+    return server
+
+
+def envelopes(directory, count, start=1):
+    return [
+        write(enviodte([dte(folio)]), directory / 'envio_{0}.xml'.format(folio))
+        for folio in range(start, start + count)
+    ]
+
+
+def send(tmp_path, paths, *options):
+    argv = [
+        'xch', 'email', '--from', 'dte@example.com', '--to', 'recepcion@example.com',
+        '--outbox', str(tmp_path / 'outbox.db'), '--xsd', permissive_xsd(tmp_path, 'EnvioDTE')
+    ]
+    cmd_xch.handle(types.SimpleNamespace(), argv + list(options) + list(paths))
+
+
+class TestPrepare:
+
+    def test_envelope(self, tmp_path):
+        fpath    = envelopes(tmp_path, 1, start=7)[0]
+        envelope = cmd_xch._prepare_envelope(fpath, permissive_xsd(tmp_path, 'EnvioDTE'))
+
+        with open(fpath, 'rb') as fh:
+            assert envelope.payload == fh.read()
+
+        assert envelope.encoding == 'ISO-8859-1'
+        assert envelope.recpt_rut == RUT_RECEPTOR
+        assert (envelope.dte_rut, envelope.dte_type, envelope.dte_id) == ('76000000', 33, 7)
+
+    def test_invalid_envelope(self, tmp_path):
+        fpath = write(dte(1), tmp_path / 'dte.xml')
+
+        with pytest.raises(ValueError) as exc:
+            cmd_xch._prepare_envelope(fpath, permissive_xsd(tmp_path, 'EnvioDTE'))
+
+        assert fpath in str(exc.value)
+
+    def test_pipeline_keeps_order(self, tmp_path):
+        paths = envelopes(tmp_path, 20)
+        ready = cmd_xch._prepare_pipeline(paths, permissive_xsd(tmp_path, 'EnvioDTE'), workers=2, depth=4)
+
+        assert [envelope.path for envelope in ready] == paths
+
+    def test_pipeline_raises_when_reached(self, tmp_path):
+        paths = envelopes(tmp_path, 3)
+        paths.insert(2, write(dte(9), tmp_path / 'dte.xml'))
+
+        ready = cmd_xch._prepare_pipeline(paths, permissive_xsd(tmp_path, 'EnvioDTE'), workers=2)
+
+        assert next(ready).path == paths[0]
+        assert next(ready).path == paths[1]
+
+        with pytest.raises(ValueError):
+            next(ready)
+
+
+class TestEmail:
+
+    def test_attaches_the_file_as_read(self, tmp_path, smtp):
+        paths = envelopes(tmp_path, 2)
+
+        preamble = tmp_path / 'preamble.txt'
+        preamble.write_text("Estimados, adjuntamos.")
+
+        send(tmp_path, paths, '--preamble', str(preamble))
+
+        assert len(smtp.sent) == 2
+
+        for fpath, msg in zip(paths, smtp.sent):
+            text, attachment = msg.get_payload()
+
+            with open(fpath, 'rb') as fh:
+                assert attachment.get_payload(decode=True) == fh.read()
+
+            assert text.get_payload(decode=True).decode('UTF-8') == "Estimados, adjuntamos."
+            assert attachment.get_filename() == "76000000_33_{0}.xml".format(paths.index(fpath) + 1)
+            assert msg['Subject'] == "EnvioDTE 76000000-33-{0}".format(paths.index(fpath) + 1)